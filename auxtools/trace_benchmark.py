@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+"""Measure the cost of the protocol trace calls on the hot paths.
+
+Compares an eager ``logger.debug("...".format(...))`` call with the
+`pyxmpp2.trace` channel calls, with the 'DEBUG' level disabled and with the
+channel switched off."""
+
+import argparse
+import logging
+import timeit
+
+from pyxmpp2.trace import TraceChannel
+
+SETUP = """
+import logging
+from collections import deque
+from __main__ import logger, channel
+queue = deque(["x" * 100] * {0})
+"""
+
+TESTS = [
+    ("eager logger.debug(.format())",
+        'logger.debug("handle_write: queue: {0!r}".format(queue))'),
+    ("logger.debug() with lazy %r",
+        'logger.debug("handle_write: queue: %r", queue)'),
+    ("channel, DEBUG disabled",
+        'channel("handle_write: queue: {0!r}", queue)'),
+    ("channel switched off",
+        'channel("handle_write: queue: {0!r}", queue)'),
+    ("no trace at all",
+        'pass'),
+    ]
+
+logger = logging.getLogger("pyxmpp2.benchmark")
+channel = TraceChannel("benchmark", "pyxmpp2.benchmark")
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--number", type = int, default = 100000,
+                                    help = "Number of calls per test")
+    parser.add_argument("--queue-length", type = int, default = 50,
+                        help = "Length of the traced queue object")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    setup = SETUP.format(args.queue_length)
+    for name, statement in TESTS:
+        channel.switch = not name.endswith("switched off")
+        channel.update()
+        timer = timeit.Timer(statement, setup)
+        best = min(timer.repeat(3, args.number))
+        print "{0:35} {1:8.3f} us/call".format(name,
+                                                best * 1000000 / args.number)
+
+if __name__ == "__main__":
+    main()
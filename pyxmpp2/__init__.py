@@ -166,6 +166,11 @@ special cases though:
 Those two can be used to intercept the data for application-specific monitoring
 (e.g. an 'XML console' in a client GUI).
 
+The most frequent debug messages (the data above, I/O, stanza and event
+dispatching and timers) are emitted via the `pyxmpp2.trace` channels, which
+format the messages only when they are actually logged and can be switched
+off completely with `pyxmpp2.trace.disable_channels`.
+
 Most of the log messages generated by PyXMPP have level 'DEBUG', no higher
 level messages should appear during normal operation. Some 'WARNING' messages
 may be emitted when a remote party misbehaves and 'ERROR' messages in case of
@@ -103,6 +103,8 @@ class ResourceBindingHandler(StreamFeatureHandler, XMPPFeatureHandler):
     def __init__(self, settings = None):
         self.stream = None
         self.settings = settings if settings else XMPPSettings()
+        self._speculative = False
+        self._ignore_error = False
 
     def make_stream_features(self, stream, features):
         """Add resource binding feature to the <features/> element of the
@@ -126,6 +128,15 @@ class ResourceBindingHandler(StreamFeatureHandler, XMPPFeatureHandler):
         logger.debug(u"Handling stream features: {0}".format(
                                         element_to_unicode(features)))
         element = features.find(FEATURE_BIND)
+        if self._speculative:
+            self._speculative = False
+            if element is not None:
+                logger.debug("Pipelined resource binding confirmed")
+                return StreamFeatureHandled("Resource binding",
+                                                            mandatory = True)
+            logger.debug("Resource binding not offered, ignoring"
+                                                " the pipelined request result")
+            self._ignore_error = True
         if element is None:
             logger.debug("No <bind/> in features")
             return None
@@ -133,6 +144,18 @@ class ResourceBindingHandler(StreamFeatureHandler, XMPPFeatureHandler):
         self.bind(stream, resource)
         return StreamFeatureHandled("Resource binding", mandatory = True)
 
+    def handle_cached_stream_features(self, stream, features):
+        """Send the resource binding request if <bind/> is present in the
+        cached <stream:features/>, without waiting for the actual ones.
+
+        [initiating entity only]
+        """
+        if features.find(FEATURE_BIND) is None:
+            return None
+        self.bind(stream, stream.settings["resource"])
+        self._speculative = True
+        return StreamFeatureHandled("Resource binding", mandatory = True)
+
     def bind(self, stream, resource):
         """Bind to a resource.
 
@@ -173,12 +196,16 @@ class ResourceBindingHandler(StreamFeatureHandler, XMPPFeatureHandler):
         self.stream.me = jid
         self.stream.event(AuthorizedEvent(self.stream.me))
 
-    def _bind_error(self, stanza): # pylint: disable-msg=R0201,W0613
+    def _bind_error(self, stanza): # pylint: disable-msg=W0613
         """Handle resource binding success.
 
         [initiating entity only]
 
         :raise FatalStreamError:"""
+        if self._ignore_error:
+            self._ignore_error = False
+            logger.debug("Pipelined resource binding failed")
+            return
         raise FatalStreamError("Resource binding failed")
 
     @iq_set_stanza_handler(ResourceBindingPayload)
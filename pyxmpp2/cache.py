@@ -19,27 +19,46 @@
 
 This package provides facilities to retrieve and transparently cache
 cachable objects like Service Discovery responses or e.g. client version
-informations."""
+informations.
+
+The in-memory caches may be backed by a persistent storage (see
+`CacheStorage`, `SQLiteCacheStorage` and `PersistentTier`), so the cached
+objects survive application restarts."""
 
 from __future__ import absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
-raise ImportError("{0} is not yet rewritten for PyXMPP2".format(__name__))
-
 import threading
+import heapq
+import functools
+import itertools
+import logging
+import sqlite3
+import cPickle as pickle
+import Queue
+
+from collections import OrderedDict
+
+from abc import ABCMeta, abstractmethod
 from datetime import datetime, timedelta
 
+from .mainloop.interfaces import TimeoutHandler, timeout_handler
+
+logger = logging.getLogger("pyxmpp2.cache")
+
 _state_values = {
         'new': 0,
         'fresh': 1,
         'old': 2,
         'stale': 3,
         'purged': 4
-    };
+    }
 
 # locking order (anti-deadlock):
-# CacheSuite, Cache, CacheHandler, CacheItem
+# CacheSuite, Cache
+#
+# `CacheItem` objects stored in a `Cache` are protected by the cache lock.
 
 class CacheItem(object):
     """An item in a cache.
@@ -55,7 +74,6 @@ class CacheItem(object):
         - `expire_time`: time when the object expires.
         - `purge_time`: time when the object should be purged. When 0 then
           item will never be automaticaly purged.
-        - `_lock`: lock for thread safety.
     :Types:
         - `value`: `instance`
         - `address`: any hashable
@@ -64,10 +82,9 @@ class CacheItem(object):
         - `timestamp`: :std:`datetime`
         - `freshness_time`: :std:`datetime`
         - `expire_time`: :std:`datetime`
-        - `purge_time`: :std:`datetime`
-        - `_lock`: :std:`threading.RLock`"""
+        - `purge_time`: :std:`datetime`"""
     __slots__ = ['value', 'address', 'state', 'timestamp', 'freshness_time',
-            'expire_time', 'purge_time', 'state_value', '_lock']
+            'expire_time', 'purge_time', 'state_value']
     def __init__(self, address, value, freshness_period, expiration_period,
             purge_period, state = "new"):
         """Initialize an CacheItem object.
@@ -87,61 +104,105 @@ class CacheItem(object):
             - `expiration_period`: `timedelta`
             - `purge_period`: `timedelta`
             - `state`: `str`"""
-        if freshness_period>expiration_period:
+        if freshness_period > expiration_period:
             raise ValueError("freshness_period greater then expiration_period")
-        if expiration_period>purge_period:
+        if purge_period and expiration_period > purge_period:
             raise ValueError("expiration_period greater then purge_period")
         self.address = address
         self.value = value
         now = datetime.utcnow()
         self.timestamp = now
-        self.freshness_time = now+freshness_period
-        self.expire_time = now+expiration_period
+        self.freshness_time = now + freshness_period
+        self.expire_time = now + expiration_period
         if purge_period:
-            self.purge_time = now+purge_period
+            self.purge_time = now + purge_period
         else:
             self.purge_time = datetime.max
         self.state = state
         self.state_value = _state_values[state]
-        self._lock = threading.RLock()
 
-    def update_state(self):
-        """Update current status of the item and compute time of the next
-        state change.
+    @classmethod
+    def from_record(cls, address, value, state, timestamp, freshness_time,
+                                                    expire_time, purge_time):
+        """Re-create a cache item, e.g. loaded from a persistent storage.
+
+        :Parameters:
+            - `address`: item address.
+            - `value`: item value (cached object).
+            - `state`: the item state when it was stored.
+            - `timestamp`: time when the object was created.
+            - `freshness_time`: time when the object stops being fresh.
+            - `expire_time`: time when the object expires.
+            - `purge_time`: time when the object should be purged.
+        :Types:
+            - `address`: any hashable
+            - `value`: `instance`
+            - `state`: `str`
+            - `timestamp`: :std:`datetime`
+            - `freshness_time`: :std:`datetime`
+            - `expire_time`: :std:`datetime`
+            - `purge_time`: :std:`datetime`
+
+        :returntype: `CacheItem`"""
+        # pylint: disable-msg=R0913
+        item = cls.__new__(cls)
+        item.address = address
+        item.value = value
+        item.timestamp = timestamp
+        item.freshness_time = freshness_time
+        item.expire_time = expire_time
+        item.purge_time = purge_time
+        item.state = state
+        item.state_value = _state_values[state]
+        item.update_state()
+        return item
+
+    def update_state(self, now = None):
+        """Update current status of the item.
+
+        :Parameters:
+            - `now`: the current time
+        :Types:
+            - `now`: :std:`datetime`
 
         :return: the new state.
-        :returntype: :std:`datetime`"""
-        self._lock.acquire()
-        try:
+        :returntype: `str`"""
+        if now is None:
             now = datetime.utcnow()
-            if self.state == 'new':
-                self.state = 'fresh'
-            if self.state == 'fresh':
-                if now > self.freshness_time:
-                    self.state = 'old'
-            if self.state == 'old':
-                if now > self.expire_time:
-                    self.state = 'stale'
-            if self.state == 'stale':
-                if now > self.purge_time:
-                    self.state = 'purged'
-            self.state_value = _state_values[self.state]
-            return self.state
-        finally:
-            self._lock.release()
-
-    def __cmp__(self,other):
-        try:
-            return cmp(
-                    (-self.state_value, self.timestamp, id(self)),
-                    (-other.state_value, other.timestamp, id(other))
-                )
-        except AttributeError:
-            return cmp(id(self),id(other))
+        if self.state == 'new':
+            self.state = 'fresh'
+        if self.state == 'fresh':
+            if now > self.freshness_time:
+                self.state = 'old'
+        if self.state == 'old':
+            if now > self.expire_time:
+                self.state = 'stale'
+        if self.state == 'stale':
+            if now > self.purge_time:
+                self.state = 'purged'
+        self.state_value = _state_values[self.state]
+        return self.state
+
+    def next_transition(self):
+        """Compute the time of the next state change.
+
+        The state changes as soon as the current time is past the returned
+        value.
+
+        :return: the time or `None` if the state will not change any more.
+        :returntype: :std:`datetime`"""
+        if self.state in ('new', 'fresh'):
+            return self.freshness_time
+        elif self.state == 'old':
+            return self.expire_time
+        elif self.state == 'stale' and self.purge_time != datetime.max:
+            return self.purge_time
+        return None
 
 _hour = timedelta(hours = 1)
+_negative = timedelta(seconds = 30)
 
-class CacheFetcher:
+class CacheFetcher(object):
     """Base class for cache object fetchers -- classes responsible for
     retrieving objects from network.
 
@@ -166,7 +227,7 @@ class CacheFetcher:
     def __init__(self, cache, address,
             item_freshness_period, item_expiration_period, item_purge_period,
             object_handler, error_handler, timeout_handler, timeout_period,
-            backup_state = None):
+            backup_state = None, negative_period = None):
         """Initialize an `CacheFetcher` object.
 
         :Parameters:
@@ -183,6 +244,8 @@ class CacheFetcher:
               object from cache of at least this state will be passed to the
               `object_handler`. If such object is not available, then
               `error_handler` is called.
+            - `negative_period`: how long the fetch failure should be
+              remembered (see `Cache.fetch_failed`)
         :Types:
             - `cache`: `Cache`
             - `address`: any hashable
@@ -193,22 +256,46 @@ class CacheFetcher:
             - `error_handler`: callable(address, error_data)
             - `timeout_handler`: callable(address)
             - `timeout_period`: `timedelta`
-            - `backup_state`: `bool`"""
+            - `backup_state`: `bool`
+            - `negative_period`: `timedelta`"""
+        # pylint: disable-msg=R0913
         self.cache = cache
         self.address = address
         self._item_freshness_period = item_freshness_period
         self._item_expiration_period = item_expiration_period
         self._item_purge_period = item_purge_period
-        self._object_handler = object_handler
-        self._error_handler = error_handler
-        self._timeout_handler = timeout_handler
+        self._waiters = []
+        self.add_waiter(object_handler, error_handler, timeout_handler,
+                                                                backup_state)
         if timeout_period:
             self.timeout_time = datetime.utcnow()+timeout_period
         else:
             self.timeout_time = datetime.max
-        self._backup_state = backup_state
+        self._negative_period = negative_period
         self.active = True
 
+    def add_waiter(self, object_handler, error_handler, timeout_handler,
+                                                        backup_state = None):
+        """Add another requestor of the object being fetched.
+
+        All the requestors are notified of the fetch result, as the one
+        which started the fetch.
+
+        :Parameters:
+            - `object_handler`: function to be called after the item is fetched.
+            - `error_handler`: function to be called on error.
+            - `timeout_handler`: function to be called on timeout
+            - `backup_state`: when not `None` and the fetch fails than an
+              object from cache of at least this state will be passed to the
+              `object_handler`.
+        :Types:
+            - `object_handler`: callable(address, value, state)
+            - `error_handler`: callable(address, error_data)
+            - `timeout_handler`: callable(address)
+            - `backup_state`: `bool`"""
+        self._waiters.append((object_handler, error_handler, timeout_handler,
+                                                                backup_state))
+
     def _deactivate(self):
         """Remove the fetcher from cache and mark it not active."""
         self.cache.remove_fetcher(self)
@@ -243,9 +330,10 @@ class CacheFetcher:
             return
         item = CacheItem(self.address, value, self._item_freshness_period,
                 self._item_expiration_period, self._item_purge_period, state)
-        self._object_handler(item.address, item.value, item.state)
-        self.cache.add_item(item)
         self._deactivate()
+        self.cache.add_item(item)
+        for object_handler, _unused, _unused, _unused in self._waiters:
+            object_handler(item.address, item.value, state)
 
     def error(self, error_data):
         """Handle a retrieval error and call apriopriate handler.
@@ -262,10 +350,7 @@ class CacheFetcher:
         """
         if not self.active:
             return
-        if not self._try_backup_item():
-            self._error_handler(self.address, error_data)
-        self.cache.invalidate_object(self.address)
-        self._deactivate()
+        self._failed(error_data, False)
 
     def timeout(self):
         """Handle fetcher timeout and call apriopriate handler.
@@ -277,30 +362,511 @@ class CacheFetcher:
         one of handlers was already called)."""
         if not self.active:
             return
-        if not self._try_backup_item():
-            if self._timeout_handler:
-                self._timeout_handler(self.address)
+        self._failed(None, True)
+
+    def _failed(self, error_data, timed_out):
+        """Handle a retrieval error or timeout: call the apriopriate handlers,
+        invalidate the cached object and record the failure in the cache.
+
+        The fetcher is removed from the cache before any handler is called,
+        so the handlers may request the object again.
+
+        :Parameters:
+            - `error_data`: additional information about the error
+            - `timed_out`: `True` for a timeout
+        :Types:
+            - `timed_out`: `bool`
+        """
+        self._deactivate()
+        calls = []
+        for object_handler, error_handler, timeout_handler, backup_state \
+                                                            in self._waiters:
+            item = self._get_backup_item(backup_state)
+            if item:
+                calls.append((object_handler,
+                                        (item.address, item.value, item.state)))
+            elif timed_out and timeout_handler:
+                calls.append((timeout_handler, (self.address,)))
             else:
-                self._error_handler(self.address, None)
+                calls.append((error_handler, (self.address, error_data)))
         self.cache.invalidate_object(self.address)
-        self._deactivate()
+        self.cache.fetch_failed(self.address, error_data, timed_out,
+                                                        self._negative_period)
+        for handler, args in calls:
+            handler(*args)
 
-    def _try_backup_item(self):
-        """Check if a backup item is available in cache and call
-        the item handler if it is.
-
-        :return: `True` if backup item was found.
-        :returntype: `bool`"""
-        if not self._backup_state:
-            return False
-        item = self.cache.get_item(self.address, self._backup_state)
-        if item:
-            self._object_handler(item.address, item.value, item.state)
-            return True
-        else:
-            False
+    def _get_backup_item(self, backup_state):
+        """Check if a backup item is available in cache.
+
+        :Parameters:
+            - `backup_state`: the worst acceptable state of the backup item
+              or `None` if no backup item is requested.
+
+        :return: the item found or `None`.
+        :returntype: `CacheItem`"""
+        if not backup_state:
+            return None
+        # the request has looked the persistent tier up already
+        return self.cache.get_item(self.address, backup_state, False)
+
+class _Failure(object):
+    """A remembered fetch failure.
+
+    :Ivariables:
+        - `count`: number of consecutive failures
+        - `until`: the failure is reported without fetching the object until
+          this time
+        - `forget_time`: the failure count is kept until this time
+        - `error_data`: the error information
+        - `timed_out`: `True` for a timeout
+    """
+    # pylint: disable-msg=R0903
+    __slots__ = ['count', 'until', 'forget_time', 'error_data', 'timed_out']
+    def __init__(self, count, until, forget_time, error_data, timed_out):
+        # pylint: disable-msg=R0913
+        self.count = count
+        self.until = until
+        self.forget_time = forget_time
+        self.error_data = error_data
+        self.timed_out = timed_out
+
+class CacheStorage(object):
+    """Base class for the persistent cache storage backends.
+
+    The items are identified by the "kind" (a string, e.g. the name of
+    the cached object class) and the item address.
+
+    The methods may be called from different threads. `PersistentTier`
+    serializes the `load` calls and the `save_many` calls, but a `load` may
+    run concurrently with a `save_many`.
+    """
+    # pylint: disable-msg=W0232
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def load(self, kind, address):
+        """Load an item from the storage.
+
+        :Parameters:
+            - `kind`: the item kind
+            - `address`: the item address
+        :Types:
+            - `kind`: `unicode`
+            - `address`: any hashable
+
+        :return: the item or `None` if not found
+        :returntype: `CacheItem`"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_many(self, items):
+        """Store many items at once. Items in the 'purged' state are
+        removed from the storage.
+
+        :Parameters:
+            - `items`: sequence of (kind, item) pairs.
+        :Types:
+            - `items`: sequence of (`unicode`, `CacheItem`)"""
+        raise NotImplementedError
+
+    def close(self):
+        """Close the storage."""
+        pass
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _to_timestamp(value):
+    """Convert a `datetime` to a number of seconds since the epoch
+    (`None` for ``datetime.max``)."""
+    if value == datetime.max:
+        return None
+    return (value - _EPOCH).total_seconds()
+
+def _from_timestamp(value):
+    """Convert a number of seconds since the epoch to a `datetime`
+    (``datetime.max`` for `None`)."""
+    if value is None:
+        return datetime.max
+    return _EPOCH + timedelta(seconds = value)
+
+class SQLiteCacheStorage(CacheStorage):
+    """Cache storage in a SQLite database.
+
+    The addresses and the values are stored pickled, so they must be
+    picklable.
+
+    The database is opened on the first use and the purged items are removed
+    then. It is used in the write-ahead log mode, with a separate connection
+    for reading, so the reads do not wait for the writes.
+
+    :Ivariables:
+        - `path`: the database file path
+    :Types:
+        - `path`: `str`
+    """
+    def __init__(self, path):
+        """Initialize the storage object.
+
+        :Parameters:
+            - `path`: the database file path
+        :Types:
+            - `path`: `str`
+        """
+        self.path = path
+        self._connection = None
+        self._reader = None
+        self._open_lock = threading.Lock()
+
+    def _connect(self):
+        """Open the database, if not open yet.
+
+        :Returntype: :std:`sqlite3.Connection`"""
+        with self._open_lock:
+            return self._open()
+
+    def _open(self):
+        """Open the database for writing, if not open yet. Must be called
+        with `_open_lock` acquired.
+
+        :Returntype: :std:`sqlite3.Connection`"""
+        if self._connection is None:
+            connection = sqlite3.connect(self.path,
+                                                check_same_thread = False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS items ("
+                        " kind TEXT, address BLOB, value BLOB, state TEXT,"
+                        " timestamp REAL, freshness_time REAL,"
+                        " expire_time REAL, purge_time REAL,"
+                        " PRIMARY KEY (kind, address))")
+                connection.execute("DELETE FROM items WHERE purge_time < ?",
+                                        (_to_timestamp(datetime.utcnow()),))
+            self._connection = connection
+        return self._connection
+
+    def _connect_reader(self):
+        """Open the reading connection, if not open yet.
+
+        :Returntype: :std:`sqlite3.Connection`"""
+        with self._open_lock:
+            if self._reader is None:
+                self._open()
+                self._reader = sqlite3.connect(self.path,
+                                                check_same_thread = False)
+            return self._reader
+
+    def load(self, kind, address):
+        connection = self._connect_reader()
+        key = buffer(pickle.dumps(address, 2))
+        row = connection.execute("SELECT value, state, timestamp,"
+                    " freshness_time, expire_time, purge_time"
+                    " FROM items WHERE kind = ? AND address = ?",
+                    (kind, key)).fetchone()
+        if row is None:
+            return None
+        value = pickle.loads(str(row[0]))
+        return CacheItem.from_record(address, value, row[1],
+                    _from_timestamp(row[2]), _from_timestamp(row[3]),
+                    _from_timestamp(row[4]), _from_timestamp(row[5]))
+
+    def save_many(self, items):
+        rows = []
+        purged = []
+        for kind, item in items:
+            try:
+                key = pickle.dumps(item.address, 2)
+                if item.state == 'purged':
+                    purged.append((kind, buffer(key)))
+                    continue
+                value = pickle.dumps(item.value, 2)
+            except (pickle.PicklingError, TypeError, AttributeError), err:
+                logger.warning("Cannot store cache item {0!r}: {1}"
+                                                .format(item.address, err))
+                continue
+            rows.append((kind, buffer(key), buffer(value), item.state,
+                        _to_timestamp(item.timestamp),
+                        _to_timestamp(item.freshness_time),
+                        _to_timestamp(item.expire_time),
+                        _to_timestamp(item.purge_time)))
+        connection = self._connect()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO items"
+                                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.executemany("DELETE FROM items"
+                                    " WHERE kind = ? AND address = ?", purged)
+
+    def close(self):
+        with self._open_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+class PersistentTier(object):
+    """Persistent storage tier for the in-memory caches.
+
+    Items are loaded from the storage on demand (when not found in the
+    memory cache) and the stored items are written back to the storage in
+    batches, by a background thread, so the thread using the cache (usually
+    the main loop thread) does not wait for the disk writes. `load_async`
+    reads the storage in another background thread, so that thread does not
+    wait for the disk reads either.
+
+    Multiple updates of the same item waiting to be written are merged.
+
+    The reads do not wait for the writes in progress. The addresses not
+    found in the storage are remembered (up to `max_misses` of them), so
+    they are not looked up again, until an item is saved at the address.
+
+    :Ivariables:
+        - `storage`: the storage backend
+        - `batch_size`: the number of items which triggers an immediate
+          write
+        - `flush_interval`: maximum time (in seconds) the items wait to be
+          written
+        - `max_misses`: the number of the addresses not found to remember
+        - `_pending`: items waiting to be written
+        - `_writing`: items being written
+        - `_misses`: the keys not found in the storage, the least recently
+          used first
+        - `_saves`: counter of the `save` calls, to detect saves during
+          a lookup
+        - `_lock`: the `_pending`, `_writing` and `_misses` lock
+        - `_storage_lock`: the `storage` write lock
+        - `_read_lock`: the `storage` read lock
+        - `_cond`: condition variable to wake up the writer thread
+        - `_loads`: the `load_async` requests for the reader thread
+    :Types:
+        - `storage`: `CacheStorage`
+        - `batch_size`: `int`
+        - `flush_interval`: `float`
+        - `max_misses`: `int`
+        - `_pending`: `dict` of (`unicode`, any hashable) -> `CacheItem`
+        - `_writing`: `dict` of (`unicode`, any hashable) -> `CacheItem`
+        - `_misses`: :std:`collections.OrderedDict` of (`unicode`, any
+          hashable) -> `None`
+        - `_saves`: `int`
+        - `_lock`: :std:`threading.Lock`
+        - `_storage_lock`: :std:`threading.Lock`
+        - `_read_lock`: :std:`threading.Lock`
+        - `_cond`: :std:`threading.Condition`
+        - `_loads`: :std:`Queue.Queue` of (`unicode`, any hashable,
+          callable)
+    """
+    def __init__(self, storage, batch_size = 100, flush_interval = 1.0,
+                                                        max_misses = 1000):
+        """Initialize the tier.
+
+        :Parameters:
+            - `storage`: the storage backend
+            - `batch_size`: the number of items which triggers an immediate
+              write
+            - `flush_interval`: maximum time (in seconds) the items wait to
+              be written
+            - `max_misses`: the number of the addresses not found to
+              remember, 0 to disable
+        :Types:
+            - `storage`: `CacheStorage`
+            - `batch_size`: `int`
+            - `flush_interval`: `float`
+            - `max_misses`: `int`
+        """
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_misses = max_misses
+        self._pending = {}
+        self._writing = {}
+        self._misses = OrderedDict()
+        self._saves = 0
+        self._lock = threading.Lock()
+        self._storage_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._quit = False
+        self._loads = Queue.Queue()
+        self._reader = None
+
+    def _lookup(self, key):
+        """Find an item which is known without reading the storage:
+        waiting to be written or remembered as not found.
+
+        Must be called with `_lock` acquired.
+
+        :Parameters:
+            - `key`: (kind, address) of the item
+        :Types:
+            - `key`: (`unicode`, any hashable)
+
+        :return: `True` and the item (or `None`) if found, `False`
+            and `None` otherwise.
+        :returntype: (`bool`, `CacheItem`)"""
+        item = self._pending.get(key)
+        if item is None:
+            item = self._writing.get(key)
+        if item is not None:
+            return True, item
+        if key in self._misses:
+            del self._misses[key]
+            self._misses[key] = None
+            return True, None
+        return False, None
+
+    def load(self, kind, address):
+        """Load an item from the storage (or from the items waiting to be
+        written).
+
+        :Parameters:
+            - `kind`: the item kind
+            - `address`: the item address
+        :Types:
+            - `kind`: `unicode`
+            - `address`: any hashable
+
+        :return: the item or `None` if not found
+        :returntype: `CacheItem`"""
+        key = (kind, address)
+        with self._lock:
+            found, item = self._lookup(key)
+            if found:
+                return item
+            saves = self._saves
+        with self._read_lock:
+            try:
+                item = self.storage.load(kind, address)
+            except (sqlite3.Error, pickle.UnpicklingError, EnvironmentError,
+                                    EOFError, AttributeError, ImportError), err:
+                logger.warning("Cannot load cache item {0!r}: {1}"
+                                                        .format(address, err))
+                return None
+        if item is None and self.max_misses:
+            with self._lock:
+                if self._saves == saves:
+                    self._misses[key] = None
+                    if len(self._misses) > self.max_misses:
+                        self._misses.popitem(last = False)
+        return item
+
+    def load_async(self, kind, address, callback):
+        """Load an item in the background (reader) thread.
+
+        The `callback` is called with the item (or `None` if not found) in
+        the reader thread or, when the storage needs not to be read,
+        immediately.
+
+        :Parameters:
+            - `kind`: the item kind
+            - `address`: the item address
+            - `callback`: the function to call with the result
+        :Types:
+            - `kind`: `unicode`
+            - `address`: any hashable
+            - `callback`: callable(`CacheItem`)
+        """
+        with self._lock:
+            found, item = self._lookup((kind, address))
+            if not found:
+                self._loads.put((kind, address, callback))
+                if self._reader is None:
+                    self._reader = threading.Thread(name = "Cache reader",
+                                                    target = self._run_reader)
+                    self._reader.daemon = True
+                    self._reader.start()
+                return
+        callback(item)
 
-class Cache:
+    def save(self, kind, item):
+        """Queue an item to be written to the storage (or removed from it,
+        when 'purged').
+
+        :Parameters:
+            - `kind`: the item kind
+            - `item`: the item
+        :Types:
+            - `kind`: `unicode`
+            - `item`: `CacheItem`
+        """
+        with self._lock:
+            key = (kind, item.address)
+            self._pending[key] = item
+            self._misses.pop(key, None)
+            self._saves += 1
+            if self._thread is None:
+                self._thread = threading.Thread(name = "Cache writer",
+                                                        target = self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            count = len(self._pending)
+        if count == 1 or count >= self.batch_size:
+            with self._cond:
+                self._cond.notify()
+
+    def flush(self):
+        """Write all the pending items to the storage now."""
+        with self._storage_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._writing = self._pending
+                self._pending = {}
+            items = [(kind, item) for (kind, dummy), item
+                                                in self._writing.iteritems()]
+            try:
+                self.storage.save_many(items)
+            except (sqlite3.Error, EnvironmentError), err:
+                logger.warning("Cannot store cache items: {0}".format(err))
+            with self._lock:
+                self._writing = {}
+
+    def close(self):
+        """Stop the background threads, write the pending items and close
+        the storage."""
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        reader = self._reader
+        if reader is not None:
+            self._loads.put(None)
+            reader.join()
+        self.flush()
+        with self._storage_lock:
+            with self._read_lock:
+                self.storage.close()
+
+    def _run(self):
+        """The writer thread main loop."""
+        while True:
+            with self._cond:
+                while not self._quit and not self._pending:
+                    self._cond.wait()
+                if self._quit:
+                    return
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self._quit:
+                    return
+            self.flush()
+
+    def _run_reader(self):
+        """The reader thread main loop."""
+        while True:
+            request = self._loads.get()
+            if request is None:
+                return
+            kind, address, callback = request
+            item = self.load(kind, address)
+            try:
+                callback(item)
+            except Exception: # pylint: disable=W0703
+                logger.exception("Exception in a cache load callback")
+
+class Cache(object):
     """Caching proxy for object retrieval and caching.
 
     Object factories ("fetchers") are registered in the `Cache` object and used
@@ -318,32 +884,90 @@ class Cache:
       - 'old': object not fresh, but most probably still valid.
       - 'stale': object known to be expired.
 
+    Nothing is ever re-sorted: the items are kept in heaps ordered by the time
+    of their next state change (`_transitions`) and, for each state, by their
+    creation time (`_states`), the worse state and the older items being
+    the first to purge. Heap entries of removed items, or items which
+    have changed their state since, are dropped lazily. Active fetchers are
+    kept in a heap ordered by their timeout time. That makes item lookup O(1)
+    and insertion, purging and fetcher timeouts O(log n).
+
+    Concurrent requests for the same address are coalesced: when an object
+    is already being fetched, the handlers of the next request are added to
+    the active fetcher (see `CacheFetcher.add_waiter`), instead of starting
+    another fetch.
+
+    Fetch failures (errors and timeouts) are remembered for
+    `default_negative_period` (or the period given in the request), doubled
+    on each consecutive failure, up to `max_negative_period`. Requests for
+    the address are failed immediately during that time, the same way as
+    the remembered failure. A successfully fetched or added item resets
+    the failure count.
+
+    When a `PersistentTier` is given, items added to the cache are also
+    written to it and items not found in memory are looked up there. The
+    requests wait for these lookups in the tier reader thread (see
+    `PersistentTier.load_async`), concurrent requests for the same address
+    waiting for a single lookup.
+
     :Ivariables:
         - `default_freshness_period`: default freshness period (in seconds).
         - `default_expiration_period`: default expiration period (in seconds).
         - `default_purge_period`: default purge period (in seconds). When
           0 then items are never purged because of their age.
+        - `default_negative_period`: default period for which fetch
+          failures are remembered, 0 to disable the negative caching.
+        - `max_negative_period`: maximum period for which fetch failures are
+          remembered, after the consecutive failures.
         - `max_items`: maximum number of items to store.
+        - `tier`: the persistent storage tier
+        - `kind`: kind of the items in the persistent storage
         - `_items`: dictionary of stored items.
-        - `_items_list`: list of stored items with the most suitable for
-          purging first.
+        - `_transitions`: heap of (time, sequence number, item) of the next
+          item state changes.
+        - `_states`: state value to a heap of (timestamp, sequence number,
+          item) for items in that state.
         - `_fetcher`: fetcher class for this cache.
-        - `_active_fetchers`: list of active fetchers sorted by the time of
-          its expiration time.
+        - `_fetchers`: the active fetchers.
+        - `_fetcher_timeouts`: heap of (timeout time, sequence number,
+          fetcher) for the active fetchers.
+        - `_in_flight`: the active fetchers by address, for coalescing
+          the requests.
+        - `_failures`: the remembered fetch failures by address.
+        - `_failure_timeouts`: heap of (time, sequence number, address)
+          to forget the failures.
+        - `_loading`: functions to call when the tier lookup of an address
+          completes, by address.
         - `_lock`: lock for thread safety.
     :Types:
         - `default_freshness_period`: timedelta
         - `default_expiration_period`: timedelta
         - `default_purge_period`: timedelta
+        - `default_negative_period`: timedelta
+        - `max_negative_period`: timedelta
         - `max_items`: `int`
+        - `tier`: `PersistentTier`
+        - `kind`: `unicode`
         - `_items`: `dict` of (`classobj`, addr) -> `CacheItem`
-        - `_items_list`: `list` of (`int`, :std:`datetime`, `CacheItem`)
+        - `_transitions`: `list` of (:std:`datetime`, `int`, `CacheItem`)
+        - `_states`: `dict` of `int` -> `list` of (:std:`datetime`, `int`,
+          `CacheItem`)
         - `_fetcher`: `CacheFetcher` based class
-        - `_active_fetchers`: `list` of (`int`, `CacheFetcher`)
+        - `_fetchers`: `set` of `CacheFetcher`
+        - `_fetcher_timeouts`: `list` of (:std:`datetime`, `int`,
+          `CacheFetcher`)
+        - `_in_flight`: `dict` of any hashable -> `CacheFetcher`
+        - `_failures`: `dict` of any hashable -> `_Failure`
+        - `_failure_timeouts`: `list` of (:std:`datetime`, `int`, any
+          hashable)
+        - `_loading`: `dict` of any hashable -> `list` of callable()
         - `_lock`: :std:`threading.RLock`
     """
+    # pylint: disable-msg=R0902
     def __init__(self, max_items, default_freshness_period = _hour,
-            default_expiration_period = 12*_hour, default_purge_period = 24*_hour):
+            default_expiration_period = 12*_hour, default_purge_period = 24*_hour,
+            default_negative_period = _negative, max_negative_period = _hour,
+            tier = None, kind = u""):
         """Initialize a `Cache` object.
 
             :Parameters:
@@ -351,29 +975,52 @@ class Cache:
                 - `default_expiration_period`: default expiration period (in seconds).
                 - `default_purge_period`: default purge period (in seconds). When
                   0 then items are never purged because of their age.
+                - `default_negative_period`: default period for which fetch
+                  failures are remembered, 0 to disable the negative caching.
+                - `max_negative_period`: maximum period for which fetch
+                  failures are remembered.
                 - `max_items`: maximum number of items to store.
+                - `tier`: the persistent storage tier
+                - `kind`: kind of the items in the persistent storage
             :Types:
                 - `default_freshness_period`: number
                 - `default_expiration_period`: number
                 - `default_purge_period`: number
+                - `default_negative_period`: timedelta
+                - `max_negative_period`: timedelta
                 - `max_items`: number
+                - `tier`: `PersistentTier`
+                - `kind`: `unicode`
         """
+        # pylint: disable-msg=R0913
         self.default_freshness_period = default_freshness_period
         self.default_expiration_period = default_expiration_period
         self.default_purge_period = default_purge_period
+        self.default_negative_period = default_negative_period
+        self.max_negative_period = max_negative_period
         self.max_items = max_items
+        self.tier = tier
+        self.kind = kind
         self._items = {}
-        self._items_list = []
+        self._transitions = []
+        self._states = dict((_state_values[state], []) for state
+                                                in ('fresh', 'old', 'stale'))
         self._fetcher = None
-        self._active_fetchers = []
-        self._purged = 0
+        self._fetchers = set()
+        self._fetcher_timeouts = []
+        self._in_flight = {}
+        self._failures = {}
+        self._failure_timeouts = []
+        self._loading = {}
+        self._counter = itertools.count()
         self._lock = threading.RLock()
 
     def request_object(self, address, state, object_handler,
             error_handler = None, timeout_handler = None,
             backup_state = None, timeout = timedelta(minutes=60),
             freshness_period = None, expiration_period = None,
-            purge_period = None):
+            purge_period = None, single_flight = True,
+            negative_period = None):
         """Request an object with given address and state not worse than
         `state`. The object will be taken from cache if available, and
         created/fetched otherwise. The request is asynchronous -- this metod
@@ -412,6 +1059,13 @@ class Cache:
               should become 'stale'.
             - `purge_period`: time interval after which the item created
               shuld be removed from the cache.
+            - `single_flight`: if `True` and the object is already being
+              fetched, wait for the result of that fetch instead of starting
+              another one.
+            - `negative_period`: time interval for which a failure to fetch
+              the object should be remembered (doubled on each consecutive
+              failure). `default_negative_period` when `None`, 0 to ignore
+              and not to record the failures.
         :Types:
             - `address`: any hashable
             - `state`: "new", "fresh", "old" or "stale"
@@ -423,12 +1077,41 @@ class Cache:
             - `freshness_period`: `timedelta`
             - `expiration_period`: `timedelta`
             - `purge_period`: `timedelta`
+            - `single_flight`: `bool`
+            - `negative_period`: `timedelta`
+        """
+        # pylint: disable-msg=R0913
+        self._request_object(True, address, state, object_handler,
+                error_handler, timeout_handler, backup_state, timeout,
+                freshness_period, expiration_period, purge_period,
+                single_flight, negative_period)
+
+    def _request_object(self, load, address, state, object_handler,
+            error_handler, timeout_handler, backup_state, timeout,
+            freshness_period, expiration_period, purge_period,
+            single_flight, negative_period):
+        """Handle an object request.
+
+        :Parameters:
+            - `load`: if `True`, look the item up in the persistent tier
+              first, when not in memory
+        :Types:
+            - `load`: `bool`
+
+        Other parameters as for `request_object`.
         """
-        self._lock.acquire()
-        try:
+        # pylint: disable-msg=R0912,R0913
+        with self._lock:
+            if load and self.tier and address not in self._items:
+                self._load(address, functools.partial(self._request_object,
+                        False, address, state, object_handler, error_handler,
+                        timeout_handler, backup_state, timeout,
+                        freshness_period, expiration_period, purge_period,
+                        single_flight, negative_period))
+                return
             if state == 'stale':
                 state = 'purged'
-            item = self.get_item(address, state)
+            item = self.get_item(address, state, False)
             if item:
                 object_handler(item.address, item.value, item.state)
                 return
@@ -450,15 +1133,75 @@ class Cache:
                 expiration_period = self.default_expiration_period
             if purge_period is None:
                 purge_period = self.default_purge_period
+            if negative_period is None:
+                negative_period = self.default_negative_period
+
+            if negative_period:
+                failure = self._failures.get(address)
+                if failure and datetime.utcnow() < failure.until:
+                    item = backup_state and self.get_item(address,
+                                                        backup_state, False)
+                    if item:
+                        object_handler(item.address, item.value, item.state)
+                    elif failure.timed_out:
+                        timeout_handler(address)
+                    else:
+                        error_handler(address, failure.error_data)
+                    return
+
+            if single_flight:
+                fetcher = self._in_flight.get(address)
+                if fetcher is not None:
+                    fetcher.add_waiter(object_handler, error_handler,
+                                                timeout_handler, backup_state)
+                    return
 
             fetcher = self._fetcher(self, address, freshness_period,
                     expiration_period, purge_period, object_handler, error_handler,
-                    timeout_handler, timeout, backup_state)
+                    timeout_handler, timeout, backup_state,
+                    negative_period = negative_period)
             fetcher.fetch()
-            self._active_fetchers.append((fetcher.timeout_time,fetcher))
-            self._active_fetchers.sort()
-        finally:
-            self._lock.release()
+            if fetcher.active:
+                self._add_fetcher(fetcher)
+
+    def fetch_failed(self, address, error_data, timed_out,
+                                                    negative_period = None):
+        """Remember a fetch failure, so the object is not requested again
+        for some time.
+
+        Each consecutive failure doubles the period (up to
+        `max_negative_period`). The failure count is kept for one more period
+        after that.
+
+        :Parameters:
+            - `address`: address of the object.
+            - `error_data`: additional information about the error
+            - `timed_out`: `True` for a timeout
+            - `negative_period`: the base period, `default_negative_period`
+              when `None`
+        :Types:
+            - `address`: any hashable
+            - `timed_out`: `bool`
+            - `negative_period`: `timedelta`
+        """
+        with self._lock:
+            if negative_period is None:
+                negative_period = self.default_negative_period
+            if not negative_period:
+                return
+            failure = self._failures.get(address)
+            if failure:
+                count = failure.count + 1
+            else:
+                count = 1
+            period = min(negative_period * (2 ** min(count - 1, 32)),
+                                                    self.max_negative_period)
+            now = datetime.utcnow()
+            failure = _Failure(count, now + period, now + 2 * period,
+                                                    error_data, timed_out)
+            self._failures[address] = failure
+            heapq.heappush(self._failure_timeouts,
+                    (failure.forget_time, next(self._counter), address))
 
     def invalidate_object(self, address, state = 'stale'):
         """Force cache item state change (to 'worse' state only).
@@ -467,15 +1210,70 @@ class Cache:
             - `state`: the new state requested.
         :Types:
             - `state`: `str`"""
-        self._lock.acquire()
-        try:
-            item = self.get_item(address)
-            if item and item.state_value<_state_values[state]:
-                item.state=state
-                item.update_state()
-                self._items_list.sort()
-        finally:
-            self._lock.release()
+        with self._lock:
+            if self.tier and address not in self._items:
+                self._load(address, functools.partial(self._invalidate_object,
+                                                            address, state))
+            else:
+                self._invalidate_object(address, state)
+
+    def _invalidate_object(self, address, state):
+        """Force cache item state change, if the item is in memory.
+
+        :Parameters:
+            - `state`: the new state requested.
+        :Types:
+            - `state`: `str`"""
+        with self._lock:
+            item = self.get_item(address, 'stale', False)
+            if item and item.state_value < _state_values[state]:
+                item.state = state
+                self._update(item)
+                if self.tier:
+                    self.tier.save(self.kind, item)
+
+    def _load(self, address, callback):
+        """Look an item up in the persistent tier, in the tier reader
+        thread, and call `callback` when done.
+
+        Lookups of the same address are coalesced.
+
+        Must be called with `_lock` acquired.
+
+        :Parameters:
+            - `address`: the item address
+            - `callback`: function to call after the item is loaded
+        :Types:
+            - `address`: any hashable
+            - `callback`: callable()
+        """
+        waiting = self._loading.get(address)
+        if waiting is not None:
+            waiting.append(callback)
+            return
+        self._loading[address] = [callback]
+        self.tier.load_async(self.kind, address,
+                                    functools.partial(self._loaded, address))
+
+    def _loaded(self, address, item):
+        """Add an item loaded from the persistent tier and call the
+        functions waiting for it.
+
+        :Parameters:
+            - `address`: the item address
+            - `item`: the item loaded or `None`
+        :Types:
+            - `address`: any hashable
+            - `item`: `CacheItem`
+        """
+        with self._lock:
+            callbacks = self._loading.pop(address)
+            if item is not None and address not in self._items:
+                self._add_item(item)
+                if item.state == 'purged':
+                    self.tier.save(self.kind, item)
+        for callback in callbacks:
+            callback()
 
     def add_item(self, item):
         """Add an item to the cache.
@@ -490,42 +1288,65 @@ class Cache:
         :return: state of the item after addition.
         :returntype: `str`
         """
-        self._lock.acquire()
-        try:
-            state = item.update_state()
-            if state != 'purged':
-                if len(self._items_list) >= self.max_items:
-                    self.purge_items()
-                self._items[item.address] = item
-                self._items_list.append(item)
-                self._items_list.sort()
+        with self._lock:
+            self._failures.pop(item.address, None)
+            self._add_item(item)
+            if self.tier and item.state != 'purged':
+                self.tier.save(self.kind, item)
             return item.state
-        finally:
-            self._lock.release()
 
-    def get_item(self, address, state = 'fresh'):
+    def _add_item(self, item):
+        """Add an item to the memory cache.
+
+        :Parameters:
+            - `item`: the item to add.
+        :Types:
+            - `item`: `CacheItem`
+        """
+        state = item.update_state()
+        if state != 'purged':
+            if (item.address not in self._items
+                                and len(self._items) >= self.max_items):
+                self.purge_items()
+            self._items[item.address] = item
+            self._schedule(item)
+
+    def get_item(self, address, state = 'fresh', load = True):
         """Get an item from the cache.
 
+        An item not in memory is loaded from the persistent tier in
+        the calling thread, unless `load` is `False`. `request_object`
+        does not wait for that.
+
         :Parameters:
             - `address`: its address.
             - `state`: the worst state that is acceptable.
+            - `load`: if `False`, do not look the item up in the persistent
+              tier.
         :Types:
             - `address`: any hashable
             - `state`: `str`
+            - `load`: `bool`
 
         :return: the item or `None` if it was not found.
         :returntype: `CacheItem`"""
-        self._lock.acquire()
-        try:
+        with self._lock:
             item = self._items.get(address)
             if not item:
-                return None
+                if not load or not self.tier:
+                    return None
+                item = self.tier.load(self.kind, address)
+                if not item:
+                    return None
+                self._add_item(item)
             self.update_item(item)
+            if item.state == 'purged':
+                if self.tier:
+                    self.tier.save(self.kind, item)
+                return None
             if _state_values[state] >= item.state_value:
                 return item
             return None
-        finally:
-            self._lock.release()
 
     def update_item(self, item):
         """Update state of an item in the cache.
@@ -540,69 +1361,144 @@ class Cache:
 
         :return: new state of the item.
         :returntype: `str`"""
+        with self._lock:
+            state = item.state
+            item.update_state()
+            if item.state != state:
+                self._update(item)
+            return item.state
 
-        self._lock.acquire()
-        try:
-            state = item.update_state()
-            self._items_list.sort()
-            if item.state == 'purged':
-                self._purged += 1
-                if self._purged > 0.25*self.max_items:
-                    self.purge_items()
-            return state
-        finally:
-            self._lock.release()
+    def _update(self, item):
+        """Handle an item state change: remove a purged item from the cache,
+        schedule the next state change of the others.
+
+        :Parameters:
+            - `item`: item to update.
+        :Types:
+            - `item`: `CacheItem`"""
+        item.update_state()
+        if self._items.get(item.address) is not item:
+            return
+        if item.state == 'purged':
+            del self._items[item.address]
+        else:
+            self._schedule(item)
+
+    def _schedule(self, item):
+        """Put an item into the heaps for its current state.
+
+        :Parameters:
+            - `item`: the item.
+        :Types:
+            - `item`: `CacheItem`"""
+        heapq.heappush(self._states[item.state_value],
+                                (item.timestamp, next(self._counter), item))
+        when = item.next_transition()
+        if when is not None:
+            heapq.heappush(self._transitions,
+                                        (when, next(self._counter), item))
+        size = len(self._transitions) + sum(len(heap)
+                                            for heap in self._states.values())
+        if size > 4 * len(self._items) + 64:
+            self._compact()
+
+    def _compact(self):
+        """Rebuild the heaps without the entries of removed items
+        and items which have changed their state since."""
+        items = self._items
+        counter = self._counter
+        self._transitions = [(item.next_transition(), next(counter), item)
+                                for item in items.itervalues()
+                                    if item.next_transition() is not None]
+        heapq.heapify(self._transitions)
+        for state_value in self._states:
+            heap = [(item.timestamp, next(counter), item)
+                                for item in items.itervalues()
+                                    if item.state_value == state_value]
+            heapq.heapify(heap)
+            self._states[state_value] = heap
+
+    def _process_transitions(self, now):
+        """Update the items which should have changed their state by now.
+
+        :Parameters:
+            - `now`: the current time
+        :Types:
+            - `now`: :std:`datetime`"""
+        transitions = self._transitions
+        while transitions and transitions[0][0] < now:
+            item = heapq.heappop(transitions)[2]
+            state = item.state
+            item.update_state(now)
+            if item.state != state:
+                self._update(item)
 
     def num_items(self):
         """Get the number of items in the cache.
 
         :return: number of items.
         :returntype: `int`"""
-        return len(self._items_list)
+        return len(self._items)
 
     def purge_items(self):
         """Remove purged and overlimit items from the cache.
 
-        TODO: optimize somehow.
-
         Leave no more than 75% of `self.max_items` items in the cache."""
-        self._lock.acquire()
-        try:
-            il=self._items_list
-            num_items = len(il)
-            need_remove = num_items - int(0.75 * self.max_items)
-
-            for _unused in range(need_remove):
-                item=il.pop(0)
-                try:
-                    del self._items[item.address]
-                except KeyError:
-                    pass
-
-            while il and il[0].update_state()=="purged":
-                item=il.pop(0)
-                try:
-                    del self._items[item.address]
-                except KeyError:
-                    pass
-        finally:
-            self._lock.release()
+        with self._lock:
+            self._process_transitions(datetime.utcnow())
+            need_remove = len(self._items) - int(0.75 * self.max_items)
+            if need_remove <= 0:
+                return
+            items = self._items
+            for state_value in sorted(self._states, reverse = True):
+                heap = self._states[state_value]
+                while heap and need_remove > 0:
+                    item = heapq.heappop(heap)[2]
+                    if (item.state_value != state_value
+                                    or items.get(item.address) is not item):
+                        continue
+                    del items[item.address]
+                    need_remove -= 1
+                if need_remove <= 0:
+                    break
 
     def tick(self):
         """Do the regular cache maintenance.
 
         Must be called from time to time for timeouts and cache old items
         purging to work."""
-        self._lock.acquire()
-        try:
+        with self._lock:
             now = datetime.utcnow()
-            for t,f in list(self._active_fetchers):
-                if t > now:
-                    break
-                f.timeout()
+            timeouts = self._fetcher_timeouts
+            while timeouts and timeouts[0][0] <= now:
+                fetcher = heapq.heappop(timeouts)[2]
+                if fetcher in self._fetchers:
+                    fetcher.timeout()
+            timeouts = self._failure_timeouts
+            while timeouts and timeouts[0][0] <= now:
+                address = heapq.heappop(timeouts)[2]
+                failure = self._failures.get(address)
+                if failure and failure.forget_time <= now:
+                    del self._failures[address]
             self.purge_items()
-        finally:
-            self._lock.release()
+
+    def _add_fetcher(self, fetcher):
+        """Add a fetcher to the active fetchers.
+
+        :Parameters:
+            - `fetcher`: fetcher instance.
+        :Types:
+            - `fetcher`: `CacheFetcher`"""
+        self._fetchers.add(fetcher)
+        if fetcher.address not in self._in_flight:
+            self._in_flight[fetcher.address] = fetcher
+        heapq.heappush(self._fetcher_timeouts,
+                        (fetcher.timeout_time, next(self._counter), fetcher))
+        if len(self._fetcher_timeouts) > 2 * len(self._fetchers) + 64:
+            self._fetcher_timeouts = [(fetcher.timeout_time,
+                                            next(self._counter), fetcher)
+                                            for fetcher in self._fetchers]
+            heapq.heapify(self._fetcher_timeouts)
 
     def remove_fetcher(self, fetcher):
         """Remove a running fetcher from the list of active fetchers.
@@ -611,15 +1507,13 @@ class Cache:
             - `fetcher`: fetcher instance.
         :Types:
             - `fetcher`: `CacheFetcher`"""
-        self._lock.acquire()
-        try:
-            for t, f in list(self._active_fetchers):
-                if f is fetcher:
-                    self._active_fetchers.remove((t, f))
-                    f._deactivated()
-                    return
-        finally:
-            self._lock.release()
+        # pylint: disable-msg=W0212
+        with self._lock:
+            if fetcher in self._fetchers:
+                self._fetchers.remove(fetcher)
+                if self._in_flight.get(fetcher.address) is fetcher:
+                    del self._in_flight[fetcher.address]
+                fetcher._deactivated()
 
     def set_fetcher(self, fetcher_class):
         """Set the fetcher class.
@@ -629,13 +1523,10 @@ class Cache:
         :Types:
             - `fetcher_class`: `CacheFetcher` based class
         """
-        self._lock.acquire()
-        try:
+        with self._lock:
             self._fetcher = fetcher_class
-        finally:
-            self._lock.release()
 
-class CacheSuite:
+class CacheSuite(TimeoutHandler):
     """Caching proxy for object retrieval and caching.
 
     Object factories for other classes are registered in the
@@ -658,24 +1549,43 @@ class CacheSuite:
       - 'old': object not fresh, but most probably still valid.
       - 'stale': object known to be expired.
 
+    Concurrent requests for the same object are coalesced into a single
+    fetch and fetch failures are remembered for some time (see `Cache`).
+
+    The caches may be backed by a `PersistentTier`, where the objects are
+    stored by their class name.
+
+    The suite is a `TimeoutHandler`: when added to the main loop, it does
+    the regular cache maintenance (see `tick`) every second.
+
     :Ivariables:
         - `default_freshness_period`: default freshness period (in seconds).
         - `default_expiration_period`: default expiration period (in seconds).
         - `default_purge_period`: default purge period (in seconds). When
           0 then items are never purged because of their age.
+        - `default_negative_period`: default period for which fetch
+          failures are remembered, 0 to disable the negative caching.
+        - `max_negative_period`: maximum period for which fetch failures are
+          remembered, after the consecutive failures.
         - `max_items`: maximum number of obejects of one class to store.
+        - `tier`: the persistent storage tier
         - `_caches`: dictionary of per-class caches.
         - `_lock`: lock for thread safety.
     :Types:
         - `default_freshness_period`: timedelta
         - `default_expiration_period`: timedelta
         - `default_purge_period`: timedelta
+        - `default_negative_period`: timedelta
+        - `max_negative_period`: timedelta
         - `max_items`: `int`
+        - `tier`: `PersistentTier`
         - `_caches`: `dict` of (`classobj`, addr) -> `Cache`
         - `_lock`: :std:`threading.RLock`
     """
     def __init__(self, max_items, default_freshness_period = _hour,
-            default_expiration_period = 12*_hour, default_purge_period = 24*_hour):
+            default_expiration_period = 12*_hour, default_purge_period = 24*_hour,
+            default_negative_period = _negative, max_negative_period = _hour,
+            tier = None):
         """Initialize a `Cache` object.
 
             :Parameters:
@@ -683,24 +1593,37 @@ class CacheSuite:
                 - `default_expiration_period`: default expiration period (in seconds).
                 - `default_purge_period`: default purge period (in seconds). When
                   0 then items are never purged because of their age.
+                - `default_negative_period`: default period for which fetch
+                  failures are remembered, 0 to disable the negative caching.
+                - `max_negative_period`: maximum period for which fetch
+                  failures are remembered.
                 - `max_items`: maximum number of items to store.
+                - `tier`: the persistent storage tier
             :Types:
                 - `default_freshness_period`: number
                 - `default_expiration_period`: number
                 - `default_purge_period`: number
+                - `default_negative_period`: timedelta
+                - `max_negative_period`: timedelta
                 - `max_items`: number
+                - `tier`: `PersistentTier`
         """
+        # pylint: disable-msg=R0913
         self.default_freshness_period = default_freshness_period
         self.default_expiration_period = default_expiration_period
         self.default_purge_period = default_purge_period
+        self.default_negative_period = default_negative_period
+        self.max_negative_period = max_negative_period
         self.max_items = max_items
+        self.tier = tier
         self._caches = {}
         self._lock = threading.RLock()
 
     def request_object(self, object_class, address, state, object_handler,
             error_handler = None, timeout_handler = None,
             backup_state = None, timeout = None,
-            freshness_period = None, expiration_period = None, purge_period = None):
+            freshness_period = None, expiration_period = None, purge_period = None,
+            single_flight = True, negative_period = None):
         """Request an object of given class, with given address and state not
         worse than `state`. The object will be taken from cache if available,
         and created/fetched otherwise. The request is asynchronous -- this
@@ -741,6 +1664,13 @@ class CacheSuite:
               should become 'stale'.
             - `purge_period`: time interval after which the item created
               shuld be removed from the cache.
+            - `single_flight`: if `True` and the object is already being
+              fetched, wait for the result of that fetch instead of starting
+              another one.
+            - `negative_period`: time interval for which a failure to fetch
+              the object should be remembered (doubled on each consecutive
+              failure). `default_negative_period` when `None`, 0 to ignore
+              and not to record the failures.
         :Types:
             - `object_class`: `classobj`
             - `address`: any hashable
@@ -753,30 +1683,37 @@ class CacheSuite:
             - `freshness_period`: `timedelta`
             - `expiration_period`: `timedelta`
             - `purge_period`: `timedelta`
+            - `single_flight`: `bool`
+            - `negative_period`: `timedelta`
         """
-
-        self._lock.acquire()
-        try:
+        # pylint: disable-msg=R0913
+        with self._lock:
             if object_class not in self._caches:
                 raise TypeError("No cache for %r" % (object_class,))
 
             self._caches[object_class].request_object(address, state, object_handler,
                     error_handler, timeout_handler, backup_state, timeout,
-                    freshness_period, expiration_period, purge_period)
-        finally:
-            self._lock.release()
+                    freshness_period, expiration_period, purge_period,
+                    single_flight, negative_period)
 
     def tick(self):
         """Do the regular cache maintenance.
 
         Must be called from time to time for timeouts and cache old items
         purging to work."""
-        self._lock.acquire()
-        try:
+        with self._lock:
             for cache in self._caches.values():
                 cache.tick()
-        finally:
-            self._lock.release()
+
+    @timeout_handler(1, True)
+    def regular_tasks(self):
+        """Call `tick` every second, when the suite is added to a main loop.
+
+        :Return: the delay (in seconds) before the next call
+        :Returntype: `int`
+        """
+        self.tick()
+        return 1
 
     def register_fetcher(self, object_class, fetcher_class):
         """Register a fetcher class for an object class.
@@ -788,16 +1725,16 @@ class CacheSuite:
             - `object_class`: `classobj`
             - `fetcher_class`: `CacheFetcher` based class
         """
-        self._lock.acquire()
-        try:
+        with self._lock:
             cache = self._caches.get(object_class)
             if not cache:
                 cache = Cache(self.max_items, self.default_freshness_period,
-                        self.default_expiration_period, self.default_purge_period)
+                        self.default_expiration_period, self.default_purge_period,
+                        self.default_negative_period, self.max_negative_period,
+                        self.tier, u"{0}.{1}".format(object_class.__module__,
+                                                    object_class.__name__))
                 self._caches[object_class] = cache
             cache.set_fetcher(fetcher_class)
-        finally:
-            self._lock.release()
 
     def unregister_fetcher(self, object_class):
         """Unregister a fetcher class for an object class.
@@ -807,13 +1744,10 @@ class CacheSuite:
         :Types:
             - `object_class`: `classobj`
         """
-        self._lock.acquire()
-        try:
+        with self._lock:
             cache = self._caches.get(object_class)
             if not cache:
                 return
             cache.set_fetcher(None)
-        finally:
-            self._lock.release()
 
 # vi: sts=4 et sw=4
@@ -23,8 +23,9 @@ To create an XMPP client session applications should create a `Client` instance
 providing in the constructor: a client JID, settings and handlers providing
 application behaviour (the list may contain a single handler object which will
 be 'the application). The `Client` class will provide some other handlers:
-`StreamTLSHandler`, `StreamSASLHandler`, `SessionHandler`,
-`ResourceBindingHandler` and `RosterClient`. The last one is available via the
+`StreamTLSHandler`, `StreamSASLHandler`, `StreamCompressionHandler`,
+`StreamManagementHandler`, `SessionHandler`, `ResourceBindingHandler` and
+`RosterClient`. The last one is available via the
 `Client.roster_client` attribute and should be used to manipulate the roster.
 The roster itself is available via the `Client.roster` property.
 
@@ -54,19 +55,24 @@ import logging
 
 from .clientstream import ClientStream
 from .mainloop import main_loop_factory
+from .mainloop.workers import WorkerPool
 from .interfaces import EventHandler, event_handler
 from .interfaces import TimeoutHandler, timeout_handler
 from .streamevents import DisconnectedEvent, AuthenticatedEvent
-from .streamevents import AuthorizedEvent
+from .streamevents import AuthorizedEvent, StreamResumedEvent
 from .transport import TCPTransport
 from .settings import XMPPSettings
 from .session import SessionHandler
 from .streamtls import StreamTLSHandler
 from .streamsasl import StreamSASLHandler
+from .streamcompression import StreamCompressionHandler
+from .streammanagement import StreamManagementHandler
 from .binding import ResourceBindingHandler
 from .stanzaprocessor import StanzaProcessor
+from .ratelimit import RateLimiter
 from .roster import RosterClient
 from .presence import Presence
+from .xmppstringprep import warm_up_stringprep
 
 logger = logging.getLogger("pyxmpp2.client")
 
@@ -122,25 +128,35 @@ class Client(StanzaProcessor, TimeoutHandler, EventHandler):
         self._ml_handlers = []
         self.jid = jid
         self.settings = settings if settings else XMPPSettings()
+        warm_up_stringprep()
         StanzaProcessor.__init__(self, self.settings[u"default_stanza_timeout"])
+        self.instrumentation = self.settings[u"instrumentation"]
         self.handlers = handlers
         self._base_handlers = self.base_handlers_factory()
         self.roster_client = self.roster_client_factory()
         self._base_handlers += [self.roster_client]
         self._ml_handlers += list(handlers) + self._base_handlers + [self]
         _move_session_handler(self._ml_handlers)
+        threads = self.settings[u"stanza_handler_threads"]
+        if threads:
+            self.worker_pool = WorkerPool(self.settings, threads)
+            self._ml_handlers.append(self.worker_pool)
         if main_loop is not None:
             self.main_loop = main_loop
             for handler in self._ml_handlers:
                 self.main_loop.add_handler(handler)
         else:
             self.main_loop = main_loop_factory(settings, self._ml_handlers)
+        if self.settings[u"stanza_rate_limits"]:
+            self.rate_limiter = RateLimiter(self.settings, self.main_loop)
         self.stream = None
 
     def __del__(self):
         for handler in self._ml_handlers:
             self.main_loop.remove_handler(handler)
         self._ml_handlers = []
+        if self.worker_pool:
+            self.worker_pool.stop()
 
     @property
     def roster(self):
@@ -162,6 +178,9 @@ class Client(StanzaProcessor, TimeoutHandler, EventHandler):
                 logger.debug("Closing the previously used stream.")
                 self._close_stream()
 
+            if self.worker_pool:
+                self.worker_pool.start()
+
             transport = TCPTransport(self.settings)
 
             addr = self.settings["server"]
@@ -174,7 +193,10 @@ class Client(StanzaProcessor, TimeoutHandler, EventHandler):
             transport.connect(addr, self.settings["c2s_port"], service)
             handlers = self._base_handlers
             handlers += self.handlers + [self]
-            self.clear_response_handlers()
+            sm_handler = self._stream_management_handler()
+            if not sm_handler or not sm_handler.resumable:
+                # the responses may still come in the resumed session
+                self.clear_response_handlers()
             self.setup_stanza_handlers(handlers, "pre-auth")
             stream = ClientStream(self.jid, self, handlers, self.settings)
             stream.initiate(transport)
@@ -191,12 +213,19 @@ class Client(StanzaProcessor, TimeoutHandler, EventHandler):
                 if self.settings[u"initial_presence"]:
                     self.send(Presence(stanza_type = "unavailable"))
                 self.stream.disconnect()
+            sm_handler = self._stream_management_handler()
+            if sm_handler:
+                sm_handler.reset()
+            if self.worker_pool:
+                self.worker_pool.stop()
 
     def close_stream(self):
         """Close the stream immediately.
         """
         with self.lock:
             self._close_stream()
+            if self.worker_pool:
+                self.worker_pool.stop()
 
     def _close_stream(self):
         """Same as `close_stream` but with the `lock` acquired.
@@ -241,6 +270,19 @@ class Client(StanzaProcessor, TimeoutHandler, EventHandler):
             if presence:
                 self.send(presence)
 
+    @event_handler(StreamResumedEvent)
+    def _stream_resumed(self, event):
+        """Handle the `StreamResumedEvent`.
+
+        The initial presence is not sent, as the session state is preserved
+        by the server.
+        """
+        with self.lock:
+            if event.stream != self.stream:
+                return
+            self.me = event.stream.me
+            self.peer = event.stream.peer
+
     @event_handler(DisconnectedEvent)
     def _stream_disconnected(self, event):
         """Handle stream disconnection event.
@@ -273,6 +315,16 @@ class Client(StanzaProcessor, TimeoutHandler, EventHandler):
             else:
                 return min(1, ret)
 
+    def _stream_management_handler(self):
+        """Find the stream management handler in the base handlers.
+
+        :Returntype: `StreamManagementHandler`
+        """
+        for handler in self._base_handlers:
+            if isinstance(handler, StreamManagementHandler):
+                return handler
+        return None
+
     def base_handlers_factory(self):
         """Default base client handlers factory.
 
@@ -282,9 +334,12 @@ class Client(StanzaProcessor, TimeoutHandler, EventHandler):
         """
         tls_handler = StreamTLSHandler(self.settings)
         sasl_handler = StreamSASLHandler(self.settings)
+        compression_handler = StreamCompressionHandler(self.settings)
+        sm_handler = StreamManagementHandler(self.settings)
         session_handler = SessionHandler()
         binding_handler = ResourceBindingHandler(self.settings)
-        return [tls_handler, sasl_handler, binding_handler, session_handler]
+        return [tls_handler, sasl_handler, compression_handler, sm_handler,
+                                            binding_handler, session_handler]
 
     def roster_client_factory(self):
         """Creates the `RosterClient` instance for the `roster_client`
@@ -334,5 +389,11 @@ XMPPSettings.add_setting(u"default_stanza_timeout", type = float, default = 300,
         cmdline_help = "Time in seconds to wait for a stanza response",
         doc = u"""Time in seconds to wait for a stanza response."""
     )
+XMPPSettings.add_setting(u"stanza_handler_threads", type = int, default = 0,
+        cmdline_help = "Number of threads for blocking stanza handlers",
+        doc = u"""Number of worker threads to run stanza handlers decorated
+with `interfaces.blocking_stanza_handler`. When 0 such handlers are run
+directly in the main loop thread."""
+    )
 
 # vi: sts=4 et sw=4
@@ -53,5 +53,14 @@ SASL_QNP = "{{{0}}}".format(SASL_NS)
 TLS_NS = "urn:ietf:params:xml:ns:xmpp-tls"
 TLS_QNP = "{{{0}}}".format(TLS_NS)
 
+COMPRESS_FEATURE_NS = "http://jabber.org/features/compress"
+COMPRESS_FEATURE_QNP = "{{{0}}}".format(COMPRESS_FEATURE_NS)
+
+COMPRESS_NS = "http://jabber.org/protocol/compress"
+COMPRESS_QNP = "{{{0}}}".format(COMPRESS_NS)
+
+SM_NS = "urn:xmpp:sm:3"
+SM_QNP = "{{{0}}}".format(SM_NS)
+
 
 XML_LANG_QNAME = XML_QNP + "lang"
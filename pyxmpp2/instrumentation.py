@@ -0,0 +1,295 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Handler latency instrumentation.
+
+When the :r:`instrumentation setting` is set, every stanza handler, event
+handler and timeout handler call is timed and reported to the
+`Instrumentation` object provided.
+
+`HandlerStats` is the default implementation, keeping call counts
+and fixed-size latency histograms for every handler.
+
+Normative reference:
+  - `HdrHistogram <http://hdrhistogram.github.io/HdrHistogram/>`__
+    (the histogram bucket layout)
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import time
+import threading
+
+from abc import ABCMeta, abstractmethod
+
+from .settings import XMPPSettings
+
+STANZA = "stanza"
+EVENT = "event"
+TIMEOUT = "timeout"
+
+class Instrumentation:
+    """Handler call instrumentation interface."""
+    # pylint: disable-msg=W0232,R0903
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def record(self, category, handler, duration):
+        """Record a handler call.
+
+        May be called from any thread.
+
+        :Parameters:
+            - `category`: handler category: `STANZA`, `EVENT` or `TIMEOUT`
+            - `handler`: the handler called
+            - `duration`: call duration in seconds
+        :Types:
+            - `category`: `str`
+            - `handler`: callable
+            - `duration`: `float`
+        """
+        # pylint: disable-msg=W0613
+        pass
+
+def call_handler(instrumentation, category, handler, *args):
+    """Call a handler, timing the call if `instrumentation` is not `None`.
+
+    :Parameters:
+        - `instrumentation`: the instrumentation object or `None`
+        - `category`: the handler category
+        - `handler`: the handler to call
+        - `args`: the handler arguments
+    :Types:
+        - `instrumentation`: `Instrumentation`
+
+    :Return: the handler result
+    """
+    if instrumentation is None:
+        return handler(*args)
+    start = time.time()
+    try:
+        return handler(*args)
+    finally:
+        instrumentation.record(category, handler, time.time() - start)
+
+def handler_name(handler):
+    """Return a human-readable name of a handler.
+
+    :Parameters:
+        - `handler`: a function or a bound method
+
+    :Returntype: `str`
+    """
+    func = getattr(handler, "im_func", handler)
+    name = getattr(func, "__name__", None)
+    if name is None:
+        return repr(handler)
+    klass = getattr(handler, "im_class", None)
+    if klass is not None:
+        name = klass.__name__ + "." + name
+    module = getattr(func, "__module__", None)
+    if module:
+        name = module + "." + name
+    return name
+
+class LatencyHistogram(object):
+    """Fixed-memory latency histogram with a bounded relative error.
+
+    Values are stored in microseconds. Values below 2^`precision` are
+    counted exactly, above that every power of two range is split into
+    2^(`precision` - 1) buckets, so the relative error is below
+    2^(1 - `precision`).
+
+    Not thread-safe.
+
+    :Ivariables:
+        - `precision`: number of significant bits kept
+        - `max_value`: the largest value tracked exactly, in microseconds
+          (larger values are clamped to this one)
+        - `count`: number of values recorded
+        - `total`: sum of the values recorded
+        - `min`: the smallest value recorded
+        - `max`: the largest value recorded
+        - `buckets`: the bucket counters
+    :Types:
+        - `precision`: `int`
+        - `max_value`: `int`
+        - `count`: `int`
+        - `total`: `int`
+        - `min`: `int`
+        - `max`: `int`
+        - `buckets`: `list` of `int`
+    """
+    def __init__(self, precision = 5, max_bits = 36):
+        """Initialize the histogram.
+
+        :Parameters:
+            - `precision`: number of significant bits kept
+            - `max_bits`: bit length of the largest value tracked
+              (the default, 36, is about 19 hours)
+        :Types:
+            - `precision`: `int`
+            - `max_bits`: `int`
+        """
+        self.precision = precision
+        self.max_value = (1 << max_bits) - 1
+        self._sub_count = 1 << precision
+        self._half = self._sub_count >> 1
+        self.buckets = [0] * self._bucket_index(self.max_value)
+        self.buckets.append(0)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket_index(self, value):
+        """Return bucket index for a value."""
+        if value < self._sub_count:
+            return value
+        shift = value.bit_length() - self.precision
+        return self._sub_count + (shift - 1) * self._half + (
+                                            (value >> shift) - self._half)
+
+    def _bucket_high(self, index):
+        """Return the largest value counted in a bucket."""
+        if index < self._sub_count:
+            return index
+        index -= self._sub_count
+        shift = index // self._half + 1
+        mantissa = index % self._half + self._half
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        """Record a value.
+
+        :Parameters:
+            - `value`: the value in microseconds
+        :Types:
+            - `value`: `int`
+        """
+        if value < 0:
+            value = 0
+        elif value > self.max_value:
+            value = self.max_value
+        self.buckets[self._bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return the value below which `percent` percent of the recorded
+        values fall.
+
+        The result is the upper bound of the bucket containing the
+        requested value, but no more than `max`.
+
+        :Parameters:
+            - `percent`: the percentile (0-100)
+        :Types:
+            - `percent`: `float`
+
+        :Returntype: `int`
+        """
+        if not self.count:
+            return 0
+        target = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target:
+                return min(self._bucket_high(index), self.max)
+        return self.max
+
+    def snapshot(self, percentiles = (50, 90, 99, 99.9)):
+        """Return the histogram summary.
+
+        :Parameters:
+            - `percentiles`: the percentiles to include
+        :Return: dictionary with "count", "min", "max", "mean" and
+            "p<percentile>" keys, the values are in seconds
+        :Returntype: `dict`
+        """
+        result = {"count": self.count}
+        if not self.count:
+            return result
+        result["min"] = self.min / 1000000.0
+        result["max"] = self.max / 1000000.0
+        result["mean"] = self.total / self.count / 1000000.0
+        for percent in percentiles:
+            key = "p{0}".format(percent).replace(".", "_")
+            result[key] = self.percentile(percent) / 1000000.0
+        return result
+
+class HandlerStats(Instrumentation):
+    """Per-handler call counts and latency histograms.
+
+    :Ivariables:
+        - `precision`: histogram precision (see `LatencyHistogram`)
+        - `lock`: the thread synchronisation lock
+        - `_histograms`: (category, function) -> (name, histogram) mapping
+    :Types:
+        - `precision`: `int`
+        - `lock`: :std:`threading.Lock`
+        - `_histograms`: `dict`
+    """
+    def __init__(self, precision = 5):
+        self.precision = precision
+        self.lock = threading.Lock()
+        self._histograms = {}
+
+    def record(self, category, handler, duration):
+        # bound methods are created on every attribute access, so
+        # the underlying function is used as the key
+        key = (category, getattr(handler, "im_func", handler))
+        value = int(duration * 1000000)
+        with self.lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = (handler_name(handler),
+                                    LatencyHistogram(self.precision))
+                self._histograms[key] = entry
+            entry[1].record(value)
+
+    def snapshot(self):
+        """Return the statistics collected.
+
+        :Return: category -> handler name -> histogram summary mapping (see
+            `LatencyHistogram.snapshot`)
+        :Returntype: `dict`
+        """
+        result = {}
+        with self.lock:
+            for (category, dummy), (name, hist) in self._histograms.items():
+                result.setdefault(category, {})[name] = hist.snapshot()
+        return result
+
+    def reset(self):
+        """Forget all the statistics collected."""
+        with self.lock:
+            self._histograms = {}
+
+XMPPSettings.add_setting(u"instrumentation", type = Instrumentation,
+        doc = u"""Object receiving the handler call timings. E.g. a
+`HandlerStats` instance. No instrumentation when not set."""
+    )
+
+# vi: sts=4 et sw=4
@@ -203,6 +203,9 @@ class XMPPFeatureHandler:
       - `presence_stanza_handler`: for methods handling ``<presence />``
         stanzas
 
+    Handler methods which may block should be also decorated with
+    `blocking_stanza_handler`.
+
     :Ivariables:
         - `stanza_processor`: a stanza processor where this object was
           registered most recently (injected by `StanzaProcessor`)
@@ -347,6 +350,19 @@ def presence_stanza_handler(stanza_type = None, payload_class = None,
     return _stanza_handler("presence", stanza_type, payload_class, payload_key,
                                                             usage_restriction)
 
+def blocking_stanza_handler(func):
+    """Method decorator marking a stanza handler as blocking (e.g. doing
+    a database lookup).
+
+    To be used together with one of the stanza handler decorators
+    (`iq_get_stanza_handler`, `message_stanza_handler`, etc.). When
+    the `StanzaProcessor` has a `WorkerPool` assigned, such handler will be
+    run in a worker thread and its result will be processed in the main loop
+    thread. Otherwise it is called directly, as any other handler.
+    """
+    func._pyxmpp_blocking = True
+    return func
+
 class StanzaPayload:
     """Abstract base class for stanza payload objects.
 
@@ -483,6 +499,33 @@ class StreamFeatureHandler:
         # pylint: disable-msg=W0613,R0201
         return False
 
+    def handle_cached_stream_features(self, stream, features):
+        """Handle features cached from a previous connection to the peer,
+        before the actual features are received.
+
+        Used for stream negotiation pipelining. A handler may send its
+        request speculatively here, then it must verify in
+        `handle_stream_features` that the features received permit the
+        request and fall back to the normal negotiation otherwise.
+
+        [initiator only]
+
+        :Parameters:
+            - `stream`: the stream
+            - `features`: the features cached
+        :Types:
+            - `stream`: `StreamBase`
+            - `features`: :etree:`ElementTree.Element`
+
+        :Return:
+            - `StreamFeatureHandled` instance if a request has been sent
+            - `StreamFeatureNotHandled` instance if the features must not be
+              acted upon before the actual features are received
+            - `None` if no feature was recognized
+        """
+        # pylint: disable-msg=W0613,R0201
+        return None
+
     def make_stream_features(self, stream, features):
         """Update the features element announced by the stream.
 
@@ -33,7 +33,7 @@ import logging
 
 from encodings import idna
 
-from .xmppstringprep import NODEPREP, RESOURCEPREP
+from .xmppstringprep import NODEPREP, RESOURCEPREP, NAMEPREP
 from .exceptions import JIDError, StringprepError
 
 logger = logging.getLogger("pyxmpp2.jid")
@@ -43,9 +43,22 @@ GOOD_OUTER = u"[^\x00-\x2C\x2E-\x2F\x3A-\x40\x5B-\x60\x7B-\x7F-]"
 GOOD_INNER = u"[^\x00-\x2C\x2E-\x2F\x3A-\x40\x5B-\x60\x7B-\x7F]"
 STD3_LABEL_RE = re.compile(u"^{0}({1}*{0})?$".format(GOOD_OUTER, GOOD_INNER))
 
+ASCII_RE = re.compile(u"^[\x00-\x7f]*\\Z")
+
 # '.' equivalents, according to IDNA
 UNICODE_DOT_RE = re.compile(u"[\u3002\uFF0E\uFF61]")
 
+# ASCII-only JID which would not be changed by the stringprep profiles
+# and passes the domain name checks
+NORMALIZED_JID_RE = re.compile(
+        ur"^(?:([\x21\x23-\x25\x28-\x2e\x30-\x39\x3b\x3d\x3f\x5b-\x7e]"
+                                                            ur"{1,1023})@)?"
+        ur"((?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)*"
+                                        ur"[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?)"
+        ur"(?:/([\x20-\x7e]{1,1023}))?\Z")
+
+_jid_cache_size = 1000 # pylint: disable-msg=C0103
+
 def are_domains_equal(domain1, domain2):
     """Compare two International Domain Names.
 
@@ -97,9 +110,15 @@ class JID(object):
         - `domain`: domainpart of the JID
         - `resource`: resourcepart of the JID
 
-    JID objects are immutable. They are also cached for better performance.
+    JID objects are immutable. They are also cached for better performance:
+    all JIDs in use are available in the weak `cache` and the recently
+    created ones are also kept in a bounded LRU cache (see
+    `set_jid_cache_size`), keyed by the string or by the parts used to
+    create them.
     """
     cache = weakref.WeakValueDictionary()
+    _lru_recent = {}
+    _lru_old = {}
     __slots__ = ("local", "domain", "resource", "__weakref__",)
     def __new__(cls, local_or_jid = None, domain = None, resource = None,
                                                                 check = True):
@@ -118,9 +137,21 @@ class JID(object):
             return local_or_jid
 
         if domain is None and resource is None:
-            obj = cls.cache.get(unicode(local_or_jid))
-            if obj:
+            key = unicode(local_or_jid)
+            obj = _lru_get(key)
+            if obj is None:
+                obj = cls.cache.get(key)
+                if obj is not None:
+                    _lru_put(key, obj)
+            if obj is not None:
+                return obj
+        elif check:
+            key = (local_or_jid, domain, resource)
+            obj = _lru_get(key)
+            if obj is not None:
                 return obj
+        else:
+            key = None
 
         obj = object.__new__(cls)
 
@@ -141,6 +172,109 @@ class JID(object):
         object.__setattr__(obj, "local", local)
         object.__setattr__(obj, "domain", domain)
         object.__setattr__(obj, "resource", resource)
+        if key is not None:
+            _lru_put(key, obj)
+        return obj
+
+    @classmethod
+    def from_trusted(cls, data):
+        """Create a JID object from a string which is expected to be
+        normalized already, e.g. an address stamped by our server.
+
+        Stringprep and the other checks are skipped when the string is
+        ASCII-only and already in its normalized form, which is verified
+        with a single regular expression match. Any other string is fully
+        prepared, as by the `JID` constructor, so a misbehaving peer cannot
+        inject a non-normalized address this way.
+
+        :Parameters:
+            - `data`: the JID string
+        :Types:
+            - `data`: `unicode`
+
+        :Returntype: `JID`
+        """
+        data = unicode(data)
+        obj = _lru_get(data)
+        if obj is not None:
+            return obj
+        obj = cls.cache.get(data)
+        if obj is None:
+            obj = cls.__from_normalized(data)
+            if obj is None:
+                return cls(data)
+            cls.cache[data] = obj
+        _lru_put(data, obj)
+        return obj
+
+    @classmethod
+    def parse_many(cls, data):
+        """Create JID objects for many strings at once, e.g. for all the
+        items of a roster.
+
+        Duplicate strings are parsed only once, domains shared by the JIDs
+        (usually there are only a few of them) are prepared once, already
+        normalized strings skip the stringprep completely (as in
+        `from_trusted`) and the created objects are added to the `cache`
+        in bulk (and to the LRU cache, as by the other constructors).
+
+        :Parameters:
+            - `data`: the JID strings (`JID` objects are passed unchanged)
+        :Types:
+            - `data`: iterable of `unicode` or `JID`
+
+        :Return: the JIDs, in the order of `data`
+        :Returntype: `list` of `JID`
+
+        :raise JIDError: if any of the strings is not a valid JID
+        """
+        result = []
+        parsed = {}
+        created = {}
+        domains = {}
+        for item in data:
+            if isinstance(item, JID):
+                result.append(item)
+                continue
+            if not item:
+                raise JIDError("At least domain must be given")
+            item = unicode(item)
+            obj = parsed.get(item)
+            if obj is None:
+                obj = _lru_get(item)
+                if obj is None:
+                    obj = cls.cache.get(item)
+                    if obj is None:
+                        obj = cls.__from_normalized(item)
+                        if obj is None:
+                            obj = object.__new__(cls)
+                            local, domain, resource = cls.__from_unicode(item,
+                                                        domains = domains)
+                            object.__setattr__(obj, "local", local)
+                            object.__setattr__(obj, "domain", domain)
+                            object.__setattr__(obj, "resource", resource)
+                        created[item] = obj
+                    _lru_put(item, obj)
+                parsed[item] = obj
+            result.append(obj)
+        cls.cache.update(created)
+        return result
+
+    @classmethod
+    def __from_normalized(cls, data):
+        """Create a new JID object from a string, if it is already in
+        the normalized form (ASCII-only, verified with `NORMALIZED_JID_RE`).
+
+        :Return: the new JID object or `None` if the string needs to
+            be prepared
+        """
+        match = NORMALIZED_JID_RE.match(data)
+        if not match or len(match.group(2)) > 1023:
+            return None
+        obj = object.__new__(cls)
+        object.__setattr__(obj, "local", match.group(1))
+        object.__setattr__(obj, "domain", match.group(2))
+        object.__setattr__(obj, "resource", match.group(3))
         return obj
 
     def __setattr__(self, name, value):
@@ -153,13 +287,17 @@ class JID(object):
         self.resource = u""
 
     @classmethod
-    def __from_unicode(cls, data, check = True):
+    def __from_unicode(cls, data, check = True, domains = None):
         """Return jid tuple from an Unicode string.
 
         :Parameters:
             - `data`: the JID string
             - `check`: when `False` then the JID is not checked for
               specification compliance.
+            - `domains`: prepared domains cache (raw domain to the prepared
+              one mapping), updated with the domain of `data`
+        :Types:
+            - `domains`: `dict`
 
         :Return: (localpart, domainpart, resourcepart) tuple"""
         parts1 = data.split(u"/", 1)
@@ -169,12 +307,12 @@ class JID(object):
             domain = parts2[1]
             if check:
                 local = cls.__prepare_local(local)
-                domain = cls.__prepare_domain(domain)
+                domain = cls.__get_domain(domain, domains)
         else:
             local = None
             domain = parts2[0]
             if check:
-                domain = cls.__prepare_domain(domain)
+                domain = cls.__get_domain(domain, domains)
         if len(parts1) == 2:
             resource = parts1[1]
             if check:
@@ -185,6 +323,26 @@ class JID(object):
             raise JIDError("Domain is required in JID.")
         return (local, domain, resource)
 
+    @classmethod
+    def __get_domain(cls, data, domains):
+        """Prepare the domainpart of the JID, using the prepared domains
+        cache, when available.
+
+        :Parameters:
+            - `data`: Domain part of the JID
+            - `domains`: prepared domains cache or `None`
+        :Types:
+            - `data`: `unicode`
+            - `domains`: `dict`
+        """
+        if domains is None:
+            return cls.__prepare_domain(data)
+        domain = domains.get(data)
+        if domain is None:
+            domain = cls.__prepare_domain(data)
+            domains[data] = domain
+        return domain
+
     @staticmethod
     def __prepare_local(data):
         """Prepare localpart of the JID
@@ -242,11 +400,15 @@ class JID(object):
                 logger.debug("ValueError: {0}".format(err))
         data = UNICODE_DOT_RE.sub(u".", data)
         data = data.rstrip(u".")
-        labels = data.split(u".")
-        try:
-            labels = [idna.nameprep(label) for label in labels]
-        except UnicodeError:
-            raise JIDError(u"Domain name invalid")
+        if ASCII_RE.match(data):
+            # nameprep of ASCII is just lowercasing
+            labels = data.lower().split(u".")
+        else:
+            labels = data.split(u".")
+            try:
+                labels = [NAMEPREP.prepare(label) for label in labels]
+            except StringprepError:
+                raise JIDError(u"Domain name invalid")
         for label in labels:
             if not STD3_LABEL_RE.match(label):
                 raise JIDError(u"Domain name invalid")
@@ -321,6 +483,10 @@ class JID(object):
         :return: new JID object without resource part."""
         return JID(self.local, self.domain, check = False)
 
+    def __reduce__(self):
+        """Pickle the JID by its (already normalized) parts."""
+        return (JID, (self.local, self.domain, self.resource, False))
+
     def __eq__(self, other):
         if other is None:
             return False
@@ -362,4 +528,49 @@ class JID(object):
     def __hash__(self):
         return hash(self.local) ^ hash(self.domain) ^ hash(self.resource)
 
+def _lru_get(key):
+    """Get a JID from the LRU cache.
+
+    The cache consists of two generations: the recently used JIDs and
+    the JIDs used before the last generation switch. A JID found in
+    the older generation is moved to the recent one.
+
+    :Return: the JID or `None`
+    """
+    obj = JID._lru_recent.get(key)
+    if obj is None:
+        obj = JID._lru_old.get(key)
+        if obj is not None:
+            _lru_put(key, obj)
+    return obj
+
+def _lru_put(key, obj):
+    """Put a JID into the LRU cache.
+
+    When the recent generation is full it becomes the old one (and the
+    old one is dropped), so at most `_jid_cache_size` keys are kept."""
+    recent = JID._lru_recent
+    if len(recent) * 2 >= _jid_cache_size:
+        if not _jid_cache_size:
+            return
+        JID._lru_old = recent
+        JID._lru_recent = recent = {}
+    recent[key] = obj
+
+def set_jid_cache_size(size):
+    """Modify the size of the LRU JID cache.
+
+    The cache keeps references to the recently created `JID` objects,
+    so they are not re-created (and the strings not stringprepped again)
+    when used again. Setting the size to 0 disables the cache.
+
+    :Parameters:
+        - `size`: maximum number of the JIDs kept
+    """
+    # pylint: disable-msg=W0603
+    global _jid_cache_size
+    _jid_cache_size = size
+    JID._lru_recent = {}
+    JID._lru_old = {}
+
 # vi: sts=4 et sw=4
@@ -0,0 +1,499 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""In-process loopback transport.
+
+A pair of `LoopbackTransport` objects, created by `loopback_pair`, connects
+two streams within a single process without any sockets: the data serialized
+by one transport is queued directly for the `StreamReader` of the other one.
+This allows testing and benchmarking the parser, the serializer and the
+stanza processing end to end, or running thousands of simulated streams in
+one process.
+
+The data may be delayed to simulate the network latency and bandwidth.
+
+The transports work with any main loop implementation and use no file
+descriptors: the data due is passed to the reader from the
+`LoopbackTransport.prepare` method, which the main loops call on every
+iteration for such handlers.
+
+TLS and stream compression are not supported.
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import threading
+import logging
+import time
+
+from collections import deque
+
+from .etree import element_to_unicode
+from .mainloop.interfaces import IOHandler, PrepareAgain
+from .settings import XMPPSettings
+from .streamevents import DisconnectedEvent
+from .xmppserializer import XMPPSerializer
+from .xmppparser import StreamReader
+from .interfaces import XMPPTransport
+from .trace import TRACE_IN, TRACE_IO
+
+logger = logging.getLogger("pyxmpp2.loopback")
+
+def loopback_pair(settings = None, peer_settings = None, latency = 0,
+                                                        bandwidth = None):
+    """Create two connected `LoopbackTransport` objects.
+
+    :Parameters:
+        - `settings`: settings for the first transport
+        - `peer_settings`: settings for the second transport, `settings`
+          are used by default
+        - `latency`: delay (in seconds) of data delivery, in each direction
+        - `bandwidth`: maximum data rate (bytes per second) in each
+          direction, `None` for unlimited
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `peer_settings`: `XMPPSettings`
+        - `latency`: `float`
+        - `bandwidth`: `float`
+
+    :Returntype: (`LoopbackTransport`, `LoopbackTransport`)
+    """
+    if peer_settings is None:
+        peer_settings = settings
+    first = LoopbackTransport(settings, latency, bandwidth)
+    second = LoopbackTransport(peer_settings, latency, bandwidth)
+    # pylint: disable=W0212
+    first._peer = second
+    second._peer = first
+    first._state = "connected"
+    second._state = "connected"
+    return first, second
+
+class LoopbackTransport(XMPPTransport, IOHandler):
+    """One end of an in-process XMPP connection.
+
+    Use `loopback_pair` to create the objects.
+
+    :Ivariables:
+        - `lock`: the lock protecting this object
+        - `settings`: settings for this object
+        - `latency`: delay of the data sent
+        - `bandwidth`: maximum data rate of the data sent
+        - `_eof`: `True` when the peer has closed its end of the connection
+        - `_event_queue`: queue to send connection events to
+        - `_hup`: `True` when this end of the connection is closed for
+          writing
+        - `_incoming`: (delivery time, data) tuples sent by the peer, `None`
+          data is the end of stream; `None` after the transport is closed
+        - `_incoming_lock`: lock protecting `_incoming`
+        - `_link_free`: time when the data sent will have passed through the
+          simulated link of limited `bandwidth`
+        - `_peer`: the other end of the connection
+        - `_reader`: parser for the data received
+        - `_serializer`: XML serializer for data sent
+        - `_state`: connection state (one of: `None`, "connected",
+          "closing", "closed")
+        - `_state_cond`: condition object to synchronize threads over state
+          change
+        - `_stream`: the stream associated with this transport
+    :Types:
+        - `lock`: :std:`threading.RLock`
+        - `settings`: `XMPPSettings`
+        - `latency`: `float`
+        - `bandwidth`: `float`
+        - `_eof`: `bool`
+        - `_event_queue`: :std:`Queue.Queue`
+        - `_hup`: `bool`
+        - `_incoming`: :std:`collections.deque`
+        - `_incoming_lock`: :std:`threading.Lock`
+        - `_link_free`: `float`
+        - `_peer`: `LoopbackTransport`
+        - `_reader`: `StreamReader`
+        - `_serializer`: `XMPPSerializer`
+        - `_state`: `unicode`
+        - `_state_cond`: :std:`threading.Condition`
+        - `_stream`: `streambase.StreamBase`
+    """
+    # pylint: disable=R0902
+    def __init__(self, settings = None, latency = 0, bandwidth = None):
+        """Initialize the `LoopbackTransport` object.
+
+        :Parameters:
+            - `settings`: XMPP settings to use
+            - `latency`: delay (in seconds) of the data sent
+            - `bandwidth`: maximum rate (bytes per second) of the data sent,
+              `None` for unlimited
+        :Types:
+            - `settings`: `XMPPSettings`
+            - `latency`: `float`
+            - `bandwidth`: `float`
+        """
+        if settings:
+            self.settings = settings
+        else:
+            self.settings = XMPPSettings()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.RLock()
+        self._state_cond = threading.Condition(self.lock)
+        self._incoming_lock = threading.Lock()
+        self._incoming = deque()
+        self._link_free = 0
+        self._eof = False
+        self._hup = False
+        self._peer = None
+        self._stream = None
+        self._serializer = None
+        self._reader = None
+        self._state = None
+        self._event_queue = self.settings["event_queue"]
+
+    def _set_state(self, state):
+        """Set `_state` and notify any threads waiting for the change.
+        """
+        TRACE_IO(" _set_state({0!r})", state)
+        self._state = state
+        self._state_cond.notify()
+
+    def _write(self, data):
+        """Queue data for the peer.
+
+        [ called with `lock` acquired ]
+
+        :Parameters:
+            - `data`: the data to send, `None` for the end of stream
+        :Types:
+            - `data`: `bytes`
+        """
+        now = time.time()
+        if self.bandwidth and data:
+            start = max(now, self._link_free)
+            self._link_free = start + len(data) / self.bandwidth
+            deliver = self._link_free + self.latency
+        else:
+            deliver = max(now, self._link_free) + self.latency
+        # pylint: disable=W0212
+        self._peer._deliver(deliver, data)
+
+    def _deliver(self, deliver, data):
+        """Queue data from the peer.
+
+        Only `_incoming_lock` is acquired, so the peer may call this
+        with its own `lock` acquired. The data is passed to the reader
+        later, from `prepare`, so the peer never gets a reply before its
+        send call returns.
+
+        :Parameters:
+            - `deliver`: when the data may be received
+            - `data`: the data received, `None` for the end of stream
+        :Types:
+            - `deliver`: `float`
+            - `data`: `bytes`
+        """
+        with self._incoming_lock:
+            if self._incoming is not None:
+                self._incoming.append((deliver, data))
+
+    def _next_delivery(self):
+        """Get the time until the next data is due.
+
+        :Returntype: `float` or `None` if no data is waiting
+        """
+        with self._incoming_lock:
+            if not self._incoming:
+                return None
+            return max(self._incoming[0][0] - time.time(), 0)
+
+    def _take_incoming(self):
+        """Remove the data due from the incoming queue.
+
+        :Return: (data, eof, delay) tuple: the data received, `True` if the
+            end of stream has been received, the time (in seconds) until more
+            data will be due or `None`.
+        """
+        now = time.time()
+        chunks = []
+        eof = False
+        with self._incoming_lock:
+            while self._incoming:
+                deliver, data = self._incoming[0]
+                if deliver > now:
+                    return b"".join(chunks), eof, deliver - now
+                self._incoming.popleft()
+                if data is None:
+                    eof = True
+                    break
+                chunks.append(data)
+        return b"".join(chunks), eof, None
+
+    def set_target(self, stream):
+        """Make the `stream` the target for this transport instance.
+
+        :Parameters:
+            - `stream`: the stream handler to receive stream content
+              from the transport
+        :Types:
+            - `stream`: `StreamBase`
+        """
+        with self.lock:
+            if self._stream:
+                raise ValueError("Target stream already set")
+            self._stream = stream
+            self._reader = StreamReader(stream)
+
+    def send_stream_head(self, stanza_namespace, stream_from, stream_to,
+                        stream_id = None, version = u'1.0', language = None):
+        """
+        Send stream head via the transport.
+
+        :Parameters:
+            - `stanza_namespace`: namespace of stream stanzas (e.g.
+              'jabber:client')
+            - `stream_from`: the 'from' attribute of the stream. May be `None`.
+            - `stream_to`: the 'to' attribute of the stream. May be `None`.
+            - `version`: the 'version' of the stream.
+            - `language`: the 'xml:lang' of the stream
+        :Types:
+            - `stanza_namespace`: `unicode`
+            - `stream_from`: `unicode`
+            - `stream_to`: `unicode`
+            - `version`: `unicode`
+            - `language`: `unicode`
+        """
+        # pylint: disable=R0913
+        with self.lock:
+            self._serializer = XMPPSerializer(stanza_namespace,
+                                            self.settings["extra_ns_prefixes"])
+            head = self._serializer.emit_head(stream_from, stream_to,
+                                                stream_id, version, language)
+            self._write(head.encode("utf-8"))
+
+    def restart(self):
+        """Restart the stream after SASL handshake."""
+        self._reader = StreamReader(self._stream)
+        self._serializer = None
+
+    def send_stream_tail(self):
+        """
+        Send stream tail via the transport.
+        """
+        with self.lock:
+            if self._state != "connected" or self._hup:
+                logger.debug(u"Cannot send stream closing tag: already closed")
+                return
+            data = self._serializer.emit_tail()
+            self._write(data.encode("utf-8"))
+            self._write(None)
+            self._serializer = None
+            self._hup = True
+            self._set_state("closing")
+
+    def send_element(self, element):
+        """
+        Send an element via the transport.
+        """
+        with self.lock:
+            if self._eof or self._hup or not self._serializer:
+                logger.debug("Dropping element: {0}".format(
+                                                element_to_unicode(element)))
+                return
+            data = self._serializer.emit_stanza(element)
+            self._write(data.encode("utf-8"))
+
+    def prepare(self):
+        """Pass the data due to the stream reader.
+
+        Called by the main loop on every iteration, as the transport has no
+        file descriptor to wait on.
+
+        :Return: `PrepareAgain` with the time until more data is due for
+            this transport or the peer. The peer may have received data
+            from the stream after its own `prepare` was called in this loop
+            iteration.
+        """
+        self.handle_read()
+        delays = [self._next_delivery()]
+        if self._peer is not None:
+            # pylint: disable=W0212
+            delays.append(self._peer._next_delivery())
+        delays = [delay for delay in delays if delay is not None]
+        if not delays:
+            return PrepareAgain(None)
+        return PrepareAgain(min(delays))
+
+    def fileno(self):
+        """Return `None`, as no file descriptor is used."""
+        return None
+
+    def is_readable(self):
+        """
+        :Return: `False`, as there is no file descriptor to wait on; the
+            data is received in `prepare`
+        """
+        return False
+
+    def wait_for_readability(self):
+        """
+        Stop current thread until the channel is readable.
+
+        :Return: `False` if it won't be readable (e.g. is closed)
+        """
+        with self.lock:
+            while True:
+                if self._eof or self._state not in (None, "connected",
+                                                                "closing"):
+                    return False
+                if self._state is not None:
+                    return True
+                self._state_cond.wait()
+
+    def is_writable(self):
+        """
+        :Return: `False` as the data is always written synchronously
+        """
+        return False
+
+    def wait_for_writability(self):
+        """
+        Stop current thread until the channel is closed, as it is never
+        writable.
+
+        :Return: `False`
+        """
+        with self.lock:
+            while self._state != "closed":
+                self._state_cond.wait()
+        return False
+
+    def handle_write(self):
+        """Nothing to do, the data is always written synchronously."""
+        pass
+
+    def handle_read(self):
+        """
+        Pass the data due to the stream reader.
+        """
+        with self.lock:
+            TRACE_IO("handle_read()")
+            if (self._eof or not self._reader
+                    or self._state not in ("connected", "closing")):
+                return
+            data, eof, dummy = self._take_incoming()
+            if data:
+                self._feed_reader(data)
+            if eof and not self._eof:
+                self._feed_reader(None)
+
+    def handle_hup(self):
+        """
+        Handle the 'channel hungup' state. Never called, as no file
+        descriptor is used.
+        """
+        pass
+
+    def handle_err(self):
+        """
+        Handle an error reported. Never called, as no file descriptor is used.
+        """
+        pass
+
+    def handle_nval(self):
+        """
+        Handle an error reported. Never called, as no file descriptor is used.
+        """
+        pass
+
+    def is_connected(self):
+        """
+        Check if the transport is connected.
+
+        :Return: `True` if is connected.
+        """
+        return self._state == "connected" and not self._eof and not self._hup
+
+    def disconnect(self):
+        """Disconnect the stream gracefully."""
+        logger.debug("LoopbackTransport.disconnect()")
+        with self.lock:
+            if self._hup or not self._serializer:
+                self._close()
+            else:
+                self.send_stream_tail()
+
+    def close(self):
+        """Close the stream immediately, so it won't expect more events."""
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        """Same as `close` but expects `lock` acquired.
+        """
+        if self._state == "closed":
+            return
+        if self._peer is not None and not self._hup:
+            self._write(None)
+            self._hup = True
+        self.event(DisconnectedEvent(None))
+        self._set_state("closed")
+        with self._incoming_lock:
+            # drop the data not received
+            self._incoming = None
+
+    def _feed_reader(self, data):
+        """Feed the stream reader with data received.
+
+        [ called with `lock` acquired ]
+
+        If `data` is None or empty, then stream end (peer disconnected) is
+        assumed and the stream is closed.
+
+        :Parameters:
+            - `data`: data received from the peer.
+        :Types:
+            - `data`: `bytes`
+        """
+        TRACE_IN("IN: {0!r}", data)
+        if data:
+            self.lock.release() # not to deadlock with the stream
+            try:
+                self._reader.feed(data)
+            finally:
+                self.lock.acquire()
+        else:
+            self._eof = True
+            self.lock.release() # not to deadlock with the stream
+            try:
+                self._stream.stream_eof()
+            finally:
+                self.lock.acquire()
+            if not self._serializer:
+                self._close()
+
+    def event(self, event):
+        """Pass an event to the target stream or just log it."""
+        logger.debug(u"Loopback transport event: {0}".format(event))
+        if self._stream:
+            event.stream = self._stream
+        self._event_queue.put(event)
+
+    @property
+    def auth_properties(self):
+        return {"security-layer": None}
+
+# vi: sts=4 et sw=4
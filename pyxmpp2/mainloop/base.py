@@ -29,6 +29,8 @@ import inspect
 from .events import EventDispatcher
 from .interfaces import EventHandler, IOHandler, TimeoutHandler, MainLoop, QUIT
 from ..settings import XMPPSettings
+from ..instrumentation import call_handler, TIMEOUT
+from ..trace import TRACE_TIMERS
 
 logger = logging.getLogger("pyxmpp2.mainloop.base")
 
@@ -42,6 +44,7 @@ class MainLoopBase(MainLoop):
         self._timeout_handlers = []
         self.event_dispatcher = EventDispatcher(self.settings, handlers)
         self.event_queue = self.settings["event_queue"]
+        self.instrumentation = self.settings["instrumentation"]
         self._quit = False
         self._started = False
         for handler in handlers:
@@ -135,21 +138,20 @@ class MainLoopBase(MainLoop):
             schedule, handler = self._timeout_handlers[0]
             if schedule <= now:
                 # pylint: disable-msg=W0212
-                logger.debug("About to call a timeout handler: {0!r}"
-                                                        .format(handler))
+                TRACE_TIMERS("About to call a timeout handler: {0!r}", handler)
                 self._timeout_handlers = self._timeout_handlers[1:]
-                result = handler()
-                logger.debug(" handler result: {0!r}".format(result))
+                result = call_handler(self.instrumentation, TIMEOUT, handler)
+                TRACE_TIMERS(" handler result: {0!r}", result)
                 rec = handler._pyxmpp_recurring
                 if rec:
-                    logger.debug(" recurring, restarting in {0} s"
-                                        .format(handler._pyxmpp_timeout))
+                    TRACE_TIMERS(" recurring, restarting in {0} s",
+                                                       handler._pyxmpp_timeout)
                     self._timeout_handlers.append(
                                     (now + handler._pyxmpp_timeout, handler))
                     self._timeout_handlers.sort(key = lambda x: x[0])
                 elif rec is None and result is not None:
-                    logger.debug(" auto-recurring, restarting in {0} s"
-                                                            .format(result))
+                    TRACE_TIMERS(" auto-recurring, restarting in {0} s",
+                                                                        result)
                     self._timeout_handlers.append((now + result, handler))
                     self._timeout_handlers.sort(key = lambda x: x[0])
                 sources_handled += 1
@@ -33,6 +33,8 @@ logger = logging.getLogger("pyxmpp2.mainloop.events")
 
 from .interfaces import EventHandler, Event, QUIT
 from ..settings import XMPPSettings
+from ..instrumentation import call_handler, EVENT
+from ..trace import TRACE_DISPATCH
 
 class EventDispatcher(object):
     """Dispatches events from an event queue to event handlers.
@@ -45,11 +47,13 @@ class EventDispatcher(object):
     :Ivariables:
         - `queue`: the event queue
         - `handlers`: list of handler objects
+        - `instrumentation`: handler call instrumentation
         - `lock`: the thread synchronisation lock
         - `_handler_map`: mapping of event type to list of handler methods
     :Types:
         - `queue`: :std:`Queue.Queue`
         - `handlers`: `list` of `EventHandler`
+        - `instrumentation`: `instrumentation.Instrumentation`
         - `lock`: :std:`threading.RLock`
         - `_handler_map`: `type` -> `list` of callable mapping
     """
@@ -58,7 +62,8 @@ class EventDispatcher(object):
 
         :Parameters:
             - `settings`: the settings. "event_queue" settings provides the
-              event queue object.
+              event queue object, "instrumentation" the handler call
+              instrumentation.
             - `handlers`: the initial list of event handler objects.
         :Types:
             - `settings`: `XMPPSettings`
@@ -67,6 +72,7 @@ class EventDispatcher(object):
         if settings is None:
             settings = XMPPSettings()
         self.queue = settings["event_queue"]
+        self.instrumentation = settings["instrumentation"]
         self._handler_map = defaultdict(list)
         if handlers:
             self.handlers = list(handlers)
@@ -128,26 +134,27 @@ class EventDispatcher(object):
 
         :Return: the event handled (may be `QUIT`) or `None`
         """
-        logger.debug(" dispatching...")
+        TRACE_DISPATCH(" dispatching...")
         try:
             event = self.queue.get(block, timeout)
         except Queue.Empty:
-            logger.debug("    queue empty")
+            TRACE_DISPATCH("    queue empty")
             return None
         try:
-            logger.debug("    event: {0!r}".format(event))
+            TRACE_DISPATCH("    event: {0!r}", event)
             if event is QUIT:
                 return QUIT
             handlers = list(self._handler_map[None])
             klass = event.__class__
             if klass in self._handler_map:
                 handlers += self._handler_map[klass]
-            logger.debug("    handlers: {0!r}".format(handlers))
+            TRACE_DISPATCH("    handlers: {0!r}", handlers)
             # to restore the original order of handler objects
             handlers.sort(key = lambda x: x[0])
             for dummy, handler in handlers:
-                logger.debug(u"  passing the event to: {0!r}".format(handler))
-                result = handler(event)
+                TRACE_DISPATCH(u"  passing the event to: {0!r}", handler)
+                result = call_handler(self.instrumentation, EVENT,
+                                                            handler, event)
                 if isinstance(result, Event):
                     self.queue.put(result)
                 elif result and event is not QUIT:
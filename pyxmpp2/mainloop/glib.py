@@ -30,6 +30,8 @@ import functools
 
 from .interfaces import HandlerReady, PrepareAgain
 from .base import MainLoopBase
+from ..instrumentation import call_handler, TIMEOUT
+from ..trace import TRACE_IO, TRACE_TIMERS
 
 logger = logging.getLogger("pyxmpp2.mainloop.glib")
 
@@ -110,14 +112,14 @@ class GLibMainLoop(MainLoopBase):
             return
         events = 0
         if handler.is_readable():
-            logger.debug(" {0!r} readable".format(handler))
+            TRACE_IO(" {0!r} readable", handler)
             events |= glib.IO_IN | glib.IO_ERR
         if handler.is_writable():
-            logger.debug(" {0!r} writable".format(handler))
+            TRACE_IO(" {0!r} writable", handler)
             events |= glib.IO_OUT | glib.IO_HUP | glib.IO_ERR
         if events:
-            logger.debug(" registering {0!r} handler fileno {1} for"
-                            " events {2}".format(handler, fileno, events))
+            TRACE_IO(" registering {0!r} handler fileno {1} for"
+                            " events {2}", handler, fileno, events)
             glib.io_add_watch(fileno, events, self._io_callback, handler)
 
     @hold_exception
@@ -227,8 +229,8 @@ class GLibMainLoop(MainLoopBase):
         """Call the timeout handler due.
         """
         self._anything_done = True
-        logger.debug("_timeout_cb() called for: {0!r}".format(method))
-        result = method()
+        TRACE_TIMERS("_timeout_cb() called for: {0!r}", method)
+        result = call_handler(self.instrumentation, TIMEOUT, method)
         # pylint: disable=W0212
         rec = method._pyxmpp_recurring
         if rec:
@@ -236,8 +238,7 @@ class GLibMainLoop(MainLoopBase):
             return True
 
         if rec is None and result is not None:
-            logger.debug(" auto-recurring, restarting in {0} s"
-                                                            .format(result))
+            TRACE_TIMERS(" auto-recurring, restarting in {0} s", result)
             tag = glib.timeout_add(int(result * 1000), self._timeout_cb, method)
             self._timer_sources[method] = tag
         else:
@@ -33,6 +33,7 @@ import select
 
 from .interfaces import HandlerReady, PrepareAgain
 from .base import MainLoopBase
+from ..trace import TRACE_IO
 
 logger = logging.getLogger("pyxmpp2.mainloop.poll")
 
@@ -76,23 +77,23 @@ class PollMainLoop(MainLoopBase):
         self._handlers[fileno] = handler
         events = 0
         if handler.is_readable():
-            logger.debug(" {0!r} readable".format(handler))
+            TRACE_IO(" {0!r} readable", handler)
             events |= select.POLLIN
         if handler.is_writable():
-            logger.debug(" {0!r} writable".format(handler))
+            TRACE_IO(" {0!r} writable", handler)
             events |= select.POLLOUT
         if events:
-            logger.debug(" registering {0!r} handler fileno {1} for"
-                            " events {2}".format(handler, fileno, events))
+            TRACE_IO(" registering {0!r} handler fileno {1} for"
+                            " events {2}", handler, fileno, events)
             self.poll.register(fileno, events)
 
     def _prepare_io_handler(self, handler):
         """Call the `interfaces.IOHandler.prepare` method and
         remove the handler from unprepared handler list when done.
         """
-        logger.debug(" preparing handler: {0!r}".format(handler))
+        TRACE_IO(" preparing handler: {0!r}", handler)
         ret = handler.prepare()
-        logger.debug("   prepare result: {0!r}".format(ret))
+        TRACE_IO("   prepare result: {0!r}", ret)
         if isinstance(ret, HandlerReady):
             del self._unprepared_handlers[handler]
             prepared = True
@@ -128,12 +129,12 @@ class PollMainLoop(MainLoopBase):
         next_timeout, sources_handled = self._call_timeout_handlers()
         if self._quit:
             return sources_handled
-        if self._timeout is not None:
-            timeout = min(timeout, self._timeout)
         if next_timeout is not None:
             timeout = min(next_timeout, timeout)
         for handler in list(self._unprepared_handlers):
             self._configure_io_handler(handler)
+        if self._timeout is not None:
+            timeout = min(timeout, self._timeout)
         events = self.poll.poll(timeout * 1000)
         self._timeout = None
         for (fileno, event) in events:
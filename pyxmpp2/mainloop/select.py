@@ -34,6 +34,7 @@ import logging
 
 from .interfaces import HandlerReady, PrepareAgain
 from .base import MainLoopBase
+from ..trace import TRACE_IO
 
 logger = logging.getLogger("pyxmpp2.mainloop.select")
 
@@ -69,8 +70,8 @@ class SelectMainLoop(MainLoopBase):
             readable, writable, _unused = [], [], None
             time.sleep(timeout)
         else:
-            logger.debug("select({0!r}, {1!r}, [], {2!r})"
-                                    .format( readable, writable,timeout))
+            TRACE_IO("select({0!r}, {1!r}, [], {2!r})",
+                                                    readable, writable, timeout)
             readable, writable, _unused = select.select(
                                             readable, writable, [], timeout)
         for handler in readable:
@@ -94,9 +95,9 @@ class SelectMainLoop(MainLoopBase):
         writable = []
         for handler in self._handlers:
             if handler not in self._prepared:
-                logger.debug(" preparing handler: {0!r}".format(handler))
+                TRACE_IO(" preparing handler: {0!r}", handler)
                 ret = handler.prepare()
-                logger.debug("   prepare result: {0!r}".format(ret))
+                TRACE_IO("   prepare result: {0!r}", ret)
                 if isinstance(ret, HandlerReady):
                     self._prepared.add(handler)
                 elif isinstance(ret, PrepareAgain):
@@ -108,13 +109,13 @@ class SelectMainLoop(MainLoopBase):
                 else:
                     raise TypeError("Unexpected result type from prepare()")
             if not handler.fileno():
-                logger.debug(" {0!r}: no fileno".format(handler))
+                TRACE_IO(" {0!r}: no fileno", handler)
                 continue
             if handler.is_readable():
-                logger.debug(" {0!r} readable".format(handler))
+                TRACE_IO(" {0!r} readable", handler)
                 readable.append(handler)
             if handler.is_writable():
-                logger.debug(" {0!r} writable".format(handler))
+                TRACE_IO(" {0!r} writable", handler)
                 writable.append(handler)
         return readable, writable, timeout
 
@@ -39,6 +39,7 @@ from .interfaces import MainLoop, HandlerReady, PrepareAgain
 from .interfaces import IOHandler, QUIT, EventHandler, TimeoutHandler
 from .events import EventDispatcher
 from ..settings import XMPPSettings
+from ..instrumentation import call_handler, TIMEOUT
 from .wait import wait_for_read, wait_for_write
 
 logger = logging.getLogger("pyxmpp2.mainloop.threads")
@@ -278,6 +279,7 @@ class TimeoutThread(object):
         - `exc_info`: this will hold exception information tuple whenever the
           thread was aborted by an exception.
         - `exc_queue`: queue for raised exceptions
+        - `instrumentation`: handler call instrumentation
 
     :Types:
         - `name`: `unicode`
@@ -285,8 +287,10 @@ class TimeoutThread(object):
         - `thread`: :std:`threading.Thread`
         - `exc_info`: (type, value, traceback) tuple
         - `exc_queue`: queue for raised exceptions
+        - `instrumentation`: `instrumentation.Instrumentation`
     """
-    def __init__(self, method, name = None, daemon = True, exc_queue = None):
+    def __init__(self, method, name = None, daemon = True, exc_queue = None,
+                                                    instrumentation = None):
         if name is None:
             name = "{0!r} timer thread"
         self.name = name
@@ -295,6 +299,7 @@ class TimeoutThread(object):
         self.thread.daemon = daemon
         self.exc_info = None
         self.exc_queue = exc_queue
+        self.instrumentation = instrumentation
         self._quit = False
 
     def start(self):
@@ -348,7 +353,7 @@ class TimeoutThread(object):
                 time.sleep(timeout)
             if self._quit:
                 break
-            ret = self.method()
+            ret = call_handler(self.instrumentation, TIMEOUT, self.method)
             if recurring is None:
                 timeout = ret
             elif not recurring:
@@ -432,7 +437,8 @@ class ThreadPool(MainLoop):
             if not hasattr(method, "_pyxmpp_timeout"):
                 continue
             thread = TimeoutThread(method, daemon = self.daemon,
-                                                    exc_queue = self.exc_queue)
+                            exc_queue = self.exc_queue,
+                            instrumentation = self.settings["instrumentation"])
             self.timeout_threads.append(thread)
             thread.start()
 
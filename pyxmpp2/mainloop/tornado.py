@@ -27,6 +27,7 @@ import time
 from tornado import ioloop
 from .interfaces import HandlerReady, PrepareAgain, QUIT
 from .base import MainLoopBase
+from ..instrumentation import call_handler, TIMEOUT
 
 logger = logging.getLogger(__name__)
 
@@ -134,7 +135,8 @@ class TornadoMainLoop(MainLoopBase):
             logger.debug(" registering {0!r} handler with timeout {1}".format(
                 handler, method._pyxmpp_timeout))
             handler._tornado_timeout = self.io_loop.add_timeout(
-                now + method._pyxmpp_timeout, method
+                now + method._pyxmpp_timeout,
+                partial(call_handler, self.instrumentation, TIMEOUT, method)
             )
 
     def _remove_timeout_handler(self, handler):
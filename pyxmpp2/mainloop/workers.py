@@ -0,0 +1,278 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Bounded worker thread pool for blocking jobs.
+
+Jobs submitted to a `WorkerPool` are run in worker threads and their results
+are passed back via the main loop event queue, so the result callbacks are
+always called from the thread dispatching events (the main loop thread
+for the asynchronous main loops).
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import sys
+import threading
+import logging
+import Queue
+
+from .interfaces import Event, EventHandler, event_handler
+from ..settings import XMPPSettings
+
+logger = logging.getLogger("pyxmpp2.mainloop.workers")
+
+class WorkerPoolFull(Exception):
+    """Raised by `WorkerPool.submit` when the job queue is full."""
+    pass
+
+class WorkerJobCancelled(Exception):
+    """Passed (in the exception information tuple) to the callbacks of the
+    jobs discarded by `WorkerPool.stop`."""
+    pass
+
+class WorkerJobDoneEvent(Event):
+    """Event emitted by a worker thread when a job has been completed.
+
+    :Ivariables:
+        - `pool`: the pool which run the job
+        - `callback`: the result callback of the job
+        - `result`: value returned by the job function
+        - `exc_info`: exception information tuple if the job raised
+          an exception, `None` otherwise
+    :Types:
+        - `pool`: `WorkerPool`
+        - `exc_info`: (type, value, traceback) tuple
+    """
+    # pylint: disable-msg=R0903
+    def __init__(self, pool, callback, result, exc_info):
+        self.pool = pool
+        self.callback = callback
+        self.result = result
+        self.exc_info = exc_info
+    def __unicode__(self):
+        if self.exc_info:
+            return u"Worker job failed: {0!r}".format(self.exc_info[1])
+        return u"Worker job done"
+
+class WorkerPool(EventHandler):
+    """Bounded pool of worker threads.
+
+    The pool must be registered at the main loop (as an `EventHandler`), for
+    the job results to be delivered.
+
+    :Ivariables:
+        - `settings`: the settings used
+        - `max_threads`: maximum number of the worker threads
+        - `threads`: currently running threads
+        - `queue`: the job queue
+        - `lock`: the thread synchronisation lock
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `max_threads`: `int`
+        - `threads`: `list` of :std:`threading.Thread`
+        - `queue`: :std:`Queue.Queue`
+        - `lock`: :std:`threading.RLock`
+    """
+    def __init__(self, settings = None, max_threads = None,
+                                                        max_queued = None):
+        """Initialize the pool.
+
+        :Parameters:
+            - `settings`: the settings. "event_queue" provides the queue for
+              the result events. :r:`worker_threads setting` and
+              :r:`worker_queue_size setting` provide the defaults for the
+              other arguments.
+            - `max_threads`: maximum number of the worker threads
+            - `max_queued`: maximum number of jobs waiting for a free worker
+              thread (0 for no limit)
+        :Types:
+            - `settings`: `XMPPSettings`
+            - `max_threads`: `int`
+            - `max_queued`: `int`
+        """
+        if settings is None:
+            settings = XMPPSettings()
+        self.settings = settings
+        if max_threads is None:
+            max_threads = settings["worker_threads"]
+        if max_queued is None:
+            max_queued = settings["worker_queue_size"]
+        self.max_threads = max_threads
+        self.threads = []
+        self.queue = Queue.Queue(max_queued)
+        self.lock = threading.RLock()
+        self._idle = 0
+        self._last_thread_n = 0
+        self._stopped = False
+        self._event_queue = settings["event_queue"]
+
+    def submit(self, function, callback):
+        """Run `function` in a worker thread and pass the result to
+        `callback` in the main loop thread.
+
+        `callback` will be called with two arguments: the value returned
+        by `function` and the exception information tuple (`None` if
+        `function` returned normally).
+
+        :Parameters:
+            - `function`: the job to run; a callable accepting no arguments
+            - `callback`: the result callback
+        :Raise `WorkerPoolFull`: when the job queue is full or the pool
+            has been stopped.
+        """
+        with self.lock:
+            if self._stopped:
+                raise WorkerPoolFull("Worker pool stopped")
+            try:
+                self.queue.put_nowait((function, callback))
+            except Queue.Full:
+                raise WorkerPoolFull("Worker job queue is full")
+            self._start_thread()
+
+    @property
+    def stopped(self):
+        """`True` after `stop` until `start` is called."""
+        return self._stopped
+
+    def start(self):
+        """Accept jobs again after `stop`.
+
+        The threads still running are reused, new ones are started as
+        needed.
+        """
+        with self.lock:
+            if not self._stopped:
+                return
+            self._stopped = False
+            self._drain()
+
+    def stop(self):
+        """Stop the worker threads, when they finish current jobs.
+
+        The jobs still waiting in the queue are cancelled: their callbacks
+        will be called (in the main loop thread) with a `WorkerJobCancelled`
+        exception.
+        """
+        with self.lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            try:
+                raise WorkerJobCancelled("Worker pool stopped")
+            except WorkerJobCancelled:
+                exc_info = sys.exc_info()
+            for job in self._drain():
+                self._event_queue.put(WorkerJobDoneEvent(self, job[1], None,
+                                                                    exc_info))
+            # the queue is empty now and nothing can be submitted, so this
+            # will not block; each thread passes it on before exiting
+            self.queue.put_nowait(None)
+
+    def _drain(self):
+        """Remove all jobs and stop requests from the queue.
+
+        [called with `lock` acquired]
+
+        :Return: the jobs removed
+        :Returntype: `list` of (function, callback) tuples
+        """
+        jobs = []
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Queue.Empty:
+                return jobs
+            if job is not None:
+                jobs.append(job)
+
+    def _start_thread(self):
+        """Start a new worker thread unless there is an idle thread or the
+        maximum number of threads has been reached.
+
+        [called with `lock` acquired]
+        """
+        if self._stopped:
+            return
+        if self._idle >= self.queue.qsize():
+            return
+        if len(self.threads) >= self.max_threads:
+            return
+        thread_n = self._last_thread_n + 1
+        self._last_thread_n = thread_n
+        thread = threading.Thread(target = self._run,
+                        name = "{0!r} #{1}".format(self, thread_n),
+                        args = (thread_n,))
+        self.threads.append(thread)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, thread_n):
+        """The worker thread function."""
+        logger.debug("{0!r}: entering thread #{1}".format(self, thread_n))
+        try:
+            while True:
+                with self.lock:
+                    self._idle += 1
+                try:
+                    job = self.queue.get()
+                finally:
+                    with self.lock:
+                        self._idle -= 1
+                if job is None:
+                    with self.lock:
+                        if self._stopped:
+                            try:
+                                self.queue.put_nowait(None)
+                            except Queue.Full:
+                                # stopped again, a new request is queued
+                                pass
+                    break
+                function, callback = job
+                try:
+                    result = function()
+                except Exception: # pylint: disable-msg=W0703
+                    event = WorkerJobDoneEvent(self, callback, None,
+                                                            sys.exc_info())
+                else:
+                    event = WorkerJobDoneEvent(self, callback, result, None)
+                self._event_queue.put(event)
+        finally:
+            logger.debug("{0!r}: leaving thread #{1}".format(self, thread_n))
+            with self.lock:
+                self.threads.remove(threading.currentThread())
+
+    @event_handler(WorkerJobDoneEvent)
+    def _job_done(self, event):
+        """Pass a job result to its callback."""
+        if event.pool is not self:
+            return False
+        event.callback(event.result, event.exc_info)
+        return True
+
+XMPPSettings.add_setting(u"worker_threads", type = int, default = 4,
+        validator = XMPPSettings.validate_positive_int,
+        cmdline_help = "Maximum number of worker threads",
+        doc = u"""Maximum number of threads in a `WorkerPool`."""
+    )
+XMPPSettings.add_setting(u"worker_queue_size", type = int, default = 1000,
+        doc = u"""Maximum number of jobs waiting for a free thread in a
+`WorkerPool`. 0 means no limit."""
+    )
+
+# vi: sts=4 et sw=4
@@ -0,0 +1,258 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Per-sender rate limiting of incoming stanzas.
+
+A `RateLimiter` keeps a token bucket for every (stanza kind, sender) pair
+seen recently. Each stanza received takes one token from the bucket and
+the tokens are refilled with a configured rate, up to the 'burst' size.
+When the bucket is empty the stanza is dropped, delayed or rejected
+with the 'resource-constraint' error, depending on the
+:r:`stanza_rate_limit_policy setting`.
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+from .settings import XMPPSettings
+from .mainloop.interfaces import Event
+
+logger = logging.getLogger("pyxmpp2.ratelimit")
+
+class StanzaThrottledEvent(Event):
+    """Emitted when stanzas from a sender start being throttled.
+
+    The event is emitted once, for the first stanza exceeding the limit. It
+    will be emitted again after the sender stops exceeding the limit and
+    exceeds it again.
+
+    :Ivariables:
+        - `sender`: the sender JID (bare or full, depending on the
+          :r:`stanza_rate_limit_key setting`)
+        - `kind`: the stanza element name: "message", "presence" or "iq"
+        - `policy`: the action taken: "drop", "delay" or "error"
+    :Types:
+        - `sender`: `unicode`
+        - `kind`: `unicode`
+        - `policy`: `unicode`
+    """
+    # pylint: disable-msg=R0903
+    def __init__(self, sender, kind, policy):
+        self.sender = sender
+        self.kind = kind
+        self.policy = policy
+    def __unicode__(self):
+        return u"Throttling {0} stanzas from {1} ({2})".format(self.kind,
+                                                    self.sender, self.policy)
+
+class TokenBucket(object):
+    """A token bucket.
+
+    :Ivariables:
+        - `rate`: tokens added per second
+        - `burst`: maximum number of tokens in the bucket
+        - `tokens`: current number of tokens (negative when stanzas have been
+          delayed in advance)
+        - `stamp`: time when `tokens` was last updated
+        - `throttled`: `True` if the last stanza was over the limit
+    """
+    # pylint: disable-msg=R0903
+    __slots__ = ("rate", "burst", "tokens", "stamp", "throttled")
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+        self.throttled = False
+
+    def take(self, now, max_delay = None):
+        """Take a token from the bucket.
+
+        :Parameters:
+            - `now`: current time
+            - `max_delay`: when not `None` and no token is available the token
+              will be borrowed if it will be available within `max_delay`
+              seconds
+        :Return: 0 if a token was available, the time in seconds until the
+            borrowed token is available or `None` if no token could be taken
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0
+        delay = (1 - tokens) / self.rate
+        if max_delay is not None and delay <= max_delay:
+            self.tokens = tokens - 1
+            return delay
+        self.tokens = tokens
+        return None
+
+class RateLimiter(object):
+    """Per-sender stanza rate limiter used by the `StanzaProcessor`.
+
+    :Ivariables:
+        - `settings`: the settings used
+        - `main_loop`: main loop used to schedule delayed stanzas
+        - `limits`: mapping of stanza element name to (rate, burst) tuples
+        - `policy`: "drop", "delay" or "error"
+        - `lock`: the thread synchronisation lock
+        - `_buckets`: the token buckets, least recently used first
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `main_loop`: `mainloop.interfaces.MainLoop`
+        - `limits`: `dict`
+        - `policy`: `unicode`
+        - `lock`: :std:`threading.RLock`
+        - `_buckets`: :std:`collections.OrderedDict`
+    """
+    def __init__(self, settings = None, main_loop = None):
+        """Initialize the rate limiter.
+
+        :Parameters:
+            - `settings`: the settings. See :r:`stanza_rate_limits setting`
+              and related.
+            - `main_loop`: the main loop, required for the "delay" policy
+        :Types:
+            - `settings`: `XMPPSettings`
+            - `main_loop`: `mainloop.interfaces.MainLoop`
+        """
+        if settings is None:
+            settings = XMPPSettings()
+        self.settings = settings
+        self.main_loop = main_loop
+        self.limits = {}
+        for kind, (rate, burst) in (settings["stanza_rate_limits"]
+                                                            or {}).items():
+            if rate <= 0 or burst <= 0:
+                raise ValueError("Bad rate limit for {0!r} stanzas: {1!r}"
+                                            .format(kind, (rate, burst)))
+            self.limits[kind] = (float(rate), burst)
+        self.policy = settings["stanza_rate_limit_policy"]
+        if self.policy not in ("drop", "delay", "error"):
+            raise ValueError("Bad rate limit policy: {0!r}"
+                                                        .format(self.policy))
+        if self.policy == "delay" and main_loop is None:
+            raise ValueError("Main loop required for the 'delay' policy")
+        self._bare = settings["stanza_rate_limit_key"] == "bare"
+        self._max_buckets = settings["stanza_rate_limit_buckets"]
+        self._max_delay = settings["stanza_rate_limit_max_delay"]
+        self._event_queue = settings["event_queue"]
+        self._buckets = OrderedDict()
+        self.lock = threading.RLock()
+
+    def check(self, stanza):
+        """Check if a stanza received exceeds the limit.
+
+        :Parameters:
+            - `stanza`: the stanza received
+        :Types:
+            - `stanza`: `Stanza`
+
+        :Return: 0 if the stanza may be processed now, number of seconds
+            the processing should be delayed or `None` if the stanza should be
+            rejected (dropped or replied with an error, according to
+            `policy`).
+        """
+        kind = stanza.element_name
+        limit = self.limits.get(kind)
+        if not limit:
+            return 0
+        from_jid = stanza.from_jid
+        if not from_jid:
+            return 0
+        if self._bare:
+            from_jid = from_jid.bare()
+        sender = from_jid.as_unicode()
+        key = (kind, sender)
+        now = time.time()
+        with self.lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(limit[0], limit[1], now)
+                if len(self._buckets) >= self._max_buckets:
+                    self._buckets.popitem(last = False)
+            self._buckets[key] = bucket
+            if self.policy == "delay":
+                result = bucket.take(now, self._max_delay)
+            else:
+                result = bucket.take(now)
+            if result == 0:
+                bucket.throttled = False
+                return 0
+            if bucket.throttled:
+                return result
+            bucket.throttled = True
+        logger.debug("Throttling {0} stanzas from {1}".format(kind, sender))
+        self._event_queue.put(StanzaThrottledEvent(sender, kind, self.policy))
+        return result
+
+    def schedule(self, delay, function):
+        """Schedule processing of a delayed stanza.
+
+        :Parameters:
+            - `delay`: seconds to wait
+            - `function`: the function to call
+        """
+        self.main_loop.delayed_call(delay, function)
+
+XMPPSettings.add_setting(u"stanza_rate_limits", type = dict,
+        doc = u"""Incoming stanza rate limits. A mapping of stanza element
+name ("message", "presence" or "iq") to a (rate, burst) tuple: stanzas per
+second allowed from a single sender and the number of stanzas that may be
+received at once (both must be positive). Replies to our own <iq/> requests
+are never limited. No limits if not set."""
+    )
+XMPPSettings.add_setting(u"stanza_rate_limit_key", type = unicode,
+        default = u"bare",
+        cmdline_help = u"'bare' to rate limit whole accounts, 'full'"
+                                                    u" for single resources",
+        doc = u"""Sender address used to select the rate limit bucket:
+"bare" or "full" JID."""
+    )
+XMPPSettings.add_setting(u"stanza_rate_limit_policy", type = unicode,
+        default = u"drop",
+        cmdline_help = u"Action for stanzas over the rate limit: 'drop',"
+                                                    u" 'delay' or 'error'",
+        doc = u"""What to do with stanzas exceeding the rate limit: "drop"
+- ignore them, "delay" - process them later (up to
+:r:`stanza_rate_limit_max_delay setting` seconds later, drop if that is not
+enough) or "error" - respond with the 'resource-constraint' error."""
+    )
+XMPPSettings.add_setting(u"stanza_rate_limit_max_delay", type = float,
+        default = 10.0,
+        validator = XMPPSettings.validate_positive_float,
+        doc = u"""Maximum delay (in seconds) of a stanza over the rate limit
+with the "delay" :r:`stanza_rate_limit_policy setting`."""
+    )
+XMPPSettings.add_setting(u"stanza_rate_limit_buckets", type = int,
+        default = 10000,
+        validator = XMPPSettings.validate_positive_int,
+        doc = u"""Maximum number of senders tracked by the rate limiter.
+The least recently active senders are forgotten first."""
+    )
+
+# vi: sts=4 et sw=4
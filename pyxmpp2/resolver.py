@@ -17,6 +17,9 @@
 
 """DNS resolever with SRV record support.
 
+The answers are cached process-wide (see `CachingResolver`), honouring
+the record TTLs.
+
 Normative reference:
   - `RFC 1035 <http://www.ietf.org/rfc/rfc1035.txt>`__
   - `RFC 2782 <http://www.ietf.org/rfc/rfc2782.txt>`__
@@ -26,17 +29,34 @@ from __future__ import absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
+import os
 import socket
+import select
+import struct
+import errno
 import random
 import logging
 import threading
+import time
 import Queue
 
+from collections import namedtuple
+from functools import partial
+
 from .settings import XMPPSettings
 from .interfaces import Resolver
+from .mainloop.interfaces import IOHandler, HandlerReady
+from .mainloop.interfaces import TimeoutHandler, timeout_handler
+from .trace import TRACE_IO
 
 logger = logging.getLogger("pyxmpp2.resolver")
 
+BLOCKING_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+_random = random.SystemRandom()
+
+SRVRecord = namedtuple("SRVRecord", "priority weight port target")
+
 try:
     import dns.resolver     # pylint: disable=W0404
     import dns.name         # pylint: disable=W0404
@@ -68,6 +88,51 @@ def is_ipv4_available():
         return False
     return True
 
+class ResolverAnswer(list):
+    """Answer of a resolver lookup, as passed to the `Resolver` callbacks.
+
+    This is the list of the targets or addresses the plain callbacks
+    expect, with the details of the answer for the callers which need them
+    (like `CachingResolver`).
+
+    :Ivariables:
+        - `ttl`: the TTL of the answer (in seconds), `None` if not known
+        - `srv_records`: the SRV records, as received (before the
+          reordering), `None` if not an SRV answer
+        - `failed`: `True` when the answer is empty because the lookup
+          failed (e.g. timed out), not because of a negative answer
+    :Types:
+        - `ttl`: `int`
+        - `srv_records`: `list` of `SRVRecord`
+        - `failed`: `bool`
+    """
+    def __init__(self, items = (), ttl = None, srv_records = None,
+                                                            failed = False):
+        list.__init__(self, items)
+        self.ttl = ttl
+        if srv_records is not None:
+            srv_records = list(srv_records)
+        self.srv_records = srv_records
+        self.failed = failed
+
+def srv_targets(records):
+    """Reorder SRV records (see `reorder_srv`) and return the targets, as
+    passed to the `Resolver.resolve_srv` callbacks.
+
+    :Parameters:
+        - `records`: the SRV records
+    :Types:
+        - `records`: `list` of `SRVRecord`
+
+    :return: (hostname, port) pairs, only (".", 0) if the service is
+        explicitely disabled
+    :returntype: `list` of (`unicode`, `int`)"""
+    result = [(record.target, record.port) for record in reorder_srv(records)
+                                        if record.target not in (".", "")]
+    if records and not result:
+        return [(".", 0)]
+    return result
+
 def shuffle_srv(records):
     """Randomly reorder SRV records using their weights.
 
@@ -252,12 +317,13 @@ class DumbBlockingResolver(Resolver):
         except socket.gaierror, err:
             logger.warning("Couldn't resolve {0!r}: {1}".format(hostname,
                                                                         err))
-            callback([])
+            callback(ResolverAnswer(
+                                failed = err.args[0] != socket.EAI_NONAME))
             return
         except IOError as err:
             logger.warning("Couldn't resolve {0!r}, unexpected error: {1}"
                                                         .format(hostname,err))
-            callback([])
+            callback(ResolverAnswer(failed = True))
             return
         if family == socket.AF_UNSPEC:
             tmp = ret
@@ -271,6 +337,9 @@ class DumbBlockingResolver(Resolver):
 
 
 if HAVE_DNSPYTHON:
+    # exceptions meaning there is no such record
+    _NEGATIVE_ANSWERS = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+
     class BlockingResolver(Resolver):
         """Blocking resolver using the DNSPython package.
 
@@ -310,23 +379,16 @@ if HAVE_DNSPYTHON:
             except dns.exception.DNSException, err:
                 logger.warning("Could not resolve {0!r}: {1}"
                                     .format(domain, err.__class__.__name__))
-                callback([])
+                callback(ResolverAnswer(failed = not isinstance(err,
+                                                        _NEGATIVE_ANSWERS)))
                 return
             if not records:
                 callback([])
                 return
-
-            result = []
-            for record in reorder_srv(records):
-                hostname = record.target.to_text()
-                if hostname in (".", ""):
-                    continue
-                result.append((hostname, record.port))
-
-            if not result:
-                callback([(".", 0)])
-            else:
-                callback(result)
+            ttl = records.rrset.ttl
+            records = [SRVRecord(record.priority, record.weight, record.port,
+                                record.target.to_text()) for record in records]
+            callback(ResolverAnswer(srv_targets(records), ttl, records))
             return
 
         def resolve_address(self, hostname, callback, allow_cname = True):
@@ -357,6 +419,7 @@ if HAVE_DNSPYTHON:
                 rtypes.reverse()
             exception = None
             result = []
+            ttl = None
             for rtype, rfamily in rtypes:
                 try:
                     try:
@@ -374,11 +437,15 @@ if HAVE_DNSPYTHON:
                 if records:
                     for record in records:
                         result.append((rfamily, record.to_text()))
+                    if ttl is None or records.rrset.ttl < ttl:
+                        ttl = records.rrset.ttl
 
+            failed = False
             if not result and exception:
                 logger.warning("Could not resolve {0!r}: {1}".format(hostname,
                                                 exception.__class__.__name__))
-            callback(result)
+                failed = not isinstance(exception, _NEGATIVE_ANSWERS)
+            callback(ResolverAnswer(result, ttl, failed = failed))
 
     class ThreadedResolver(ThreadedResolverBase):
         """Threaded resolver implementation using the DNSPython
@@ -391,11 +458,1270 @@ if HAVE_DNSPYTHON:
 else:
     _DEFAULT_RESOLVER = DumbBlockingResolver
 
+DNS_PORT = 53
+
+_TYPE_A = 1
+_TYPE_CNAME = 5
+_TYPE_AAAA = 28
+_TYPE_SRV = 33
+_CLASS_IN = 1
+
+_FLAG_RESPONSE = 0x8000
+_FLAG_TRUNCATED = 0x0200
+_FLAG_RECURSION_DESIRED = 0x0100
+
+_RCODE_NOERROR = 0
+_RCODE_NXDOMAIN = 3
+
+def _encode_name(name):
+    """Encode a domain name in the DNS wire format.
+
+    :Parameters:
+        - `name`: the domain name
+    :Types:
+        - `name`: `unicode` or `str`
+
+    :Returntype: `str`"""
+    if isinstance(name, unicode):
+        name = name.encode("idna")
+    name = name.rstrip(".")
+    if not name:
+        return "\0"
+    result = []
+    for label in name.split("."):
+        if not label or len(label) > 63:
+            raise ValueError("Invalid domain name: {0!r}".format(name))
+        result.append(chr(len(label)) + label)
+    result.append("\0")
+    result = "".join(result)
+    if len(result) > 255:
+        raise ValueError("Domain name too long: {0!r}".format(name))
+    return result
+
+def _make_query(query_id, name, rtype):
+    """Build a DNS query packet.
+
+    :Parameters:
+        - `query_id`: the query identifier
+        - `name`: the name to look up
+        - `rtype`: the record type to look up
+    :Types:
+        - `query_id`: `int`
+        - `name`: `unicode`
+        - `rtype`: `int`
+
+    :Returntype: `str`"""
+    header = struct.pack("!HHHHHH", query_id, _FLAG_RECURSION_DESIRED,
+                                                                1, 0, 0, 0)
+    return header + _encode_name(name) + struct.pack("!HH", rtype, _CLASS_IN)
+
+def _read_name(data, offset):
+    """Decode a (possibly compressed) domain name from a DNS packet.
+
+    :Parameters:
+        - `data`: the packet
+        - `offset`: offset of the name in the packet
+    :Types:
+        - `data`: `str`
+        - `offset`: `int`
+
+    :Return: the lower-cased name (without the trailing dot) and offset
+        of the data following it
+    :Returntype: (`str`, `int`)"""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated domain name")
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            if offset + 1 >= len(data):
+                raise ValueError("Truncated domain name")
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 127:
+                raise ValueError("Domain name compression loop")
+            offset = ((length & 0x3f) << 8) | ord(data[offset + 1])
+            continue
+        elif length & 0xc0:
+            raise ValueError("Unsupported label type")
+        offset += 1
+        if not length:
+            break
+        if offset + length > len(data):
+            raise ValueError("Truncated domain name")
+        labels.append(data[offset:offset + length])
+        offset += length
+    if end is None:
+        end = offset
+    return ".".join(labels).lower(), end
+
+def _parse_rdata(data, offset, length, rtype):
+    """Decode the record data of the types we understand.
+
+    :Return: address literal (A, AAAA), name (CNAME), `SRVRecord` (SRV)
+        or `None` for other record types."""
+    if rtype == _TYPE_A:
+        if length != 4:
+            raise ValueError("Invalid A record")
+        return socket.inet_ntop(socket.AF_INET, data[offset:offset + 4])
+    elif rtype == _TYPE_AAAA:
+        if length != 16:
+            raise ValueError("Invalid AAAA record")
+        return socket.inet_ntop(socket.AF_INET6, data[offset:offset + 16])
+    elif rtype == _TYPE_CNAME:
+        return _read_name(data, offset)[0]
+    elif rtype == _TYPE_SRV:
+        if length < 7:
+            raise ValueError("Invalid SRV record")
+        priority, weight, port = struct.unpack("!HHH",
+                                                data[offset:offset + 6])
+        return SRVRecord(priority, weight, port,
+                                            _read_name(data, offset + 6)[0])
+    return None
+
+class _DNSResponse(object):
+    """A parsed DNS response.
+
+    :Ivariables:
+        - `query_id`: the query identifier
+        - `truncated`: `True` if the response was truncated
+        - `rcode`: the response code
+        - `qname`: the name looked up
+        - `qtype`: the record type looked up
+        - `answers`: the answer records of the known types
+    :Types:
+        - `query_id`: `int`
+        - `truncated`: `bool`
+        - `rcode`: `int`
+        - `qname`: `str`
+        - `qtype`: `int`
+        - `answers`: `list` of (name, type, ttl, value) tuples
+    """
+    # pylint: disable-msg=R0903
+    __slots__ = ("query_id", "truncated", "rcode", "qname", "qtype",
+                                                                "answers")
+    def __init__(self, query_id, truncated, rcode, qname, qtype, answers):
+        # pylint: disable-msg=R0913
+        self.query_id = query_id
+        self.truncated = truncated
+        self.rcode = rcode
+        self.qname = qname
+        self.qtype = qtype
+        self.answers = answers
+
+def _parse_response(data):
+    """Parse a DNS response packet.
+
+    :Parameters:
+        - `data`: the packet
+    :Types:
+        - `data`: `str`
+
+    :Raise ValueError: when the packet is malformed
+    :Returntype: `_DNSResponse`"""
+    if len(data) < 12:
+        raise ValueError("DNS packet too short")
+    query_id, flags, qdcount, ancount = struct.unpack("!HHHH", data[:8])
+    if not flags & _FLAG_RESPONSE:
+        raise ValueError("Not a DNS response")
+    offset = 12
+    qname, qtype = None, None
+    for i in range(qdcount):
+        name, offset = _read_name(data, offset)
+        if offset + 4 > len(data):
+            raise ValueError("Truncated DNS question")
+        if i == 0:
+            qname = name
+            qtype = struct.unpack("!H", data[offset:offset + 2])[0]
+        offset += 4
+    truncated = bool(flags & _FLAG_TRUNCATED)
+    answers = []
+    if not truncated:
+        for dummy in range(ancount):
+            name, offset = _read_name(data, offset)
+            if offset + 10 > len(data):
+                raise ValueError("Truncated DNS record")
+            rtype, rclass, ttl, length = struct.unpack("!HHIH",
+                                                    data[offset:offset + 10])
+            offset += 10
+            if offset + length > len(data):
+                raise ValueError("Truncated DNS record")
+            if rclass == _CLASS_IN:
+                value = _parse_rdata(data, offset, length, rtype)
+                if value is not None:
+                    answers.append((name, rtype, ttl, value))
+            offset += length
+    return _DNSResponse(query_id, truncated, flags & 0x000f, qname, qtype,
+                                                                    answers)
+
+def read_resolv_conf(path = "/etc/resolv.conf"):
+    """Read the name server addresses from the system resolver
+    configuration.
+
+    :Parameters:
+        - `path`: the configuration file path
+    :Types:
+        - `path`: `str`
+
+    :Return: the name server addresses, ``["127.0.0.1"]`` when none
+        is configured
+    :Returntype: `list` of `str`"""
+    result = []
+    try:
+        with open(path) as resolv_conf:
+            for line in resolv_conf:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    result.append(fields[1])
+    except IOError, err:
+        logger.warning("Could not read {0!r}: {1}".format(path, err))
+    if not result:
+        result = ["127.0.0.1"]
+    return result
+
+class _Query(object):
+    """A DNS query in progress.
+
+    :Ivariables:
+        - `query_id`: the query identifier
+        - `name`: the name looked up (lower-case, without the trailing dot)
+        - `rtype`: the record type looked up
+        - `packet`: the query packet
+        - `handler`: function to call with the `_DNSResponse` or `None`
+          on failure
+        - `deadline`: when the current attempt times out
+        - `attempt`: the attempt number (counted from 0)
+        - `tcp`: the TCP connection used for the query, if any
+    """
+    # pylint: disable-msg=R0903
+    __slots__ = ("query_id", "name", "rtype", "packet", "handler",
+                                            "deadline", "attempt", "tcp")
+    def __init__(self, query_id, name, rtype, handler, deadline):
+        # pylint: disable-msg=R0913
+        self.query_id = query_id
+        self.name = name
+        self.rtype = rtype
+        self.packet = _make_query(query_id, name, rtype)
+        self.handler = handler
+        self.deadline = deadline
+        self.attempt = 0
+        self.tcp = None
+
+class _AddressLookup(object):
+    """An `AsyncResolver.resolve_address` request in progress.
+
+    :Ivariables:
+        - `hostname`: the name looked up
+        - `callback`: the user callback
+        - `allow_cname`: `True` if CNAMEs should be followed
+        - `rtypes`: (record type, address family) pairs to look up,
+          in the order of preference
+        - `results`: record type -> (addresses, ttl) for the finished
+          queries
+        - `failed`: `True` if any of the queries failed (not with
+          a negative answer)
+    """
+    # pylint: disable-msg=R0903
+    __slots__ = ("hostname", "callback", "allow_cname", "rtypes", "results",
+                                                                    "failed")
+    def __init__(self, hostname, callback, allow_cname, rtypes):
+        self.hostname = hostname
+        self.callback = callback
+        self.allow_cname = allow_cname
+        self.rtypes = rtypes
+        self.results = {}
+        self.failed = False
+
+class _TCPQuery(IOHandler):
+    """TCP connection used to repeat a DNS query which response
+    was truncated.
+
+    :Ivariables:
+        - `resolver`: the resolver
+        - `query`: the query
+        - `_socket`: the socket
+        - `_out`: data to send
+        - `_in`: data received
+        - `_done`: `True` when the query has been finished
+    """
+    def __init__(self, resolver, query, server):
+        self.resolver = resolver
+        self.query = query
+        self._socket = socket.socket(server[0], socket.SOCK_STREAM)
+        self._socket.setblocking(False)
+        self._socket.connect_ex(server[1])
+        self._out = struct.pack("!H", len(query.packet)) + query.packet
+        self._in = ""
+        self._done = False
+
+    def __repr__(self):
+        return "<_TCPQuery {0!r}>".format(self.query.name)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def prepare(self):
+        return HandlerReady()
+
+    def is_readable(self):
+        return not self._done and not self._out
+
+    def is_writable(self):
+        return not self._done and bool(self._out)
+
+    def wait_for_readability(self):
+        while self.is_readable():
+            readable = select.select([self._socket], [], [], 1)[0]
+            if readable:
+                return True
+        return False
+
+    def wait_for_writability(self):
+        while self.is_writable():
+            writable = select.select([], [self._socket], [], 1)[1]
+            if writable:
+                return True
+        return False
+
+    def handle_write(self):
+        try:
+            sent = self._socket.send(self._out)
+        except socket.error, err:
+            if err.args[0] in BLOCKING_ERRORS:
+                return
+            self.fail(err)
+            return
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        try:
+            data = self._socket.recv(65537 - len(self._in))
+        except socket.error, err:
+            if err.args[0] in BLOCKING_ERRORS:
+                return
+            self.fail(err)
+            return
+        if not data:
+            self.fail("connection closed")
+            return
+        self._in += data
+        if len(self._in) < 2:
+            return
+        length = struct.unpack("!H", self._in[:2])[0]
+        if len(self._in) < length + 2:
+            return
+        self.finish()
+        self.resolver._process_response(self._in[2:length + 2], None)
+
+    def handle_hup(self):
+        self.fail("connection closed")
+
+    def handle_err(self):
+        self.fail("connection error")
+
+    def handle_nval(self):
+        self.fail("invalid file descriptor")
+
+    def fail(self, reason):
+        """Abort the query, the resolver will retry it."""
+        if self._done:
+            return
+        logger.debug("TCP DNS query for {0!r} failed: {1}"
+                                            .format(self.query.name, reason))
+        self.finish()
+        self.resolver._tcp_failed(self.query)
+
+    def finish(self):
+        """Stop handling the I/O and schedule the connection close.
+
+        The handler cannot be removed from the main loop while its I/O
+        event is being handled, so that is done in the next loop iteration.
+        """
+        if self._done:
+            return
+        self._done = True
+        self.resolver.main_loop.delayed_call(0, self.close)
+
+    def close(self):
+        self._done = True
+        self.resolver.main_loop.remove_handler(self)
+        self._socket.close()
+
+class AsyncResolver(IOHandler, TimeoutHandler, Resolver):
+    """Asynchronous resolver working in the main loop.
+
+    The DNS queries are sent over a single non-blocking UDP socket
+    and the responses are handled (and the callbacks called) by the main
+    loop thread, so no threads or locks are needed per lookup. Truncated
+    responses are repeated over TCP. No additional packages are required.
+
+    A query not answered in 'dns_timeout' seconds is repeated, using
+    the next name server, up to 'dns_attempts' times.
+
+    The resolver adds itself to the main loop. To be used by the streams
+    it must be set as the 'dns_resolver' setting (directly or wrapped in
+    a `CachingResolver`).
+
+    :Ivariables:
+        - `main_loop`: the main loop
+        - `settings`: the settings
+        - `nameservers`: (family, socket address) of the name servers
+        - `_socket`: the UDP socket
+        - `_queries`: the queries in progress
+        - `_lock`: lock protecting `_queries`
+    :Types:
+        - `main_loop`: `mainloop.interfaces.MainLoop`
+        - `settings`: `XMPPSettings`
+        - `nameservers`: `list` of (`int`, `tuple`)
+        - `_socket`: :std:`socket.socket`
+        - `_queries`: `dict` of `int` -> `_Query`
+        - `_lock`: :std:`threading.RLock`
+    """
+    def __init__(self, main_loop, settings = None, nameservers = None):
+        """Initialize the resolver and add it to the main loop.
+
+        :Parameters:
+            - `main_loop`: the main loop
+            - `settings`: the settings
+            - `nameservers`: the name server addresses or (address, port)
+              pairs. By default the name servers from ``/etc/resolv.conf``
+              are used.
+        :Types:
+            - `main_loop`: `mainloop.interfaces.MainLoop`
+            - `settings`: `XMPPSettings`
+            - `nameservers`: `list`
+        """
+        if settings:
+            self.settings = settings
+        else:
+            self.settings = XMPPSettings()
+        if nameservers is None:
+            nameservers = read_resolv_conf()
+        self.nameservers = []
+        for server in nameservers:
+            if isinstance(server, basestring):
+                server = (server, DNS_PORT)
+            try:
+                addrinfo = socket.getaddrinfo(server[0], server[1],
+                            socket.AF_UNSPEC, socket.SOCK_DGRAM, 0,
+                            socket.AI_NUMERICHOST)[0]
+            except socket.gaierror, err:
+                logger.warning("Invalid name server address {0!r}: {1}"
+                                                    .format(server[0], err))
+                continue
+            if self.nameservers and addrinfo[0] != self.nameservers[0][0]:
+                logger.warning("Ignoring name server {0!r}: address family"
+                                " differs from the first one's"
+                                                        .format(server[0]))
+                continue
+            self.nameservers.append((addrinfo[0], addrinfo[4]))
+        if not self.nameservers:
+            raise ValueError("No usable name server address given")
+        self._socket = socket.socket(self.nameservers[0][0],
+                                                        socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._queries = {}
+        self._lock = threading.RLock()
+        self.main_loop = main_loop
+        main_loop.add_handler(self)
+
+    def __repr__(self):
+        return "<AsyncResolver {0!r}>".format(
+                            [server[1][0] for server in self.nameservers])
+
+    def resolve_srv(self, domain, service, protocol, callback):
+        """Start looking up an SRV record for `service` at `domain`.
+
+        `callback` will be called, from the main loop, with a properly sorted
+        list of (hostname, port) pairs on success. The list will be empty on
+        error and it will contain only (".", 0) when the service is
+        explicitely disabled.
+
+        :Parameters:
+            - `domain`: domain name to look up
+            - `service`: service name e.g. 'xmpp-client'
+            - `protocol`: protocol name, e.g. 'tcp'
+            - `callback`: a function to be called with a list of received
+              addresses
+        :Types:
+            - `domain`: `unicode`
+            - `service`: `unicode`
+            - `protocol`: `unicode`
+            - `callback`: function accepting a single argument
+        """
+        if isinstance(domain, unicode):
+            domain = domain.encode("idna")
+        name = "_{0}._{1}.{2}".format(service, protocol, domain)
+        self._start_query(name, _TYPE_SRV,
+                                    partial(self._got_srv, name, callback))
+
+    def _got_srv(self, name, callback, response):
+        """Handle the SRV query response."""
+        if response is None or response.rcode != _RCODE_NOERROR:
+            logger.warning("Could not resolve {0!r}".format(name))
+            callback(ResolverAnswer(failed = response is None
+                                    or response.rcode != _RCODE_NXDOMAIN))
+            return
+        records = [(value, ttl) for owner, rtype, ttl, value
+                                in response.answers if rtype == _TYPE_SRV]
+        if not records:
+            callback([])
+            return
+        ttl = min(ttl for dummy, ttl in records)
+        records = [record for record, dummy in records]
+        callback(ResolverAnswer(srv_targets(records), ttl, records))
+
+    def resolve_address(self, hostname, callback, allow_cname = True):
+        """Start looking up an A or AAAA record.
+
+        `callback` will be called, from the main loop, with a list of
+        (family, address) tuples (each holiding socket.AF_* and IPv4 or IPv6
+        address literal) on success. The list will be empty on error.
+
+        :Parameters:
+            - `hostname`: the host name to look up
+            - `callback`: a function to be called with a list of received
+              addresses
+            - `allow_cname`: `True` if CNAMEs should be followed
+        :Types:
+            - `hostname`: `unicode`
+            - `callback`: function accepting a single argument
+            - `allow_cname`: `bool`
+        """
+        try:
+            addrinfo = socket.getaddrinfo(hostname, 0, socket.AF_UNSPEC,
+                        socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)[0]
+        except socket.gaierror:
+            pass
+        else:
+            callback([(addrinfo[0], addrinfo[4][0])])
+            return
+        rtypes = []
+        if self.settings["ipv6"]:
+            rtypes.append((_TYPE_AAAA, socket.AF_INET6))
+        if self.settings["ipv4"]:
+            rtypes.append((_TYPE_A, socket.AF_INET))
+        if not self.settings["prefer_ipv6"]:
+            rtypes.reverse()
+        if not rtypes:
+            logger.warning("Neither IPv6 or IPv4 allowed.")
+            callback([])
+            return
+        if isinstance(hostname, unicode):
+            hostname = hostname.encode("idna")
+        lookup = _AddressLookup(hostname, callback, allow_cname, rtypes)
+        for rtype, dummy in rtypes:
+            self._start_query(hostname, rtype,
+                                partial(self._got_address, lookup, rtype))
+
+    def _got_address(self, lookup, rtype, response):
+        """Handle the A or AAAA query response and call the callback when
+        all the queries for the `lookup` are finished."""
+        if response is None or response.rcode != _RCODE_NOERROR:
+            lookup.results[rtype] = ([], None)
+            if response is None or response.rcode != _RCODE_NXDOMAIN:
+                lookup.failed = True
+        else:
+            lookup.results[rtype] = self._extract_addresses(lookup, response)
+        if len(lookup.results) < len(lookup.rtypes):
+            return
+        result = []
+        ttls = []
+        for rtype, family in lookup.rtypes:
+            addresses, ttl = lookup.results[rtype]
+            result += [(family, address) for address in addresses]
+            if ttl is not None:
+                ttls.append(ttl)
+        if result:
+            lookup.callback(ResolverAnswer(result, min(ttls)))
+        else:
+            logger.warning("Could not resolve {0!r}".format(lookup.hostname))
+            lookup.callback(ResolverAnswer(failed = lookup.failed))
+
+    @staticmethod
+    def _extract_addresses(lookup, response):
+        """Get the addresses for `lookup` from the `response`, following
+        the CNAMEs if allowed.
+
+        :Return: the addresses and the minimum TTL of the records used
+        :Returntype: (`list` of `str`, `int`)"""
+        names = set([response.qname])
+        cnames = dict((owner, (value, ttl))
+                            for owner, rtype, ttl, value in response.answers
+                                                    if rtype == _TYPE_CNAME)
+        ttls = []
+        name = response.qname
+        while name in cnames:
+            if not lookup.allow_cname:
+                logger.warning("Unexpected CNAME record found for {0!r}"
+                                                    .format(lookup.hostname))
+                return [], None
+            name, ttl = cnames.pop(name)
+            names.add(name)
+            ttls.append(ttl)
+        addresses = []
+        for owner, rtype, ttl, value in response.answers:
+            if rtype == response.qtype and owner in names:
+                addresses.append(value)
+                ttls.append(ttl)
+        if not addresses:
+            return [], None
+        return addresses, min(ttls)
+
+    def _start_query(self, name, rtype, handler):
+        """Send a new DNS query.
+
+        :Parameters:
+            - `name`: the name to look up
+            - `rtype`: the record type
+            - `handler`: function to be called with the `_DNSResponse`
+              or `None` on failure
+        """
+        deadline = time.time() + self.settings["dns_timeout"]
+        try:
+            with self._lock:
+                query_id = _random.randrange(65536)
+                while query_id in self._queries:
+                    query_id = _random.randrange(65536)
+                query = _Query(query_id, name.rstrip(".").lower(), rtype,
+                                                            handler, deadline)
+                self._queries[query_id] = query
+        except ValueError, err:
+            logger.warning("Could not resolve {0!r}: {1}".format(name, err))
+            handler(None)
+            return
+        self._send(query)
+
+    def _send(self, query):
+        """Send the query over UDP to the name server for the current
+        attempt."""
+        server = self.nameservers[query.attempt % len(self.nameservers)][1]
+        TRACE_IO("Sending DNS query {0!r}/{1} to {2!r}", query.name,
+                                                        query.rtype, server)
+        try:
+            self._socket.sendto(query.packet, server)
+        except socket.error, err:
+            # will be retried on timeout
+            logger.debug("Could not send DNS query to {0!r}: {1}"
+                                                        .format(server, err))
+
+    def _process_response(self, data, sender):
+        """Handle a DNS response packet.
+
+        :Parameters:
+            - `data`: the packet
+            - `sender`: the source address of an UDP packet, `None` for
+              a response received over TCP
+        """
+        try:
+            response = _parse_response(data)
+        except (ValueError, struct.error, socket.error), err:
+            logger.debug("Invalid DNS response from {0!r}: {1}"
+                                                        .format(sender, err))
+            return
+        start_tcp = None
+        with self._lock:
+            query = self._queries.get(response.query_id)
+            if (query is None or response.qname != query.name
+                                        or response.qtype != query.rtype):
+                return
+            if sender is not None:
+                family, server = self.nameservers[
+                                        query.attempt % len(self.nameservers)]
+                if sender[:2] != server[:2]:
+                    return
+            if response.truncated:
+                if sender is None or query.tcp:
+                    return
+                query.tcp = _TCPQuery(self, query, (family, server))
+                start_tcp = query.tcp
+            elif (response.rcode not in (_RCODE_NOERROR, _RCODE_NXDOMAIN)
+                    and query.attempt + 1 < self.settings["dns_attempts"]):
+                self._next_attempt(query)
+                retry = query
+            else:
+                del self._queries[query.query_id]
+                retry = None
+        if start_tcp:
+            self.main_loop.add_handler(start_tcp)
+        elif retry:
+            self._send(retry)
+        else:
+            query.handler(response)
+
+    def _next_attempt(self, query):
+        """Prepare a query to be sent again.
+
+        [called with `_lock` acquired]"""
+        query.attempt += 1
+        query.deadline = time.time() + self.settings["dns_timeout"]
+        if query.tcp:
+            query.tcp.finish()
+            query.tcp = None
+
+    def _tcp_failed(self, query):
+        """Make the query time out now, after its TCP connection failed."""
+        with self._lock:
+            if query.tcp:
+                query.tcp = None
+                query.deadline = time.time()
+
+    @timeout_handler(1, None)
+    def _check_timeouts(self):
+        """Repeat or fail the queries which have not been answered in time.
+
+        :Return: the time until the next check
+        """
+        now = time.time()
+        retry = []
+        failed = []
+        with self._lock:
+            attempts = self.settings["dns_attempts"]
+            for query in self._queries.values():
+                if query.deadline > now:
+                    continue
+                if query.attempt + 1 < attempts:
+                    self._next_attempt(query)
+                    retry.append(query)
+                else:
+                    if query.tcp:
+                        query.tcp.finish()
+                    del self._queries[query.query_id]
+                    failed.append(query)
+            if self._queries:
+                next_check = min(query.deadline
+                                    for query in self._queries.values()) - now
+            else:
+                next_check = self.settings["dns_timeout"]
+        for query in retry:
+            TRACE_IO("DNS query {0!r}/{1} timed out, retrying", query.name,
+                                                                query.rtype)
+            self._send(query)
+        for query in failed:
+            logger.debug("DNS query {0!r}/{1} timed out".format(query.name,
+                                                                query.rtype))
+            query.handler(None)
+        return min(max(next_check, 0.01), 1)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def prepare(self):
+        return HandlerReady()
+
+    def is_readable(self):
+        return True
+
+    def is_writable(self):
+        return False
+
+    def wait_for_readability(self):
+        while True:
+            readable = select.select([self._socket], [], [], 1)[0]
+            if readable:
+                return True
+
+    def wait_for_writability(self):
+        return False
+
+    def handle_read(self):
+        while True:
+            try:
+                data, sender = self._socket.recvfrom(65535)
+            except socket.error, err:
+                if err.args[0] not in BLOCKING_ERRORS:
+                    logger.debug("DNS socket error: {0}".format(err))
+                return
+            self._process_response(data, sender)
+
+    def handle_write(self):
+        pass
+
+    def handle_hup(self):
+        pass
+
+    def handle_err(self):
+        # clear the pending socket error (e.g. ICMP port unreachable)
+        err = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        logger.debug("DNS socket error: {0}".format(os.strerror(err)))
+
+    def handle_nval(self):
+        pass
+
+    def close(self):
+        """Close the resolver sockets and remove it from the main loop.
+
+        The lookups in progress are abandoned."""
+        with self._lock:
+            queries = self._queries.values()
+            self._queries = {}
+        for query in queries:
+            if query.tcp:
+                query.tcp.close()
+        self.main_loop.remove_handler(self)
+        self._socket.close()
+
+class _DNSCacheEntry(object):
+    """A `DNSCache` entry.
+
+    :Ivariables:
+        - `result`: the cached answer
+        - `ttl`: the time to live of the answer (in seconds)
+        - `expire`: the time when the entry expires (as returned by
+          :std:`time.time`)
+        - `prefetching`: `True` when the entry is being refreshed
+    """
+    # pylint: disable-msg=R0903
+    __slots__ = ("result", "ttl", "expire", "prefetching")
+    def __init__(self, result, ttl, now):
+        self.result = result
+        self.ttl = ttl
+        self.expire = now + ttl
+        self.prefetching = False
+
+class DNSCache(object):
+    """DNS answer cache.
+
+    Stores the answers of the `CachingResolver` lookups until their TTL
+    passes and keeps track of the lookups in progress, so concurrent
+    requests for the same name wait for a single lookup.
+
+    A lookup in progress may be given a timeout. When it passes without an
+    answer, the requests waiting for it get an empty, failed answer and
+    the next request starts a new lookup. The timeouts are handled by
+    a thread running only while there are such lookups.
+
+    A single process-wide instance (`DNS_CACHE`) is shared by all the
+    `CachingResolver` objects, unless told otherwise.
+
+    :Ivariables:
+        - `max_entries`: maximum number of cached answers
+        - `_entries`: the cached answers
+        - `_pending`: the lookups in progress: their deadlines and the
+          callbacks waiting for them
+        - `_lock`: the lock protecting the cache
+        - `_cond`: condition variable to wake up `_reaper` on
+        - `_reaper`: the thread failing the lookups which timed out
+    :Types:
+        - `max_entries`: `int`
+        - `_entries`: `dict` of `tuple` -> `_DNSCacheEntry`
+        - `_pending`: `dict` of `tuple` -> (`float`, `list` of callables)
+        - `_lock`: :std:`threading.Lock`
+        - `_cond`: :std:`threading.Condition`
+        - `_reaper`: :std:`threading.Thread`
+    """
+    def __init__(self, max_entries = 1000):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._reaper = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all the cached answers."""
+        with self._lock:
+            self._entries.clear()
+
+    def lookup(self, key, callback, prefetch_fraction = 0.0, timeout = None):
+        """Look up an answer in the cache.
+
+        If the answer is not cached, `callback` is registered to receive
+        the result of the lookup for `key`.
+
+        :Parameters:
+            - `key`: the lookup key
+            - `callback`: the function to be called with the answer
+            - `prefetch_fraction`: the remaining part of the TTL below which
+              the answer should be refreshed
+            - `timeout`: time (in seconds) to wait for the answer, when
+              a new lookup is to be started, `None` for no limit
+        :Types:
+            - `key`: `tuple`
+            - `callback`: callable
+            - `prefetch_fraction`: `float`
+            - `timeout`: `float`
+
+        :Return: (status, result) tuple, where `status` is "hit" (`result`
+            is the cached answer), "prefetch" (as "hit", but the caller
+            should refresh the entry), "pending" (the lookup is in progress
+            and the `callback` will be called with its result) or "miss"
+            (the caller should start the lookup and pass its result to
+            `store`)
+        :Returntype: (`str`, `list`)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expire > now:
+                    if (prefetch_fraction and not entry.prefetching
+                            and entry.expire - now
+                                        < entry.ttl * prefetch_fraction):
+                        entry.prefetching = True
+                        return "prefetch", entry.result
+                    return "hit", entry.result
+                del self._entries[key]
+            if key in self._pending:
+                self._pending[key][1].append(callback)
+                return "pending", None
+            if timeout is None:
+                deadline = None
+            else:
+                deadline = now + timeout
+                self._start_reaper()
+            self._pending[key] = (deadline, [callback])
+            return "miss", None
+
+    def store(self, key, result, ttl):
+        """Store a lookup result and pass it to the waiting callbacks.
+
+        :Parameters:
+            - `key`: the lookup key
+            - `result`: the answer
+            - `ttl`: the time to live of the answer (in seconds), 0 if
+              the answer must not be cached
+        :Types:
+            - `key`: `tuple`
+            - `result`: `list`
+            - `ttl`: `float`
+        """
+        now = time.time()
+        with self._lock:
+            if ttl > 0:
+                if key not in self._entries and (
+                                    len(self._entries) >= self.max_entries):
+                    self._purge(now)
+                self._entries[key] = _DNSCacheEntry(result, ttl, now)
+            else:
+                self._entries.pop(key, None)
+            dummy, callbacks = self._pending.pop(key, (None, []))
+        for callback in callbacks:
+            callback(list(result))
+
+    def cancel(self, key):
+        """Cancel a lookup which could not be started.
+
+        The other callbacks waiting for it are called with an empty answer.
+
+        :Parameters:
+            - `key`: the lookup key
+        :Types:
+            - `key`: `tuple`
+        """
+        with self._lock:
+            dummy, callbacks = self._pending.pop(key, (None, []))
+        for callback in callbacks[1:]:
+            callback([])
+
+    def prefetch_failed(self, key):
+        """Keep the cached answer when its refresh failed.
+
+        It will be refreshed again on the next request.
+
+        :Parameters:
+            - `key`: the lookup key
+        :Types:
+            - `key`: `tuple`
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.prefetching = False
+
+    def _start_reaper(self):
+        """Start the `_reaper` thread, unless already running, or wake it
+        up to check the deadline of a new lookup.
+
+        [called with `_lock` acquired]
+        """
+        if self._reaper is not None:
+            self._cond.notify()
+            return
+        self._reaper = threading.Thread(target = self._reap,
+                                                name = "DNS cache reaper")
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def _reap(self):
+        """The `_reaper` thread function: fail the lookups which timed out.
+
+        Exits when there are no more lookups with a timeout in progress.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                expired = [key for key, (deadline, dummy)
+                                    in self._pending.iteritems()
+                                    if deadline is not None and deadline <= now]
+                callbacks = []
+                for key in expired:
+                    callbacks += self._pending.pop(key)[1]
+                if not callbacks:
+                    deadlines = [deadline for deadline, dummy
+                                                in self._pending.itervalues()
+                                                if deadline is not None]
+                    if not deadlines:
+                        self._reaper = None
+                        return
+                    self._cond.wait(min(deadlines) - now)
+                    continue
+            for key in expired:
+                logger.warning("DNS lookup timed out: {0!r}".format(key))
+            for callback in callbacks:
+                try:
+                    callback(ResolverAnswer(failed = True))
+                except Exception: # pylint: disable=W0703
+                    logger.exception("Exception in a DNS callback")
+
+    def _purge(self, now):
+        """Remove the expired entries and, if still needed, those expiring
+        first, to make place for a new one.
+
+        [called with `_lock` acquired]
+        """
+        for key, entry in self._entries.items():
+            if entry.expire <= now:
+                del self._entries[key]
+        excess = len(self._entries) - self.max_entries + 1
+        if excess > 0:
+            by_expiry = sorted(self._entries.iteritems(),
+                                            key = lambda x: x[1].expire)
+            for key, dummy in by_expiry[:excess]:
+                del self._entries[key]
+
+DNS_CACHE = DNSCache()
+
+class _CacheFiller(object):
+    """Callback passed to the resolver wrapped by `CachingResolver`,
+    storing the answer in the cache.
+
+    The TTL, the SRV records and the failure flag are taken from the
+    answer, when it is a `ResolverAnswer`.
+    """
+    # pylint: disable-msg=R0903
+    __slots__ = ("resolver", "key", "prefetch")
+    def __init__(self, resolver, key, prefetch):
+        self.resolver = resolver
+        self.key = key
+        self.prefetch = prefetch
+
+    def __call__(self, result):
+        if isinstance(result, ResolverAnswer):
+            ttl, srv_records, failed = (result.ttl, result.srv_records,
+                                                                result.failed)
+        else:
+            ttl, srv_records, failed = None, None, False
+        cache = self.resolver.cache
+        if self.prefetch and (failed or not result):
+            cache.prefetch_failed(self.key)
+        elif failed:
+            # pass the empty answer to the waiting callbacks, do not cache it
+            cache.store(self.key, result, 0)
+        else:
+            if srv_records is not None:
+                result = srv_records
+            cache.store(self.key, result, self.resolver.clamp_ttl(result, ttl))
+
+def _cached_srv_targets(result):
+    """Make the SRV lookup answer from the cached data: the SRV records or,
+    when the wrapped resolver does not report them, the targets."""
+    if result and isinstance(result[0], SRVRecord):
+        return srv_targets(result)
+    return result
+
+class CachingResolver(Resolver):
+    """Resolver caching the answers of another resolver.
+
+    The answers are kept for their TTL, clamped to the 'dns_cache_min_ttl'
+    .. 'dns_cache_max_ttl' range. When the wrapped resolver does not report
+    the TTL (e.g. `DumbBlockingResolver`) 'dns_cache_default_ttl' is used.
+    Empty (negative) answers are kept for 'dns_cache_negative_ttl'.
+
+    Lookup failures (e.g. timeouts, as opposed to negative answers) are
+    not cached.
+
+    The SRV records are cached as received and reordered by their weights
+    on each request (see `srv_targets`), so the load is still distributed
+    between the targets.
+
+    Concurrent lookups of the same name are coalesced into a single lookup
+    of the wrapped resolver. When it does not answer within
+    'dns_lookup_timeout', the requests get an empty answer.
+
+    When 'dns_cache_prefetch' is set, an answer requested during the last
+    10% of its TTL is returned from the cache and refreshed in the
+    background, so frequently used names never expire.
+
+    :Ivariables:
+        - `resolver`: the wrapped resolver
+        - `settings`: the settings
+        - `cache`: the answer cache
+    :Types:
+        - `resolver`: `Resolver`
+        - `settings`: `XMPPSettings`
+        - `cache`: `DNSCache`
+    """
+    prefetch_fraction = 0.1
+    def __init__(self, resolver = None, settings = None, cache = None):
+        """Initialize the resolver.
+
+        :Parameters:
+            - `resolver`: the resolver to wrap, by default a new
+              `BlockingResolver` or `DumbBlockingResolver`
+            - `settings`: the settings
+            - `cache`: the answer cache, by default the process-wide
+              `DNS_CACHE`
+        :Types:
+            - `resolver`: `Resolver`
+            - `settings`: `XMPPSettings`
+            - `cache`: `DNSCache`
+        """
+        if settings:
+            self.settings = settings
+        else:
+            self.settings = XMPPSettings()
+        if resolver is None:
+            resolver = _DEFAULT_RESOLVER(self.settings)
+        self.resolver = resolver
+        if cache is None:
+            cache = DNS_CACHE
+        self.cache = cache
+
+    def clamp_ttl(self, result, ttl):
+        """Compute the caching period for an answer.
+
+        :Parameters:
+            - `result`: the answer
+            - `ttl`: the TTL reported by the resolver or `None`
+        :Types:
+            - `result`: `list`
+            - `ttl`: `int`
+
+        :Returntype: `float`"""
+        if not result:
+            return self.settings["dns_cache_negative_ttl"]
+        if ttl is None:
+            ttl = self.settings["dns_cache_default_ttl"]
+        ttl = max(ttl, self.settings["dns_cache_min_ttl"])
+        return min(ttl, self.settings["dns_cache_max_ttl"])
+
+    def _lookup(self, key, callback, convert, method, *args):
+        """Return the cached answer or start the lookup.
+
+        :Parameters:
+            - `key`: the cache key
+            - `callback`: the function to be called with the answer
+            - `convert`: function to make the answer from the cached data
+              or `None`
+            - `method`: the wrapped resolver method to call on cache miss
+            - `args`: arguments for the `method`, before the callback
+        """
+        if self.settings["dns_cache_prefetch"]:
+            prefetch_fraction = self.prefetch_fraction
+        else:
+            prefetch_fraction = 0.0
+        if convert is not None:
+            user_callback = callback
+            callback = lambda result: user_callback(convert(result))
+        status, result = self.cache.lookup(key, callback, prefetch_fraction,
+                                        self.settings["dns_lookup_timeout"])
+        if status == "pending":
+            return
+        if status != "miss":
+            callback(list(result))
+            if status == "hit":
+                return
+        filler = _CacheFiller(self, key, status == "prefetch")
+        try:
+            method(*(args + (filler,)))
+        except Exception:
+            if status == "prefetch":
+                self.cache.prefetch_failed(key)
+            else:
+                self.cache.cancel(key)
+            raise
+
+    def resolve_srv(self, domain, service, protocol, callback):
+        key = ("srv", domain.lower(), service, protocol)
+        self._lookup(key, callback, _cached_srv_targets,
+                        self.resolver.resolve_srv, domain, service, protocol)
+
+    def resolve_address(self, hostname, callback, allow_cname = True):
+        settings = self.settings
+        key = ("address", hostname.lower(), allow_cname, settings["ipv4"],
+                                settings["ipv6"], settings["prefer_ipv6"])
+        self._lookup(key, callback, None, self._resolve_address, hostname,
+                                                                allow_cname)
+
+    def _resolve_address(self, hostname, allow_cname, callback):
+        """Call the `resolver.resolve_address` with the arguments reordered
+        for `_lookup`."""
+        self.resolver.resolve_address(hostname, callback, allow_cname)
+
+def _default_resolver(settings):
+    """Create the default resolver: `_DEFAULT_RESOLVER`, wrapped in
+    a `CachingResolver` unless 'dns_cache' is disabled."""
+    resolver = _DEFAULT_RESOLVER(settings)
+    if settings["dns_cache"]:
+        resolver = CachingResolver(resolver, settings)
+    return resolver
+
 XMPPSettings.add_setting(u"dns_resolver", type = Resolver,
-        factory = _DEFAULT_RESOLVER,
-        default_d = "A `{0}` instance".format(_DEFAULT_RESOLVER.__name__),
+        factory = _default_resolver,
+        default_d = "A `{0}` instance, wrapped in `CachingResolver`"
+                        " unless 'dns_cache' is `False`"
+                                        .format(_DEFAULT_RESOLVER.__name__),
         doc = u"""The DNS resolver implementation to be used by PyXMPP."""
     )
+XMPPSettings.add_setting(u"dns_timeout", type = float, default = 2.0,
+        validator = XMPPSettings.validate_positive_float,
+        doc = u"""Time (in seconds) `AsyncResolver` waits for a DNS
+response before the query is repeated."""
+    )
+XMPPSettings.add_setting(u"dns_attempts", type = int, default = 3,
+        validator = XMPPSettings.get_int_range_validator(1, 100),
+        doc = u"""Number of times `AsyncResolver` sends a DNS query before
+it gives up."""
+    )
+XMPPSettings.add_setting(u"dns_cache", type = bool, default = True,
+        doc = u"""Cache the DNS answers in the process-wide cache (used
+by the default 'dns_resolver')."""
+    )
+XMPPSettings.add_setting(u"dns_cache_min_ttl", type = float, default = 30.0,
+        doc = u"""Minimum time (in seconds) a DNS answer is cached for,
+regardless of its TTL."""
+    )
+XMPPSettings.add_setting(u"dns_cache_max_ttl", type = float,
+        default = 86400.0,
+        doc = u"""Maximum time (in seconds) a DNS answer is cached for,
+regardless of its TTL."""
+    )
+XMPPSettings.add_setting(u"dns_cache_default_ttl", type = float,
+        default = 300.0,
+        doc = u"""Time (in seconds) a DNS answer is cached for, when
+the resolver does not provide its TTL."""
+    )
+XMPPSettings.add_setting(u"dns_cache_negative_ttl", type = float,
+        default = 60.0,
+        doc = u"""Time (in seconds) a failed DNS lookup is remembered for."""
+    )
+XMPPSettings.add_setting(u"dns_lookup_timeout", type = float, default = 30.0,
+        validator = XMPPSettings.validate_positive_float,
+        doc = u"""Time (in seconds) `CachingResolver` waits for the answer of
+the wrapped resolver. Then the requests waiting for it get an empty answer and
+the next request starts a new lookup."""
+    )
+XMPPSettings.add_setting(u"dns_cache_prefetch", type = bool, default = False,
+        doc = u"""Refresh cached DNS answers requested shortly before their
+expiration, so the frequently used answers never expire."""
+    )
 XMPPSettings.add_setting(u"ipv4", type = bool, default = True,
         cmdline_help = "Allow IPv4 address lookup",
         doc = u"""Look up IPv4 addresses for a server host name."""
@@ -189,23 +189,27 @@ class RosterItem(object):
         self._duplicate_group = False
 
     @classmethod
-    def from_xml(cls, element):
+    def from_xml(cls, element, jid = None):
         """Make a RosterItem from an XML element.
 
         :Parameters:
             - `element`: the XML element
+            - `jid`: the item JID, already parsed from the 'jid' attribute
+              of `element` (e.g. with `JID.parse_many`)
         :Types:
             - `element`: :etree:`ElementTree.Element`
+            - `jid`: `JID`
 
         :return: a freshly created roster item
         :returntype: `cls`
         """
         if element.tag != ITEM_TAG:
             raise ValueError("{0!r} is not a roster item".format(element))
-        try:
-            jid = JID(element.get("jid"))
-        except ValueError:
-            raise BadRequestProtocolError(u"Bad item JID")
+        if jid is None:
+            try:
+                jid = JID(element.get("jid"))
+            except ValueError:
+                raise BadRequestProtocolError(u"Bad item JID")
         subscription = element.get("subscription")
         ask = element.get("ask")
         name = element.get("name")
@@ -420,11 +424,18 @@ class RosterPayload(StanzaPayload, Sequence):
         if element.tag != QUERY_TAG:
             raise ValueError("{0!r} is not a roster item".format(element))
         version = element.get("ver")
+        children = []
         for child in element:
             if child.tag != ITEM_TAG:
                 logger.debug("Unknown element in roster: {0!r}".format(child))
                 continue
-            item = RosterItem.from_xml(child)
+            children.append(child)
+        try:
+            item_jids = JID.parse_many(child.get("jid") for child in children)
+        except ValueError:
+            raise BadRequestProtocolError(u"Bad item JID")
+        for child, jid in zip(children, item_jids):
+            item = RosterItem.from_xml(child, jid)
             if item.jid in jids:
                 logger.warning("Duplicate jid in roster: {0!r}".format(
                                                                     item.jid))
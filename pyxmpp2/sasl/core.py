@@ -42,7 +42,7 @@ mechanism-dependant, but these are the usually expected properties:
       mechanisms.
     * ``"authzid"`` - authorization id. Optional for most mechanisms.
     * ``"security-layer"`` - security layer if any. ``"TLS"`` when TLS is in
-      use.
+      use, ``"unix"`` on a Unix domain socket connection.
     * ``"channel-binding"`` - mapping of 'channel binding type' to 'channel
       binding date' if available on the channel
     * ``"service-type"`` - service type as required by the DIGEST-MD5 protocol
@@ -51,6 +51,8 @@ mechanism-dependant, but these are the usually expected properties:
     * ``"service-hostname"`` - service host name (the 'host' par of diges-uri
       of DIGEST-MD5)
     * ``"remote-ip"`` - remote IP address
+    * ``"peer-credentials"`` - (pid, uid, gid) of the peer process on a Unix
+      domain socket connection
     * ``"realm"`` - the realm to use if needed
     * ``"realms"`` - list of acceptable realms
     * ``"available_mechanisms"`` - mechanism list provided by peer
@@ -184,6 +186,41 @@ class PasswordDatabase:
         logger.debug("got password in unknown format: {0!r}".format(pwd_format))
         return False
 
+    def get_external_username(self, properties):
+        """Get the name of the user authenticated by the channel.
+
+        Used by the EXTERNAL mechanism.
+
+        Default implementation: on a Unix domain socket connection return
+        the name of the system user the peer process runs as.
+
+        May be overridden e.g. to map the peer credentials or the TLS
+        client certificate to the XMPP users in a different way.
+
+        :Parameters:
+            - `properties`: mapping with authentication properties (those
+              provided to the authenticator's ``start()`` method).
+        :Types:
+            - `properties`: mapping
+
+        :return: the user name or `None` if the peer is not authenticated
+            by the channel.
+        :returntype: `unicode`
+        """
+        credentials = properties.get("peer-credentials")
+        if credentials is None:
+            return None
+        try:
+            import pwd
+        except ImportError:
+            return None
+        try:
+            name = pwd.getpwuid(credentials[1]).pw_name
+        except KeyError:
+            logger.debug("Unknown uid: {0!r}".format(credentials[1]))
+            return None
+        return name.decode("utf-8")
+
 
 def default_nonce_factory():
     """Generate a random string for digest authentication challenges.
@@ -434,6 +471,46 @@ class ServerAuthenticator:
         :returntype: `Challenge` or `Success` or `Failure`"""
         raise NotImplementedError
 
+    def start_async(self, properties, initial_response, callback):
+        """Start the authentication process, passing the result to a callback.
+
+        The default implementation calls `start` and passes its result
+        to `callback` immediately. Authenticators that need to wait for
+        external resources (e.g. a remote password database) may override
+        it to call `callback` later, from the main loop thread.
+
+        :Parameters:
+            - `properties`: the `authentication properties`_
+            - `initial_response`: the initial response send by the client with
+              the authentication request.
+            - `callback`: function to call with the challenge, success or
+              failure indicator
+        :Types:
+            - `properties`: mapping
+            - `initial_response`: `bytes`
+            - `callback`: function accepting a `Challenge`, `Success`
+              or `Failure` argument
+        """
+        callback(self.start(properties, initial_response))
+
+    def response_async(self, response, callback):
+        """Process a response from a client, passing the result to
+        a callback.
+
+        The default implementation calls `response` and passes its result
+        to `callback` immediately. See `start_async`.
+
+        :Parameters:
+            - `response`: the response from the client to our challenge.
+            - `callback`: function to call with the challenge, success or
+              failure indicator
+        :Types:
+            - `response`: `bytes`
+            - `callback`: function accepting a `Challenge`, `Success`
+              or `Failure` argument
+        """
+        callback(self.response(response))
+
 def _key_func(item):
     """Key function used for sorting SASL authenticator classes
     """
@@ -17,6 +17,10 @@
 #
 """External SASL authentication mechanism for PyXMPP SASL implementation.
 
+On the server side the peer is authenticated by the channel: the user name
+is provided by `PasswordDatabase.get_external_username`, by default from the
+credentials of a process connected via a Unix domain socket.
+
 Normative reference:
   - `RFC 6120 <http://www.ietf.org/rfc/rfc3920.txt>`__
   - `XEP-0178 <http://xmpp.org/extensions/xep-0178.html#c2s>`__
@@ -26,15 +30,33 @@ from __future__ import absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
-from .core import ClientAuthenticator, Response, Success
+import logging
+
+from .core import ClientAuthenticator, ServerAuthenticator
+from .core import Response, Challenge, Success, Failure
 from .core import sasl_mechanism
 
+logger = logging.getLogger("pyxmpp2.sasl.external")
+
 @sasl_mechanism("EXTERNAL", False, 20)
 class ExternalClientAuthenticator(ClientAuthenticator):
-    """Provides client-side External SASL (TLS-Identify) authentication."""
+    """Provides client-side External SASL (TLS-Identify) authentication.
+
+    Authentication properties used:
+
+        - ``"username"`` - user name (optional, the expected identity)
+        - ``"authzid"`` - authorization id (optional)
+
+    Authentication properties returned:
+
+        - ``"username"`` - user name, if provided
+        - ``"authzid"`` - authorization id
+    """
     def __init__(self):
         ClientAuthenticator.__init__(self)
         self.authzid = None
+        self.username = None
+        self.finished = False
 
     @classmethod
     def are_properties_sufficient(cls, properties):
@@ -42,12 +64,21 @@ class ExternalClientAuthenticator(ClientAuthenticator):
 
     def start(self, properties):
         self.authzid = properties.get("authzid")
+        self.username = properties.get("username")
+        self.finished = False
         # TODO: This isn't very XEP-0178'ish.
         # XEP-0178 says "=" should be sent when only one id-on-xmppAddr is
         # in the cert, but we don't know that. Still, this conforms to the
         # standard and works.
+        return self.challenge(b"")
+
+    def challenge(self, challenge):
+        if self.finished or challenge:
+            logger.debug(u"Unexpected challenge")
+            return Failure(u"extra-challenge")
+        self.finished = True
         if self.authzid:
-            return Response(self.authzid)
+            return Response(self.authzid.encode("utf-8"))
         else:
             return Response(b"")
 
@@ -61,4 +92,47 @@ class ExternalClientAuthenticator(ClientAuthenticator):
 
         :return: a success indicator.
         :returntype: `Success`"""
-        return Success({"authzid": self.authzid})
+        properties = {"authzid": self.authzid}
+        if self.username:
+            properties["username"] = self.username
+        return Success(properties)
+
+@sasl_mechanism("EXTERNAL", True, 20)
+class ExternalServerAuthenticator(ServerAuthenticator):
+    """Provides server-side External SASL authentication.
+
+    Authentication properties used:
+
+        - ``"peer-credentials"`` - the credentials of the peer process (used
+          by the default `PasswordDatabase.get_external_username`)
+
+    Authentication properties returned:
+
+        - ``"username"`` - user name
+        - ``"authzid"`` - authorization id, if requested by the client
+    """
+    def __init__(self, password_database):
+        ServerAuthenticator.__init__(self, password_database)
+        self.properties = None
+
+    def start(self, properties, initial_response):
+        self.properties = properties
+        if initial_response is None:
+            return Challenge(b"")
+        return self.response(initial_response)
+
+    def response(self, response):
+        username = self.password_database.get_external_username(
+                                                            self.properties)
+        if not username:
+            logger.debug("Peer not authenticated by the channel")
+            return Failure("not-authorized")
+        out_props = {"username": username}
+        if response and response != b"=":
+            try:
+                out_props["authzid"] = response.decode("utf-8")
+            except UnicodeError:
+                return Failure("invalid-authzid")
+        return Success(out_props)
+
+# vi: sts=4 et sw=4
@@ -0,0 +1,103 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+"""Running server SASL authenticators in a worker pool.
+
+Kept out of `pyxmpp2.sasl.core`, so the SASL mechanisms may be used without
+the main loop machinery.
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import logging
+
+from ..mainloop.workers import WorkerPoolFull
+from .core import ServerAuthenticator, Failure
+
+logger = logging.getLogger("pyxmpp2.sasl.offload")
+
+class OffloadedServerAuthenticator(ServerAuthenticator):
+    """Server authenticator running the steps of another authenticator
+    in a worker pool.
+
+    The `start_async` and `response_async` methods return immediately and
+    the wrapped authenticator (including its password database lookups
+    and key derivation) runs in a worker thread. The result is passed
+    to the callback in the main loop thread, so other streams are
+    processed in the meantime.
+
+    When the pool queue is full or the wrapped authenticator raises an
+    exception the result is `Failure` with the 'temporary-auth-failure'
+    reason.
+
+    :Ivariables:
+        - `authenticator`: the wrapped authenticator
+        - `worker_pool`: the worker pool
+    :Types:
+        - `authenticator`: `ServerAuthenticator`
+        - `worker_pool`: `pyxmpp2.mainloop.workers.WorkerPool`
+    """
+    def __init__(self, authenticator, worker_pool):
+        """Initialize an `OffloadedServerAuthenticator` object.
+
+        :Parameters:
+            - `authenticator`: the authenticator to wrap
+            - `worker_pool`: the worker pool to run the authenticator in.
+              It must be registered as an event handler in the main loop.
+        :Types:
+            - `authenticator`: `ServerAuthenticator`
+            - `worker_pool`: `pyxmpp2.mainloop.workers.WorkerPool`
+        """
+        ServerAuthenticator.__init__(self, authenticator.password_database)
+        self.authenticator = authenticator
+        self.worker_pool = worker_pool
+
+    def start(self, properties, initial_response):
+        return self.authenticator.start(properties, initial_response)
+
+    def response(self, response):
+        return self.authenticator.response(response)
+
+    def start_async(self, properties, initial_response, callback):
+        self._submit(lambda: self.authenticator.start(properties,
+                                            initial_response), callback)
+
+    def response_async(self, response, callback):
+        self._submit(lambda: self.authenticator.response(response), callback)
+
+    def _submit(self, function, callback):
+        """Run an authenticator step in the worker pool.
+
+        :Parameters:
+            - `function`: the step to run
+            - `callback`: the function to pass the result to
+        """
+        def job_done(result, exc_info):
+            """Pass the step result to `callback`."""
+            if exc_info:
+                logger.error("SASL authenticator failed",
+                                                        exc_info = exc_info)
+                result = Failure("temporary-auth-failure")
+            callback(result)
+        try:
+            self.worker_pool.submit(function, job_done)
+        except WorkerPoolFull:
+            logger.warning("SASL worker pool full, refusing authentication")
+            callback(Failure("temporary-auth-failure"))
+
+# vi: sts=4 et sw=4
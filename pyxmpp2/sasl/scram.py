@@ -16,6 +16,12 @@
 #
 """SCRAM authentication mechanisms for PyXMPP SASL implementation.
 
+The key derivation (the Hi() function) uses :std:`hashlib.pbkdf2_hmac`
+when available. The client remembers the salted passwords computed, so
+re-authentication with the same password, salt and iteration count costs
+no key stretching. On the server side `SCRAMKeysPasswordDatabase` may be
+used to compute and store the SCRAM keys once per user.
+
 Normative reference:
   - :RFC:`5802`
 """
@@ -24,16 +30,20 @@ from __future__ import absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
+import os
 import sys
 import re
 import logging
 import hashlib
 import hmac
+import threading
+
+from collections import OrderedDict
 
 from binascii import a2b_base64
 from base64 import standard_b64encode
 
-from .core import ClientAuthenticator, ServerAuthenticator
+from .core import ClientAuthenticator, ServerAuthenticator, PasswordDatabase
 from .core import Failure, Response, Challenge, Success, Failure
 from .core import sasl_mechanism, default_nonce_factory
 from .saslprep import SASLPREP
@@ -79,6 +89,28 @@ CLIENT_FINAL_MESSAGE_RE = re.compile(
 SERVER_FINAL_MESSAGE_RE = re.compile(
         br"^(?:e=(?P<error>[^,]+)|v=(?P<verifier>[a-zA-Z0-9/+=]+)(?:,.*)?)$")
 
+DEFAULT_ITERATION_COUNT = 4096
+
+# (hash name, password digest, salt, iteration count) -> salted password
+_salted_password_cache = OrderedDict()
+_salted_password_cache_size = 16
+_salted_password_cache_lock = threading.Lock()
+
+def set_salted_password_cache_size(size):
+    """Modify the size of the client-side SCRAM salted password cache.
+
+    :Parameters:
+        - `size`: the new size; 0 disables the cache
+    :Types:
+        - `size`: `int`
+    """
+    # pylint: disable-msg=W0603
+    global _salted_password_cache_size
+    with _salted_password_cache_lock:
+        _salted_password_cache_size = size
+        while len(_salted_password_cache) > size:
+            _salted_password_cache.popitem(last = False)
+
 class SCRAMOperations(object):
     """Functions used during SCRAM authentication and defined in the RFC.
 
@@ -86,7 +118,9 @@ class SCRAMOperations(object):
     def __init__(self, hash_function_name):
         self.hash_function_name = hash_function_name
         self.hash_factory = HASH_FACTORIES[hash_function_name]
-        self.digest_size = self.hash_factory().digest_size
+        hash_obj = self.hash_factory()
+        self.digest_size = hash_obj.digest_size
+        self.hashlib_name = hash_obj.name
 
     @staticmethod
     def Normalize(str_):
@@ -123,8 +157,19 @@ class SCRAMOperations(object):
             """The XOR operator for two byte strings."""
             return "".join(chr(ord(a) ^ ord(b)) for a, b in zip(str1, str2))
 
-    def Hi(self, str_, salt, i):
-        """The Hi(str, salt, i) function."""
+    if hasattr(hashlib, "pbkdf2_hmac"):
+        def Hi(self, str_, salt, i):
+            """The Hi(str, salt, i) function."""
+            # pylint: disable=C0103,E1101
+            return hashlib.pbkdf2_hmac(self.hashlib_name, str_, salt, i)
+    else:
+        def Hi(self, str_, salt, i):
+            """The Hi(str, salt, i) function."""
+            # pylint: disable=C0103
+            return self._Hi(str_, salt, i)
+
+    def _Hi(self, str_, salt, i):
+        """The Hi(str, salt, i) function, as defined in the RFC."""
         # pylint: disable=C0103
         Uj = self.HMAC(str_, salt + b"\000\000\000\001") # U1
         result = Uj
@@ -302,7 +347,7 @@ class SCRAMClientAuthenticator(SCRAMOperations, ClientAuthenticator):
         :return: the response or a failure indicator.
         :returntype: `sasl.Response` or `sasl.Failure`
         """
-        self._salted_password = self.Hi(self.Normalize(self.password), salt,
+        self._salted_password = self._get_salted_password(salt,
                                                             iteration_count)
         self.password = None # not needed any more
         if self.channel_binding:
@@ -327,6 +372,31 @@ class SCRAMClientAuthenticator(SCRAMOperations, ClientAuthenticator):
                                                                     proof)
         return Response(client_final_message)
 
+    def _get_salted_password(self, salt, iteration_count):
+        """Compute the SaltedPassword or get it from the cache.
+
+        The cache is keyed by a digest of the password, not the password
+        itself.
+
+        :Returntype: `bytes`
+        """
+        normalized = self.Normalize(self.password)
+        key = (self.hash_function_name, hashlib.sha256(normalized).digest(),
+                                                        salt, iteration_count)
+        with _salted_password_cache_lock:
+            salted_password = _salted_password_cache.pop(key, None)
+            if salted_password is not None:
+                _salted_password_cache[key] = salted_password
+                return salted_password
+        salted_password = self.Hi(normalized, salt, iteration_count)
+        with _salted_password_cache_lock:
+            if _salted_password_cache_size > 0:
+                _salted_password_cache[key] = salted_password
+                while len(_salted_password_cache) > \
+                                            _salted_password_cache_size:
+                    _salted_password_cache.popitem(last = False)
+        return salted_password
+
     def _final_challenge(self, challenge):
         """Process the second challenge from the server and return the
         response.
@@ -490,29 +560,33 @@ class SCRAMServerAuthenticator(SCRAMOperations, ServerAuthenticator):
         s_pformat = "SCRAM-{0}-SaltedPassword".format(self.hash_function_name)
         k_pformat = "SCRAM-{0}-Keys".format(self.hash_function_name)
         password, pformat = self.password_database.get_password(username,
-                                           (s_pformat, "plain"), properties)
-        if pformat == s_pformat:
-            if password is not None:
-                salt, iteration_count, salted_password = password
-            else:
-                logger.debug("No password for user {0!r}".format(username))
-        elif pformat != k_pformat:
+                                (k_pformat, s_pformat, "plain"), properties)
+        salted_password = None
+        if pformat == k_pformat and password is not None:
+            salt, iteration_count, stored_key, server_key = password
+        elif pformat == s_pformat and password is not None:
+            salt, iteration_count, salted_password = password
+        else:
             salt = self.properties.get("SCRAM-salt")
             if not salt:
                 salt = nonce_factory()
-            iteration_count = self.properties.get("SCRAM-iteration-count", 4096)
+            iteration_count = self.properties.get("SCRAM-iteration-count",
+                                                    DEFAULT_ITERATION_COUNT)
             if pformat == "plain" and password is not None:
                 salted_password = self.Hi(self.Normalize(password), salt,
                                                             iteration_count)
+            elif pformat in (k_pformat, s_pformat):
+                logger.debug("No password for user {0!r}".format(username))
+                # the database does no key stretching for the known users,
+                # so use dummy keys and fail later
+                stored_key = server_key = self.H(salt)
             else:
                 logger.debug("No password for user {0!r}".format(username))
                 password = None
                 # to prevent timing attack, compute the key anyway
                 salted_password = self.Hi(self.Normalize(""), salt,
                                                             iteration_count)
-        if pformat == k_pformat:
-            salt, iteration_count, stored_key, server_key = password
-        else:
+        if salted_password is not None:
             client_key = self.HMAC(salted_password, b"Client Key")
             stored_key = self.H(client_key)
             server_key = self.HMAC(salted_password, b"Server Key")
@@ -686,3 +760,166 @@ class SCRAM_SHA_1_PLUS_ServerAuthenticator(SCRAMServerAuthenticator):
             return False
         return bool(properties.get("channel-binding"))
 
+
+def make_scram_keys(hash_name, password, salt = None,
+                                    iteration_count = DEFAULT_ITERATION_COUNT):
+    """Compute the SCRAM keys for a password.
+
+    :Parameters:
+        - `hash_name`: hash function name, e.g. ``"SHA-1"``
+        - `password`: the plain text password
+        - `salt`: the salt to use, a random one when not given
+        - `iteration_count`: the Hi() iteration count
+    :Types:
+        - `hash_name`: `unicode`
+        - `password`: `unicode`
+        - `salt`: `bytes`
+        - `iteration_count`: `int`
+
+    :Return: password data in the "SCRAM-{hash_name}-Keys" format:
+        (salt, iteration_count, stored_key, server_key) tuple
+    :Returntype: `tuple`
+    """
+    ops = SCRAMOperations(hash_name)
+    if salt is None:
+        salt = default_nonce_factory()
+    salted_password = ops.Hi(ops.Normalize(password), salt, iteration_count)
+    stored_key = ops.H(ops.HMAC(salted_password, b"Client Key"))
+    server_key = ops.HMAC(salted_password, b"Server Key")
+    return salt, iteration_count, stored_key, server_key
+
+class SCRAMKeysPasswordDatabase(PasswordDatabase):
+    """Password database computing the SCRAM keys from the plain text
+    passwords of another database and remembering them.
+
+    The keys are computed on the first SCRAM authentication of a user (or by
+    `add_user`), so the following logins cost no key stretching.
+
+    For an unknown user fake keys are returned, derived from the username
+    and `secret` without key stretching either, so the response time does
+    not reveal which users exist. The salt is the same on every request
+    for the user.
+
+    :Ivariables:
+        - `database`: the password database providing the plain text
+          passwords
+        - `store`: the SCRAM keys by (password format, username). May be
+          any persistent mapping.
+        - `iteration_count`: the Hi() iteration count for new keys
+        - `secret`: the server secret for the fake keys of unknown users
+    :Types:
+        - `database`: `PasswordDatabase`
+        - `store`: mapping
+        - `iteration_count`: `int`
+        - `secret`: `bytes`
+    """
+    def __init__(self, database, store = None,
+                                    iteration_count = DEFAULT_ITERATION_COUNT,
+                                    secret = None):
+        """Initialize the database.
+
+        :Parameters:
+            - `database`: the password database providing the plain text
+              passwords
+            - `store`: the SCRAM keys store, a new `dict` by default
+            - `iteration_count`: the Hi() iteration count for new keys
+            - `secret`: the server secret for the fake keys of unknown
+              users. Random by default, it should be persistent when
+              `store` is.
+        :Types:
+            - `database`: `PasswordDatabase`
+            - `store`: mapping
+            - `iteration_count`: `int`
+            - `secret`: `bytes`
+        """
+        self.database = database
+        if store is None:
+            store = {}
+        self.store = store
+        self.iteration_count = iteration_count
+        if secret is None:
+            secret = os.urandom(32)
+        self.secret = secret
+        self._lock = threading.Lock()
+
+    def add_user(self, username, password, hash_names = ("SHA-1",)):
+        """Compute and store the SCRAM keys for a user.
+
+        :Parameters:
+            - `username`: the username
+            - `password`: the plain text password
+            - `hash_names`: hash functions to compute the keys for
+        :Types:
+            - `username`: `unicode`
+            - `password`: `unicode`
+            - `hash_names`: sequence of `unicode`
+        """
+        for hash_name in hash_names:
+            keys = make_scram_keys(hash_name, password,
+                                    iteration_count = self.iteration_count)
+            with self._lock:
+                self.store["SCRAM-{0}-Keys".format(hash_name), username] = keys
+
+    def remove_user(self, username):
+        """Forget the SCRAM keys of a user (e.g. on a password change).
+
+        :Parameters:
+            - `username`: the username
+        :Types:
+            - `username`: `unicode`
+        """
+        with self._lock:
+            for key in list(self.store.keys()):
+                if key[1] == username:
+                    del self.store[key]
+
+    def get_password(self, username, acceptable_formats, properties):
+        for pformat in acceptable_formats:
+            if pformat.startswith("SCRAM-") and pformat.endswith("-Keys"):
+                break
+        else:
+            return self.database.get_password(username, acceptable_formats,
+                                                                properties)
+        with self._lock:
+            keys = self.store.get((pformat, username))
+        if keys is not None:
+            return keys, pformat
+        password, password_format = self.database.get_password(username,
+                                                    ("plain",), properties)
+        if password_format != "plain" or password is None:
+            password, password_format = self.database.get_password(username,
+                                                acceptable_formats, properties)
+            if password is None:
+                return self._fake_keys(pformat, username), pformat
+            return password, password_format
+        keys = make_scram_keys(pformat[6:-5], password,
+                                    iteration_count = self.iteration_count)
+        with self._lock:
+            self.store[pformat, username] = keys
+        return keys, pformat
+
+    def _fake_keys(self, pformat, username):
+        """Make up the SCRAM keys for an unknown user.
+
+        :Parameters:
+            - `pformat`: the "SCRAM-{hash_name}-Keys" password format
+            - `username`: the username
+        :Types:
+            - `pformat`: `unicode`
+            - `username`: `unicode`
+
+        :Return: fake password data in the `pformat` format
+        :Returntype: `tuple`
+        """
+        ops = SCRAMOperations(pformat[6:-5])
+        seed = pformat.encode("utf-8") + b"\000" + username.encode("utf-8")
+        salt = hmac.new(self.secret, b"salt\000" + seed, hashlib.sha256
+                                            ).hexdigest()[:32].encode("us-ascii")
+        stored_key = ops.HMAC(self.secret, b"Stored Key\000" + seed)
+        server_key = ops.HMAC(self.secret, b"Server Key\000" + seed)
+        return salt, self.iteration_count, stored_key, server_key
+
+    def check_password(self, username, password, properties):
+        return self.database.check_password(username, password, properties)
+
+# vi: sts=4 et sw=4
@@ -17,12 +17,17 @@
 
 """TCP Socket listener
 ======================
+
+The listener may also accept connections on a Unix domain socket.
 """
 
 from __future__ import absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
+import os
+import stat
+import errno
 import threading
 import socket
 import logging
@@ -34,12 +39,42 @@ except ImportError:
 
 from ..mainloop.interfaces import IOHandler, HandlerReady
 from ..exceptions import PyXMPPIOError
+from ..transport import BLOCKING_ERRORS, AF_UNIX, LINUX_GENERIC_SOCKOPTS
 
 logger = logging.getLogger("pyxmpp2.server.listener")
 
-from ..transport import BLOCKING_ERRORS
-
-
+# not exported by the Python 2 socket module
+if hasattr(socket, "SO_REUSEPORT"):
+    SO_REUSEPORT = socket.SO_REUSEPORT # pylint: disable=E1101
+elif LINUX_GENERIC_SOCKOPTS:
+    SO_REUSEPORT = 15
+else:
+    SO_REUSEPORT = None
+
+def _remove_stale_socket(path):
+    """Remove a Unix domain socket file, if it exists and nothing listens
+    on it.
+
+    Other files and sockets still in use are left untouched, so `bind`
+    fails on them."""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return
+    sock = socket.socket(AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, err:
+        if err.args[0] != errno.ECONNREFUSED:
+            return
+        logger.debug("Removing stale socket: {0!r}".format(path))
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    finally:
+        sock.close()
 
 class TCPListener(IOHandler):
     """Listens on a TCPSocket calling a function on incoming connection.
@@ -50,43 +85,94 @@ class TCPListener(IOHandler):
         - `_target`: function to be called with accepted connection. It should
           expect two arguments: a connected socket and a socket address (as
           returned by accept)
+        - `_unix_path`: path of the Unix domain socket to remove on close
+        - `_unix_file`: (pid, st_dev, st_ino) identifying the socket file
+          created by this listener and the process which created it
     :Types:
         - `_lock`: :std:`threading.RLock`
         - `_socket`: socket object
         - `_target`: callable
+        - `_unix_path`: `str`
+        - `_unix_file`: `tuple`
     """
     _socket = None
-    def __init__(self, family, address, target):
+    _unix_path = None
+    _unix_file = None
+    def __init__(self, family, address, target, reuse_port = False):
         """Initialize the `TCPListener` object and create the socket.
 
+        A stale Unix domain socket file left at `address` is replaced.
+
+        With `reuse_port` several listeners, e.g. in the worker processes
+        of a `prefork.PreforkServer`, may bind the same address and the
+        kernel distributes the incoming connections between them.
+
         :Parameters:
-            - `family`: address family (:std:`socket.AF_INET` or
-              :std:`socket.AF_INET6`)
-            - `address`: address to listen on (address, port)
+            - `family`: address family (:std:`socket.AF_INET`,
+              :std:`socket.AF_INET6` or :std:`socket.AF_UNIX`)
+            - `address`: address to listen on (address, port) or a Unix
+              socket path
             - `target`: function to call on an accepted connection
+            - `reuse_port`: set the ``SO_REUSEPORT`` socket option
         """
         self._socket = None
         self._lock = threading.RLock()
+        if reuse_port and (SO_REUSEPORT is None or family == AF_UNIX):
+            raise ValueError("SO_REUSEPORT not available")
         self._target = target
         sock = socket.socket(family, socket.SOCK_STREAM)
         try:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == AF_UNIX:
+                if not address.startswith("\0"):
+                    _remove_stale_socket(address)
+                    self._unix_path = address
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
             sock.bind(address)
+            if self._unix_path:
+                stat_info = os.stat(address)
+                self._unix_file = (os.getpid(), stat_info.st_dev,
+                                                        stat_info.st_ino)
         except:
             sock.close()
+            self._unix_path = None
             raise
         self._socket = sock
 
     def __del__(self):
-        if self._socket:
-            self._socket.close()
-            self._socket = None
+        self.close()
 
     def close(self):
         with self._lock:
             if self._socket:
                 self._socket.close()
                 self._socket = None
+            if self._unix_path:
+                self._remove_socket_file()
+                self._unix_path = None
+
+    def _remove_socket_file(self):
+        """Remove the Unix domain socket file created by this listener.
+
+        The file is not removed by other processes (forked copies of the
+        listener) or when it has been replaced in the meantime.
+
+        [called with `_lock` acquired]
+        """
+        if self._unix_file is None or self._unix_file[0] != os.getpid():
+            return
+        try:
+            stat_info = os.stat(self._unix_path)
+        except OSError:
+            return
+        if (stat_info.st_dev, stat_info.st_ino) != self._unix_file[1:]:
+            return
+        try:
+            os.unlink(self._unix_path)
+        except OSError:
+            pass
 
     def prepare(self):
         """When connecting start the next connection step and schedule
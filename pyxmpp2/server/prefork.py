@@ -0,0 +1,545 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Pre-forking multi-process server
+===================================
+
+A `PreforkServer` forks a number of worker processes, restarts the
+workers that die and stops them gracefully on shutdown.
+
+Each worker runs its own main loop with its own `listener.TCPListener`,
+all bound to the same address with the ``SO_REUSEPORT`` socket option,
+so the kernel distributes the incoming connections between the workers::
+
+    def worker_main(worker):
+        main_loop = main_loop_factory(settings)
+        listener = TCPListener(socket.AF_INET6, ("::", 5222), accept,
+                                                        reuse_port = True)
+        main_loop.add_handler(listener)
+        main_loop.add_handler(worker)
+        worker.on_shutdown(listener.close)
+        worker.on_shutdown(close_streams_and_quit)
+        main_loop.loop()
+
+    server = PreforkServer(worker_main, peer_channels = True)
+    server.run()
+
+The worker object is an `IOHandler` watching the control channel from the
+supervisor. When the server stops, or the supervisor dies, the worker
+calls its shutdown handlers from its main loop. These should stop
+accepting new connections, close the streams gracefully and quit the loop
+when done. Workers still running after the 'prefork_shutdown_timeout' are
+killed.
+
+With `peer_channels` every two workers are connected with a Unix socket
+pair, e.g. to route stanzas for the local users connected to another
+worker. The protocol used on the channels is up to the application.
+When a worker dies the other workers see the end of file on their channels
+to it. The restarted worker gets new channels and the new sockets are
+passed to the other workers (see `PreforkWorker.on_peer_channel`).
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import os
+import errno
+import signal
+import socket
+import threading
+import time
+import logging
+
+try:
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    # pylint: disable=C0103
+    sendfd = recvfd = None
+
+from ..mainloop.interfaces import IOHandler, HandlerReady
+from ..settings import XMPPSettings
+from ..xmppstringprep import warm_up_stringprep
+
+logger = logging.getLogger("pyxmpp2.server.prefork")
+
+# control channel message announcing a new peer channel: the command byte,
+# the peer index (decimal, zero-padded) and the socket passed with
+# SCM_RIGHTS
+PEER_COMMAND = b"P"
+PEER_INDEX_LENGTH = 8
+
+class PreforkWorker(IOHandler):
+    """The worker process context, passed to the worker function.
+
+    Should be added to the worker main loop, so the shutdown handlers are
+    called when the supervisor requests a shutdown.
+
+    :Ivariables:
+        - `index`: the worker number, kept when the worker is restarted
+        - `peers`: sockets connected to the other workers, by their
+          `index`
+        - `stopping`: `True` when a shutdown has been requested
+        - `_control`: the control channel from the supervisor
+        - `_shutdown_handlers`: functions to call on shutdown
+        - `_peer_handlers`: functions to call when a new peer channel is
+          received
+    :Types:
+        - `index`: `int`
+        - `peers`: `dict` of `int` -> socket object
+        - `stopping`: `bool`
+        - `_control`: socket object
+        - `_shutdown_handlers`: `list` of callables
+        - `_peer_handlers`: `list` of callables
+    """
+    def __init__(self, index, control, peers):
+        self.index = index
+        self.peers = peers
+        self.stopping = False
+        self._control = control
+        self._shutdown_handlers = []
+        self._peer_handlers = []
+
+    def on_shutdown(self, handler):
+        """Register a function to call, without arguments, when the worker
+        is requested to stop."""
+        self._shutdown_handlers.append(handler)
+
+    def on_peer_channel(self, handler):
+        """Register a function to call when a peer worker has been restarted.
+
+        The handler is called from the main loop with the peer index and
+        the socket connected to the new peer process, already stored in
+        `peers`. The previous socket for that peer (which reached the end
+        of file when the peer died) is not closed automatically.
+        """
+        self._peer_handlers.append(handler)
+
+    def shutdown(self):
+        """Call the shutdown handlers (only once)."""
+        if self.stopping:
+            return
+        logger.debug("Worker {0} shutting down".format(self.index))
+        self.stopping = True
+        self.close()
+        for handler in self._shutdown_handlers:
+            try:
+                handler()
+            except Exception: # pylint: disable=W0703
+                logger.exception("Worker shutdown handler failed:")
+
+    def prepare(self):
+        return HandlerReady()
+
+    def fileno(self):
+        if self._control:
+            return self._control.fileno()
+
+    def is_readable(self):
+        return self._control is not None
+
+    def wait_for_readability(self):
+        return self._control is not None
+
+    def is_writable(self):
+        return False
+
+    def wait_for_writability(self):
+        return False
+
+    def handle_write(self):
+        return
+
+    def handle_read(self):
+        """Receive a new peer channel or shut down on end of file (or any
+        other data) on the control channel.
+        """
+        try:
+            command = self._control.recv(1)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            command = None
+        if command == PEER_COMMAND:
+            try:
+                self._receive_peer_channel()
+                return
+            except (socket.error, OSError, ValueError):
+                logger.exception("Could not receive a peer channel:")
+        self.shutdown()
+
+    def _receive_peer_channel(self):
+        """Receive the rest of a new peer channel message from the control
+        channel and pass the socket to the peer channel handlers."""
+        index = b""
+        while len(index) < PEER_INDEX_LENGTH:
+            data = self._control.recv(PEER_INDEX_LENGTH - len(index))
+            if not data:
+                raise ValueError("Truncated peer channel message")
+            index += data
+        index = int(index)
+        fileno = recvfd(self._control.fileno())
+        try:
+            sock = socket.fromfd(fileno, socket.AF_UNIX, socket.SOCK_STREAM)
+        finally:
+            os.close(fileno)
+        logger.debug("Worker {0} got a new channel to worker {1}"
+                                                .format(self.index, index))
+        self.peers[index] = sock
+        for handler in self._peer_handlers:
+            try:
+                handler(index, sock)
+            except Exception: # pylint: disable=W0703
+                logger.exception("Peer channel handler failed:")
+
+    def handle_hup(self):
+        self.shutdown()
+
+    def handle_err(self):
+        self.shutdown()
+
+    def handle_nval(self):
+        self.shutdown()
+
+    def close(self):
+        if self._control:
+            self._control.close()
+            self._control = None
+
+class PreforkServer(object):
+    """The worker process supervisor.
+
+    `run` runs the whole server until SIGTERM or SIGINT. `start`,
+    `check_workers` and `stop` may be used instead to supervise the
+    workers from an other loop.
+
+    :Ivariables:
+        - `settings`: the settings
+        - `worker_function`: function to run in a worker process, with
+          a `PreforkWorker` as the only argument
+        - `peer_channels`: connect every two workers with a Unix socket
+          pair
+        - `workers`: process id of each running worker, by its index
+        - `stopping`: `True` when the workers are being stopped
+        - `_controls`: the supervisor ends of the control channels
+        - `_peer_sockets`: both ends of each peer channel not passed to the
+          workers yet, by the indices of the workers
+        - `_restarts`: when to restart each dead worker
+        - `_stop_requested`: set by the signal handlers installed by `run`
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `worker_function`: callable
+        - `peer_channels`: `bool`
+        - `workers`: `dict` of `int` -> `int`
+        - `stopping`: `bool`
+        - `_controls`: `dict` of `int` -> socket object
+        - `_peer_sockets`: `dict` of (`int`, `int`) -> (socket, socket)
+        - `_restarts`: `dict` of `int` -> `float`
+        - `_stop_requested`: `bool`
+    """
+    # pylint: disable=R0902
+    def __init__(self, worker_function, settings = None,
+                                                    peer_channels = False):
+        """Initialize the `PreforkServer` object.
+
+        :Parameters:
+            - `worker_function`: function to run in each worker process
+            - `settings`: the settings. 'prefork_workers',
+              'prefork_restart_delay' and 'prefork_shutdown_timeout' are
+              used.
+            - `peer_channels`: connect every two workers with a Unix socket
+              pair
+        :Types:
+            - `worker_function`: callable
+            - `settings`: `XMPPSettings`
+            - `peer_channels`: `bool`
+        """
+        if settings is None:
+            settings = XMPPSettings()
+        self.settings = settings
+        self.worker_function = worker_function
+        self.peer_channels = peer_channels
+        self.workers = {}
+        self.stopping = False
+        self._controls = {}
+        self._peer_sockets = {}
+        self._restarts = {}
+        self._stop_requested = False
+
+    def start(self):
+        """Start the worker processes."""
+        count = self.settings["prefork_workers"]
+        # compiled once, for all the workers
+        warm_up_stringprep()
+        if self.peer_channels:
+            for i in range(count):
+                for j in range(i + 1, count):
+                    self._peer_sockets[(i, j)] = socket.socketpair()
+        try:
+            for index in range(count):
+                self._spawn(index)
+        finally:
+            # the workers see each other's death only when nobody else
+            # keeps the channels open
+            self._close_peer_sockets()
+
+    def _close_peer_sockets(self):
+        """Close the supervisor copies of the peer channels."""
+        for sock_i, sock_j in self._peer_sockets.values():
+            sock_i.close()
+            sock_j.close()
+        self._peer_sockets = {}
+
+    def _restart(self, index):
+        """Start a worker again, with new channels to the running workers.
+        """
+        live = []
+        if self.peer_channels and sendfd is not None:
+            live = [i for i in self._controls if i != index]
+            for i in live:
+                self._peer_sockets[(index, i)] = socket.socketpair()
+        elif self.peer_channels:
+            logger.warning("Cannot pass file descriptors, restarted worker"
+                                    " {0} has no peer channels".format(index))
+        try:
+            self._spawn(index)
+            for i in live:
+                self._send_peer_channel(i, index,
+                                            self._peer_sockets[(index, i)][1])
+        finally:
+            self._close_peer_sockets()
+
+    def _send_peer_channel(self, index, peer_index, sock):
+        """Pass a peer channel socket to a running worker.
+
+        :Parameters:
+            - `index`: index of the worker to send the socket to
+            - `peer_index`: index of the worker at the other end
+            - `sock`: the socket
+        """
+        control = self._controls[index]
+        message = PEER_COMMAND + str(peer_index).zfill(
+                                        PEER_INDEX_LENGTH).encode("us-ascii")
+        try:
+            control.sendall(message)
+            sendfd(control.fileno(), sock.fileno())
+        except (socket.error, OSError), err:
+            logger.warning("Could not pass the channel to worker {0} to worker"
+                                " {1}: {2}".format(peer_index, index, err))
+
+    def _spawn(self, index):
+        """Fork a worker process."""
+        control, worker_control = socket.socketpair()
+        try:
+            pid = os.fork()
+        except:
+            control.close()
+            worker_control.close()
+            raise
+        if pid == 0:
+            status = 1
+            try:
+                control.close()
+                self._run_worker(index, worker_control)
+                status = 0
+            except: # pylint: disable=W0702
+                logger.exception("Worker {0} failed:".format(index))
+            finally:
+                os._exit(status) # pylint: disable=W0212
+        worker_control.close()
+        self._controls[index] = control
+        self.workers[index] = pid
+        logger.debug("Worker {0} started with pid {1}".format(index, pid))
+
+    def _run_worker(self, index, control):
+        """Set up the worker process context and call the worker function.
+        """
+        # the supervisor handles these
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for sock in self._controls.values():
+            # so the other workers see the supervisor death
+            sock.close()
+        self._controls = {}
+        peers = {}
+        for (i, j), (sock_i, sock_j) in self._peer_sockets.items():
+            if i == index:
+                peers[j] = sock_i
+                sock_j.close()
+            elif j == index:
+                peers[i] = sock_j
+                sock_i.close()
+            else:
+                sock_i.close()
+                sock_j.close()
+        self._peer_sockets = {}
+        worker = PreforkWorker(index, control, peers)
+        try:
+            self.worker_function(worker)
+        finally:
+            worker.close()
+            for sock in peers.values():
+                sock.close()
+
+    def _reap(self):
+        """Collect the exit status of the dead workers.
+
+        :Return: indices of the workers which died.
+        :Returntype: `list` of `int`
+        """
+        dead = []
+        for index, pid in list(self.workers.items()):
+            try:
+                wpid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError, err:
+                if err.errno != errno.ECHILD:
+                    raise
+                wpid, status = pid, None
+            if not wpid:
+                continue
+            logger.debug("Worker {0} (pid {1}) exited with status {2!r}"
+                                                .format(index, pid, status))
+            del self.workers[index]
+            control = self._controls.pop(index, None)
+            if control:
+                control.close()
+            dead.append(index)
+        return dead
+
+    def check_workers(self):
+        """Reap the dead workers and restart them, after the
+        'prefork_restart_delay'.
+
+        Should be called periodically.
+        """
+        for index in self._reap():
+            if self.stopping:
+                continue
+            logger.warning("Worker {0} died, restarting".format(index))
+            self._restarts[index] = (time.time()
+                                    + self.settings["prefork_restart_delay"])
+        now = time.time()
+        for index, when in list(self._restarts.items()):
+            if when <= now:
+                del self._restarts[index]
+                self._restart(index)
+
+    def stop(self, timeout = None):
+        """Stop the workers gracefully.
+
+        The workers are requested to shut down and killed if they are
+        still running after `timeout`.
+
+        :Parameters:
+            - `timeout`: the shutdown timeout, 'prefork_shutdown_timeout' by
+              default
+        :Types:
+            - `timeout`: `float`
+        """
+        if timeout is None:
+            timeout = self.settings["prefork_shutdown_timeout"]
+        self.stopping = True
+        self._restarts = {}
+        for control in self._controls.values():
+            control.close()
+        self._controls = {}
+        deadline = time.time() + timeout
+        while self.workers and time.time() < deadline:
+            self._reap()
+            if self.workers:
+                time.sleep(0.05)
+        for index, pid in list(self.workers.items()):
+            logger.warning("Killing worker {0} (pid {1})".format(index, pid))
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError, err:
+                if err.errno not in (errno.ESRCH, errno.ECHILD):
+                    raise
+            del self.workers[index]
+        self._close_peer_sockets()
+
+    def _request_stop(self, signum, frame):
+        """Signal handler requesting the `run` loop to stop."""
+        # pylint: disable=W0613
+        self._stop_requested = True
+
+    def run(self, interval = 0.5):
+        """Start the workers and supervise them until SIGTERM or SIGINT,
+        then stop them.
+
+        Must be called from the main thread.
+
+        :Parameters:
+            - `interval`: how often to check the workers
+        :Types:
+            - `interval`: `float`
+        """
+        if not isinstance(threading.current_thread(), threading._MainThread):
+            # pylint: disable=W0212
+            raise RuntimeError("PreforkServer.run() must be called from"
+                                                        " the main thread")
+        self._stop_requested = False
+        old_handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            old_handlers[signum] = signal.signal(signum, self._request_stop)
+        try:
+            self.start()
+            while not self._stop_requested:
+                self.check_workers()
+                time.sleep(interval)
+        finally:
+            self.stop()
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+
+def _cpu_count(settings):
+    """Return the number of processors, for the 'prefork_workers' default.
+    """
+    # pylint: disable=W0613
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+XMPPSettings.add_setting(u"prefork_workers", type = int,
+        factory = _cpu_count, cache = True,
+        default_d = u"The number of processors",
+        validator = XMPPSettings.validate_positive_int,
+        cmdline_help = "Number of the server worker processes",
+        doc = u"""Number of the worker processes started by the
+`PreforkServer`."""
+    )
+
+XMPPSettings.add_setting(u"prefork_restart_delay", type = float,
+        default = 1.0,
+        validator = XMPPSettings.validate_positive_float,
+        cmdline_help = "Delay before restarting a dead worker",
+        doc = u"""Time (in seconds) to wait before restarting a dead
+worker process."""
+    )
+
+XMPPSettings.add_setting(u"prefork_shutdown_timeout", type = float,
+        default = 30.0,
+        validator = XMPPSettings.validate_positive_float,
+        cmdline_help = "Time for the workers to shut down gracefully",
+        doc = u"""Time (in seconds) for the worker processes to close their
+connections on shutdown. Workers still running after that are killed."""
+    )
+
+# vi: sts=4 et sw=4
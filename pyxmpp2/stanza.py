@@ -147,10 +147,10 @@ class Stanza(object):
         try:
             from_jid = self._element.get('from')
             if from_jid:
-                self._from_jid = JID(from_jid)
+                self._from_jid = JID.from_trusted(from_jid)
             to_jid = self._element.get('to')
             if to_jid:
-                self._to_jid = JID(to_jid)
+                self._to_jid = JID.from_trusted(to_jid)
         except ValueError:
             raise JIDMalformedProtocolError
         self._stanza_type = self._element.get('type')
@@ -22,6 +22,7 @@ from collections import defaultdict
 
 from .etree import ElementClass
 from .interfaces import StanzaPayload
+from .trace import TRACE_DISPATCH
 
 STANZA_PAYLOAD_CLASSES = {}
 STANZA_PAYLOAD_ELEMENTS = defaultdict(list)
@@ -65,9 +66,9 @@ class XMLPayload(StanzaPayload):
 
 def payload_class_for_element_name(element_name):
     """Return a payload class for given element name."""
-    logger.debug(" looking up payload class for element: {0!r}".format(
-                                                                element_name))
-    logger.debug("  known: {0!r}".format(STANZA_PAYLOAD_CLASSES))
+    TRACE_DISPATCH(" looking up payload class for element: {0!r}",
+                                                                  element_name)
+    TRACE_DISPATCH("  known: {0!r}", STANZA_PAYLOAD_CLASSES)
     if element_name in STANZA_PAYLOAD_CLASSES:
         return STANZA_PAYLOAD_CLASSES[element_name]
     else:
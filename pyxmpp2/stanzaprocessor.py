@@ -27,12 +27,14 @@ __docformat__ = "restructuredtext en"
 
 import logging
 import threading
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import partial
 import inspect
 
 from .expdict import ExpiringDictionary
 from .exceptions import ProtocolError, BadRequestProtocolError
 from .exceptions import ServiceUnavailableProtocolError, NoRouteError
+from .exceptions import ResourceConstraintProtocolError
 from .stanza import Stanza
 from .message import Message
 from .presence import Presence
@@ -40,6 +42,9 @@ from .stanzapayload import XMLPayload
 from .iq import Iq
 
 from .interfaces import XMPPFeatureHandler, StanzaRoute
+from .mainloop.workers import WorkerPoolFull, WorkerJobCancelled
+from .instrumentation import call_handler, STANZA
+from .trace import TRACE_DISPATCH
 
 logger = logging.getLogger("pyxmpp2.stanzaprocessor")
 
@@ -79,12 +84,29 @@ class StanzaProcessor(StanzaRoute):
         - `process_all_stanzas`: when `True` then all stanzas received (and
           not only those addressed to `me`) are considered local.
         - `uplink`: object to route outgoing stanzas through
+        - `rate_limiter`: rate limiter for the stanzas received, `None` for
+          no limits
+        - `worker_pool`: worker pool for handlers decorated with
+          `interfaces.blocking_stanza_handler`. When `None` such handlers
+          are called directly.
+        - `instrumentation`: stanza handler call instrumentation, `None` for
+          none
+        - `_held_stanzas`: mapping of sender JID to stanzas waiting until
+          the blocking handler processing the previous stanza of the sender
+          finishes
+        - `_busy_senders`: senders which stanzas are being processed by
+          blocking handlers
     :Types:
         - `lock`: :std:`threading.RLock`
         - `me`: `JID`
         - `peer`: `JID`
         - `process_all_stanzas`: `bool`
         - `uplink`: `StanzaRoute`
+        - `rate_limiter`: `ratelimit.RateLimiter`
+        - `worker_pool`: `mainloop.workers.WorkerPool`
+        - `instrumentation`: `instrumentation.Instrumentation`
+        - `_held_stanzas`: `unicode` -> :std:`collections.deque` mapping
+        - `_busy_senders`: `set` of `unicode`
     """
     # pylint: disable-msg=R0902
     def __init__(self, default_timeout = 300):
@@ -101,6 +123,11 @@ class StanzaProcessor(StanzaRoute):
         self._iq_handlers = defaultdict(dict)
         self._message_handlers = []
         self._presence_handlers = []
+        self.rate_limiter = None
+        self.worker_pool = None
+        self.instrumentation = None
+        self._held_stanzas = {}
+        self._busy_senders = set()
         self.lock = threading.RLock()
 
     def _process_handler_result(self, response):
@@ -154,44 +181,58 @@ class StanzaProcessor(StanzaRoute):
         ignore it if it is "error" or "result" stanza or return
         "feature-not-implemented" error if it is "get" or "set".
         """
-        stanza_id = stanza.stanza_id
-        from_jid = stanza.from_jid
-        if from_jid:
-            ufrom = from_jid.as_unicode()
-        else:
-            ufrom = None
         res_handler = err_handler = None
-        try:
-            res_handler, err_handler = self._iq_response_handlers.pop(
-                                                    (stanza_id, ufrom))
-        except KeyError:
-            logger.debug("No response handler for id={0!r} from={1!r}"
-                                                .format(stanza_id, ufrom))
-            logger.debug(" from_jid: {0!r} peer: {1!r}  me: {2!r}"
-                                        .format(from_jid, self.peer, self.me))
-            if ( (from_jid == self.peer or from_jid == self.me
-                            or self.me and from_jid == self.me.bare()) ):
-                try:
-                    logger.debug("  trying id={0!r} from=None"
-                                                        .format(stanza_id))
-                    res_handler, err_handler = \
-                            self._iq_response_handlers.pop(
-                                                    (stanza_id, None))
-                except KeyError:
-                    pass
+        key = self._response_handlers_key(stanza)
+        if key is not None:
+            try:
+                res_handler, err_handler = self._iq_response_handlers.pop(key)
+            except KeyError:
+                pass
         if stanza.stanza_type == "result":
             if res_handler:
-                response = res_handler(stanza)
+                response = call_handler(self.instrumentation, STANZA,
+                                                        res_handler, stanza)
             else:
                 return False
         else:
             if err_handler:
-                response = err_handler(stanza)
+                response = call_handler(self.instrumentation, STANZA,
+                                                        err_handler, stanza)
             else:
                 return False
         self._process_handler_result(response)
         return True
 
+    def _response_handlers_key(self, stanza):
+        """Find the response handlers registered for an IQ response.
+
+        :Parameters:
+            - `stanza`: the "result" or "error" stanza received
+        :Types:
+            - `stanza`: `Iq`
+
+        :Return: the `_iq_response_handlers` key or `None` if the stanza
+            is not a response to our request.
+        """
+        stanza_id = stanza.stanza_id
+        from_jid = stanza.from_jid
+        if from_jid:
+            ufrom = from_jid.as_unicode()
+        else:
+            ufrom = None
+        if (stanza_id, ufrom) in self._iq_response_handlers:
+            return (stanza_id, ufrom)
+        TRACE_DISPATCH("No response handler for id={0!r} from={1!r}",
+                                                          stanza_id, ufrom)
+        TRACE_DISPATCH(" from_jid: {0!r} peer: {1!r}  me: {2!r}",
+                                              from_jid, self.peer, self.me)
+        if ( (from_jid == self.peer or from_jid == self.me
+                        or self.me and from_jid == self.me.bare()) ):
+            TRACE_DISPATCH("  trying id={0!r} from=None", stanza_id)
+            if (stanza_id, None) in self._iq_response_handlers:
+                return (stanza_id, None)
+        return None
+
     def process_iq(self, stanza):
         """Process IQ stanza received.
 
@@ -209,21 +250,19 @@ class StanzaProcessor(StanzaRoute):
             return self._process_iq_response(stanza)
         if typ not in ("get", "set"):
             raise BadRequestProtocolError("Bad <iq/> type")
-        logger.debug("Handling <iq type='{0}'> stanza: {1!r}".format(
-                                                            stanza, typ))
+        TRACE_DISPATCH("Handling <iq type='{0}'> stanza: {1!r}", typ, stanza)
         payload = stanza.get_payload(None)
-        logger.debug("  payload: {0!r}".format(payload))
+        TRACE_DISPATCH("  payload: {0!r}", payload)
         if not payload:
             raise BadRequestProtocolError("<iq/> stanza with no child element")
         handler = self._get_iq_handler(typ, payload)
         if not handler:
             payload = stanza.get_payload(None, specialize = True)
-            logger.debug("  specialized payload: {0!r}".format(payload))
+            TRACE_DISPATCH("  specialized payload: {0!r}", payload)
             if not isinstance(payload, XMLPayload):
                 handler = self._get_iq_handler(typ, payload)
         if handler:
-            response = handler(stanza)
-            self._process_handler_result(response)
+            self._call_handlers([handler], stanza)
             return True
         else:
             raise ServiceUnavailableProtocolError("Not implemented")
@@ -231,17 +270,15 @@ class StanzaProcessor(StanzaRoute):
     def _get_iq_handler(self, iq_type, payload):
         """Get an <iq/> handler for given iq  type and payload."""
         key = (payload.__class__, payload.handler_key)
-        logger.debug("looking up iq {0} handler for {1!r}, key: {2!r}"
-                            .format(iq_type, payload, key))
-        logger.debug("handlers: {0!r}".format(self._iq_handlers))
+        TRACE_DISPATCH("looking up iq {0} handler for {1!r}, key: {2!r}",
+                                                         iq_type, payload, key)
+        TRACE_DISPATCH("handlers: {0!r}", self._iq_handlers)
         handler = self._iq_handlers[iq_type].get(key)
         return handler
 
-    def __try_handlers(self, handler_list, stanza, stanza_type = None):
+    def __match_handlers(self, handler_list, stanza, stanza_type = None):
         """ Search the handler list for handlers matching
-        given stanza type and payload namespace. Run the
-        handlers found ordering them by priority until
-        the first one which returns `True`.
+        given stanza type and payload namespace.
 
         :Parameters:
             - `handler_list`: list of available handlers
@@ -249,8 +286,7 @@ class StanzaProcessor(StanzaRoute):
             - `stanza_type`: stanza type override (value of its "type"
               attribute)
 
-        :return: result of the last handler or `False` if no
-            handler was found.
+        :return: the matching handlers, in the order they should be tried.
         """
         # pylint: disable=W0212
         if stanza_type is None:
@@ -258,6 +294,7 @@ class StanzaProcessor(StanzaRoute):
         payload = stanza.get_all_payload()
         classes = [p.__class__ for p in payload]
         keys = [(p.__class__, p.handler_key) for p in payload]
+        result = []
         for handler in handler_list:
             type_filter = handler._pyxmpp_stanza_handled[1]
             class_filter = handler._pyxmpp_payload_class_handled
@@ -269,11 +306,115 @@ class StanzaProcessor(StanzaRoute):
                     continue
                 if extra_filter and (class_filter, extra_filter) not in keys:
                     continue
-            response = handler(stanza)
+            result.append(handler)
+        return result
+
+    def _call_handlers(self, handlers, stanza):
+        """Run the `handlers` one by one until the first one which returns
+        `True` (or stanzas to send).
+
+        Handlers decorated with `blocking_stanza_handler` are passed to the
+        `worker_pool` (if available) and the rest of the list is processed
+        when such handler returns.
+
+        :Parameters:
+            - `handlers`: the handlers to call
+            - `stanza`: the stanza to handle
+
+        :return: `True` if the stanza was handled or the processing continues
+            in a worker thread, `False` when no handler accepted the stanza.
+        """
+        for i, handler in enumerate(handlers):
+            if self.worker_pool and getattr(handler, "_pyxmpp_blocking", False):
+                self._call_blocking_handler(handler, stanza, handlers[i + 1:])
+                return True
+            response = call_handler(self.instrumentation, STANZA,
+                                                            handler, stanza)
             if self._process_handler_result(response):
                 return True
         return False
 
+    @staticmethod
+    def _sender_key(stanza):
+        """Return the key used to keep stanzas from a single sender
+        in order."""
+        from_jid = stanza.from_jid
+        if from_jid:
+            return from_jid.as_unicode()
+        return None
+
+    def _call_blocking_handler(self, handler, stanza, remaining):
+        """Pass the handler call to the `worker_pool`.
+
+        Until the handler returns, other stanzas from the same sender are held
+        in `_held_stanzas`.
+
+        :Parameters:
+            - `handler`: the handler to call
+            - `stanza`: the stanza to handle
+            - `remaining`: the handlers to try if `handler` doesn't handle
+              the stanza
+        """
+        key = self._sender_key(stanza)
+        callback = partial(self._blocking_handler_done, stanza, remaining)
+        with self.lock:
+            created = key not in self._held_stanzas
+            if created:
+                self._held_stanzas[key] = deque()
+            try:
+                self.worker_pool.submit(partial(call_handler,
+                                self.instrumentation, STANZA, handler, stanza),
+                                                                    callback)
+            except WorkerPoolFull:
+                if created:
+                    del self._held_stanzas[key]
+                raise ResourceConstraintProtocolError(
+                                            "Too many stanzas being processed")
+            self._busy_senders.add(key)
+
+    def _blocking_handler_done(self, stanza, remaining, result, exc_info):
+        """Process the result of a blocking handler, then the stanzas held
+        while it was running.
+
+        [called in the main loop thread]
+
+        :Parameters:
+            - `stanza`: the stanza handled
+            - `remaining`: the handlers to try if the stanza was not handled
+            - `result`: value returned by the handler
+            - `exc_info`: exception information if the handler failed
+        """
+        key = self._sender_key(stanza)
+        with self.lock:
+            self._busy_senders.discard(key)
+        try:
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if not self._process_handler_result(result) and remaining:
+                self._call_handlers(remaining, stanza)
+        except ProtocolError, err:
+            self._report_protocol_error(stanza, err)
+        except WorkerJobCancelled:
+            logger.debug("Blocking stanza handler cancelled")
+            if stanza.stanza_type not in ("error", "result"):
+                self.send(stanza.make_error_response(u"service-unavailable"))
+        except Exception: # pylint: disable-msg=W0703
+            logger.error("Exception in a blocking stanza handler",
+                                                        exc_info = True)
+            if stanza.stanza_type not in ("error", "result"):
+                self.send(stanza.make_error_response(u"internal-server-error"))
+        while True:
+            with self.lock:
+                if key in self._busy_senders:
+                    # another blocking handler started
+                    return
+                held = self._held_stanzas.get(key)
+                if not held:
+                    self._held_stanzas.pop(key, None)
+                    return
+                stanza = held.popleft()
+            self._process_local_stanza(stanza)
+
     def process_message(self, stanza):
         """Process message stanza.
 
@@ -289,15 +430,13 @@ class StanzaProcessor(StanzaRoute):
         if stanza_type is None:
             stanza_type = "normal"
 
-        if self.__try_handlers(self._message_handlers, stanza,
-                                                stanza_type = stanza_type):
-            return True
-
+        handlers = self.__match_handlers(self._message_handlers, stanza,
+                                                    stanza_type = stanza_type)
         if stanza_type not in ("error", "normal"):
             # try 'normal' handler additionaly to the regular handler
-            return self.__try_handlers(self._message_handlers, stanza,
+            handlers += self.__match_handlers(self._message_handlers, stanza,
                                                     stanza_type = "normal")
-        return False
+        return self._call_handlers(handlers, stanza)
 
     def process_presence(self, stanza):
         """Process presence stanza.
@@ -308,8 +447,8 @@ class StanzaProcessor(StanzaRoute):
             - `stanza`: presence stanza to be handled
         """
 
-        stanza_type = stanza.stanza_type
-        return self.__try_handlers(self._presence_handlers, stanza, stanza_type)
+        handlers = self.__match_handlers(self._presence_handlers, stanza)
+        return self._call_handlers(handlers, stanza)
 
     def route_stanza(self, stanza):
         """Process stanza not addressed to us.
@@ -332,11 +471,12 @@ class StanzaProcessor(StanzaRoute):
     def process_stanza(self, stanza):
         """Process stanza received from the stream.
 
-        First "fix" the stanza with `self.fix_in_stanza()`,
-        then pass it to `self.route_stanza()` if it is not directed
-        to `self.me` and `self.process_all_stanzas` is not True. Otherwise
-        stanza is passwd to `self.process_iq()`, `self.process_message()`
-        or `self.process_presence()` appropriately.
+        First "fix" the stanza with `self.fix_in_stanza()`, check it against
+        the `rate_limiter` (if any, responses to our own requests are not
+        limited), then pass it to `self.route_stanza()` if
+        it is not directed to `self.me` and `self.process_all_stanzas` is not
+        True. Otherwise stanza is passwd to `self.process_iq()`,
+        `self.process_message()` or `self.process_presence()` appropriately.
 
         :Parameters:
             - `stanza`: the stanza received.
@@ -345,12 +485,50 @@ class StanzaProcessor(StanzaRoute):
         """
 
         self.fix_in_stanza(stanza)
+
+        if self.rate_limiter and not (isinstance(stanza, Iq)
+                        and stanza.stanza_type in ("result", "error")
+                        and self._response_handlers_key(stanza) is not None):
+            delay = self.rate_limiter.check(stanza)
+            if delay is None:
+                if self.rate_limiter.policy == "error":
+                    self._report_protocol_error(stanza,
+                        ResourceConstraintProtocolError("Rate limit exceeded"))
+                return True
+            elif delay:
+                self.rate_limiter.schedule(delay,
+                                    partial(self._dispatch_stanza, stanza))
+                return True
+
+        return self._dispatch_stanza(stanza)
+
+    def _dispatch_stanza(self, stanza):
+        """Route a stanza received or pass it to the local handlers.
+
+        :returns: `True` when stanza was handled
+        """
         to_jid = stanza.to_jid
 
         if not self.process_all_stanzas and to_jid and (
                 to_jid != self.me and to_jid.bare() != self.me.bare()):
             return self.route_stanza(stanza)
 
+        if self._held_stanzas:
+            key = self._sender_key(stanza)
+            with self.lock:
+                if key in self._held_stanzas:
+                    # keep the order of stanzas from a single sender
+                    self._held_stanzas[key].append(stanza)
+                    return True
+
+        return self._process_local_stanza(stanza)
+
+    def _process_local_stanza(self, stanza):
+        """Pass a stanza addressed to us to `self.process_iq()`,
+        `self.process_message()` or `self.process_presence()`.
+
+        :returns: `True` when stanza was handled
+        """
         try:
             if isinstance(stanza, Iq):
                 if self.process_iq(stanza):
@@ -362,19 +540,25 @@ class StanzaProcessor(StanzaRoute):
                 if self.process_presence(stanza):
                     return True
         except ProtocolError, err:
-            typ = stanza.stanza_type
-            if typ != 'error' and (typ != 'result'
-                                                or stanza.stanza_type != 'iq'):
-                response = stanza.make_error_response(err.xmpp_name)
-                self.send(response)
-                err.log_reported()
-            else:
-                err.log_ignored()
+            self._report_protocol_error(stanza, err)
             return
         logger.debug("Unhandled %r stanza: %r" % (stanza.stanza_type,
                                                         stanza.serialize()))
         return False
 
+    def _report_protocol_error(self, stanza, err):
+        """Send an error response for a stanza which processing raised
+        a `ProtocolError`, unless the stanza is an error or a result itself.
+        """
+        typ = stanza.stanza_type
+        if typ != 'error' and (typ != 'result'
+                                            or stanza.stanza_type != 'iq'):
+            response = stanza.make_error_response(err.xmpp_name)
+            self.send(response)
+            err.log_reported()
+        else:
+            err.log_ignored()
+
     def check_to(self, to_jid):
         """Check "to" attribute of received stream header.
 
@@ -48,6 +48,7 @@ from .stanzaprocessor import stanza_factory
 
 from .interfaces import StreamFeatureHandler
 from .interfaces import StreamFeatureHandled, StreamFeatureNotHandled
+from .trace import TRACE_DISPATCH
 
 logger = logging.getLogger("pyxmpp2.streambase")
 
@@ -73,6 +74,7 @@ class StreamBase(XMLStreamHandler):
 
     :Ivariables:
         - `authenticated`: `True` if local entity has authenticated to peer
+        - `compression_established`: `True` when the stream is compressed
         - `features`: stream features as annouced by the receiver.
         - `handlers`: handlers for stream elements
         - `initiator`: `True` if local stream endpoint is the initiating entity.
@@ -83,11 +85,15 @@ class StreamBase(XMLStreamHandler):
           by the peer
         - `peer`: remote stream endpoint JID.
         - `settings`: stream settings
+        - `sm_state`: stream management state, when the stream management
+          is enabled
         - `stanza_namespace`: default namespace of the stream
         - `tls_established`: `True` when the stream is protected by TLS
         - `transport`: transport used by this stream
         - `version`: Negotiated version of the XMPP protocol. (0,9) for the
           legacy (pre-XMPP) Jabber protocol.
+        - `_cached_features`: features cached from a previous connection,
+          acted upon before the peer's features arrive (pipelining)
         - `_element_handlers`: mapping from stream element names to lists of
           methods handling them
         - `_input_state`: `None`, "open" (<stream:stream> has been received)
@@ -98,6 +104,7 @@ class StreamBase(XMLStreamHandler):
         - `_stream_feature_handlers`: stream features handlers
     :Types:
         - `authenticated`: `bool`
+        - `compression_established`: `bool`
         - `features`: :etree:`ElementTree.Element`
         - `handlers`: `list`
         - `initiator`: `bool`
@@ -107,10 +114,12 @@ class StreamBase(XMLStreamHandler):
         - `peer_language`: `unicode`
         - `peer`: `JID`
         - `settings`: XMPPSettings
+        - `sm_state`: `streammanagement.StreamManagementState`
         - `stanza_namespace`: `unicode`
         - `tls_established`: `bool`
         - `transport`: `transport.XMPPTransport`
         - `version`: (`int`, `int`) tuple
+        - `_cached_features`: :etree:`ElementTree.Element`
         - `_element_handlers`: `dict`
         - `_input_state`: `unicode`
         - `_output_state`: `unicode`
@@ -155,14 +164,18 @@ class StreamBase(XMLStreamHandler):
         self.authenticated = False
         self.peer_authenticated = False
         self.tls_established = False
+        self.compression_established = False
         self.auth_method_used = None
         self.version = None
         self.language = None
         self.peer_language = None
         self.transport = None
+        self.sm_state = None
         self._input_state = None
         self._output_state = None
         self._element_handlers = {}
+        self._features_cache_peer = None
+        self._cached_features = None
 
     def initiate(self, transport, to = None):
         """Initiate an XMPP connection over the `transport`.
@@ -177,6 +190,7 @@ class StreamBase(XMLStreamHandler):
             transport.set_target(self)
             if to:
                 self.peer = JID(to)
+                self._features_cache_peer = unicode(self.peer)
             else:
                 self.peer = None
             if transport.is_connected():
@@ -189,6 +203,7 @@ class StreamBase(XMLStreamHandler):
         """
         self._setup_stream_element_handlers()
         self._send_stream_start()
+        self._pipeline_features()
 
     def receive(self, transport, myname):
         """Receive an XMPP connection over the `transport`.
@@ -428,6 +443,53 @@ class StreamBase(XMLStreamHandler):
         self.transport.restart()
         if self.initiator:
             self._send_stream_start(self.stream_id)
+            self._pipeline_features()
+
+    def _features_cache_key(self):
+        """Get the :r:`stream_features_cache setting` key for the features
+        expected at the current stage of the stream negotiation.
+
+        [initiating entity only]
+
+        :Return: the key or `None` if features should not be cached
+        """
+        if not self._features_cache_peer:
+            return None
+        return (self._features_cache_peer, self.tls_established,
+                                self.authenticated, self.compression_established)
+
+    def _pipeline_features(self):
+        """Act on the features cached from a previous connection to the same
+        peer, without waiting for the peer's <features/>.
+
+        Used when the :r:`stream_pipelining setting` is enabled.
+        The feature handlers may send their requests speculatively
+        (see `StreamFeatureHandler.handle_cached_stream_features`) and
+        must check them against the features actually received.
+
+        [initiating entity only, called with `lock` acquired]
+        """
+        self._cached_features = None
+        if not self.settings["stream_pipelining"]:
+            return
+        key = self._features_cache_key()
+        if key is None:
+            return
+        cached = self.settings["stream_features_cache"].get(key)
+        if cached is None:
+            return
+        logger.debug("Pipelining with cached features: {0}"
+                                                    .format(serialize(cached)))
+        self._cached_features = cached
+        self.features = cached
+        try:
+            for handler in self._stream_feature_handlers:
+                ret = handler.handle_cached_stream_features(self, cached)
+                if ret is not None:
+                    break
+        finally:
+            if self.features is cached:
+                self.features = None
 
     def _make_stream_features(self):
         """Create the <features/> element for the stream.
@@ -480,6 +542,14 @@ class StreamBase(XMLStreamHandler):
         self.fix_out_stanza(stanza)
         element = stanza.as_xml()
         self._write_element(element)
+        if self.sm_state is not None:
+            request = self.sm_state.stanza_sent(element)
+            if self.sm_state.overflow:
+                logger.warning("Too many stanzas not acknowledged by the peer,"
+                                                    " closing the stream")
+                self._send_stream_error("resource-constraint")
+            elif request is not None:
+                self._write_element(request)
 
     def _process_element(self, element):
         """Process first level element of the stream.
@@ -495,12 +565,14 @@ class StreamBase(XMLStreamHandler):
         tag = element.tag
         if tag in self._element_handlers:
             handler = self._element_handlers[tag]
-            logger.debug("Passing element {0!r} to method {1!r}"
-                                                .format(element, handler))
+            TRACE_DISPATCH("Passing element {0!r} to method {1!r}",
+                                                              element, handler)
             handled = handler(self, element)
             if handled:
                 return
         if tag.startswith(self._stanza_namespace_p):
+            if self.sm_state is not None:
+                self.sm_state.stanza_received()
             stanza = stanza_factory(element, self, self.language)
             self.uplink_receive(stanza)
         elif tag == ERROR_TAG:
@@ -560,6 +632,14 @@ class StreamBase(XMLStreamHandler):
 
         The received features node is available in `features`."""
         self.features = features
+        if self.settings["stream_pipelining"]:
+            key = self._features_cache_key()
+            if key is not None:
+                self.settings["stream_features_cache"][key] = features
+            cached = self._cached_features
+            if cached is not None and serialize(cached) != serialize(features):
+                logger.debug("Features differ from the cached ones")
+            self._cached_features = None
         logger.debug("got features, passing to event handlers...")
         handled = self.event(GotFeaturesEvent(self.features))
         logger.debug("  handled: {0}".format(handled))
@@ -682,6 +762,22 @@ XMPPSettings.add_setting(u"extra_auth_properties", type = "dictionary",
         doc = u"""Extra properties to pass to the SASL authenticators."""
     )
 
+XMPPSettings.add_setting(u"stream_pipelining", type = bool, default = False,
+        cmdline_help = u"Pipeline the stream negotiation",
+        doc = u"""Send the stream negotiation requests (e.g. SASL
+authentication or resource binding) together with the stream header,
+without waiting for the peer's features, when the features received on the
+previous connection to the same peer permit that. Saves a round trip on each
+negotiation step."""
+    )
+XMPPSettings.add_setting(u"stream_features_cache", type = "dictionary",
+        factory = lambda settings: {}, cache = True,
+        default_d = u"Shared by all streams",
+        doc = u"""Stream features received from the peers, as a mapping
+from (peer, TLS established, authenticated, compression established) tuples to
+the <features/> elements. Used for the :r:`stream_pipelining setting`."""
+    )
+
 XMPPSettings.add_setting(u"extra_ns_prefixes", type = "prefix -> uri mapping",
         default = {},
         doc = u"""Extra namespace prefix declarations to use at the stream root
@@ -0,0 +1,251 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Stream compression support for XMPP streams.
+
+Only the 'zlib' method is supported. The compression itself is done by the
+transport (`transport.TCPTransport.start_compression`).
+
+Normative reference:
+  - `XEP-0138 <http://xmpp.org/extensions/xep-0138.html>`__
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import logging
+
+from .etree import ElementTree
+from .constants import COMPRESS_FEATURE_QNP, COMPRESS_QNP
+from .settings import XMPPSettings
+
+from .interfaces import StreamFeatureHandler
+from .interfaces import StreamFeatureHandled, StreamFeatureNotHandled
+from .interfaces import stream_element_handler
+
+COMPRESSION_TAG = COMPRESS_FEATURE_QNP + u"compression"
+FEATURE_METHOD_TAG = COMPRESS_FEATURE_QNP + u"method"
+COMPRESS_TAG = COMPRESS_QNP + u"compress"
+METHOD_TAG = COMPRESS_QNP + u"method"
+COMPRESSED_TAG = COMPRESS_QNP + u"compressed"
+FAILURE_TAG = COMPRESS_QNP + u"failure"
+
+METHODS = [u"zlib"]
+
+logger = logging.getLogger("pyxmpp2.streamcompression")
+
+class StreamCompressionHandler(StreamFeatureHandler):
+    """Handler for the stream compression.
+
+    The compression is offered and requested only on authenticated streams.
+    On the initiating side the handler should be placed before the
+    resource binding handler, so the compression is negotiated first.
+
+    :Ivariables:
+        - `settings`: the settings
+        - `requested`: `True` when <compress/> has been sent and the answer
+          is not received yet
+        - `failed`: `True` when the peer refused the compression
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `requested`: `bool`
+        - `failed`: `bool`
+    """
+    def __init__(self, settings = None):
+        """Initialize the compression handler.
+
+        :Parameters:
+          - `settings`: the settings
+        :Types:
+          - `settings`: `XMPPSettings`
+        """
+        if settings is None:
+            self.settings = XMPPSettings()
+        else:
+            self.settings = settings
+        self.requested = False
+        self.failed = False
+
+    def make_stream_features(self, stream, features):
+        """Update the <features/> element with the compression feature.
+
+        [receving entity only]
+        """
+        if (self.settings["compression"] and stream.peer_authenticated
+                                    and not stream.compression_established):
+            element = ElementTree.SubElement(features, COMPRESSION_TAG)
+            for method in METHODS:
+                ElementTree.SubElement(element, FEATURE_METHOD_TAG).text = \
+                                                                        method
+        return features
+
+    def _select_method(self, stream, element):
+        """Select the compression method to request.
+
+        [initiating entity only]
+
+        :Parameters:
+            - `stream`: the stream
+            - `element`: the <compression/> feature element
+        :Types:
+            - `stream`: `StreamBase`
+            - `element`: :etree:`ElementTree.Element`
+
+        :Return: the method name or `None` if the compression should not be
+            requested
+        :Returntype: `unicode`
+        """
+        if (not self.settings["compression"] or self.failed
+                                            or stream.compression_established):
+            return None
+        methods = [sub.text for sub in element.findall(FEATURE_METHOD_TAG)]
+        for method in METHODS:
+            if method in methods:
+                return method
+        logger.debug("No supported compression method offered")
+        return None
+
+    def handle_stream_features(self, stream, features):
+        """Request the compression if it is offered by the peer.
+
+        [initiating entity only]
+        """
+        element = features.find(COMPRESSION_TAG)
+        if element is None:
+            return None
+        method = self._select_method(stream, element)
+        if method is None:
+            return StreamFeatureNotHandled("Compression")
+        logger.debug("Requesting {0} stream compression".format(method))
+        request = ElementTree.Element(COMPRESS_TAG)
+        ElementTree.SubElement(request, METHOD_TAG).text = method
+        self.requested = True
+        stream.write_element(request)
+        return StreamFeatureHandled("Compression")
+
+    def handle_cached_stream_features(self, stream, features):
+        """Stop the negotiation pipelining when the compression is expected.
+
+        [initiating entity only]
+        """
+        element = features.find(COMPRESSION_TAG)
+        if element is None or self._select_method(stream, element) is None:
+            return None
+        return StreamFeatureNotHandled("Compression")
+
+    @stream_element_handler(COMPRESSED_TAG, "initiator")
+    def _process_compressed(self, stream, element):
+        """Handle the <compressed/> element: start the compression and
+        restart the stream.
+
+        [initiating entity only]
+        """
+        if not self.requested:
+            logger.debug("Unexpected compression element: {0!r}"
+                                                            .format(element))
+            return False
+        self.requested = False
+        logger.debug("Stream compression established")
+        stream.transport.start_compression()
+        stream.compression_established = True
+        stream._restart_stream() # pylint: disable-msg=W0212
+        return True
+
+    @stream_element_handler(FAILURE_TAG, "initiator")
+    def _process_failure(self, stream, element):
+        """Handle the <failure/> element: continue the stream negotiation
+        without the compression.
+
+        [initiating entity only]
+        """
+        if not self.requested:
+            logger.debug("Unexpected compression element: {0!r}"
+                                                            .format(element))
+            return False
+        self.requested = False
+        self.failed = True
+        logger.warning("Stream compression refused by peer")
+        stream._got_features(stream.features) # pylint: disable-msg=W0212
+        return True
+
+    @stream_element_handler(COMPRESS_TAG, "receiver")
+    def _process_compress(self, stream, element):
+        """Handle the <compress/> request: start the compression and
+        restart the stream or reply with <failure/>.
+
+        [receiving entity only]
+        """
+        if (not self.settings["compression"] or not stream.peer_authenticated
+                                        or stream.compression_established):
+            logger.debug("Unexpected compression request")
+            self._refuse(stream, u"setup-failed")
+            return True
+        method = element.find(METHOD_TAG)
+        if method is None or method.text not in METHODS:
+            self._refuse(stream, u"unsupported-method")
+            return True
+        stream.write_element(ElementTree.Element(COMPRESSED_TAG))
+        logger.debug("Stream compression established")
+        stream.transport.start_compression()
+        stream.compression_established = True
+        stream._restart_stream() # pylint: disable-msg=W0212
+        return True
+
+    @staticmethod
+    def _refuse(stream, condition):
+        """Send the <failure/> element.
+
+        [receiving entity only]
+        """
+        element = ElementTree.Element(FAILURE_TAG)
+        ElementTree.SubElement(element, COMPRESS_QNP + condition)
+        stream.write_element(element)
+
+XMPPSettings.add_setting(u"compression", type = bool, default = False,
+        cmdline_help = "Enable stream compression",
+        doc = u"""Enable the stream compression (XEP-0138). Note that
+compression of the encrypted streams may reveal information about their
+content."""
+    )
+
+XMPPSettings.add_setting(u"compression_level", type = int, default = 6,
+        validator = XMPPSettings.get_int_range_validator(0, 10),
+        cmdline_help = "Stream compression level",
+        doc = u"""The zlib compression level: from 1 (fastest) to 9 (best
+compression), 0 means no compression."""
+    )
+
+XMPPSettings.add_setting(u"compression_window_bits", type = int, default = 15,
+        validator = XMPPSettings.get_int_range_validator(9, 16),
+        cmdline_help = "Stream compression window size (as a power of two)",
+        doc = u"""Base-2 logarithm of the zlib compression window size. Smaller
+windows use less memory per stream, but compress worse. The decompressor
+always accepts the full window, as chosen by the peer."""
+    )
+
+XMPPSettings.add_setting(u"compression_max_inflated", type = int,
+        default = 4194304,
+        validator = XMPPSettings.validate_positive_int,
+        cmdline_help = "Maximum size of data decompressed from a single"
+                                                            " read",
+        doc = u"""Maximum number of bytes decompressed from a single block of
+compressed data received. The connection is closed with an I/O error when
+the peer sends more ('zlib bomb')."""
+    )
+
+# vi: sts=4 et sw=4
@@ -86,13 +86,15 @@ class ConnectedEvent(StreamEvent):
     XMPP exchange happens.
 
     :Ivariables:
-        - `sockaddr`: remote IP address and port
+        - `sockaddr`: remote IP address and port or Unix socket path
     :Types:
-        - `sockaddr`: (`str`, `int`)
+        - `sockaddr`: (`str`, `int`) or `str`
     """
     def __init__(self, sockaddr):
         self.sockaddr = sockaddr
     def __unicode__(self):
+        if isinstance(self.sockaddr, basestring):
+            return u"Connected to {0}".format(self.sockaddr)
         ipaddr, port = self.sockaddr
         if ":" in ipaddr:
             return u"Connected to [{0}]:{1}".format(ipaddr, port)
@@ -106,13 +108,15 @@ class ConnectingEvent(StreamEvent):
     Probably useful only for connection progres monitoring.
 
     :Ivariables:
-        - `sockaddr`: remote IP address and port
+        - `sockaddr`: remote IP address and port or Unix socket path
     :Types:
-        - `sockaddr`: (`str`, `int`)
+        - `sockaddr`: (`str`, `int`) or `str`
     """
     def __init__(self, sockaddr):
         self.sockaddr = sockaddr
     def __unicode__(self):
+        if isinstance(self.sockaddr, basestring):
+            return u"Connecting to {0}...".format(self.sockaddr)
         ipaddr, port = self.sockaddr
         if ":" in ipaddr:
             return u"Connecting to [{0}]:{1}...".format(ipaddr, port)
@@ -251,6 +255,25 @@ class TLSConnectedEvent(StreamEvent):
         return u"TLS connected using {0} cipher {1} ({2} bits)".format(
                             self.cipher[0], self.cipher[1], self.cipher[2])
 
+class StreamResumedEvent(StreamEvent):
+    """Emitted when a previous session has been resumed on a new stream
+    (XEP-0198 stream management).
+
+    The stream is authorized as `resumed_jid` and the stanzas not
+    acknowledged on the previous stream have been sent again. Unlike after
+    the `AuthorizedEvent`, the roster and the presence should not be sent
+    again.
+
+    :Ivariables:
+        - `resumed_jid`: JID of the session resumed
+    :Types:
+        - `resumed_jid`: `pyxmpp2.jid.JID`
+    """
+    def __init__(self, resumed_jid):
+        self.resumed_jid = resumed_jid
+    def __unicode__(self):
+        return u"Resumed: {0}".format(self.resumed_jid)
+
 class StreamRestartedEvent(StreamEvent):
     """Emitted after stream is restarted (<stream:stream> tag exchange)
     e.g. after SASL.
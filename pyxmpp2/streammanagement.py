@@ -0,0 +1,482 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Stream management: stanza acknowledgements and stream resumption.
+
+`StreamBase` counts the stanzas sent and received in its `sm_state`
+(`StreamManagementState`) once the stream management is enabled by the
+`StreamManagementHandler`. The handler keeps the state after the stream
+is closed, so the session can be resumed on the next connection made with
+the same handler (as `client.Client.connect` does), instead of binding
+a new resource and fetching the roster again. The stanzas not acknowledged
+by the server are sent again after resumption.
+
+The receiving side supports the acknowledgements only, as there is no
+session registry to resume the sessions from.
+
+Normative reference:
+  - `XEP-0198 <http://xmpp.org/extensions/xep-0198.html>`__
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import logging
+import uuid
+
+from collections import deque
+
+from .etree import ElementTree
+from .constants import SM_QNP, STANZA_ERROR_QNP
+from .settings import XMPPSettings
+from .streamevents import AuthorizedEvent, StreamResumedEvent
+
+from .interfaces import StreamFeatureHandler
+from .interfaces import StreamFeatureHandled, StreamFeatureNotHandled
+from .interfaces import stream_element_handler
+from .interfaces import EventHandler, event_handler
+
+SM_FEATURE_TAG = SM_QNP + u"sm"
+ENABLE_TAG = SM_QNP + u"enable"
+ENABLED_TAG = SM_QNP + u"enabled"
+RESUME_TAG = SM_QNP + u"resume"
+RESUMED_TAG = SM_QNP + u"resumed"
+FAILED_TAG = SM_QNP + u"failed"
+REQUEST_TAG = SM_QNP + u"r"
+ANSWER_TAG = SM_QNP + u"a"
+
+# the stanza counters wrap around at 2^32
+COUNTER_MODULO = 2 ** 32
+
+logger = logging.getLogger("pyxmpp2.streammanagement")
+
+class StreamManagementState(object):
+    """Stream management session state.
+
+    :Ivariables:
+        - `session_id`: the stream management session id (from <enabled/>)
+        - `resumable`: `True` if the session may be resumed
+        - `jid`: full JID of the session
+        - `inbound`: number of stanzas received (modulo 2^32)
+        - `outbound`: number of stanzas sent (modulo 2^32)
+        - `acked`: number of stanzas sent and acknowledged by the peer
+          (modulo 2^32)
+        - `unacked`: stanzas sent, but not acknowledged by the peer yet
+        - `counting_inbound`: `True` when the received stanzas are counted
+        - `ack_interval`: number of stanzas sent, after which an
+          acknowledgement should be requested (0 for never)
+        - `max_unacked`: maximum number of stanzas kept unacknowledged
+          (0 for no limit)
+    :Types:
+        - `session_id`: `unicode`
+        - `resumable`: `bool`
+        - `jid`: `JID`
+        - `inbound`: `int`
+        - `outbound`: `int`
+        - `acked`: `int`
+        - `unacked`: :std:`collections.deque` of :etree:`ElementTree.Element`
+        - `counting_inbound`: `bool`
+        - `ack_interval`: `int`
+        - `max_unacked`: `int`
+    """
+    # pylint: disable=R0902
+    def __init__(self, ack_interval = 0, counting_inbound = True,
+                                                        max_unacked = 0):
+        """Initialize the state.
+
+        :Parameters:
+            - `ack_interval`: number of stanzas sent, after which an
+              acknowledgement should be requested (0 for never)
+            - `counting_inbound`: `True` if the received stanzas should be
+              counted from now on
+            - `max_unacked`: maximum number of stanzas kept unacknowledged
+              (0 for no limit)
+        :Types:
+            - `ack_interval`: `int`
+            - `counting_inbound`: `bool`
+            - `max_unacked`: `int`
+        """
+        self.session_id = None
+        self.resumable = False
+        self.jid = None
+        self.inbound = 0
+        self.outbound = 0
+        self.acked = 0
+        self.unacked = deque()
+        self.counting_inbound = counting_inbound
+        self.ack_interval = ack_interval
+        self.max_unacked = max_unacked
+
+    @property
+    def overflow(self):
+        """`True` when more stanzas are waiting for the acknowledgement than
+        `max_unacked` allows."""
+        return bool(self.max_unacked) and len(self.unacked) > self.max_unacked
+
+    def stanza_received(self):
+        """Count a stanza received."""
+        if self.counting_inbound:
+            self.inbound = (self.inbound + 1) % COUNTER_MODULO
+
+    def stanza_sent(self, element):
+        """Count a stanza sent and keep it until acknowledged.
+
+        :Parameters:
+            - `element`: the stanza sent
+        :Types:
+            - `element`: :etree:`ElementTree.Element`
+
+        :Return: the <r/> element to send, when an acknowledgement should be
+            requested now, `None` otherwise.
+        """
+        self.outbound = (self.outbound + 1) % COUNTER_MODULO
+        self.unacked.append(element)
+        if self.ack_interval and len(self.unacked) % self.ack_interval == 0:
+            return ElementTree.Element(REQUEST_TAG)
+        return None
+
+    def ack(self, handled):
+        """Process the number of stanzas handled by the peer.
+
+        :Parameters:
+            - `handled`: the 'h' value received from the peer
+        :Types:
+            - `handled`: `int`
+        """
+        count = (handled - self.acked) % COUNTER_MODULO
+        if count > len(self.unacked):
+            logger.warning("Peer acknowledged {0} stanzas, but only {1}"
+                            " were sent".format(count, len(self.unacked)))
+            count = len(self.unacked)
+        for dummy in range(count):
+            self.unacked.popleft()
+        # the bogus excess is not counted, so the later acks still match
+        # the stanzas sent
+        self.acked = (self.acked + count) % COUNTER_MODULO
+
+class StreamManagementHandler(StreamFeatureHandler, EventHandler):
+    """Handler for the stream management.
+
+    On the initiating side the handler should be placed before the
+    resource binding handler, so it can resume the previous session instead
+    of binding a new resource. One handler instance should be used for the
+    consecutive connections of a client to keep the session state.
+
+    :Ivariables:
+        - `settings`: the settings
+        - `state`: state of the last session enabled [initiator only]
+        - `_request`: the request waiting for the reply: "enable", "resume"
+          or `None`
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `state`: `StreamManagementState`
+        - `_request`: `unicode`
+    """
+    def __init__(self, settings = None):
+        """Initialize the stream management handler.
+
+        :Parameters:
+          - `settings`: the settings
+        :Types:
+          - `settings`: `XMPPSettings`
+        """
+        if settings is None:
+            self.settings = XMPPSettings()
+        else:
+            self.settings = settings
+        self.state = None
+        self._request = None
+
+    @property
+    def resumable(self):
+        """`True` when there is a session to resume on the next connection.
+        """
+        return (self.state is not None and self.state.resumable
+                                and self.settings["stream_management_resume"])
+
+    def reset(self):
+        """Forget the session state, e.g. after the session has been closed
+        gracefully."""
+        self.state = None
+
+    def make_stream_features(self, stream, features):
+        """Add the stream management feature to the <features/> element.
+
+        [receving entity only]
+        """
+        if (self.settings["stream_management"] and stream.peer_authenticated
+                                                and stream.sm_state is None):
+            ElementTree.SubElement(features, SM_FEATURE_TAG)
+        return features
+
+    def handle_stream_features(self, stream, features):
+        """Resume the previous session, if possible.
+
+        A new session is enabled after the resource binding.
+
+        [initiating entity only]
+        """
+        if features.find(SM_FEATURE_TAG) is None:
+            return None
+        if not self.settings["stream_management"] or not stream.authenticated:
+            return None
+        if stream.sm_state is not None or not self._can_resume(stream):
+            return None
+        state = self.state
+        logger.debug("Resuming stream management session {0!r}"
+                                                    .format(state.session_id))
+        element = ElementTree.Element(RESUME_TAG)
+        element.set("previd", state.session_id)
+        element.set("h", unicode(state.inbound))
+        self._request = "resume"
+        stream.write_element(element)
+        return StreamFeatureHandled("Stream management")
+
+    def handle_cached_stream_features(self, stream, features):
+        """Stop the negotiation pipelining when the session is to be resumed,
+        so the resource binding is not requested.
+
+        [initiating entity only]
+        """
+        if features.find(SM_FEATURE_TAG) is None:
+            return None
+        if not self.settings["stream_management"] or not stream.authenticated:
+            return None
+        if stream.sm_state is not None or not self._can_resume(stream):
+            return None
+        return StreamFeatureNotHandled("Stream management")
+
+    def _can_resume(self, stream):
+        """Check if the previous session can be resumed on the `stream`.
+
+        [initiating entity only]
+        """
+        if not self.resumable or not self.state.session_id:
+            return False
+        if not stream.me or self.state.jid.bare() != stream.me.bare():
+            return False
+        return True
+
+    @event_handler(AuthorizedEvent)
+    def handle_authorized(self, event):
+        """Enable the stream management after the resource binding, if
+        supported by the server.
+
+        [initiating entity only]
+        """
+        stream = event.stream
+        if not stream or not stream.initiator:
+            return
+        if not self.settings["stream_management"]:
+            return
+        with stream.lock:
+            if stream.sm_state is not None or stream.features is None:
+                return
+            if stream.features.find(SM_FEATURE_TAG) is None:
+                return
+            logger.debug("Enabling stream management")
+            element = ElementTree.Element(ENABLE_TAG)
+            if self.settings["stream_management_resume"]:
+                element.set("resume", "true")
+            self._request = "enable"
+            stream.write_element(element)
+            stream.sm_state = StreamManagementState(
+                            self.settings["stream_management_ack_interval"],
+                            counting_inbound = False,
+                            max_unacked =
+                                self.settings["stream_management_max_unacked"])
+
+    @stream_element_handler(ENABLED_TAG, "initiator")
+    def _process_enabled(self, stream, element):
+        """Handle the <enabled/> element.
+
+        [initiating entity only]
+        """
+        if self._request != "enable" or stream.sm_state is None:
+            logger.debug("Unexpected <enabled/>")
+            return False
+        self._request = None
+        state = stream.sm_state
+        state.session_id = element.get("id")
+        state.resumable = element.get("resume") in ("true", "1")
+        state.jid = stream.me
+        state.counting_inbound = True
+        self.state = state
+        logger.debug("Stream management enabled, session id: {0!r}"
+                                                    .format(state.session_id))
+        return True
+
+    @stream_element_handler(RESUMED_TAG, "initiator")
+    def _process_resumed(self, stream, element):
+        """Handle the <resumed/> element: acknowledge the stanzas handled by
+        the server and send the rest again.
+
+        [initiating entity only]
+        """
+        if self._request != "resume":
+            logger.debug("Unexpected <resumed/>")
+            return False
+        self._request = None
+        state = self.state
+        try:
+            handled = int(element.get("h"))
+        except (TypeError, ValueError):
+            logger.warning("Invalid 'h' in <resumed/>")
+            handled = state.acked
+        state.ack(handled)
+        stream.sm_state = state
+        stream.me = state.jid
+        logger.debug("Session resumed, sending {0} unacknowledged stanzas"
+                                                .format(len(state.unacked)))
+        for stanza in list(state.unacked):
+            stream.write_element(stanza)
+        stream.event(StreamResumedEvent(stream.me))
+        return True
+
+    @stream_element_handler(FAILED_TAG, "initiator")
+    def _process_failed(self, stream, element):
+        """Handle the <failed/> element.
+
+        When resumption failed, continue the stream negotiation (bind a new
+        resource).
+
+        [initiating entity only]
+        """
+        request = self._request
+        if request is None:
+            logger.debug("Unexpected <failed/>")
+            return False
+        self._request = None
+        if request == "enable":
+            logger.debug("Server refused to enable stream management")
+            stream.sm_state = None
+            return True
+        if self.state.unacked:
+            logger.warning("Session resumption failed, {0} unacknowledged"
+                        " stanzas lost".format(len(self.state.unacked)))
+        else:
+            logger.debug("Session resumption failed")
+        self.state = None
+        stream._got_features(stream.features) # pylint: disable-msg=W0212
+        return True
+
+    @stream_element_handler(ENABLE_TAG, "receiver")
+    def _process_enable(self, stream, element):
+        """Handle the <enable/> request.
+
+        [receiving entity only]
+        """
+        _unused = element
+        if (not self.settings["stream_management"]
+                or not stream.peer_authenticated
+                or stream.sm_state is not None):
+            self._refuse(stream, u"unexpected-request")
+            return True
+        stream.sm_state = StreamManagementState(
+                            self.settings["stream_management_ack_interval"],
+                            max_unacked =
+                                self.settings["stream_management_max_unacked"])
+        reply = ElementTree.Element(ENABLED_TAG)
+        reply.set("id", unicode(uuid.uuid4()))
+        stream.write_element(reply)
+        return True
+
+    @stream_element_handler(RESUME_TAG, "receiver")
+    def _process_resume(self, stream, element):
+        """Handle the <resume/> request: refuse it, as session resumption
+        is not supported on the receiving side.
+
+        [receiving entity only]
+        """
+        _unused = element
+        self._refuse(stream, u"item-not-found")
+        return True
+
+    @staticmethod
+    def _refuse(stream, condition):
+        """Send the <failed/> element.
+
+        [receiving entity only]
+        """
+        element = ElementTree.Element(FAILED_TAG)
+        ElementTree.SubElement(element, STANZA_ERROR_QNP + condition)
+        stream.write_element(element)
+
+    @stream_element_handler(REQUEST_TAG)
+    def _process_request(self, stream, element):
+        """Handle the <r/> element: send the number of stanzas handled.
+        """
+        _unused = element
+        state = stream.sm_state
+        if state is None:
+            logger.debug("Unexpected <r/>")
+            return False
+        answer = ElementTree.Element(ANSWER_TAG)
+        answer.set("h", unicode(state.inbound))
+        stream.write_element(answer)
+        return True
+
+    @stream_element_handler(ANSWER_TAG)
+    def _process_answer(self, stream, element):
+        """Handle the <a/> element: drop the stanzas acknowledged.
+        """
+        state = stream.sm_state
+        if state is None:
+            logger.debug("Unexpected <a/>")
+            return False
+        try:
+            handled = int(element.get("h"))
+        except (TypeError, ValueError):
+            logger.warning("Invalid 'h' in <a/>")
+            return True
+        state.ack(handled)
+        return True
+
+XMPPSettings.add_setting(u"stream_management", type = bool, default = False,
+        cmdline_help = "Enable stream management",
+        doc = u"""Enable the stream management (XEP-0198): stanza
+acknowledgements and, on the client side, session resumption."""
+    )
+
+XMPPSettings.add_setting(u"stream_management_resume", type = bool,
+        default = True,
+        cmdline_help = "Resume the previous session on reconnect",
+        doc = u"""Request a resumable session and resume it on the next
+connection."""
+    )
+
+XMPPSettings.add_setting(u"stream_management_ack_interval", type = int,
+        default = 5,
+        validator = XMPPSettings.get_int_range_validator(0, 2 ** 31),
+        cmdline_help = "Number of stanzas sent between acknowledgement"
+                                                                " requests",
+        doc = u"""Request an acknowledgement from the peer after that many
+stanzas sent. 0 to never request the acknowledgements."""
+    )
+
+XMPPSettings.add_setting(u"stream_management_max_unacked", type = int,
+        default = 1000,
+        validator = XMPPSettings.get_int_range_validator(0, 2 ** 31),
+        cmdline_help = "Maximum number of stanzas waiting for"
+                                                    " an acknowledgement",
+        doc = u"""Maximum number of stanzas sent and not acknowledged by the
+peer yet. When exceeded, the stream is closed with the 'resource-constraint'
+stream error. 0 for no limit."""
+    )
+
+# vi: sts=4 et sw=4
@@ -36,6 +36,8 @@ from .exceptions import SASLNotAvailable, FatalStreamError
 from .exceptions import SASLMechanismNotAvailable, SASLAuthenticationFailed
 from .constants import SASL_QNP
 from .settings import XMPPSettings
+from .mainloop.workers import WorkerPool
+from .sasl.offload import OffloadedServerAuthenticator
 from .interfaces import StreamFeatureHandler
 from .interfaces import StreamFeatureHandled, StreamFeatureNotHandled
 from .interfaces import stream_element_handler
@@ -76,12 +78,35 @@ AUTH_TAG = SASL_QNP + u"auth"
 RESPONSE_TAG = SASL_QNP + u"response"
 ABORT_TAG = SASL_QNP + u"abort"
 
+def _decode_data(element, missing = b""):
+    """Decode the base64-encoded content of a SASL element.
+
+    :Parameters:
+        - `element`: the <auth/>, <challenge/> or <response/> element
+        - `missing`: the value to return when the element is empty
+    :Types:
+        - `element`: :etree:`ElementTree.Element`
+        - `missing`: `bytes`
+
+    :return: the decoded data, `missing` for an empty element and an
+        empty string for '=' (zero-length data).
+    :returntype: `bytes`
+    """
+    content = element.text
+    if content is None or not content.strip():
+        return missing
+    return a2b_base64(content.strip().encode("us-ascii"))
+
 class StreamSASLHandler(StreamFeatureHandler):
     """SASL authentication handler XMPP streams.
 
     :Ivariables:
         - `peer_sasl_mechanisms`: SASL mechanisms offered by peer
         - `authenticator`: the authenticator object
+        - `_speculative`: `True` when the authentication has been started
+          with the cached features
+        - `_ignore_failure`: `True` when a <failure/> reply to the speculative
+          authentication request is expected and should be ignored
     :Types:
         - `peer_sasl_mechanisms`: `list` of `unicode`
         - `authenticator`: `sasl.ClientAuthenticator` or
@@ -94,6 +119,9 @@ class StreamSASLHandler(StreamFeatureHandler):
         self.settings = settings
         self.peer_sasl_mechanisms = None
         self.authenticator = None
+        self._auth_pending = False
+        self._speculative = False
+        self._ignore_failure = False
 
     def make_stream_features(self, stream, features):
         """Add SASL features to the <features/> element of the stream.
@@ -126,6 +154,45 @@ class StreamSASLHandler(StreamFeatureHandler):
         if stream.authenticated or not self.peer_sasl_mechanisms:
             return StreamFeatureNotHandled("SASL", mandatory = True)
 
+        if self._speculative:
+            self._speculative = False
+            if stream.auth_method_used in self.peer_sasl_mechanisms:
+                logger.debug("Pipelined SASL authentication confirmed")
+                return StreamFeatureHandled("SASL", mandatory = True)
+            logger.debug("{0} not offered, restarting authentication"
+                                            .format(stream.auth_method_used))
+            self._ignore_failure = True
+
+        self._start_authentication(stream)
+        return StreamFeatureHandled("SASL", mandatory = True)
+
+    def handle_cached_stream_features(self, stream, features):
+        """Start authentication with the mechanisms from the cached
+        <stream:features/>, without waiting for the actual ones.
+
+        [initiating entity only]
+        """
+        if stream.authenticated or self.authenticator:
+            return None
+        element = features.find(MECHANISMS_TAG)
+        if element is None:
+            return None
+        self.peer_sasl_mechanisms = [sub.text for sub in element
+                                                if sub.tag == MECHANISM_TAG]
+        try:
+            self._start_authentication(stream)
+        except (SASLNotAvailable, SASLMechanismNotAvailable), err:
+            logger.debug("Cannot pipeline SASL authentication: {0}"
+                                                                .format(err))
+            return StreamFeatureNotHandled("SASL", mandatory = True)
+        self._speculative = True
+        return StreamFeatureHandled("SASL", mandatory = True)
+
+    def _start_authentication(self, stream):
+        """Start SASL authentication with the configured credentials.
+
+        [initiating entity only]
+        """
         username = self.settings.get("username")
         if not username:
             # TODO: other rules for s2s
@@ -134,7 +201,6 @@ class StreamSASLHandler(StreamFeatureHandler):
             else:
                 username = None
         self._sasl_authenticate(stream, username, self.settings.get("authzid"))
-        return StreamFeatureHandled("SASL", mandatory = True)
 
     @stream_element_handler(AUTH_TAG, "receiver")
     def process_sasl_auth(self, stream, element):
@@ -155,11 +221,69 @@ class StreamSASLHandler(StreamFeatureHandler):
         stream.auth_method_used = mechanism
         self.authenticator = sasl.server_authenticator_factory(mechanism,
                                                                 password_db)
+        worker_pool = self.settings.get("sasl_worker_pool")
+        if worker_pool is not None:
+            self.authenticator = OffloadedServerAuthenticator(
+                                            self.authenticator, worker_pool)
+
+        # no content means no initial response, '=' an empty one
+        initial_response = _decode_data(element, None)
+        properties = stream.auth_properties
+        self._auth_step(stream, lambda authenticator, callback:
+                authenticator.start_async(properties, initial_response,
+                                                                    callback))
+        return True
 
-        content = element.text.encode("us-ascii")
-        ret = self.authenticator.start(stream.auth_properties,
-                                                a2b_base64(content))
+    def _auth_step(self, stream, step):
+        """Run a server authenticator step.
+
+        A failure reported before `step` returns is raised as
+        `SASLAuthenticationFailed` from the element handler. A failure
+        reported later, from the main loop, is only sent to the peer.
+
+        [receiving entity only]
+
+        :Parameters:
+            - `stream`: the stream being authenticated
+            - `step`: function starting the step, called with the current
+              authenticator and the callback for the result
+        """
+        self._auth_pending = True
+        authenticator = self.authenticator
+        results = []
+        def callback(ret):
+            """Pass the step result to `_auth_step_done`."""
+            results.append(ret)
+            self._auth_step_done(stream, authenticator, ret)
+        step(authenticator, callback)
+        if results and isinstance(results[0], sasl.Failure):
+            raise SASLAuthenticationFailed("SASL authentication failed: {0}"
+                                                    .format(results[0].reason))
 
+    def _auth_step_done(self, stream, authenticator, ret):
+        """Send the result of a server authenticator step to the peer.
+
+        Called directly from the <sasl:auth/> or <sasl:response/> handler or,
+        when the authenticator is offloaded, later from the main loop.
+
+        The reply is dropped if the authentication has been aborted (or
+        restarted) since the step was started.
+
+        [receiving entity only]
+
+        :Parameters:
+            - `stream`: the stream being authenticated
+            - `authenticator`: the authenticator which made the step
+            - `ret`: the authenticator reply
+        :Types:
+            - `stream`: `StreamBase`
+            - `authenticator`: `sasl.ServerAuthenticator`
+            - `ret`: `sasl.Challenge`, `sasl.Success` or `sasl.Failure`
+        """
+        if authenticator is not self.authenticator:
+            logger.debug("Ignoring the result of an aborted SASL step")
+            return
+        self._auth_pending = False
         if isinstance(ret, sasl.Success):
             element = ElementTree.Element(SUCCESS_TAG)
             element.text = ret.encode()
@@ -175,9 +299,9 @@ class StreamSASLHandler(StreamFeatureHandler):
         if isinstance(ret, sasl.Success):
             self._handle_auth_success(stream, ret)
         elif isinstance(ret, sasl.Failure):
-            raise SASLAuthenticationFailed("SASL authentication failed: {0}"
-                                                            .format(ret.reason))
-        return True
+            logger.debug("SASL authentication failed: {0}".format(ret.reason))
+            # the peer may try again
+            self.authenticator = None
 
     def _handle_auth_success(self, stream, success):
         """Handle successful authentication.
@@ -192,7 +316,7 @@ class StreamSASLHandler(StreamFeatureHandler):
             return True
         authzid = success.properties.get("authzid")
         if authzid:
-            peer = JID(success.authzid)
+            peer = JID(authzid)
         elif "username" in success.properties:
             peer = JID(success.properties["username"], stream.me.domain)
         else:
@@ -210,8 +334,7 @@ class StreamSASLHandler(StreamFeatureHandler):
             logger.debug("Unexpected SASL challenge")
             return False
 
-        content = element.text.encode("us-ascii")
-        ret = self.authenticator.challenge(a2b_base64(content))
+        ret = self.authenticator.challenge(_decode_data(element))
         if isinstance(ret, sasl.Response):
             element = ElementTree.Element(RESPONSE_TAG)
             element.text = ret.encode()
@@ -232,29 +355,13 @@ class StreamSASLHandler(StreamFeatureHandler):
 
         [receiving entity only]
         """
-        if not self.authenticator:
+        if not self.authenticator or self._auth_pending:
             logger.debug("Unexpected SASL response")
             return False
 
-        content = element.text.encode("us-ascii")
-        ret = self.authenticator.response(a2b_base64(content))
-        if isinstance(ret, sasl.Success):
-            element = ElementTree.Element(SUCCESS_TAG)
-            element.text = ret.encode()
-        elif isinstance(ret, sasl.Challenge):
-            element = ElementTree.Element(CHALLENGE_TAG)
-            element.text = ret.encode()
-        else:
-            element = ElementTree.Element(FAILURE_TAG)
-            ElementTree.SubElement(element, SASL_QNP + ret.reason)
-
-        stream.write_element(element)
-
-        if isinstance(ret, sasl.Success):
-            self._handle_auth_success(stream, ret)
-        elif isinstance(ret, sasl.Failure):
-            raise SASLAuthenticationFailed("SASL authentication failed: {0!r}"
-                                                            .format(ret.reson))
+        response = _decode_data(element)
+        self._auth_step(stream, lambda authenticator, callback:
+                            authenticator.response_async(response, callback))
         return True
 
     def _check_authorization(self, properties, stream):
@@ -341,6 +448,12 @@ class StreamSASLHandler(StreamFeatureHandler):
             logger.debug("Unexpected SASL response")
             return False
 
+        if self._ignore_failure:
+            self._ignore_failure = False
+            logger.debug("Pipelined SASL authentication failed: {0!r}".format(
+                                                element_to_unicode(element)))
+            return True
+
         logger.debug("SASL authentication failed: {0!r}".format(
                                                 element_to_unicode(element)))
         raise SASLAuthenticationFailed("SASL authentication failed")
@@ -356,6 +469,7 @@ class StreamSASLHandler(StreamFeatureHandler):
             return False
 
         self.authenticator = None
+        self._auth_pending = False
         logger.debug("SASL authentication aborted")
         return True
 
@@ -411,7 +525,8 @@ class StreamSASLHandler(StreamFeatureHandler):
 
         element = ElementTree.Element(AUTH_TAG)
         element.set("mechanism", mechanism)
-        if initial_response.data:
+        if initial_response.data is not None:
+            # an empty initial response is sent as '='
             if initial_response.encode:
                 element.text = initial_response.encode()
             else:
@@ -451,6 +566,12 @@ XMPPSettings.add_setting(u"password_database",
         default_d = "A `DefaultPasswordDatabase` instance",
         doc = u"""Object providing or checking user passwords on server."""
     )
+XMPPSettings.add_setting(u"sasl_worker_pool",
+        type = WorkerPool,
+        doc = u"""Worker pool to run the server-side SASL authentication in.
+When set, password database lookups and key derivation do not block the main
+loop. The pool must be registered as a main loop event handler."""
+    )
 
 
 # vi: sts=4 et sw=4
@@ -18,6 +18,14 @@
 
 """TLS support for XMPP streams.
 
+The TLS context (with the certificates and the trusted CA store loaded) is
+built once per `XMPPSettings` object and stored there as the 'tls_context'
+setting (the 'tls_server_context' setting for the receiving side), so it is
+shared by all the streams using the same settings. It is built again when
+the 'tls_*' settings it was made from change.
+Where the Python `ssl` module supports it, the TLS sessions are remembered
+per server ('tls_session_cache') and resumed on reconnects.
+
 Normative reference:
   - `RFC 6120 <http://xmpp.org/rfcs/rfc6120.html>`__
 """
@@ -28,12 +36,14 @@ __docformat__ = "restructuredtext en"
 
 import logging
 import ssl
+import threading
+import weakref
 
 from ssl import SSLError
+from collections import OrderedDict
 
 from .etree import ElementTree
 from .constants import TLS_QNP
-from .streambase import FatalStreamError
 from .exceptions import TLSNegotiationFailed
 from .settings import XMPPSettings
 from .streamevents import TLSConnectedEvent
@@ -50,6 +60,183 @@ FAILURE_TAG = TLS_QNP + u"failure"
 
 logger = logging.getLogger("pyxmpp2.streamtls")
 
+HAVE_TLS_SESSIONS = hasattr(ssl, "SSLSession")
+
+# the settings the contexts built by `get_tls_context` were made from
+_CONTEXT_KEYS = weakref.WeakKeyDictionary()
+
+def _tls_context_key(settings, server_side):
+    """Get the values of the settings a TLS context is made from.
+
+    :Parameters:
+        - `settings`: the settings
+        - `server_side`: `True` for the receiving side context
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `server_side`: `bool`
+
+    :Returntype: `tuple`
+    """
+    return (server_side, settings["tls_verify_peer"],
+                settings["tls_cert_file"], settings["tls_key_file"],
+                settings["tls_cacert_file"])
+
+def make_tls_context(settings, server_side = False):
+    """Create a TLS context configured according to the 'tls_*' settings.
+
+    The best protocol version supported by both sides is negotiated,
+    SSLv2 and SSLv3 are disabled. When no 'tls_cacert_file' is given,
+    the system default CA certificates are trusted.
+
+    The receiving side does not require a client certificate. It verifies
+    one, when presented, only if 'tls_verify_peer' is set and
+    'tls_cacert_file' given. Session tickets are left enabled, so
+    reconnecting clients may resume their sessions.
+
+    :Parameters:
+        - `settings`: the settings
+        - `server_side`: `True` for the receiving side context
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `server_side`: `bool`
+
+    :Returntype: :std:`ssl.SSLContext`
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    if server_side:
+        context.options &= ~getattr(ssl, "OP_NO_TICKET", 0)
+        if settings["tls_verify_peer"] and settings["tls_cacert_file"]:
+            context.verify_mode = ssl.CERT_OPTIONAL
+        else:
+            context.verify_mode = ssl.CERT_NONE
+    elif settings["tls_verify_peer"]:
+        context.verify_mode = ssl.CERT_REQUIRED
+    else:
+        context.verify_mode = ssl.CERT_NONE
+    if settings["tls_cert_file"]:
+        context.load_cert_chain(settings["tls_cert_file"],
+                                                settings["tls_key_file"])
+    if settings["tls_cacert_file"]:
+        context.load_verify_locations(settings["tls_cacert_file"])
+    elif settings["tls_verify_peer"] and not server_side:
+        context.load_default_certs()
+    return context
+
+def get_tls_context(settings, server_side = False):
+    """Get the TLS context for the settings, creating it on the first use.
+
+    The context is stored as the 'tls_context' setting
+    ('tls_server_context' for the receiving side). A context stored there
+    by this function is built again when the other 'tls_*' settings have
+    changed since; one provided by the application is always used as is.
+
+    :Parameters:
+        - `settings`: the settings
+        - `server_side`: `True` for the receiving side context
+    :Types:
+        - `settings`: `XMPPSettings`
+        - `server_side`: `bool`
+
+    :Returntype: :std:`ssl.SSLContext`
+    """
+    if server_side:
+        name = u"tls_server_context"
+    else:
+        name = u"tls_context"
+    key = _tls_context_key(settings, server_side)
+    context = settings.get(name)
+    if context is not None and _CONTEXT_KEYS.get(context, key) == key:
+        return context
+    context = make_tls_context(settings, server_side)
+    _CONTEXT_KEYS[context] = key
+    settings[name] = context
+    return context
+
+class TLSSessionCache(object):
+    """Cache of TLS sessions to resume, by server.
+
+    Only the most recently used sessions are kept.
+
+    :Ivariables:
+        - `max_size`: maximum number of the sessions kept
+        - `_sessions`: the sessions
+        - `_lock`: lock protecting `_sessions`
+    :Types:
+        - `max_size`: `int`
+        - `_sessions`: :std:`OrderedDict`
+        - `_lock`: :std:`threading.Lock`
+    """
+    def __init__(self, max_size = 100):
+        self.max_size = max_size
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key):
+        """Get the session for a server.
+
+        :Parameters:
+            - `key`: the server identification
+        :Types:
+            - `key`: hashable
+
+        :Return: the session or `None`
+        """
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                self._sessions[key] = session
+            return session
+
+    def put(self, key, session):
+        """Remember the session for a server.
+
+        :Parameters:
+            - `key`: the server identification
+            - `session`: the session
+        :Types:
+            - `key`: hashable
+            - `session`: :std:`ssl.SSLSession`
+        """
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last = False)
+
+    def remove(self, key):
+        """Forget the session for a server.
+
+        :Parameters:
+            - `key`: the server identification
+        :Types:
+            - `key`: hashable
+        """
+        with self._lock:
+            self._sessions.pop(key, None)
+
+def get_tls_session_cache(settings):
+    """Get the TLS session cache for the settings, creating it on the first
+    use.
+
+    The cache is stored as the 'tls_session_cache' setting.
+
+    :Parameters:
+        - `settings`: the settings
+    :Types:
+        - `settings`: `XMPPSettings`
+
+    :Returntype: `TLSSessionCache`
+    """
+    cache = settings.get(u"tls_session_cache")
+    if cache is None:
+        cache = TLSSessionCache()
+        settings[u"tls_session_cache"] = cache
+    return cache
+
 class StreamTLSHandler(StreamFeatureHandler, EventHandler):
     """Handler for stream TLS support.
     """
@@ -69,7 +256,7 @@ class StreamTLSHandler(StreamFeatureHandler, EventHandler):
         self.requested = False
         self.tls_socket = None
 
-    def make_stream_tls_features(self, stream, features):
+    def make_stream_features(self, stream, features):
         """Update the <features/> element with StartTLS feature.
 
         [receving entity only]
@@ -126,6 +313,23 @@ class StreamTLSHandler(StreamFeatureHandler, EventHandler):
             logger.debug(" tls: not enabled")
             return StreamFeatureNotHandled("StartTLS", mandatory = required)
 
+    def handle_cached_stream_features(self, stream, features):
+        """Stop the negotiation pipelining when StartTLS is expected.
+
+        Nothing may be sent before the TLS layer is up if StartTLS is
+        enabled or required in the settings, even when the cached features
+        do not offer it -- the current features must be checked first.
+
+        [initiating entity only]
+        """
+        if stream.tls_established:
+            return None
+        if (features.find(STARTTLS_TAG) is None
+                and not self.settings["starttls"]
+                and not self.settings["tls_require"]):
+            return None
+        return StreamFeatureNotHandled("StartTLS")
+
     def _request_tls(self):
         """Request a TLS-encrypted connection.
 
@@ -158,40 +362,97 @@ class StreamTLSHandler(StreamFeatureHandler, EventHandler):
     @stream_element_handler(STARTTLS_TAG, "receiver")
     def _process_tls_starttls(self, stream, element):
         """Handle <starttls/> element.
+
+        Reply with <proceed/> and start the TLS handshake or, when TLS
+        cannot be used, with <failure/> and close the stream.
+
+        [receiving entity only]
         """
-        # pylint: disable-msg=R0201
-        _unused, _unused = stream, element
-        raise FatalStreamError("TLS not implemented for the receiving side yet")
+        # pylint: disable-msg=W0613
+        if self.stream and stream is not self.stream:
+            raise ValueError("Single StreamTLSHandler instance can handle"
+                                                            " only one stream")
+        self.stream = stream
+        if not self.settings["starttls"] or stream.tls_established:
+            logger.debug("Unexpected StartTLS request")
+            self._refuse_tls()
+            return True
+        try:
+            get_tls_context(self.settings, server_side = True)
+        except (SSLError, IOError), err:
+            logger.error("Cannot set up the TLS context: {0}".format(err))
+            self._refuse_tls()
+            return True
+        logger.debug(" tls: sending <proceed/>")
+        stream.write_element(ElementTree.Element(PROCEED_TAG))
+        self._make_tls_connection()
+        return True
+
+    def _refuse_tls(self):
+        """Send <failure/> and close the stream.
+
+        [receiving entity only]
+        """
+        self.stream.write_element(ElementTree.Element(FAILURE_TAG))
+        self.stream.disconnect()
 
     def _make_tls_connection(self):
         """Initiate TLS connection.
-
-        [initiating entity only]
         """
         logger.debug("Preparing TLS connection")
-        if self.settings["tls_verify_peer"]:
-            cert_reqs = ssl.CERT_REQUIRED
-        else:
-            cert_reqs = ssl.CERT_NONE
+        kwargs = {}
+        if self.stream.initiator:
+            if ssl.HAS_SNI and self.stream.peer:
+                kwargs["server_hostname"] = self.stream.peer.domain.encode(
+                                                                    "idna")
+            if HAVE_TLS_SESSIONS:
+                session = get_tls_session_cache(self.settings).get(
+                                                        self._session_key())
+                if session is not None:
+                    kwargs["session"] = session
+        server_side = not self.stream.initiator
         self.stream.transport.starttls(
-                    keyfile = self.settings["tls_key_file"],
-                    certfile = self.settings["tls_cert_file"],
-                    server_side = not self.stream.initiator,
-                    cert_reqs = cert_reqs,
-                    ssl_version = ssl.PROTOCOL_TLSv1,
-                    ca_certs = self.settings["tls_cacert_file"],
+                    context = get_tls_context(self.settings, server_side),
+                    server_side = server_side,
                     do_handshake_on_connect = False,
-                    )
+                    **kwargs)
+
+    def _session_key(self):
+        """Identify the server for the TLS session cache.
+
+        :Returntype: `tuple`"""
+        properties = self.stream.transport.auth_properties
+        return (unicode(self.stream.peer), properties.get("remote-ip"))
+
+    def _store_tls_session(self):
+        """Remember the TLS session for resumption.
+
+        [initiating entity only]
+        """
+        session = self.stream.transport.get_tls_session()
+        if session is None:
+            return
+        if session.has_ticket or session.id:
+            get_tls_session_cache(self.settings).put(self._session_key(),
+                                                                    session)
 
     @event_handler(TLSConnectedEvent)
     def handle_tls_connected_event(self, event):
         """Verify the peer certificate on the `TLSConnectedEvent`.
+
+        The receiving side leaves the peer certificate verification to the
+        TLS context (and the certificate matching to the authentication).
         """
-        if self.settings["tls_verify_peer"]:
+        if self.settings["tls_verify_peer"] and event.stream.initiator:
             valid = self.settings["tls_verify_callback"](event.stream,
                                                         event.peer_certificate)
             if not valid:
+                if HAVE_TLS_SESSIONS and event.stream.initiator:
+                    get_tls_session_cache(self.settings).remove(
+                                                        self._session_key())
                 raise SSLError("Certificate verification failed")
+        if HAVE_TLS_SESSIONS and event.stream.initiator:
+            self._store_tls_session()
         event.stream.tls_established = True
         with event.stream.lock:
             event.stream._restart_stream() # pylint: disable-msg=W0212
@@ -266,6 +527,27 @@ XMPPSettings.add_setting(u"tls_cacert_file", type = str, basic = True,
 the trusted CA certificates in the PEM format, concatenated."""
     )
 
+XMPPSettings.add_setting(u"tls_context", type = ssl.SSLContext,
+        default_d = u"Built from the other 'tls_*' settings on the first use",
+        doc = u"""The TLS context used for the StartTLS connections. Built and
+stored here on the first use, so the certificate and CA files are loaded only
+once, and built again when the other 'tls_*' settings change."""
+    )
+
+XMPPSettings.add_setting(u"tls_server_context", type = ssl.SSLContext,
+        default_d = u"Built from the other 'tls_*' settings on the first use",
+        doc = u"""The TLS context used for the StartTLS connections on the
+receiving side. Built and stored here on the first use, so it is shared by all
+the streams accepted with the same settings, and built again when the other
+'tls_*' settings change."""
+    )
+
+XMPPSettings.add_setting(u"tls_session_cache", type = TLSSessionCache,
+        default_d = u"Created on the first use",
+        doc = u"""The cache of the TLS sessions to resume on reconnects (when
+supported by the Python `ssl` module)."""
+    )
+
 XMPPSettings.add_setting(u"tls_verify_callback", type = "callable",
         default = StreamTLSHandler.is_certificate_valid,
         doc = u"""A function to verify if a certificate is valid and if the
@@ -104,6 +104,17 @@ class NetReaderWritter(object):
             self.write_cond.notify()
             logger.debug("tst: wrapping the socket")
             self.sock = ssl.wrap_socket(*args, **kwargs)
+            if not kwargs.get("server_side"):
+                # the client speaks first, send the ClientHello
+                timeout = self.sock.gettimeout()
+                self.sock.settimeout(0.0)
+                try:
+                    self.sock.do_handshake()
+                except ssl.SSLError, err:
+                    if err.args[0] != ssl.SSL_ERROR_WANT_READ:
+                        raise
+                finally:
+                    self.sock.settimeout(timeout)
             self.extra_on_read = self._do_tls_handshake
             self.rdata = b""
 
@@ -5,6 +5,7 @@
 import unittest
 import re
 
+from pyxmpp2.etree import ElementTree
 from pyxmpp2.streambase import StreamBase
 from pyxmpp2.streamevents import * # pylint: disable=W0401,W0614
 from pyxmpp2.jid import JID
@@ -31,6 +32,15 @@ BIND_FEATURES = b"""<stream:features>
      <bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>
 </stream:features>"""
 
+NO_FEATURES = b"""<stream:features/>"""
+
+BIND_ERROR_RESPONSE = """<iq type="error" id="{0}">
+  <error type="cancel">
+    <service-unavailable xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/>
+  </error>
+</iq>
+"""
+
 BIND_GENERATED_REQUEST = b"""<iq type="set" id="42">
   <bind  xmlns="urn:ietf:params:xml:ns:xmpp-bind">
   </bind>
@@ -129,6 +139,64 @@ class TestBindingInitiator(InitiatorSelectTestCase):
                     ConnectedEvent, StreamConnectedEvent, GotFeaturesEvent,
                     BindingResourceEvent, AuthorizedEvent, DisconnectedEvent])
 
+    def pipelined_stream(self, handler):
+        handlers = [ResourceBindingHandler(), handler]
+        processor = StanzaProcessor()
+        processor.setup_stanza_handlers(handlers, "post-auth")
+        features = ElementTree.XML(C2S_SERVER_STREAM_HEAD + BIND_FEATURES
+                                                            + STREAM_TAIL)[0]
+        settings = XMPPSettings({"resource": "Provided",
+                                "stream_pipelining": True,
+                                "stream_features_cache": {
+                                    (u"127.0.0.1", False, False, False): features}})
+        self.stream = StreamBase(u"jabber:client", processor, handlers,
+                                                                    settings)
+        processor.uplink = self.stream
+        self.stream.me = JID("test@127.0.0.1")
+        self.start_transport([handler])
+        self.stream.initiate(self.transport, u"127.0.0.1")
+        self.connect_transport()
+
+    def test_bind_pipelined(self):
+        handler = AuthorizedEventHandler()
+        self.pipelined_stream(handler)
+        # the request is sent before the features are received
+        req_id = self.wait(1,
+                    expect = re.compile(br".*<iq[^>]*id=[\"']([^\"']*)[\"'].*"
+                                            br"<resource>Provided</resource>"))
+        self.assertIsNotNone(req_id)
+        req_id = req_id.decode("utf-8")
+        self.server.rdata = b""
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(BIND_FEATURES)
+        self.server.write(BIND_PROVIDED_RESPONSE.format(req_id).encode("utf-8"))
+        self.wait()
+        self.assertNotIn(b"<iq", self.server.rdata)
+        self.assertEqual(self.stream.me, JID("test@127.0.0.1/Provided"))
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [ConnectingEvent,
+                    ConnectedEvent, BindingResourceEvent, StreamConnectedEvent,
+                    GotFeaturesEvent, AuthorizedEvent, DisconnectedEvent])
+
+    def test_bind_pipelined_mismatch(self):
+        handler = AuthorizedEventHandler()
+        self.pipelined_stream(handler)
+        req_id = self.wait(1,
+                    expect = re.compile(br".*<iq[^>]*id=[\"']([^\"']*)[\"']"))
+        self.assertIsNotNone(req_id)
+        req_id = req_id.decode("utf-8")
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(NO_FEATURES)
+        self.server.write(BIND_ERROR_RESPONSE.format(req_id).encode("utf-8"))
+        self.server.write(STREAM_TAIL)
+        self.server.disconnect()
+        self.wait()
+        self.assertEqual(self.stream.me, JID("test@127.0.0.1"))
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [ConnectingEvent,
+                    ConnectedEvent, BindingResourceEvent, StreamConnectedEvent,
+                    GotFeaturesEvent, DisconnectedEvent])
+
 class TestBindingReceiver(ReceiverSelectTestCase):
     def test_bind_no_resource(self):
         handler = EventRecorder()
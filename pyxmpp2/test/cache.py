@@ -0,0 +1,566 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111,W0212
+
+import unittest
+import time
+import os
+import shutil
+import tempfile
+import threading
+
+from datetime import datetime, timedelta
+
+from pyxmpp2.cache import Cache, CacheItem, CacheFetcher, CacheSuite
+from pyxmpp2.cache import SQLiteCacheStorage, PersistentTier
+from pyxmpp2.jid import JID
+
+HOUR = timedelta(hours = 1)
+SHORT = timedelta(milliseconds = 10)
+
+def make_item(address, freshness = HOUR, expiration = HOUR, purge = HOUR):
+    return CacheItem(address, address.upper(), freshness, expiration, purge)
+
+def wait_for(condition, timeout = 5):
+    timeout = time.time() + timeout
+    while not condition() and time.time() < timeout:
+        time.sleep(0.01)
+    return condition()
+
+class DummyFetcher(CacheFetcher):
+    results = {}
+    fetched = []
+    def fetch(self):
+        self.fetched.append(self.address)
+        if self.address in self.results:
+            self.got_it(self.results[self.address])
+
+class TestCacheItem(unittest.TestCase):
+    def test_states(self):
+        item = make_item("a", SHORT, SHORT * 3, SHORT * 5)
+        self.assertEqual(item.update_state(), "fresh")
+        self.assertEqual(item.next_transition(), item.freshness_time)
+        time.sleep(0.02)
+        self.assertEqual(item.update_state(), "old")
+        self.assertEqual(item.next_transition(), item.expire_time)
+        time.sleep(0.02)
+        self.assertEqual(item.update_state(), "stale")
+        self.assertEqual(item.next_transition(), item.purge_time)
+        time.sleep(0.02)
+        self.assertEqual(item.update_state(), "purged")
+        self.assertIsNone(item.next_transition())
+
+    def test_no_purge(self):
+        item = make_item("a", SHORT, SHORT, 0)
+        time.sleep(0.015)
+        self.assertEqual(item.update_state(), "stale")
+        self.assertIsNone(item.next_transition())
+
+class TestCache(unittest.TestCase):
+    def test_add_get(self):
+        cache = Cache(10)
+        cache.add_item(make_item("a"))
+        self.assertEqual(cache.get_item("a").value, "A")
+        self.assertIsNone(cache.get_item("b"))
+        self.assertEqual(cache.num_items(), 1)
+
+    def test_get_state(self):
+        cache = Cache(10)
+        cache.add_item(make_item("a", SHORT))
+        time.sleep(0.015)
+        self.assertIsNone(cache.get_item("a"))
+        self.assertEqual(cache.get_item("a", "old").state, "old")
+
+    def test_purged_on_tick(self):
+        cache = Cache(10)
+        cache.add_item(make_item("a", SHORT, SHORT, SHORT))
+        cache.add_item(make_item("b"))
+        time.sleep(0.015)
+        cache.tick()
+        self.assertEqual(cache.num_items(), 1)
+        self.assertIsNone(cache.get_item("a", "stale"))
+
+    def test_purge_order(self):
+        cache = Cache(4)
+        cache.add_item(make_item("fresh1"))
+        cache.add_item(make_item("old", SHORT))
+        cache.add_item(make_item("fresh2"))
+        cache.add_item(make_item("stale", SHORT, SHORT))
+        time.sleep(0.015)
+        # purged down to 3 items, the worse and the older first
+        cache.add_item(make_item("fresh3"))
+        self.assertEqual(sorted(cache._items),
+                                    ["fresh1", "fresh2", "fresh3", "old"])
+        cache.add_item(make_item("fresh4"))
+        self.assertEqual(sorted(cache._items),
+                                    ["fresh1", "fresh2", "fresh3", "fresh4"])
+        cache.add_item(make_item("fresh5"))
+        self.assertEqual(sorted(cache._items),
+                                    ["fresh2", "fresh3", "fresh4", "fresh5"])
+
+    def test_replace(self):
+        cache = Cache(10)
+        cache.add_item(make_item("a", SHORT))
+        item = make_item("a")
+        cache.add_item(item)
+        time.sleep(0.015)
+        cache.tick()
+        self.assertIs(cache.get_item("a"), item)
+        self.assertEqual(cache.num_items(), 1)
+
+    def test_invalidate(self):
+        cache = Cache(10)
+        cache.add_item(make_item("a"))
+        cache.invalidate_object("a")
+        self.assertIsNone(cache.get_item("a", "old"))
+        self.assertEqual(cache.get_item("a", "stale").state, "stale")
+
+    def test_heaps_bounded(self):
+        cache = Cache(100)
+        for i in range(10000):
+            cache.add_item(make_item(str(i)))
+        self.assertTrue(cache.num_items() <= 100)
+        size = len(cache._transitions) + sum(len(heap)
+                                            for heap in cache._states.values())
+        self.assertTrue(size <= 4 * cache.num_items() + 64 + 2, size)
+
+class TestFetchers(unittest.TestCase):
+    def setUp(self):
+        self.cache = Cache(10)
+        self.cache.set_fetcher(DummyFetcher)
+        DummyFetcher.results = {"a": "A"}
+        DummyFetcher.fetched = []
+        self.got = []
+
+    def handler(self, address, value, state):
+        self.got.append((address, value, state))
+
+    def test_fetch(self):
+        self.cache.request_object("a", "fresh", self.handler)
+        self.cache.request_object("a", "fresh", self.handler)
+        self.assertEqual(self.got, [("a", "A", "new"), ("a", "A", "fresh")])
+        self.assertEqual(DummyFetcher.fetched, ["a"])
+        self.assertEqual(self.cache._fetchers, set())
+        self.assertEqual(self.cache._fetcher_timeouts, [])
+
+    def test_timeout(self):
+        timeouts = []
+        self.cache.request_object("b", "fresh", self.handler,
+                        timeout_handler = timeouts.append,
+                        timeout = SHORT)
+        self.cache.request_object("c", "fresh", self.handler,
+                        timeout_handler = timeouts.append)
+        self.assertEqual(len(self.cache._fetchers), 2)
+        self.cache.tick()
+        self.assertEqual(timeouts, [])
+        time.sleep(0.015)
+        self.cache.tick()
+        self.assertEqual(timeouts, ["b"])
+        self.assertEqual(len(self.cache._fetchers), 1)
+
+    def test_error(self):
+        self.cache.request_object("b", "fresh", self.handler)
+        fetcher = list(self.cache._fetchers)[0]
+        fetcher.error("oops")
+        self.assertEqual(self.got, [("b", None, "error")])
+        self.assertFalse(fetcher.active)
+        self.assertEqual(self.cache._fetchers, set())
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.cache = Cache(10)
+        self.cache.set_fetcher(DummyFetcher)
+        DummyFetcher.results = {}
+        DummyFetcher.fetched = []
+        self.got = []
+        self.errors = []
+
+    def handler(self, address, value, state):
+        self.got.append((address, value, state))
+
+    def error_handler(self, address, error_data):
+        self.errors.append((address, error_data))
+
+    def test_coalesce(self):
+        for dummy in range(300):
+            self.cache.request_object("a", "fresh", self.handler)
+        self.assertEqual(DummyFetcher.fetched, ["a"])
+        list(self.cache._fetchers)[0].got_it("A")
+        self.assertEqual(self.got, [("a", "A", "new")] * 300)
+        self.assertEqual(self.cache._in_flight, {})
+
+    def test_coalesce_error(self):
+        for dummy in range(3):
+            self.cache.request_object("a", "fresh", self.handler,
+                                                        self.error_handler)
+        list(self.cache._fetchers)[0].error("oops")
+        self.assertEqual(self.errors, [("a", "oops")] * 3)
+
+    def test_no_single_flight(self):
+        for dummy in range(3):
+            self.cache.request_object("a", "fresh", self.handler,
+                                                    single_flight = False)
+        self.assertEqual(DummyFetcher.fetched, ["a"] * 3)
+        self.assertEqual(len(self.cache._fetchers), 3)
+
+    def test_request_from_handler(self):
+        def handler(address, error_data):
+            self.errors.append((address, error_data))
+            if len(self.errors) == 1:
+                self.cache.request_object(address, "fresh", self.handler,
+                                handler, negative_period = timedelta(0))
+        self.cache.request_object("a", "fresh", self.handler, handler,
+                                                negative_period = timedelta(0))
+        list(self.cache._fetchers)[0].error("oops")
+        self.assertEqual(DummyFetcher.fetched, ["a", "a"])
+        self.assertEqual(len(self.cache._fetchers), 1)
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = Cache(10, default_negative_period = SHORT * 2,
+                                        max_negative_period = SHORT * 5)
+        self.cache.set_fetcher(DummyFetcher)
+        DummyFetcher.results = {}
+        DummyFetcher.fetched = []
+        self.errors = []
+        self.timeouts = []
+
+    def request(self, **kwargs):
+        self.cache.request_object("a", "fresh", None,
+                            lambda addr, err: self.errors.append(err),
+                            self.timeouts.append, **kwargs)
+
+    def fail(self, error = "oops"):
+        self.request()
+        list(self.cache._fetchers)[0].error(error)
+
+    def test_error_cached(self):
+        self.fail()
+        self.request()
+        self.request()
+        self.assertEqual(DummyFetcher.fetched, ["a"])
+        self.assertEqual(self.errors, ["oops"] * 3)
+        time.sleep(0.025)
+        self.request()
+        self.assertEqual(DummyFetcher.fetched, ["a", "a"])
+
+    def test_timeout_cached(self):
+        self.request(timeout = SHORT)
+        time.sleep(0.015)
+        self.cache.tick()
+        self.request()
+        self.assertEqual(DummyFetcher.fetched, ["a"])
+        self.assertEqual(self.timeouts, ["a", "a"])
+
+    def test_backoff(self):
+        self.fail()
+        self.assertEqual(self.cache._failures["a"].count, 1)
+        time.sleep(0.025)
+        self.fail()
+        failure = self.cache._failures["a"]
+        self.assertEqual(failure.count, 2)
+        self.assertAlmostEqual((failure.until - failure.forget_time)
+                    .total_seconds(), -(SHORT * 4).total_seconds(), 2)
+        for dummy in range(5):
+            failure.until = datetime.utcnow() - SHORT
+            self.fail()
+            failure = self.cache._failures["a"]
+        self.assertEqual(failure.count, 7)
+        self.assertAlmostEqual((failure.forget_time - failure.until)
+                    .total_seconds(), (SHORT * 5).total_seconds(), 2)
+
+    def test_forget(self):
+        self.fail()
+        time.sleep(0.045)
+        self.cache.tick()
+        self.assertEqual(self.cache._failures, {})
+
+    def test_success_resets(self):
+        self.fail()
+        self.cache.add_item(make_item("a"))
+        self.assertEqual(self.cache._failures, {})
+
+    def test_disabled(self):
+        self.fail()
+        self.request(negative_period = timedelta(0))
+        self.assertEqual(DummyFetcher.fetched, ["a", "a"])
+
+class TestCacheSuite(unittest.TestCase):
+    def test_request(self):
+        suite = CacheSuite(10)
+        suite.register_fetcher(str, DummyFetcher)
+        DummyFetcher.results = {"a": "A"}
+        got = []
+        suite.request_object(str, "a", "fresh",
+                            lambda addr, value, state: got.append(value))
+        self.assertEqual(got, ["A"])
+        with self.assertRaises(TypeError):
+            suite.request_object(int, "a", "fresh", None)
+        self.assertEqual(suite.regular_tasks(), 1)
+
+    def test_negative(self):
+        suite = CacheSuite(10)
+        suite.register_fetcher(str, DummyFetcher)
+        DummyFetcher.results = {}
+        DummyFetcher.fetched = []
+        errors = []
+        for dummy in range(3):
+            suite.request_object(str, "a", "fresh", None,
+                        lambda addr, err: errors.append(err))
+        self.assertEqual(DummyFetcher.fetched, ["a"])
+        cache = suite._caches[str]
+        list(cache._fetchers)[0].error("oops")
+        suite.request_object(str, "a", "fresh", None,
+                        lambda addr, err: errors.append(err))
+        self.assertEqual(errors, ["oops"] * 4)
+        suite.request_object(str, "a", "fresh", None,
+                        lambda addr, err: errors.append(err),
+                        negative_period = timedelta(0), single_flight = False)
+        self.assertEqual(DummyFetcher.fetched, ["a", "a"])
+
+class CountingStorage(SQLiteCacheStorage):
+    def __init__(self, path):
+        SQLiteCacheStorage.__init__(self, path)
+        self.batches = []
+        self.loads = []
+    def save_many(self, items):
+        self.batches.append(len(items))
+        SQLiteCacheStorage.save_many(self, items)
+    def load(self, kind, address):
+        self.loads.append(address)
+        return SQLiteCacheStorage.load(self, kind, address)
+
+class BlockingStorage(CountingStorage):
+    def __init__(self, path):
+        CountingStorage.__init__(self, path)
+        self.release = threading.Event()
+        self.threads = []
+    def load(self, kind, address):
+        self.threads.append(threading.current_thread())
+        self.release.wait(5)
+        return CountingStorage.load(self, kind, address)
+
+class TestPersistentTier(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cache.db")
+        self.tiers = []
+
+    def tearDown(self):
+        for tier in self.tiers:
+            tier.close()
+        shutil.rmtree(self.tmpdir)
+
+    def make_tier(self, **kwargs):
+        tier = PersistentTier(CountingStorage(self.path), **kwargs)
+        self.tiers.append(tier)
+        return tier
+
+    def test_persist_and_reload(self):
+        tier = self.make_tier()
+        cache = Cache(10, tier = tier, kind = u"test")
+        item = make_item("a", HOUR, HOUR * 2, 0)
+        cache.add_item(item)
+        tier.close()
+        tier = self.make_tier()
+        cache = Cache(10, tier = tier, kind = u"test")
+        self.assertEqual(cache.num_items(), 0)
+        loaded = cache.get_item("a")
+        self.assertEqual(loaded.value, "A")
+        self.assertEqual(loaded.state, "fresh")
+        self.assertEqual(loaded.timestamp, item.timestamp)
+        self.assertEqual(loaded.freshness_time, item.freshness_time)
+        self.assertEqual(loaded.expire_time, item.expire_time)
+        self.assertEqual(loaded.purge_time, item.purge_time)
+        self.assertEqual(cache.num_items(), 1)
+        self.assertIs(cache.get_item("a"), loaded)
+        self.assertEqual(tier.storage.loads, ["a"])
+        self.assertIsNone(Cache(10, tier = tier, kind = u"other"
+                                                            ).get_item("a"))
+        # hydrated items are not written back
+        tier.flush()
+        self.assertEqual(tier.storage.batches, [])
+
+    def test_state_checked(self):
+        tier = self.make_tier()
+        Cache(10, tier = tier).add_item(make_item("a", SHORT))
+        tier.close()
+        time.sleep(0.015)
+        cache = Cache(10, tier = self.make_tier())
+        self.assertIsNone(cache.get_item("a"))
+        self.assertEqual(cache.get_item("a", "old").state, "old")
+
+    def test_purged_not_loaded(self):
+        tier = self.make_tier()
+        Cache(10, tier = tier).add_item(make_item("a", SHORT, SHORT, SHORT))
+        tier.close()
+        time.sleep(0.015)
+        cache = Cache(10, tier = self.make_tier())
+        self.assertIsNone(cache.get_item("a", "stale"))
+
+    def test_purged_dropped(self):
+        tier = self.make_tier()
+        Cache(10, tier = tier).add_item(make_item("a", SHORT, SHORT, SHORT))
+        tier.flush()
+        time.sleep(0.015)
+        cache = Cache(10, tier = tier)
+        self.assertIsNone(cache.get_item("a", "purged"))
+        handled = []
+        cache.set_fetcher(DummyFetcher)
+        DummyFetcher.results = {}
+        DummyFetcher.fetched = []
+        cache.request_object("a", "stale", lambda *args: handled.append(args))
+        self.assertEqual(handled, [])
+        tier.flush()
+        self.assertIsNone(tier.storage.load(u"", "a"))
+
+    def test_load_while_writing(self):
+        tier = self.make_tier(batch_size = 1000, flush_interval = 60)
+        Cache(10, tier = tier).add_item(make_item("a"))
+        tier.flush()
+        cache = Cache(10, tier = tier)
+        with tier._storage_lock:
+            # a write in progress does not block the reads
+            self.assertEqual(cache.get_item("a").value, "A")
+
+    def test_misses_remembered(self):
+        tier = self.make_tier(batch_size = 1000, flush_interval = 60)
+        cache = Cache(10, tier = tier)
+        self.assertIsNone(cache.get_item("a"))
+        self.assertIsNone(cache.get_item("a"))
+        self.assertEqual(tier.storage.loads, ["a"])
+        cache.add_item(make_item("a"))
+        tier.flush()
+        self.assertEqual(Cache(10, tier = tier).get_item("a").value, "A")
+        self.assertEqual(tier.storage.loads, ["a", "a"])
+
+    def test_batching(self):
+        tier = self.make_tier(batch_size = 50, flush_interval = 60)
+        cache = Cache(1000, tier = tier)
+        with tier._storage_lock:
+            # the writer thread is blocked here, the items accumulate
+            for i in range(120):
+                cache.add_item(make_item(str(i)))
+            for i in range(10):
+                cache.add_item(make_item(str(i)))
+        tier.flush()
+        self.assertEqual(sum(tier.storage.batches), 120)
+        self.assertTrue(len(tier.storage.batches) <= 2,
+                                                        tier.storage.batches)
+        self.assertEqual(tier._pending, {})
+
+    def test_pending_load(self):
+        tier = self.make_tier(batch_size = 1000, flush_interval = 60)
+        Cache(10, tier = tier, kind = u"k").add_item(make_item("a"))
+        cache = Cache(10, tier = tier, kind = u"k")
+        self.assertEqual(cache.get_item("a").value, "A")
+        self.assertEqual(tier.storage.loads, [])
+
+    def test_request_load_in_background(self):
+        tier = self.make_tier()
+        Cache(10, tier = tier).add_item(make_item("a"))
+        tier.close()
+        storage = BlockingStorage(self.path)
+        tier = PersistentTier(storage)
+        self.tiers.append(tier)
+        cache = Cache(10, tier = tier)
+        cache.set_fetcher(DummyFetcher)
+        DummyFetcher.results = {}
+        DummyFetcher.fetched = []
+        got = []
+        for dummy in range(3):
+            cache.request_object("a", "fresh",
+                                        lambda *args: got.append(args))
+        # the requesting thread does not wait for the storage
+        self.assertEqual(got, [])
+        self.assertTrue(wait_for(lambda: storage.threads))
+        self.assertNotIn(threading.current_thread(), storage.threads)
+        storage.release.set()
+        self.assertTrue(wait_for(lambda: len(got) == 3))
+        self.assertEqual(got, [("a", "A", "fresh")] * 3)
+        self.assertEqual(storage.loads, ["a"])
+        self.assertEqual(DummyFetcher.fetched, [])
+        self.assertEqual(cache._loading, {})
+
+    def test_request_not_found(self):
+        tier = self.make_tier()
+        cache = Cache(10, tier = tier)
+        cache.set_fetcher(DummyFetcher)
+        DummyFetcher.results = {"a": "fetched"}
+        DummyFetcher.fetched = []
+        got = []
+        cache.request_object("a", "fresh", lambda *args: got.append(args))
+        self.assertTrue(wait_for(lambda: got))
+        self.assertEqual(got, [("a", "fetched", "new")])
+        self.assertEqual(tier.storage.loads, ["a"])
+        # remembered misses are answered without the reader thread
+        cache = Cache(10, tier = tier)
+        cache.set_fetcher(DummyFetcher)
+        DummyFetcher.results = {}
+        cache.request_object("b", "fresh", lambda *args: None)
+        self.assertTrue(wait_for(lambda: "b" in DummyFetcher.fetched))
+        cache.request_object("b", "fresh", lambda *args: None,
+                                                        single_flight = False)
+        self.assertEqual(DummyFetcher.fetched, ["a", "b", "b"])
+        self.assertEqual(tier.storage.loads, ["a", "b"])
+
+    def test_invalidate(self):
+        tier = self.make_tier()
+        cache = Cache(10, tier = tier)
+        cache.add_item(make_item("a"))
+        cache.invalidate_object("a")
+        tier.close()
+        cache = Cache(10, tier = self.make_tier())
+        self.assertIsNone(cache.get_item("a", "old"))
+        self.assertEqual(cache.get_item("a", "stale").state, "stale")
+
+    def test_invalidate_not_loaded(self):
+        tier = self.make_tier()
+        Cache(10, tier = tier).add_item(make_item("a"))
+        tier.close()
+        tier = self.make_tier()
+        cache = Cache(10, tier = tier)
+        cache.invalidate_object("a")
+        self.assertTrue(wait_for(lambda: not cache._loading))
+        self.assertEqual(cache.get_item("a", "stale", False).state, "stale")
+        tier.close()
+        cache = Cache(10, tier = self.make_tier())
+        self.assertEqual(cache.get_item("a", "stale").state, "stale")
+
+    def test_unpicklable(self):
+        tier = self.make_tier()
+        cache = Cache(10, tier = tier)
+        cache.add_item(CacheItem("a", lambda: None, HOUR, HOUR, HOUR))
+        cache.add_item(make_item("b"))
+        tier.close()
+        cache = Cache(10, tier = self.make_tier())
+        self.assertIsNone(cache.get_item("a"))
+        self.assertEqual(cache.get_item("b").value, "B")
+
+    def test_suite(self):
+        tier = self.make_tier()
+        suite = CacheSuite(10, tier = tier)
+        suite.register_fetcher(JID, DummyFetcher)
+        jid = JID(u"user@example.com/res")
+        DummyFetcher.results = {jid: u"data"}
+        DummyFetcher.fetched = []
+        suite.request_object(JID, jid, "fresh",
+                                        lambda addr, value, state: None)
+        tier.close()
+        suite = CacheSuite(10, tier = self.make_tier())
+        suite.register_fetcher(JID, DummyFetcher)
+        got = []
+        suite.request_object(JID, JID(u"user@example.com/res"), "fresh",
+                            lambda addr, value, state: got.append(value))
+        self.assertTrue(wait_for(lambda: got))
+        self.assertEqual(got, [u"data"])
+        self.assertEqual(DummyFetcher.fetched, [jid])
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
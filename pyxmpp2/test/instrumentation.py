@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import Queue
+
+from pyxmpp2.instrumentation import LatencyHistogram, HandlerStats
+from pyxmpp2.instrumentation import call_handler, handler_name
+from pyxmpp2.instrumentation import STANZA, EVENT
+from pyxmpp2.mainloop.interfaces import Event, EventHandler, event_handler
+from pyxmpp2.mainloop.events import EventDispatcher
+from pyxmpp2.message import Message
+from pyxmpp2.stanzaprocessor import StanzaProcessor
+from pyxmpp2.interfaces import XMPPFeatureHandler
+from pyxmpp2.interfaces import message_stanza_handler
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.jid import JID
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_bucket_bounds(self):
+        hist = LatencyHistogram(precision = 4, max_bits = 20)
+        # pylint: disable=W0212
+        prev_high = -1
+        for index in range(len(hist.buckets)):
+            high = hist._bucket_high(index)
+            self.assertEqual(hist._bucket_index(prev_high + 1), index)
+            self.assertEqual(hist._bucket_index(high), index)
+            self.assertTrue(high > prev_high)
+            prev_high = high
+        self.assertEqual(prev_high, hist.max_value)
+
+    def test_relative_error(self):
+        for value in (1, 31, 32, 100, 1000, 123456, 987654321):
+            hist = LatencyHistogram(precision = 5)
+            hist.record(value)
+            hist.record(value + 1)
+            result = hist.percentile(50)
+            self.assertTrue(value <= result <= value * (1 + 1.0 / 16),
+                                                            (value, result))
+
+    def test_percentiles(self):
+        hist = LatencyHistogram()
+        for value in range(1, 1001):
+            hist.record(value)
+        self.assertEqual(hist.count, 1000)
+        self.assertEqual(hist.min, 1)
+        self.assertEqual(hist.max, 1000)
+        self.assertAlmostEqual(hist.percentile(50), 500, delta = 500 / 16)
+        self.assertAlmostEqual(hist.percentile(99), 990, delta = 990 / 16)
+        self.assertEqual(hist.percentile(100), 1000)
+
+    def test_clamp(self):
+        hist = LatencyHistogram(max_bits = 10)
+        hist.record(-5)
+        hist.record(1 << 20)
+        self.assertEqual(hist.min, 0)
+        self.assertEqual(hist.max, 1023)
+
+    def test_snapshot(self):
+        hist = LatencyHistogram()
+        self.assertEqual(hist.snapshot(), {"count": 0})
+        hist.record(1000)
+        snap = hist.snapshot()
+        self.assertEqual(snap["count"], 1)
+        self.assertAlmostEqual(snap["mean"], 0.001)
+        self.assertAlmostEqual(snap["p99_9"], 0.001)
+
+class TestHandlerStats(unittest.TestCase):
+    def test_call_handler(self):
+        stats = HandlerStats()
+        def func(arg):
+            return arg * 2
+        self.assertEqual(call_handler(stats, STANZA, func, 21), 42)
+        self.assertEqual(call_handler(None, STANZA, func, 21), 42)
+        snap = stats.snapshot()
+        name = handler_name(func)
+        self.assertEqual(snap[STANZA][name]["count"], 1)
+
+    def test_exception(self):
+        stats = HandlerStats()
+        def func():
+            raise ValueError("test")
+        with self.assertRaises(ValueError):
+            call_handler(stats, STANZA, func)
+        self.assertEqual(stats.snapshot()[STANZA][handler_name(func)]["count"],
+                                                                            1)
+
+    def test_reset(self):
+        stats = HandlerStats()
+        stats.record(EVENT, len, 0.1)
+        self.assertTrue(stats.snapshot())
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+class DummyEvent(Event):
+    # pylint: disable=R0903
+    def __unicode__(self):
+        return u"Test event"
+
+class TestIntegration(unittest.TestCase):
+    def test_event_dispatcher(self):
+        stats = HandlerStats()
+        settings = XMPPSettings({"event_queue": Queue.Queue(),
+                                    "instrumentation": stats})
+        class Handler(EventHandler):
+            # pylint: disable=W0232,R0201,R0903
+            @event_handler(DummyEvent)
+            def handle(self, event):
+                return True
+        dispatcher = EventDispatcher(settings, [Handler()])
+        for dummy in range(3):
+            settings["event_queue"].put(DummyEvent())
+        dispatcher.flush()
+        snap = stats.snapshot()[EVENT]
+        self.assertEqual(snap[handler_name(Handler().handle)]["count"], 3)
+
+    def test_stanza_processor(self):
+        stats = HandlerStats()
+        class Handlers(XMPPFeatureHandler):
+            # pylint: disable=W0232,R0201,R0903
+            @message_stanza_handler()
+            def message(self, stanza):
+                return True
+        proc = StanzaProcessor()
+        proc.me = JID("dest@example.com/xx")
+        proc.instrumentation = stats
+        proc.setup_stanza_handlers([Handlers()], "post-auth")
+        proc.process_stanza(Message(from_jid = JID("a@example.com/1"),
+                                    to_jid = JID("dest@example.com/xx"),
+                                    stanza_type = "normal", body = u"x"))
+        snap = stats.snapshot()[STANZA]
+        self.assertEqual(snap[handler_name(Handlers().message)]["count"], 1)
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
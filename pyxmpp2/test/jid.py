@@ -6,10 +6,12 @@
 
 import sys
 import unittest
+import weakref
 
 import logging
 
-from pyxmpp2.jid import JID, JIDError
+from pyxmpp2 import jid as jid_module
+from pyxmpp2.jid import JID, JIDError, set_jid_cache_size
 from pyxmpp2 import xmppstringprep
 
 logger = logging.getLogger("pyxmpp2.test.jid")
@@ -126,14 +128,110 @@ class TestJID(unittest.TestCase):
             result = eval(expr)
             self.assertFalse(result, 'Expression %r gave: %r' % (expr, result))
 
+    def test_from_trusted(self):
+        for jid, expected_tuple in VALID_JIDS:
+            logging.debug(" checking {0!r}...".format(jid))
+            jid = JID.from_trusted(jid)
+            jtuple = (jid.local, jid.domain, jid.resource)
+            self.assertEqual(jtuple, expected_tuple)
+    def test_from_trusted_invalid(self):
+        for jid in INVALID_JIDS:
+            logging.debug(" checking {0!r}...".format(jid))
+            with self.assertRaises(JIDError):
+                jid = JID.from_trusted(jid)
+                logging.debug("   got: {0!r}".format(jid))
+    def test_from_trusted_normalizes(self):
+        for jid in (u"Jajcus@jajcus.net", u"jajcus@JAJCUS.net/Test",
+                    u"jajcus@jajcus.net./x", u"user@example.com/a\u00adb"):
+            logging.debug(" checking {0!r}...".format(jid))
+            self.assertEqual(JID.from_trusted(jid), JID(jid))
+            self.assertEqual(JID.from_trusted(jid).as_unicode(),
+                                                    JID(jid).as_unicode())
+
+    def test_parse_many(self):
+        jids = [jid for jid, dummy in VALID_JIDS]
+        result = JID.parse_many(jids + jids)
+        self.assertEqual(len(result), len(jids) * 2)
+        for jid, (dummy, expected_tuple) in zip(result, VALID_JIDS * 2):
+            jtuple = (jid.local, jid.domain, jid.resource)
+            self.assertEqual(jtuple, expected_tuple)
+        for jid1, jid2 in zip(result[:len(jids)], result[len(jids):]):
+            self.assertIs(jid1, jid2)
+        jid = JID(u"user@example.com")
+        self.assertIs(JID.parse_many([jid])[0], jid)
+    def test_parse_many_invalid(self):
+        for jid in INVALID_JIDS:
+            logging.debug(" checking {0!r}...".format(jid))
+            with self.assertRaises(JIDError):
+                JID.parse_many([u"user@example.com", jid])
+    def test_parse_many_shared_domain(self):
+        jids = JID.parse_many(u"user{0}@\u017c\u00f3\u0142w.PL/r".format(i)
+                                                        for i in range(10))
+        self.assertEqual(set(jid.domain for jid in jids),
+                                            set([u"\u017c\u00f3\u0142w.pl"]))
+        self.assertEqual(jids[3], JID(u"user3@\u017c\u00f3\u0142w.pl/r"))
+
+class TestJIDCache(unittest.TestCase):
+    def setUp(self):
+        # pylint: disable=W0212
+        self.saved_size = jid_module._jid_cache_size
+    def tearDown(self):
+        set_jid_cache_size(self.saved_size)
+    def test_string_key(self):
+        set_jid_cache_size(10)
+        ref = weakref.ref(JID(u"lru-test@example.com/res"))
+        self.assertIsNotNone(ref())
+        self.assertIs(JID(u"lru-test@example.com/res"), ref())
+    def test_parts_key(self):
+        set_jid_cache_size(10)
+        jid1 = JID(u"Lru-Test", u"example.com", u"res")
+        self.assertIs(JID(u"Lru-Test", u"example.com", u"res"), jid1)
+        self.assertEqual(jid1.local, u"lru-test")
+    def test_bounded(self):
+        # pylint: disable=W0212
+        set_jid_cache_size(10)
+        for i in range(100):
+            JID(u"user{0}@example.com".format(i))
+            self.assertTrue(len(JID._lru_recent) + len(JID._lru_old) <= 10)
+        self.assertIn(u"user99@example.com", JID._lru_recent)
+        self.assertNotIn(u"user0@example.com", JID._lru_recent)
+        self.assertNotIn(u"user0@example.com", JID._lru_old)
+    def test_recently_used_kept(self):
+        # pylint: disable=W0212
+        set_jid_cache_size(10)
+        JID(u"keep@example.com")
+        for i in range(20):
+            JID(u"user{0}@example.com".format(i))
+            JID(u"keep@example.com")
+        self.assertIn(u"keep@example.com", JID._lru_recent)
+    def test_parse_many_cached(self):
+        # pylint: disable=W0212
+        set_jid_cache_size(10)
+        jids = JID.parse_many([u"parse-many@example.com/x",
+                                        u"Parse-Many@Example.com/y"])
+        for string, jid in ((u"parse-many@example.com/x", jids[0]),
+                                    (u"Parse-Many@Example.com/y", jids[1])):
+            self.assertIs(JID.cache.get(string), jid)
+            self.assertIs(JID._lru_recent.get(string), jid)
+        self.assertIs(JID.from_trusted(u"parse-many@example.com/x"), jids[0])
+    def test_disabled(self):
+        # pylint: disable=W0212
+        set_jid_cache_size(0)
+        JID(u"user@example.com")
+        JID.from_trusted(u"user@example.com")
+        self.assertEqual(JID._lru_recent, {})
+        self.assertEqual(JID._lru_old, {})
+
 class TestUncachedJID(TestJID):
     def setUp(self):
-        # pylint: disable=W0404,W0212
-        import weakref
+        # pylint: disable=W0212
         JID.cache = weakref.WeakValueDictionary()
+        self.saved_jid_cache_size = jid_module._jid_cache_size
+        set_jid_cache_size(0)
         self.saved_stringprep_cache_size = xmppstringprep._stringprep_cache_size
         xmppstringprep.set_stringprep_cache_size(0)
     def tearDown(self):
+        set_jid_cache_size(self.saved_jid_cache_size)
         xmppstringprep.set_stringprep_cache_size(
                                             self.saved_stringprep_cache_size)
 
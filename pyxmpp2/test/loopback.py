@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import time
+
+from pyxmpp2.streambase import StreamBase
+from pyxmpp2.streamevents import * # pylint: disable=W0401,W0614
+from pyxmpp2.jid import JID
+from pyxmpp2.message import Message
+from pyxmpp2.loopback import loopback_pair
+from pyxmpp2.mainloop.select import SelectMainLoop
+from pyxmpp2.mainloop.poll import PollMainLoop
+
+from pyxmpp2.interfaces import StanzaRoute, event_handler
+
+from pyxmpp2.test._util import EventRecorder
+
+TIMEOUT = 2.0 # seconds
+
+class RecordingRoute(StanzaRoute):
+    def __init__(self):
+        self.received = []
+    def send(self, stanza):
+        pass
+    def uplink_receive(self, stanza):
+        self.received.append(stanza)
+
+class StreamsEventRecorder(EventRecorder):
+    """Do not quit on the first `DisconnectedEvent`, as there are
+    two streams in the loop."""
+    @event_handler(DisconnectedEvent)
+    def handle_disconnected_event(self, event):
+        return False
+
+class TestLoopbackSelect(unittest.TestCase):
+    loop_class = SelectMainLoop
+
+    def setUp(self):
+        self.loop = None
+
+    def tearDown(self):
+        if self.loop:
+            self.client.transport.close()
+            self.server.transport.close()
+            # do not leave the events in the shared queue
+            self.loop.check_events()
+            self.loop = None
+
+    def start_streams(self, latency = 0, bandwidth = None):
+        self.handler = StreamsEventRecorder()
+        self.route = RecordingRoute()
+        self.client = StreamBase(u"jabber:client", None, [self.handler])
+        self.server = StreamBase(u"jabber:client", self.route, [])
+        client_transport, server_transport = loopback_pair(
+                                latency = latency, bandwidth = bandwidth)
+        self.loop = self.loop_class(None, [self.handler, client_transport,
+                                                            server_transport])
+        self.server.receive(server_transport, u"127.0.0.1")
+        self.client.initiate(client_transport, u"127.0.0.1")
+
+    def client_events(self):
+        return [e.__class__ for e in self.handler.events_received
+                                                if e.stream is self.client]
+
+    def run_until(self, condition, timeout = TIMEOUT):
+        timeout = time.time() + timeout
+        while not condition() and time.time() < timeout:
+            self.loop.loop_iteration(0.1)
+        return condition()
+
+    def test_exchange(self):
+        self.start_streams()
+        self.assertTrue(self.run_until(lambda: self.client.features
+                                                            is not None))
+        for i in range(100):
+            self.client.send(Message(to_jid = JID("test@127.0.0.1"),
+                                            body = u"Message {0}".format(i)))
+        self.assertTrue(self.run_until(lambda: len(self.route.received)
+                                                                    == 100))
+        self.assertEqual(self.route.received[99].body, u"Message 99")
+        self.client.disconnect()
+        self.assertTrue(self.run_until(lambda: DisconnectedEvent in
+                                                    self.client_events()))
+        self.assertFalse(self.server.is_connected())
+        self.assertEqual(self.client_events(), [StreamConnectedEvent,
+                                        GotFeaturesEvent, DisconnectedEvent])
+
+    def test_latency(self):
+        start = time.time()
+        self.start_streams(latency = 0.2)
+        self.assertTrue(self.run_until(lambda: self.client.features
+                                                            is not None))
+        # stream head there and back, then the features
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_bandwidth(self):
+        self.start_streams(bandwidth = 20000)
+        self.assertTrue(self.run_until(lambda: self.client.features
+                                                            is not None))
+        start = time.time()
+        self.client.send(Message(to_jid = JID("test@127.0.0.1"),
+                                                    body = u"x" * 4000))
+        self.assertTrue(self.run_until(lambda: self.route.received))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_no_wait(self):
+        self.start_streams()
+        start = time.time()
+        # the replies must not wait for the loop timeout
+        for dummy in range(10):
+            started = time.time()
+            self.loop.loop_iteration(5)
+            if self.client.features is not None:
+                break
+        self.assertIsNotNone(self.client.features)
+        self.assertLess(started - start, 2)
+
+    def test_many_streams(self):
+        self.handler = StreamsEventRecorder()
+        self.loop = self.loop_class(None, [self.handler])
+        streams = []
+        for dummy in range(200):
+            client = StreamBase(u"jabber:client", None, [])
+            server = StreamBase(u"jabber:client", RecordingRoute(), [])
+            client_transport, server_transport = loopback_pair()
+            self.assertIsNone(client_transport.fileno())
+            self.loop.add_handler(client_transport)
+            self.loop.add_handler(server_transport)
+            server.receive(server_transport, u"127.0.0.1")
+            client.initiate(client_transport, u"127.0.0.1")
+            streams.append(client)
+        self.client, self.server = streams[0], streams[0]
+        self.assertTrue(self.run_until(lambda: all(s.features is not None
+                                                        for s in streams)))
+        for client in streams[1:]:
+            client.transport.close()
+
+    def test_close(self):
+        self.start_streams()
+        self.assertTrue(self.run_until(lambda: self.client.features
+                                                            is not None))
+        self.client.transport.close()
+        self.assertTrue(self.run_until(lambda: not self.server.is_connected()))
+        self.assertIsNone(self.client.transport.fileno())
+
+class TestLoopbackPoll(TestLoopbackSelect):
+    loop_class = PollMainLoop
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
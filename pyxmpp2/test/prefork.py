@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+"""Tests for pyxmpp2.server.prefork"""
+
+import unittest
+import os
+import socket
+import signal
+import time
+import threading
+import Queue
+
+from pyxmpp2.test import _support
+
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.server.listener import TCPListener, SO_REUSEPORT
+from pyxmpp2.server.prefork import PreforkServer
+from pyxmpp2.mainloop.select import SelectMainLoop
+
+TEST_PORT = 10257
+TIMEOUT = 10 # seconds
+
+class PeerChannel(object):
+    """Answer pings from a peer worker and ping it."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.pongs = Queue.Queue()
+        thread = threading.Thread(target = self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(1)
+            except socket.error:
+                data = None
+            if not data:
+                break
+            elif data == b"?":
+                self.sock.sendall(b"!")
+            else:
+                self.pongs.put(data)
+
+    def ping(self):
+        try:
+            self.sock.sendall(b"?")
+            return self.pongs.get(True, 1) == b"!"
+        except (socket.error, Queue.Empty):
+            return False
+
+def worker_main(worker):
+    """Reply to every connection with the worker index, process id and
+    the indices of the peers answering the pings; quit on shutdown."""
+    channels = dict((i, PeerChannel(sock))
+                                        for i, sock in worker.peers.items())
+    def peer_channel(index, sock):
+        channels[index] = PeerChannel(sock)
+    worker.on_peer_channel(peer_channel)
+    def accept(sock, address):
+        # pylint: disable=W0613
+        reply = "{0} {1} {2}".format(worker.index, os.getpid(),
+                                    ",".join(str(i) for i in sorted(channels)
+                                                    if channels[i].ping()))
+        sock.sendall(reply.encode("us-ascii"))
+        sock.close()
+    settings = XMPPSettings({u"event_queue": Queue.Queue()})
+    listener = TCPListener(socket.AF_INET, ("127.0.0.1", TEST_PORT), accept,
+                                                        reuse_port = True)
+    main_loop = SelectMainLoop(settings, [listener, worker])
+    worker.on_shutdown(listener.close)
+    worker.on_shutdown(main_loop.quit)
+    main_loop.loop()
+
+def stubborn_worker_main(worker):
+    """Ignore the shutdown request."""
+    # pylint: disable=W0613
+    while True:
+        time.sleep(1)
+
+def query():
+    """Connect to the server and return the reply split into fields."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(TIMEOUT)
+        sock.connect(("127.0.0.1", TEST_PORT))
+        data = b""
+        while True:
+            chunk = sock.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return data.decode("us-ascii").split(" ")
+
+@unittest.skipIf("lo-network" not in _support.RESOURCES,
+                                        "loopback network usage disabled")
+@unittest.skipIf(SO_REUSEPORT is None, "No SO_REUSEPORT support")
+@unittest.skipUnless(hasattr(os, "fork"), "No fork() support")
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop(1)
+
+    def start_server(self, worker_function, **kwargs):
+        settings = XMPPSettings({u"prefork_workers": 2,
+                                    u"prefork_restart_delay": 0.1})
+        self.server = PreforkServer(worker_function, settings, **kwargs)
+        self.server.start()
+
+    def query_until(self, condition):
+        timeout = time.time() + TIMEOUT
+        while time.time() < timeout:
+            try:
+                reply = query()
+            except socket.error:
+                reply = None
+            if reply and condition(reply):
+                return reply
+            time.sleep(0.05)
+        return None
+
+    def test_workers(self):
+        self.start_server(worker_main, peer_channels = True)
+        pids = dict((i, str(pid)) for i, pid in self.server.workers.items())
+        replies = {}
+        def seen_all(reply):
+            replies[int(reply[0])] = reply
+            return len(replies) == 2
+        self.assertIsNotNone(self.query_until(seen_all))
+        self.assertEqual(replies[0][1], pids[0])
+        self.assertEqual(replies[1][1], pids[1])
+        self.assertEqual(replies[0][2], "1")
+        self.assertEqual(replies[1][2], "0")
+
+    def test_restart(self):
+        self.start_server(worker_main)
+        old_pid = self.server.workers[0]
+        os.kill(old_pid, signal.SIGKILL)
+        timeout = time.time() + TIMEOUT
+        while time.time() < timeout:
+            self.server.check_workers()
+            if self.server.workers.get(0, old_pid) != old_pid:
+                break
+            time.sleep(0.05)
+        new_pid = self.server.workers.get(0)
+        self.assertIsNotNone(new_pid)
+        self.assertNotEqual(new_pid, old_pid)
+        self.assertIsNotNone(self.query_until(
+                                    lambda reply: reply[1] == str(new_pid)))
+
+    def test_restart_peer_channels(self):
+        self.start_server(worker_main, peer_channels = True)
+        old_pid = self.server.workers[0]
+        os.kill(old_pid, signal.SIGKILL)
+        timeout = time.time() + TIMEOUT
+        while time.time() < timeout:
+            self.server.check_workers()
+            if self.server.workers.get(0, old_pid) != old_pid:
+                break
+            time.sleep(0.05)
+        new_pid = str(self.server.workers[0])
+        replies = {}
+        def seen_all(reply):
+            if reply[2] and (reply[0] == "1" or reply[1] == new_pid):
+                replies[int(reply[0])] = reply
+            return len(replies) == 2
+        self.assertIsNotNone(self.query_until(seen_all))
+        self.assertEqual(replies[0][2], "1")
+        self.assertEqual(replies[1][2], "0")
+
+    def test_stop(self):
+        self.start_server(worker_main)
+        self.assertIsNotNone(self.query_until(lambda reply: True))
+        pids = self.server.workers.values()
+        start = time.time()
+        self.server.stop(TIMEOUT)
+        self.assertLess(time.time() - start, TIMEOUT)
+        self.assertEqual(self.server.workers, {})
+        for pid in pids:
+            with self.assertRaises(OSError):
+                os.kill(pid, 0)
+        with self.assertRaises(socket.error):
+            query()
+
+    def test_stop_timeout(self):
+        self.start_server(stubborn_worker_main)
+        start = time.time()
+        self.server.stop(0.5)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertEqual(self.server.workers, {})
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
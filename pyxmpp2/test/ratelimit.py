@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import Queue
+import time
+
+from pyxmpp2.etree import ElementTree
+
+from pyxmpp2.message import Message
+from pyxmpp2.iq import Iq
+from pyxmpp2.presence import Presence
+from pyxmpp2.stanzaprocessor import StanzaProcessor
+from pyxmpp2.interfaces import XMPPFeatureHandler
+from pyxmpp2.interfaces import message_stanza_handler
+from pyxmpp2.ratelimit import TokenBucket, RateLimiter, StanzaThrottledEvent
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.jid import JID
+from pyxmpp2.mainloop.select import SelectMainLoop
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(1.0, 3, 100.0)
+        self.assertEqual(bucket.take(100.0), 0)
+        self.assertEqual(bucket.take(100.0), 0)
+        self.assertEqual(bucket.take(100.0), 0)
+        self.assertIsNone(bucket.take(100.0))
+
+    def test_refill(self):
+        bucket = TokenBucket(2.0, 1, 100.0)
+        self.assertEqual(bucket.take(100.0), 0)
+        self.assertIsNone(bucket.take(100.25))
+        self.assertEqual(bucket.take(100.5), 0)
+        # never more than 'burst' tokens
+        self.assertEqual(bucket.take(200.0), 0)
+        self.assertIsNone(bucket.take(200.0))
+
+    def test_borrow(self):
+        bucket = TokenBucket(1.0, 1, 100.0)
+        self.assertEqual(bucket.take(100.0, 5), 0)
+        self.assertAlmostEqual(bucket.take(100.0, 5), 1.0)
+        self.assertAlmostEqual(bucket.take(100.0, 5), 2.0)
+        self.assertIsNone(bucket.take(100.0, 2.5))
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.event_queue = Queue.Queue()
+
+    def make_limiter(self, **kwargs):
+        settings = {"event_queue": self.event_queue,
+                    "stanza_rate_limits": {"message": (0.001, 2)}}
+        settings.update(kwargs)
+        return RateLimiter(XMPPSettings(settings))
+
+    @staticmethod
+    def message(sender):
+        return Message(from_jid = JID(sender), to_jid = JID("dest@example.com"),
+                                            stanza_type = "chat", body = u"x")
+
+    def events(self):
+        result = []
+        while True:
+            try:
+                result.append(self.event_queue.get_nowait())
+            except Queue.Empty:
+                return result
+
+    def test_bare_key(self):
+        limiter = self.make_limiter()
+        self.assertEqual(limiter.check(self.message("a@example.com/1")), 0)
+        self.assertEqual(limiter.check(self.message("a@example.com/2")), 0)
+        self.assertIsNone(limiter.check(self.message("a@example.com/3")))
+        self.assertEqual(limiter.check(self.message("b@example.com/1")), 0)
+
+    def test_full_key(self):
+        limiter = self.make_limiter(stanza_rate_limit_key = u"full")
+        for dummy in range(2):
+            self.assertEqual(limiter.check(self.message("a@example.com/1")), 0)
+        self.assertIsNone(limiter.check(self.message("a@example.com/1")))
+        self.assertEqual(limiter.check(self.message("a@example.com/2")), 0)
+
+    def test_unlimited_kind(self):
+        limiter = self.make_limiter()
+        element = ElementTree.XML("<presence xmlns='jabber:client'"
+                                            " from='a@example.com/1'/>")
+        for dummy in range(10):
+            self.assertEqual(limiter.check(Presence(element)), 0)
+
+    def test_event_once(self):
+        limiter = self.make_limiter()
+        for dummy in range(5):
+            limiter.check(self.message("a@example.com/1"))
+        events = self.events()
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], StanzaThrottledEvent)
+        self.assertEqual(events[0].sender, u"a@example.com")
+        self.assertEqual(events[0].kind, u"message")
+        self.assertEqual(events[0].policy, u"drop")
+
+    def test_buckets_limit(self):
+        limiter = self.make_limiter(stanza_rate_limit_buckets = 2)
+        for dummy in range(2):
+            limiter.check(self.message("a@example.com/1"))
+        limiter.check(self.message("b@example.com/1"))
+        limiter.check(self.message("c@example.com/1"))
+        self.assertEqual(len(limiter._buckets), 2)
+        # 'a' has been forgotten, so it gets a fresh bucket
+        self.assertEqual(limiter.check(self.message("a@example.com/1")), 0)
+
+    def test_delay_needs_main_loop(self):
+        with self.assertRaises(ValueError):
+            self.make_limiter(stanza_rate_limit_policy = u"delay")
+
+    def test_bad_limits(self):
+        for limit in ((0, 2), (-1.0, 2), (1.0, 0)):
+            with self.assertRaises(ValueError):
+                self.make_limiter(stanza_rate_limits = {"message": limit})
+
+class TestStanzaProcessorLimits(unittest.TestCase):
+    def setUp(self):
+        self.stanzas_sent = []
+        self.handled = []
+        parent = self
+        class Handlers(XMPPFeatureHandler):
+            # pylint: disable=W0232,R0201,R0903
+            @message_stanza_handler()
+            def message(self, stanza):
+                parent.handled.append(stanza)
+                return True
+        self.proc = StanzaProcessor()
+        self.proc.me = JID("dest@example.com/xx")
+        self.proc.send = self.stanzas_sent.append
+        self.proc.setup_stanza_handlers([Handlers()], "post-auth")
+
+    def set_limiter(self, policy, rate = 0.001, main_loop = None):
+        settings = XMPPSettings({"event_queue": Queue.Queue(),
+                                "stanza_rate_limits": {"message": (rate, 1),
+                                                        "iq": (rate, 1)},
+                                "stanza_rate_limit_policy": policy})
+        self.proc.rate_limiter = RateLimiter(settings, main_loop)
+
+    @staticmethod
+    def message():
+        return Message(from_jid = JID("a@example.com/1"),
+                        to_jid = JID("dest@example.com/xx"),
+                        stanza_type = "normal", body = u"x")
+
+    def test_drop(self):
+        self.set_limiter(u"drop")
+        self.assertTrue(self.proc.process_stanza(self.message()))
+        self.assertTrue(self.proc.process_stanza(self.message()))
+        self.assertEqual(len(self.handled), 1)
+        self.assertEqual(self.stanzas_sent, [])
+
+    def test_error(self):
+        self.set_limiter(u"error")
+        self.proc.process_stanza(self.message())
+        self.proc.process_stanza(self.message())
+        self.assertEqual(len(self.handled), 1)
+        self.assertEqual(len(self.stanzas_sent), 1)
+        error = self.stanzas_sent[0]
+        self.assertEqual(error.stanza_type, u"error")
+        self.assertEqual(error.error.condition_name, u"resource-constraint")
+
+    def test_delay(self):
+        main_loop = SelectMainLoop(None)
+        self.set_limiter(u"delay", rate = 10.0, main_loop = main_loop)
+        self.assertTrue(self.proc.process_stanza(self.message()))
+        self.assertTrue(self.proc.process_stanza(self.message()))
+        self.assertEqual(len(self.handled), 1)
+        timeout = time.time() + 2
+        while len(self.handled) < 2 and time.time() < timeout:
+            main_loop.loop_iteration(0.05)
+        self.assertEqual(len(self.handled), 2)
+        self.assertEqual(self.stanzas_sent, [])
+
+    def test_own_responses_not_limited(self):
+        self.set_limiter(u"drop")
+        responses = []
+        for stanza_id in ("r1", "r2", "r3"):
+            request = Iq(from_jid = JID("dest@example.com/xx"),
+                        to_jid = JID("a@example.com/1"), stanza_type = "get",
+                        stanza_id = stanza_id)
+            self.proc.set_response_handlers(request, responses.append,
+                                                        responses.append)
+        for stanza_id in ("r1", "r2", "r3"):
+            self.proc.process_stanza(Iq(from_jid = JID("a@example.com/1"),
+                                    to_jid = JID("dest@example.com/xx"),
+                                    stanza_type = "result",
+                                    stanza_id = stanza_id))
+        self.assertEqual([r.stanza_id for r in responses], ["r1", "r2", "r3"])
+        # unexpected responses are still limited
+        buckets = self.proc.rate_limiter._buckets
+        self.assertEqual(len(buckets), 0)
+        for stanza_id in ("x1", "x2"):
+            self.proc.process_stanza(Iq(from_jid = JID("a@example.com/1"),
+                                    to_jid = JID("dest@example.com/xx"),
+                                    stanza_type = "result",
+                                    stanza_id = stanza_id))
+        self.assertEqual(len(buckets), 1)
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,10 @@
 import unittest
 import logging
 import time
+import socket
+import errno
+import struct
+import threading
 
 from socket import AF_INET, AF_INET6
 
@@ -19,6 +23,11 @@ from pyxmpp2.mainloop.interfaces import Event
 
 from pyxmpp2.resolver import is_ipv6_available
 from pyxmpp2.resolver import DumbBlockingResolver
+from pyxmpp2.resolver import CachingResolver, DNSCache, ResolverAnswer
+from pyxmpp2.resolver import SRVRecord, srv_targets
+from pyxmpp2.resolver import AsyncResolver
+from pyxmpp2 import resolver as resolver_mod
+from pyxmpp2.interfaces import Resolver
 
 if HAVE_DNSPYTHON:
     from pyxmpp2.resolver import BlockingResolver
@@ -236,6 +245,517 @@ class TestThreadedResolver(_TestResolver):
     def make_resolver(self, settings = None):
         return ThreadedResolver(settings, 10)
 
+class FakeResolver(Resolver):
+    """Resolver returning predefined answers, optionally deferred."""
+    def __init__(self, answers, ttl = None, deferred = False):
+        self.answers = answers
+        self.ttl = ttl
+        self.deferred = deferred
+        self.queries = []
+        self.waiting = []
+        self.failing = set()
+
+    def _answer(self, key, callback):
+        self.queries.append(key)
+        result = list(self.answers.get(key.lower(), []))
+        srv_records = None
+        if result and isinstance(result[0], SRVRecord):
+            srv_records = result
+            result = srv_targets(result)
+        result = ResolverAnswer(result, self.ttl, srv_records,
+                                            key.lower() in self.failing)
+        if self.deferred:
+            self.waiting.append((callback, result))
+        else:
+            callback(result)
+
+    def finish(self):
+        waiting, self.waiting = self.waiting, []
+        for callback, result in waiting:
+            callback(result)
+
+    def resolve_srv(self, domain, service, protocol, callback):
+        self._answer(domain, callback)
+
+    def resolve_address(self, hostname, callback, allow_cname = True):
+        self._answer(hostname, callback)
+
+class TestCachingResolver(unittest.TestCase):
+    def setUp(self):
+        self.settings = XMPPSettings({"dns_cache_min_ttl": 0.0,
+                                        "ipv4": True, "ipv6": True})
+        self.cache = DNSCache()
+        self.results = []
+        self.fake = FakeResolver({
+                "example.com": [("xmpp.example.com", 5222)],
+                "xmpp.example.com": [(AF_INET, "192.0.2.1")],
+                }, ttl = 0.05)
+
+    def make_resolver(self, fake = None):
+        return CachingResolver(fake or self.fake, self.settings, self.cache)
+
+    def test_cached(self):
+        for dummy in range(3):
+            resolver = self.make_resolver()
+            resolver.resolve_srv(u"Example.com", "xmpp-client", "tcp",
+                                                        self.results.append)
+            resolver.resolve_address(u"xmpp.example.com",
+                                                        self.results.append)
+        self.assertEqual(self.fake.queries, ["Example.com",
+                                                        "xmpp.example.com"])
+        self.assertEqual(self.results, [[("xmpp.example.com", 5222)],
+                                            [(AF_INET, "192.0.2.1")]] * 3)
+
+    def test_ttl(self):
+        resolver = self.make_resolver()
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        time.sleep(0.06)
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.assertEqual(len(self.fake.queries), 2)
+        self.assertEqual(len(self.results), 3)
+
+    def test_clamp(self):
+        resolver = self.make_resolver()
+        self.settings["dns_cache_min_ttl"] = 60.0
+        self.settings["dns_cache_max_ttl"] = 120.0
+        self.assertEqual(resolver.clamp_ttl(["x"], 1), 60.0)
+        self.assertEqual(resolver.clamp_ttl(["x"], 90), 90)
+        self.assertEqual(resolver.clamp_ttl(["x"], 86400), 120.0)
+        self.settings["dns_cache_default_ttl"] = 100.0
+        self.assertEqual(resolver.clamp_ttl(["x"], None), 100.0)
+        self.settings["dns_cache_negative_ttl"] = 5.0
+        self.assertEqual(resolver.clamp_ttl([], 90), 5.0)
+
+    def test_negative(self):
+        resolver = self.make_resolver()
+        resolver.resolve_address("nohost.example.com", self.results.append)
+        resolver.resolve_address("nohost.example.com", self.results.append)
+        self.assertEqual(self.fake.queries, ["nohost.example.com"])
+        self.assertEqual(self.results, [[], []])
+        self.settings["dns_cache_negative_ttl"] = 0.0
+        resolver.resolve_address("nohost2.example.com", self.results.append)
+        resolver.resolve_address("nohost2.example.com", self.results.append)
+        self.assertEqual(self.fake.queries.count("nohost2.example.com"), 2)
+
+    def test_srv_reordered(self):
+        self.fake.answers["example.com"] = [
+                            SRVRecord(0, 50, 5222, "a.example.com"),
+                            SRVRecord(0, 50, 5222, "b.example.com"),
+                            SRVRecord(10, 0, 5222, "backup.example.com")]
+        self.fake.ttl = 60
+        resolver = self.make_resolver()
+        for dummy in range(100):
+            resolver.resolve_srv("example.com", "xmpp-client", "tcp",
+                                                        self.results.append)
+        self.assertEqual(self.fake.queries, ["example.com"])
+        self.assertEqual(set(result[0][0] for result in self.results),
+                                    set(["a.example.com", "b.example.com"]))
+        self.assertTrue(all(result[2] == ("backup.example.com", 5222)
+                                                for result in self.results))
+
+    def test_failure_not_cached(self):
+        self.fake.failing.add("nohost.example.com")
+        resolver = self.make_resolver()
+        resolver.resolve_address("nohost.example.com", self.results.append)
+        resolver.resolve_address("nohost.example.com", self.results.append)
+        self.assertEqual(self.fake.queries, ["nohost.example.com"] * 2)
+        self.assertEqual(self.results, [[], []])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_settings_in_key(self):
+        resolver = self.make_resolver()
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.settings["ipv6"] = False
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.assertEqual(len(self.fake.queries), 2)
+
+    def test_coalesce(self):
+        fake = FakeResolver(self.fake.answers, deferred = True)
+        for dummy in range(5):
+            self.make_resolver(fake).resolve_address("xmpp.example.com",
+                                                        self.results.append)
+        self.assertEqual(fake.queries, ["xmpp.example.com"])
+        self.assertEqual(self.results, [])
+        fake.finish()
+        self.assertEqual(self.results, [[(AF_INET, "192.0.2.1")]] * 5)
+
+    def test_pending_timeout(self):
+        self.settings["dns_lookup_timeout"] = 0.1
+        fake = FakeResolver(self.fake.answers, deferred = True)
+        for dummy in range(3):
+            self.make_resolver(fake).resolve_address("xmpp.example.com",
+                                                        self.results.append)
+        timeout = time.time() + 2
+        while len(self.results) < 3 and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertEqual(self.results, [[]] * 3)
+        self.assertTrue(all(result.failed for result in self.results))
+        # the key is free for a new lookup
+        self.make_resolver(fake).resolve_address("xmpp.example.com",
+                                                        self.results.append)
+        self.assertEqual(fake.queries, ["xmpp.example.com"] * 2)
+        fake.finish()
+        self.assertEqual(self.results[-1], [(AF_INET, "192.0.2.1")])
+
+    def test_plain_answer(self):
+        class PlainResolver(FakeResolver):
+            def _answer(self, key, callback):
+                self.queries.append(key)
+                callback(list(self.answers.get(key.lower(), [])))
+        fake = PlainResolver(self.fake.answers)
+        resolver = self.make_resolver(fake)
+        for dummy in range(2):
+            resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.assertEqual(fake.queries, ["xmpp.example.com"])
+        self.assertEqual(self.results, [[(AF_INET, "192.0.2.1")]] * 2)
+
+    def expire_soon(self):
+        # pylint: disable=W0212
+        for entry in self.cache._entries.values():
+            entry.expire = time.time() + entry.ttl * 0.05
+
+    def test_prefetch(self):
+        self.settings["dns_cache_prefetch"] = True
+        self.fake.ttl = 60
+        resolver = self.make_resolver()
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.expire_soon()
+        self.fake.answers["xmpp.example.com"] = [(AF_INET, "192.0.2.2")]
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.assertEqual(len(self.fake.queries), 2)
+        self.assertEqual(self.results[-1], [(AF_INET, "192.0.2.1")])
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.assertEqual(len(self.fake.queries), 2)
+        self.assertEqual(self.results[-1], [(AF_INET, "192.0.2.2")])
+
+    def test_failed_prefetch(self):
+        self.settings["dns_cache_prefetch"] = True
+        self.fake.ttl = 60
+        resolver = self.make_resolver()
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.expire_soon()
+        del self.fake.answers["xmpp.example.com"]
+        resolver.resolve_address("xmpp.example.com", self.results.append)
+        self.assertEqual(self.results[-1], [(AF_INET, "192.0.2.1")])
+        self.assertEqual(len(self.cache), 1)
+
+    def test_error(self):
+        resolver = self.make_resolver(DumbBlockingResolver(self.settings))
+        for dummy in range(2):
+            with self.assertRaises(NotImplementedError):
+                resolver.resolve_srv("example.com", "xmpp-client", "tcp",
+                                                        self.results.append)
+        self.assertEqual(self.results, [])
+
+    def test_max_entries(self):
+        self.cache.max_entries = 10
+        resolver = self.make_resolver()
+        for i in range(25):
+            resolver.resolve_address("host{0}".format(i), self.results.append)
+        self.assertEqual(len(self.cache), 10)
+
+    def test_default(self):
+        settings = XMPPSettings()
+        self.assertIsInstance(settings["dns_resolver"], CachingResolver)
+        settings["dns_cache"] = False
+        self.assertNotIsInstance(settings["dns_resolver"], CachingResolver)
+
+class StubDNSServer(object):
+    """DNS server answering from a table, over UDP and TCP, on the same
+    port on the loopback interface."""
+    # pylint: disable=W0212
+    def __init__(self):
+        self.records = {}
+        self.truncate = set()
+        self.drop = {}
+        self.servfail = set()
+        self.queries = []
+        self.tcp, self.udp = self._bind()
+        self.port = self.tcp.getsockname()[1]
+        self.tcp.listen(5)
+        for target in (self._run_udp, self._run_tcp):
+            thread = threading.Thread(target = target)
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def _bind():
+        """Bind a TCP and an UDP socket to the same free port.
+
+        The UDP port may be taken by someone else, so retry with
+        another TCP port until both binds succeed."""
+        for dummy in range(100):
+            tcp = socket.socket(AF_INET, socket.SOCK_STREAM)
+            tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcp.bind(("127.0.0.1", 0))
+            udp = socket.socket(AF_INET, socket.SOCK_DGRAM)
+            try:
+                udp.bind(("127.0.0.1", tcp.getsockname()[1]))
+            except socket.error, err:
+                tcp.close()
+                udp.close()
+                if err.args[0] != errno.EADDRINUSE:
+                    raise
+                continue
+            return tcp, udp
+        raise RuntimeError("Could not find a free TCP and UDP port")
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+    def add(self, name, rtype, ttl, rdata):
+        self.records.setdefault((name, rtype), []).append((name, ttl, rdata))
+
+    def answer(self, query, tcp):
+        question_end = query.index("\0", 12) + 5
+        question = query[12:question_end]
+        name = resolver_mod._read_name(query, 12)[0]
+        rtype = struct.unpack("!H", query[question_end - 4:
+                                                    question_end - 2])[0]
+        self.queries.append((name, rtype, tcp))
+        if self.drop.get(name):
+            self.drop[name] -= 1
+            return None
+        flags = 0x8180
+        answers = []
+        if name in self.servfail and not tcp:
+            flags |= 2
+        elif name in self.truncate and not tcp:
+            flags |= 0x0200
+        else:
+            owner = name
+            while (owner, 5) in self.records and rtype != 5:
+                answers += self.records[(owner, 5)]
+                owner = resolver_mod._read_name(
+                                        self.records[(owner, 5)][0][2], 0)[0]
+            answers += self.records.get((owner, rtype), [])
+            if not answers and not any(key[0] == name
+                                                for key in self.records):
+                flags |= 3
+        packet = query[:2] + struct.pack("!HHHHH", flags, 1,
+                                                len(answers), 0, 0) + question
+        for owner, ttl, rdata in answers:
+            rec_type = rtype
+            if (owner, 5) in self.records and rtype != 5:
+                rec_type = 5
+            packet += resolver_mod._encode_name(owner)
+            packet += struct.pack("!HHIH", rec_type, 1, ttl, len(rdata))
+            packet += rdata
+        return packet
+
+    def _run_udp(self):
+        while True:
+            try:
+                query, addr = self.udp.recvfrom(1024)
+            except socket.error:
+                return
+            packet = self.answer(query, False)
+            if packet:
+                self.udp.sendto(packet, addr)
+
+    def _run_tcp(self):
+        while True:
+            try:
+                sock = self.tcp.accept()[0]
+            except socket.error:
+                return
+            data = ""
+            while len(data) < 2 or len(data) < struct.unpack("!H",
+                                                            data[:2])[0] + 2:
+                data += sock.recv(1024)
+            packet = self.answer(data[2:], True)
+            if packet:
+                sock.sendall(struct.pack("!H", len(packet)) + packet)
+            sock.close()
+
+def a_record(address):
+    return socket.inet_pton(AF_INET, address)
+
+def aaaa_record(address):
+    return socket.inet_pton(AF_INET6, address)
+
+def srv_record(priority, weight, port, target):
+    # pylint: disable=W0212
+    return struct.pack("!HHH", priority, weight, port) + \
+                                            resolver_mod._encode_name(target)
+
+class RecordingCallback(object):
+    # pylint: disable=R0903
+    def __init__(self):
+        self.results = []
+    def __call__(self, result):
+        self.results.append(result)
+
+@unittest.skipIf("lo-network" not in _support.RESOURCES,
+                                        "loopback network usage disabled")
+class TestAsyncResolver(unittest.TestCase):
+    def setUp(self):
+        # pylint: disable=W0212
+        XMPPSettings._defs['event_queue'].default = None
+        self.server = StubDNSServer()
+        self.settings = XMPPSettings({"ipv4": True, "ipv6": True,
+                                    "prefer_ipv6": False, "dns_timeout": 0.2,
+                                    "dns_attempts": 2})
+        self.loop = main_loop_factory(self.settings)
+        self.resolver = AsyncResolver(self.loop, self.settings,
+                                        [("127.0.0.1", self.server.port)])
+        self.callback = RecordingCallback()
+        server = self.server
+        server.add("xmpp.example.com", 1, 300, a_record("192.0.2.1"))
+        server.add("xmpp.example.com", 1, 200, a_record("192.0.2.2"))
+        server.add("xmpp.example.com", 28, 100, aaaa_record("2001:db8::1"))
+        server.add("alias.example.com", 5, 50,
+                                resolver_mod._encode_name("xmpp.example.com"))
+        server.add("_xmpp-client._tcp.example.com", 33, 600,
+                            srv_record(10, 0, 5223, "backup.example.com"))
+        server.add("_xmpp-client._tcp.example.com", 33, 500,
+                            srv_record(0, 0, 5222, "xmpp.example.com"))
+        server.add("_xmpp-server._tcp.example.com", 33, 600,
+                            srv_record(0, 0, 0, ""))
+
+    def tearDown(self):
+        self.resolver.close()
+        self.server.close()
+
+    def wait(self, count = 1, timeout = 3):
+        end = time.time() + timeout
+        while len(self.callback.results) < count and time.time() < end:
+            self.loop.loop_iteration(0.1)
+
+    def test_srv(self):
+        self.resolver.resolve_srv(u"Example.com", "xmpp-client", "tcp",
+                                                            self.callback)
+        self.resolver.resolve_srv(u"example.com", "xmpp-server", "tcp",
+                                                            self.callback)
+        self.wait(2)
+        results = sorted(self.callback.results)
+        self.assertEqual(results, [
+                    [(".", 0)], [("xmpp.example.com", 5222),
+                                            ("backup.example.com", 5223)]])
+        self.assertEqual([result.ttl for result in results], [600, 500])
+        self.assertEqual(len(results[1].srv_records), 2)
+        self.assertTrue(all(isinstance(record, SRVRecord)
+                                    for record in results[1].srv_records))
+        self.assertFalse(any(result.failed for result in results))
+
+    def test_address(self):
+        self.resolver.resolve_address(u"xmpp.example.com", self.callback)
+        self.wait()
+        self.assertEqual(self.callback.results, [[(AF_INET, "192.0.2.1"),
+                    (AF_INET, "192.0.2.2"), (AF_INET6, "2001:db8::1")]])
+        self.assertEqual(self.callback.results[0].ttl, 100)
+
+    def test_cname(self):
+        self.settings["ipv6"] = False
+        self.resolver.resolve_address(u"alias.example.com", self.callback)
+        self.resolver.resolve_address(u"alias.example.com", self.callback,
+                                                        allow_cname = False)
+        self.wait(2)
+        self.assertEqual(self.callback.results, [[(AF_INET, "192.0.2.1"),
+                                            (AF_INET, "192.0.2.2")], []])
+
+    def test_nxdomain(self):
+        self.resolver.resolve_address(u"nohost.example.com", self.callback)
+        self.resolver.resolve_srv(u"nohost.example.com", "xmpp-client", "tcp",
+                                                            self.callback)
+        self.wait(2)
+        self.assertEqual(self.callback.results, [[], []])
+        for result in self.callback.results:
+            self.assertIsNone(result.ttl)
+            self.assertFalse(result.failed)
+
+    def test_literal(self):
+        self.resolver.resolve_address(u"192.0.2.7", self.callback)
+        self.assertEqual(self.callback.results, [[(AF_INET, "192.0.2.7")]])
+        self.assertEqual(self.server.queries, [])
+
+    def test_tcp_fallback(self):
+        self.server.truncate.add("xmpp.example.com")
+        self.settings["ipv6"] = False
+        self.resolver.resolve_address(u"xmpp.example.com", self.callback)
+        self.wait()
+        self.assertEqual(self.callback.results, [[(AF_INET, "192.0.2.1"),
+                                                    (AF_INET, "192.0.2.2")]])
+        self.assertEqual(self.server.queries, [("xmpp.example.com", 1, False),
+                                            ("xmpp.example.com", 1, True)])
+        # the TCP handler is removed from the loop in the next iteration
+        self.loop.loop_iteration(0.1)
+        self.assertEqual(len(self.loop._handlers), 1) # pylint: disable=W0212
+
+    def test_retry(self):
+        self.server.drop["xmpp.example.com"] = 1
+        self.settings["ipv6"] = False
+        self.resolver.resolve_address(u"xmpp.example.com", self.callback)
+        self.wait()
+        self.assertEqual(len(self.callback.results[0]), 2)
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_servfail(self):
+        self.server.servfail.add("xmpp.example.com")
+        self.settings["ipv6"] = False
+        start = time.time()
+        self.resolver.resolve_address(u"xmpp.example.com", self.callback)
+        self.wait()
+        self.assertEqual(self.callback.results, [[]])
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertTrue(time.time() - start < 0.2)
+        self.assertTrue(self.callback.results[0].failed)
+
+    def test_timeout(self):
+        self.server.drop["xmpp.example.com"] = 10
+        self.settings["ipv6"] = False
+        self.resolver.resolve_address(u"xmpp.example.com", self.callback)
+        self.wait()
+        self.assertEqual(self.callback.results, [[]])
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertEqual(self.resolver._queries, {}) # pylint: disable=W0212
+        self.assertTrue(self.callback.results[0].failed)
+
+    def test_many(self):
+        self.settings["ipv6"] = False
+        for dummy in range(200):
+            self.resolver.resolve_address(u"xmpp.example.com", self.callback)
+        self.wait(200)
+        self.assertEqual(len(self.callback.results), 200)
+        self.assertTrue(all(len(result) == 2
+                                    for result in self.callback.results))
+
+class TestDNSWire(unittest.TestCase):
+    # pylint: disable=W0212
+    def test_query(self):
+        packet = resolver_mod._make_query(0x1234, u"\u017c.example.com", 1)
+        self.assertEqual(packet[:12],
+                    "\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+        self.assertEqual(packet[12:],
+                    "\x07xn--hha\x07example\x03com\x00\x00\x01\x00\x01")
+        with self.assertRaises(ValueError):
+            resolver_mod._make_query(1, "a..b", 1)
+        with self.assertRaises(ValueError):
+            resolver_mod._make_query(1, "a" * 64, 1)
+
+    def test_compression(self):
+        header = struct.pack("!HHHHHH", 1, 0x8180, 1, 1, 0, 0)
+        question = "\x07example\x03com\x00\x00\x01\x00\x01"
+        answer = "\x04xmpp\xc0\x0c" + struct.pack("!HHIH", 5, 1, 60, 2)
+        answer += "\xc0\x0c"
+        response = resolver_mod._parse_response(header + question + answer)
+        self.assertEqual(response.qname, "example.com")
+        self.assertEqual(response.answers,
+                                [("xmpp.example.com", 5, 60, "example.com")])
+
+    def test_malformed(self):
+        header = struct.pack("!HHHHHH", 1, 0x8180, 1, 0, 0, 0)
+        for data in ("", header, header + "\xc0\x0c",
+                                            header + "\x05abc",
+                                            header + "\x00\x00\x01"):
+            with self.assertRaises(ValueError):
+                resolver_mod._parse_response(data)
+        query = struct.pack("!HHHHHH", 1, 0x0100, 1, 0, 0, 0)
+        with self.assertRaises(ValueError):
+            resolver_mod._parse_response(query + "\x00\x00\x01\x00\x01")
+
 # pylint: disable=W0611
 from pyxmpp2.test._support import load_tests, setup_logging
 
@@ -226,6 +226,33 @@ class TestRosterItem(unittest.TestCase):
         # check if serializable
         self.assertTrue(ElementTree.tostring(xml))
 
+class TestRosterPayload(unittest.TestCase):
+    def test_parse(self):
+        element = ElementTree.XML('<query xmlns="jabber:iq:roster" ver="1">'
+                        '<item jid="a@b.c" name="A"/>'
+                        '<item jid="B@b.c"><group>G</group></item>'
+                        '<item jid="b@B.c"/>'
+                        '</query>')
+        payload = RosterPayload.from_xml(element)
+        self.assertEqual(payload.version, "1")
+        self.assertEqual(len(payload), 2)
+        self.assertEqual(payload[0].jid, JID("a@b.c"))
+        self.assertEqual(payload[0].name, u"A")
+        self.assertEqual(payload[1].jid, JID("b@b.c"))
+        self.assertEqual(payload[1].groups, set(["G"]))
+
+    def test_parse_bad_jid(self):
+        for jid in ('', 'a@', 'a@b&amp;c'):
+            element = ElementTree.XML('<query xmlns="jabber:iq:roster">'
+                        '<item jid="a@b.c"/><item jid="{0}"/>'
+                        '</query>'.format(jid))
+            with self.assertRaises(BadRequestProtocolError):
+                RosterPayload.from_xml(element)
+        element = ElementTree.XML('<query xmlns="jabber:iq:roster">'
+                                                            '<item/></query>')
+        with self.assertRaises(BadRequestProtocolError):
+            RosterPayload.from_xml(element)
+
 class Processor(StanzaProcessor):
     def __init__(self, handlers):
         StanzaProcessor.__init__(self)
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import os
+import time
+
+from pyxmpp2 import sasl
+from pyxmpp2.jid import JID
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.streambase import StreamBase
+from pyxmpp2.streamsasl import StreamSASLHandler
+from pyxmpp2.loopback import loopback_pair
+from pyxmpp2.mainloop.select import SelectMainLoop
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+TIMEOUT = 2.0 # seconds
+
+class UidPasswordDatabase(sasl.PasswordDatabase):
+    def __init__(self, users):
+        self.users = users
+    def get_external_username(self, properties):
+        credentials = properties.get("peer-credentials")
+        if credentials is None:
+            return None
+        return self.users.get(credentials[1])
+
+class TestServer(unittest.TestCase):
+    def authenticate(self, database, properties, authzid = None):
+        client = sasl.client_authenticator_factory("EXTERNAL")
+        server = sasl.server_authenticator_factory("EXTERNAL", database)
+        client_props = {}
+        if authzid:
+            client_props["authzid"] = authzid
+        response = client.start(client_props)
+        return server.start(properties, response.data)
+
+    def test_peer_credentials(self):
+        database = UidPasswordDatabase({1000: u"gateway"})
+        result = self.authenticate(database,
+                                    {"peer-credentials": (123, 1000, 1000)})
+        self.assertIsInstance(result, sasl.Success)
+        self.assertEqual(result.properties, {"username": u"gateway"})
+
+    def test_authzid(self):
+        database = UidPasswordDatabase({1000: u"gateway"})
+        result = self.authenticate(database,
+                                    {"peer-credentials": (123, 1000, 1000)},
+                                    u"gateway@example.org")
+        self.assertIsInstance(result, sasl.Success)
+        self.assertEqual(result.properties["authzid"], u"gateway@example.org")
+
+    def test_unknown_peer(self):
+        database = UidPasswordDatabase({1000: u"gateway"})
+        result = self.authenticate(database,
+                                    {"peer-credentials": (123, 1001, 1001)})
+        self.assertIsInstance(result, sasl.Failure)
+        result = self.authenticate(database, {"remote-ip": "127.0.0.1"})
+        self.assertIsInstance(result, sasl.Failure)
+
+    @unittest.skipIf(pwd is None, "No pwd module")
+    def test_system_user(self):
+        database = UidPasswordDatabase({})
+        uid = os.getuid()
+        properties = {"peer-credentials": (os.getpid(), uid, os.getgid())}
+        username = sasl.PasswordDatabase.get_external_username(database,
+                                                                properties)
+        self.assertEqual(username, pwd.getpwuid(uid).pw_name)
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        self.loop = None
+
+    def tearDown(self):
+        if self.loop:
+            self.client.transport.close()
+            self.server.transport.close()
+            # do not leave the events in the shared queue
+            self.loop.check_events()
+            self.loop = None
+
+    def run_until(self, condition):
+        timeout = time.time() + TIMEOUT
+        while not condition() and time.time() < timeout:
+            self.loop.loop_iteration(0.1)
+        return condition()
+
+    def authenticate(self, authzid = None):
+        database = UidPasswordDatabase({1000: u"gateway"})
+        server_settings = XMPPSettings({
+                        u"password_database": database,
+                        u"sasl_mechanisms": ["EXTERNAL"],
+                        u"insecure_auth": True,
+                        u"extra_auth_properties": {
+                                    "peer-credentials": (123, 1000, 1000)},
+                        })
+        client_settings = XMPPSettings({
+                        u"sasl_mechanisms": ["EXTERNAL"],
+                        u"insecure_auth": True,
+                        u"authzid": authzid,
+                        })
+        self.server = StreamBase(u"jabber:client", None,
+                    [StreamSASLHandler(server_settings)], server_settings)
+        self.client = StreamBase(u"jabber:client", None,
+                    [StreamSASLHandler(client_settings)], client_settings)
+        self.client.me = JID(u"gateway@127.0.0.1")
+        client_transport, server_transport = loopback_pair()
+        self.loop = SelectMainLoop(None, [client_transport,
+                                                        server_transport])
+        self.server.receive(server_transport, u"127.0.0.1")
+        self.client.initiate(client_transport, u"127.0.0.1")
+        self.assertTrue(self.run_until(lambda: self.server.peer_authenticated
+                                            and self.client.authenticated))
+
+    def test_no_authzid(self):
+        self.authenticate()
+        self.assertEqual(self.server.peer, JID(u"gateway@127.0.0.1"))
+
+    def test_authzid(self):
+        self.authenticate(u"gateway@127.0.0.1")
+        self.assertEqual(self.server.peer, JID(u"gateway@127.0.0.1"))
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
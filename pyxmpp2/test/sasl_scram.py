@@ -0,0 +1,185 @@
+#!/usr/bin/python -u
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import binascii
+
+from pyxmpp2 import sasl
+from pyxmpp2.sasl import scram
+from pyxmpp2.sasl.scram import SCRAMOperations, SCRAMKeysPasswordDatabase
+from pyxmpp2.sasl.scram import make_scram_keys, set_salted_password_cache_size
+
+# RFC 5802, section 5
+CLIENT_NONCE = b"fyko+d2lbbFgONRv9qkxdawL"
+SERVER_NONCE = b"3rfcNHYJY1ZVvWVs7j"
+SALT = binascii.a2b_base64(b"QSXCR+Q6sek8bf92")
+SERVER_FIRST = (b"r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,"
+                                                b"s=QSXCR+Q6sek8bf92,i=4096")
+CLIENT_FINAL = (b"c=biws,r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,"
+                                        b"p=v0X8v3Bz2T0CJGbJQyF0X+HI4Ts=")
+SERVER_FINAL = b"v=rmF9pqV8S7suAoZWja4dJRkFsKQ="
+
+class CountingPasswordDatabase(sasl.PasswordDatabase):
+    def __init__(self, passwords):
+        self.passwords = passwords
+        self.requests = []
+    def get_password(self, username, acceptable_formats, properties):
+        self.requests.append(tuple(acceptable_formats))
+        if "plain" in acceptable_formats and username in self.passwords:
+            return self.passwords[username], "plain"
+        return None, None
+
+class TestHi(unittest.TestCase):
+    def test_rfc6070(self):
+        ops = SCRAMOperations("SHA-1")
+        for password, salt, count, expected in (
+                (b"password", b"salt", 1,
+                        "0c60c80f961f0e71f3a9b524af6012062fe037a6"),
+                (b"password", b"salt", 2,
+                        "ea6c014dc72d6f8ccd1ed92ace1d41f0d8de8957"),
+                (b"password", b"salt", 4096,
+                        "4b007901b765489abead49d926f721d065a429c1"),
+                (b"passwordPASSWORDpassword",
+                        b"saltSALTsaltSALTsaltSALTsaltSALTsalt", 4096,
+                        "3d2eec4fe41c849b80c8d83662c0e44a8b291a96"),
+                ):
+            self.assertEqual(binascii.b2a_hex(ops.Hi(password, salt, count)),
+                                                                    expected)
+            # pylint: disable=W0212
+            self.assertEqual(ops._Hi(password, salt, count),
+                                                ops.Hi(password, salt, count))
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        # pylint: disable=W0212
+        self.saved_size = scram._salted_password_cache_size
+        set_salted_password_cache_size(0)
+        set_salted_password_cache_size(16)
+
+    def tearDown(self):
+        set_salted_password_cache_size(self.saved_size)
+
+    def authenticate(self):
+        authenticator = sasl.client_authenticator_factory("SCRAM-SHA-1")
+        response = authenticator.start({"username": u"user",
+                                        "password": u"pencil",
+                                        "nonce_factory": lambda: CLIENT_NONCE})
+        self.assertEqual(response.data, b"n,,n=user,r=" + CLIENT_NONCE)
+        response = authenticator.challenge(SERVER_FIRST)
+        self.assertEqual(response.data, CLIENT_FINAL)
+        result = authenticator.finish(SERVER_FINAL)
+        self.assertIsInstance(result, sasl.Success)
+
+    def test_rfc_example(self):
+        self.authenticate()
+
+    def test_salted_password_cache(self):
+        self.authenticate()
+        # pylint: disable=W0212
+        self.assertEqual(len(scram._salted_password_cache), 1)
+        key = scram._salted_password_cache.keys()[0]
+        self.assertNotIn(b"pencil", key)
+        original = SCRAMOperations.Hi
+        def failing_hi(*args):
+            raise AssertionError("Hi() called")
+        SCRAMOperations.Hi = failing_hi
+        try:
+            self.authenticate()
+        finally:
+            SCRAMOperations.Hi = original
+
+    def test_cache_disabled(self):
+        set_salted_password_cache_size(0)
+        self.authenticate()
+        # pylint: disable=W0212
+        self.assertEqual(len(scram._salted_password_cache), 0)
+
+class TestServer(unittest.TestCase):
+    def authenticate(self, database, password = u"pencil"):
+        client = sasl.client_authenticator_factory("SCRAM-SHA-1")
+        server = sasl.server_authenticator_factory("SCRAM-SHA-1", database)
+        response = client.start({"username": u"user", "password": password})
+        challenge = server.start({}, response.data)
+        response = client.challenge(challenge.data)
+        result = server.response(response.data)
+        if isinstance(result, sasl.Failure):
+            return result
+        return client.finish(result.data)
+
+    def test_make_scram_keys(self):
+        salt, count, stored_key, server_key = make_scram_keys(u"SHA-1",
+                                                        u"pencil", SALT)
+        self.assertEqual(salt, SALT)
+        self.assertEqual(count, 4096)
+        self.assertEqual(binascii.b2a_base64(stored_key).strip(),
+                                            b"6dlGYMOdZcOPutkcNY8U2g7vK9Y=")
+        self.assertEqual(binascii.b2a_base64(server_key).strip(),
+                                            b"D+CSWLOshSulAsxiupA+qs2/fTE=")
+
+    def test_keys_database(self):
+        plain = CountingPasswordDatabase({u"user": u"pencil"})
+        database = SCRAMKeysPasswordDatabase(plain)
+        self.assertIsInstance(self.authenticate(database), sasl.Success)
+        self.assertEqual(plain.requests, [("plain",)])
+        self.assertIn(("SCRAM-SHA-1-Keys", u"user"), database.store)
+        self.assertIsInstance(self.authenticate(database), sasl.Success)
+        self.assertEqual(plain.requests, [("plain",)])
+        self.assertIsInstance(self.authenticate(database, u"bad"),
+                                                            sasl.Failure)
+
+    def test_add_user(self):
+        plain = CountingPasswordDatabase({})
+        database = SCRAMKeysPasswordDatabase(plain, iteration_count = 8192)
+        database.add_user(u"user", u"pencil")
+        self.assertIsInstance(self.authenticate(database), sasl.Success)
+        self.assertEqual(plain.requests, [])
+        self.assertEqual(database.store["SCRAM-SHA-1-Keys", u"user"][1], 8192)
+        database.remove_user(u"user")
+        self.assertEqual(database.store, {})
+        self.assertIsInstance(self.authenticate(database), sasl.Failure)
+
+    def test_unknown_user(self):
+        database = SCRAMKeysPasswordDatabase(CountingPasswordDatabase({}))
+        self.assertIsInstance(self.authenticate(database), sasl.Failure)
+        self.assertEqual(database.store, {})
+
+    def test_unknown_user_fake_keys(self):
+        database = SCRAMKeysPasswordDatabase(CountingPasswordDatabase({}),
+                                                    iteration_count = 8192)
+        original = SCRAMOperations.Hi
+        def failing_hi(*args):
+            raise AssertionError("Hi() called")
+        SCRAMOperations.Hi = failing_hi
+        try:
+            keys, pformat = database.get_password(u"nobody",
+                                            ("SCRAM-SHA-1-Keys",), {})
+            other_keys = database.get_password(u"other",
+                                            ("SCRAM-SHA-1-Keys",), {})[0]
+        finally:
+            SCRAMOperations.Hi = original
+        self.assertEqual(pformat, "SCRAM-SHA-1-Keys")
+        self.assertEqual(keys[1], 8192)
+        self.assertEqual(len(keys[0]), 32)
+        self.assertEqual(database.get_password(u"nobody",
+                                    ("SCRAM-SHA-1-Keys",), {})[0], keys)
+        self.assertNotEqual(other_keys[0], keys[0])
+        self.assertEqual(database.store, {})
+
+    def test_keys_format_no_password(self):
+        class KeysOnlyDatabase(sasl.PasswordDatabase):
+            # pylint: disable=W0232
+            def get_password(self, username, acceptable_formats,
+                                                                properties):
+                return None, "SCRAM-SHA-1-Keys"
+        self.assertIsInstance(self.authenticate(KeysOnlyDatabase()),
+                                                            sasl.Failure)
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
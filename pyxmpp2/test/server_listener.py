@@ -5,7 +5,13 @@
 """Tests for pyxmpp2.server.listener"""
 
 import unittest
+import os
+import sys
+import gc
+import StringIO
 import socket
+import tempfile
+import shutil
 import threading
 import logging
 import time
@@ -19,7 +25,7 @@ except ImportError:
 
 from pyxmpp2.test import _support
 
-from pyxmpp2.server.listener import TCPListener
+from pyxmpp2.server.listener import TCPListener, SO_REUSEPORT
 from pyxmpp2.mainloop.select import SelectMainLoop
 from pyxmpp2.mainloop.poll import PollMainLoop
 from pyxmpp2.mainloop.threads import ThreadPool
@@ -146,6 +152,139 @@ class TestListenerThread(TestListenerSelect):
             self._loop.event_dispatcher.flush(False)
         super(TestListenerThread, self).tearDown()
 
+@unittest.skipIf("lo-network" not in _support.RESOURCES,
+                                        "loopback network usage disabled")
+@unittest.skipIf(SO_REUSEPORT is None, "No SO_REUSEPORT support")
+class TestListenerReusePort(unittest.TestCase):
+    def setUp(self):
+        self.accepted = []
+
+    def tearDown(self):
+        for sock, _addr in self.accepted:
+            sock.close()
+
+    def accept(self, sock, address):
+        self.accepted.append((sock, address))
+
+    def test_reuse_port(self):
+        address = ('127.0.0.1', TEST_PORT + 2)
+        listeners = [TCPListener(socket.AF_INET, address, self.accept,
+                                        reuse_port = True) for dummy in (1, 2)]
+        try:
+            loop = SelectMainLoop(None, listeners)
+            loop.loop_iteration(0.1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+                timeout = time.time() + TIMEOUT
+                while not self.accepted and time.time() < timeout:
+                    loop.loop_iteration(0.1)
+            finally:
+                sock.close()
+        finally:
+            for listener in listeners:
+                listener.close()
+        self.assertEqual(len(self.accepted), 1)
+
+    def test_without_reuse_port(self):
+        address = ('127.0.0.1', TEST_PORT + 2)
+        listener = TCPListener(socket.AF_INET, address, self.accept,
+                                                            reuse_port = True)
+        try:
+            listener.prepare()
+            with self.assertRaises(socket.error):
+                TCPListener(socket.AF_INET, address, self.accept)
+        finally:
+            listener.close()
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "No Unix sockets")
+class TestListenerUnix(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "xmpp.sock")
+        self.accepted = []
+
+    def tearDown(self):
+        for sock, _addr in self.accepted:
+            sock.close()
+        shutil.rmtree(self.tmpdir)
+
+    def accept(self, sock, address):
+        self.accepted.append((sock, address))
+
+    def test_listener(self):
+        # a stale socket file
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        listener = TCPListener(socket.AF_UNIX, self.path, self.accept)
+        loop = SelectMainLoop(None, [listener])
+        loop.loop_iteration(0.1)
+        clients = []
+        try:
+            for dummy in range(3):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                clients.append(sock)
+                sock.connect(self.path)
+            timeout = time.time() + TIMEOUT
+            while len(self.accepted) < 3 and time.time() < timeout:
+                loop.loop_iteration(0.1)
+        finally:
+            for sock in clients:
+                sock.close()
+            listener.close()
+        self.assertEqual(len(self.accepted), 3)
+        self.assertEqual(self.accepted[0][0].family, socket.AF_UNIX)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_in_use(self):
+        listener = TCPListener(socket.AF_UNIX, self.path, self.accept)
+        try:
+            listener.prepare()
+            with self.assertRaises(socket.error):
+                TCPListener(socket.AF_UNIX, self.path, self.accept)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            finally:
+                sock.close()
+        finally:
+            listener.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_replaced(self):
+        listener1 = TCPListener(socket.AF_UNIX, self.path, self.accept)
+        os.unlink(self.path)
+        listener2 = TCPListener(socket.AF_UNIX, self.path, self.accept)
+        try:
+            listener1.close()
+            self.assertTrue(os.path.exists(self.path))
+        finally:
+            listener2.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_reuse_port_unavailable(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            with self.assertRaises(ValueError):
+                TCPListener(socket.AF_UNIX, self.path, self.accept,
+                                                        reuse_port = True)
+            # drop the traceback referencing the half-initialized object
+            sys.exc_clear()
+            gc.collect()
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(output, "")
+
+    def test_not_a_socket(self):
+        with open(self.path, "w") as regular_file:
+            regular_file.write("data")
+        with self.assertRaises(socket.error):
+            TCPListener(socket.AF_UNIX, self.path, self.accept)
+        self.assertTrue(os.path.exists(self.path))
+
 # pylint: disable=W0611
 from pyxmpp2.test._support import load_tests, setup_logging
 
@@ -3,6 +3,9 @@
 # pylint: disable=C0111
 
 import unittest
+import threading
+import time
+import Queue
 
 from pyxmpp2.etree import ElementTree
 
@@ -15,6 +18,10 @@ from pyxmpp2.interfaces import iq_get_stanza_handler
 from pyxmpp2.interfaces import iq_set_stanza_handler
 from pyxmpp2.interfaces import message_stanza_handler
 from pyxmpp2.interfaces import presence_stanza_handler
+from pyxmpp2.interfaces import blocking_stanza_handler
+from pyxmpp2.mainloop.workers import WorkerPool
+from pyxmpp2.mainloop.events import EventDispatcher
+from pyxmpp2.settings import XMPPSettings
 from pyxmpp2.stanzapayload import XMLPayload
 from pyxmpp2.jid import JID
 from pyxmpp2.utils import xml_elements_equal
@@ -420,6 +427,127 @@ class TestStanzaProcessor(unittest.TestCase):
         self.assertEqual(self.handlers_called, ["pass1"])
         self.assertEqual(len(self.stanzas_sent), 0)
 
+class TestBlockingHandlers(unittest.TestCase):
+    # pylint: disable=R0904
+    def setUp(self):
+        self.stanzas_sent = []
+        self.handled = []
+        self.release = threading.Event()
+        settings = XMPPSettings({"event_queue": Queue.Queue()})
+        self.proc = StanzaProcessor()
+        self.proc.me = JID("dest@example.com/xx")
+        self.proc.peer = JID("source@example.com/yy")
+        self.proc.send = self.stanzas_sent.append
+        self.pool = WorkerPool(settings, 2, 1)
+        self.proc.worker_pool = self.pool
+        self.dispatcher = EventDispatcher(settings, [self.pool])
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.stop()
+
+    def setup_handlers(self):
+        parent = self
+        class Handlers(XMPPFeatureHandler):
+            # pylint: disable=W0232,R0201,R0903
+            @iq_get_stanza_handler(XMLPayload, "{http://pyxmpp.jajcus.net"
+                                                        "/xmlns/test}payload")
+            @blocking_stanza_handler
+            def blocking_iq(self, stanza):
+                parent.release.wait(5)
+                parent.handled.append(("iq", threading.current_thread()))
+                return stanza.make_result_response()
+            @message_stanza_handler()
+            def message(self, stanza):
+                parent.handled.append(("message",
+                                            threading.current_thread()))
+                return True
+        self.proc.setup_stanza_handlers([Handlers()], "post-auth")
+
+    def wait_for_results(self, count):
+        timeout = time.time() + 5
+        while len(self.stanzas_sent) < count and time.time() < timeout:
+            self.dispatcher.dispatch(True, 0.1)
+
+    def test_blocking_iq(self):
+        self.setup_handlers()
+        self.release.set()
+        stanza = stanza_factory(ElementTree.XML(IQ1))
+        self.assertTrue(self.proc.process_stanza(stanza))
+        self.wait_for_results(1)
+        self.assertEqual(len(self.stanzas_sent), 1)
+        self.assertEqual(self.stanzas_sent[0].stanza_type, "result")
+        self.assertNotEqual(self.handled[0][1], threading.current_thread())
+
+    def test_sender_order(self):
+        self.setup_handlers()
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(IQ1)))
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(MESSAGE1)))
+        self.assertEqual(self.handled, [])
+        self.release.set()
+        self.wait_for_results(1)
+        self.dispatcher.flush()
+        self.assertEqual([h[0] for h in self.handled], ["iq", "message"])
+        self.assertEqual(self.handled[1][1], threading.current_thread())
+
+    def test_other_sender_not_held(self):
+        self.setup_handlers()
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(IQ1)))
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(MESSAGE3)))
+        self.assertEqual([h[0] for h in self.handled], ["message"])
+        self.release.set()
+        self.wait_for_results(1)
+        self.assertEqual([h[0] for h in self.handled], ["message", "iq"])
+
+    def test_queue_full(self):
+        self.setup_handlers()
+        pool = self.pool
+        pool.max_threads = 1
+        for i in range(3):
+            xml = IQ1.replace("source@", "source{0}@".format(i))
+            self.proc.process_stanza(stanza_factory(ElementTree.XML(xml)))
+            timeout = time.time() + 5
+            while not pool.queue.empty() and time.time() < timeout:
+                # wait until the first job is taken by the worker
+                if i > 0:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(len(self.stanzas_sent), 1)
+        self.assertEqual(self.stanzas_sent[0].stanza_type, "error")
+        self.assertEqual(self.stanzas_sent[0].error.condition_name,
+                                                    "resource-constraint")
+
+    def test_stop_cancels_queued(self):
+        self.setup_handlers()
+        pool = self.pool
+        pool.max_threads = 1
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(IQ1)))
+        timeout = time.time() + 5
+        while not pool.queue.empty() and time.time() < timeout:
+            time.sleep(0.01)
+        xml = IQ1.replace("source@", "source1@")
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(xml)))
+        xml = MESSAGE1.replace("source@", "source1@")
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(xml)))
+        self.assertEqual(self.handled, [])
+        pool.stop()
+        self.dispatcher.flush()
+        # the queued stanza is refused and the one held behind it released
+        self.assertEqual(len(self.stanzas_sent), 1)
+        self.assertEqual(self.stanzas_sent[0].to_jid,
+                                            JID("source1@example.com/res"))
+        self.assertEqual(self.stanzas_sent[0].error.condition_name,
+                                                    "service-unavailable")
+        self.assertEqual([h[0] for h in self.handled], ["message"])
+
+    def test_no_pool(self):
+        self.setup_handlers()
+        self.proc.worker_pool = None
+        self.release.set()
+        self.proc.process_stanza(stanza_factory(ElementTree.XML(IQ1)))
+        self.assertEqual(len(self.stanzas_sent), 1)
+        self.assertEqual(self.handled[0][1], threading.current_thread())
+
 # pylint: disable=W0611
 from pyxmpp2.test._support import load_tests, setup_logging
 
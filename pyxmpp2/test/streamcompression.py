@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import re
+import zlib
+import logging
+
+from xml.etree.ElementTree import XML
+
+from pyxmpp2.streambase import StreamBase
+from pyxmpp2.streamcompression import StreamCompressionHandler
+from pyxmpp2.streamevents import *  # pylint: disable=W0614,W0401
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.exceptions import PyXMPPIOError
+
+from pyxmpp2.test._util import EventRecorder, InitiatorSelectTestCase
+from pyxmpp2.test._util import ReceiverSelectTestCase
+
+C2S_SERVER_STREAM_HEAD = (b'<stream:stream version="1.0"'
+                            b' from="server.example.org"'
+                            b' xmlns:stream="http://etherx.jabber.org/streams"'
+                            b' xmlns="jabber:client">')
+C2S_CLIENT_STREAM_HEAD = (b'<stream:stream version="1.0"'
+                            b' to="server.example.org"'
+                            b' xmlns:stream="http://etherx.jabber.org/streams"'
+                            b' xmlns="jabber:client">')
+
+COMPRESSION_FEATURES = b"""<stream:features>
+     <compression xmlns='http://jabber.org/features/compress'>
+        <method>zlib</method>
+     </compression>
+</stream:features>"""
+
+EMPTY_FEATURES = b"""<stream:features/>"""
+
+COMPRESS = (b"<compress xmlns='http://jabber.org/protocol/compress'>"
+                                            b"<method>zlib</method></compress>")
+COMPRESSED = b"<compressed xmlns='http://jabber.org/protocol/compress'/>"
+FAILURE = (b"<failure xmlns='http://jabber.org/protocol/compress'>"
+                                                b"<setup-failed/></failure>")
+
+STREAM_TAIL = b'</stream:stream>'
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+def compress(compressor, data):
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+class TestInitiator(InitiatorSelectTestCase):
+    def start_stream(self, handler, **kwargs):
+        settings = XMPPSettings({u"compression": True})
+        for key, value in kwargs.items():
+            settings[key] = value
+        handlers = [StreamCompressionHandler(settings), handler]
+        self.stream = StreamBase(u"jabber:client", None, handlers, settings)
+        self.start_transport(handlers)
+        self.stream.initiate(self.transport, to = "server.example.org")
+        self.connect_transport()
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(COMPRESSION_FEATURES)
+        xml = self.wait(expect = re.compile(br".*(<compress.*</compress>)"))
+        self.assertIsNotNone(xml)
+        element = XML(xml)
+        self.assertEqual(element.tag,
+                                "{http://jabber.org/protocol/compress}compress")
+        self.assertEqual(element[0].text, "zlib")
+        self.server.rdata = b""
+
+    def test_compression(self):
+        handler = EventRecorder()
+        self.start_stream(handler)
+        self.server.write(COMPRESSED)
+        self.wait(0.5)
+        self.assertTrue(self.stream.compression_established)
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(self.server.rdata)
+        self.assertTrue(data.startswith(b"<stream:stream"), data)
+        compressor = zlib.compressobj()
+        self.server.write(compress(compressor, C2S_SERVER_STREAM_HEAD))
+        self.server.write(compress(compressor, EMPTY_FEATURES))
+        self.wait(0.5)
+        self.assertIsNotNone(self.stream.features)
+        self.server.write(compress(compressor, STREAM_TAIL))
+        self.server.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [ConnectingEvent,
+                    ConnectedEvent, StreamConnectedEvent, GotFeaturesEvent,
+                    StreamRestartedEvent, GotFeaturesEvent, DisconnectedEvent])
+
+    def test_inflate_limit(self):
+        handler = EventRecorder()
+        self.start_stream(handler, compression_max_inflated = 1000000)
+        trace_handler = ListHandler()
+        trace_logger = logging.getLogger("pyxmpp2.IN")
+        trace_logger.addHandler(trace_handler)
+        trace_logger.setLevel(logging.DEBUG)
+        trace_logger.propagate = False
+        self.addCleanup(setattr, trace_logger, "propagate", True)
+        self.addCleanup(trace_logger.removeHandler, trace_handler)
+        self.addCleanup(trace_logger.setLevel, logging.NOTSET)
+        self.server.write(COMPRESSED)
+        self.wait(0.5)
+        self.assertTrue(self.stream.compression_established)
+        compressor = zlib.compressobj()
+        self.server.write(compress(compressor, C2S_SERVER_STREAM_HEAD))
+        # more than one inflate chunk, but within the limit
+        self.server.write(compress(compressor, b" " * 200000))
+        self.server.write(compress(compressor, EMPTY_FEATURES))
+        self.wait(0.5)
+        self.assertIsNotNone(self.stream.features)
+        self.server.write(compress(compressor, b"<x/>"))
+        self.wait_short()
+        # traced after decompression
+        self.assertTrue(any(u"<x/>" in record
+                                        for record in trace_handler.records))
+        # a 'zlib bomb'
+        bomb = compress(compressor, b" " * 100000000)
+        self.assertLess(len(bomb), 200000)
+        self.server.write(bomb)
+        with self.assertRaises(PyXMPPIOError):
+            self.wait()
+        self.server.disconnect()
+
+    def test_failure(self):
+        handler = EventRecorder()
+        self.start_stream(handler)
+        self.server.write(FAILURE)
+        self.wait(0.5)
+        self.assertFalse(self.stream.compression_established)
+        self.assertNotIn(b"<compress", self.server.rdata)
+        self.server.write(STREAM_TAIL)
+        self.server.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [ConnectingEvent,
+                    ConnectedEvent, StreamConnectedEvent, GotFeaturesEvent,
+                    GotFeaturesEvent, DisconnectedEvent])
+
+class TestReceiver(ReceiverSelectTestCase):
+    def start_stream(self, settings):
+        handler = EventRecorder()
+        self.start_transport([handler])
+        handlers = [StreamCompressionHandler(settings), handler]
+        self.stream = StreamBase(u"jabber:client", None, handlers, settings)
+        self.stream.receive(self.transport, u"server.example.org")
+        self.stream.peer_authenticated = True
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        return handler
+
+    def test_compression(self):
+        settings = XMPPSettings({u"compression": True,
+                                u"compression_level": 1,
+                                u"compression_window_bits": 9})
+        handler = self.start_stream(settings)
+        xml = self.wait(expect = re.compile(
+                                br".*<stream:features>(.*)</stream:features>"))
+        self.assertIsNotNone(xml)
+        element = XML(xml)
+        self.assertEqual(element.tag,
+                            "{http://jabber.org/features/compress}compression")
+        self.assertEqual(element[0].text, "zlib")
+        self.client.rdata = b""
+        self.client.write(COMPRESS)
+        self.assertIsNotNone(self.wait(expect = re.compile(b"(<compressed.*>)")))
+        self.assertTrue(self.stream.compression_established)
+        data = self.client.rdata
+        compressed = data[data.index(b"/>") + 2:]
+        compressor = zlib.compressobj()
+        self.client.write(compress(compressor, C2S_CLIENT_STREAM_HEAD))
+        self.wait(0.5)
+        decompressor = zlib.decompressobj()
+        compressed += self.client.rdata[len(data):]
+        data = decompressor.decompress(compressed)
+        self.assertTrue(data.startswith(b"<stream:stream"), data)
+        self.assertIn(b"<stream:features/>", data)
+        self.client.write(compress(compressor, STREAM_TAIL))
+        self.client.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [StreamConnectedEvent,
+                                    StreamRestartedEvent, DisconnectedEvent])
+
+    def test_not_enabled(self):
+        handler = self.start_stream(XMPPSettings())
+        xml = self.wait(expect = re.compile(br".*(<stream:features/>)"))
+        self.assertIsNotNone(xml)
+        self.client.write(COMPRESS)
+        xml = self.wait(expect = re.compile(br".*(<failure.*</failure>)"))
+        self.assertIsNotNone(xml)
+        element = XML(xml)
+        self.assertEqual(element[0].tag,
+                            "{http://jabber.org/protocol/compress}setup-failed")
+        self.assertFalse(self.stream.compression_established)
+        self.client.write(STREAM_TAIL)
+        self.client.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [StreamConnectedEvent,
+                                                        DisconnectedEvent])
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import re
+
+from xml.etree.ElementTree import XML
+
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.streambase import StreamBase
+from pyxmpp2.streamevents import * # pylint: disable=W0401,W0614
+from pyxmpp2.jid import JID
+from pyxmpp2.message import Message
+from pyxmpp2.binding import ResourceBindingHandler
+from pyxmpp2.streammanagement import StreamManagementHandler
+from pyxmpp2.streammanagement import StreamManagementState
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.stanzaprocessor import StanzaProcessor
+
+from pyxmpp2.test._util import EventRecorder
+from pyxmpp2.test._util import InitiatorSelectTestCase
+from pyxmpp2.test._util import ReceiverSelectTestCase
+
+C2S_SERVER_STREAM_HEAD = (b'<stream:stream version="1.0"'
+                            b' from="127.0.0.1"'
+                            b' xmlns:stream="http://etherx.jabber.org/streams"'
+                            b' xmlns="jabber:client">')
+C2S_CLIENT_STREAM_HEAD = (b'<stream:stream version="1.0"'
+                            b' to="127.0.0.1"'
+                            b' xmlns:stream="http://etherx.jabber.org/streams"'
+                            b' xmlns="jabber:client">')
+
+SM_FEATURES = b"""<stream:features>
+     <bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>
+     <sm xmlns='urn:xmpp:sm:3'/>
+</stream:features>"""
+
+BIND_RESPONSE = """<iq type="result" id="{0}">
+  <bind  xmlns="urn:ietf:params:xml:ns:xmpp-bind">
+    <jid>test@127.0.0.1/Res</jid>
+  </bind>
+</iq>
+"""
+
+ENABLED = b"<enabled xmlns='urn:xmpp:sm:3' id='sm-1' resume='true'/>"
+RESUMED = b"<resumed xmlns='urn:xmpp:sm:3' previd='sm-1' h='1'/>"
+FAILED = (b"<failed xmlns='urn:xmpp:sm:3'><item-not-found"
+                        b" xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></failed>")
+ENABLE = b"<enable xmlns='urn:xmpp:sm:3'/>"
+RESUME = b"<resume xmlns='urn:xmpp:sm:3' previd='sm-1' h='0'/>"
+
+MESSAGE = b"<message to='test@127.0.0.1/Res'><body>Hi</body></message>"
+
+STREAM_TAIL = b'</stream:stream>'
+
+class TestState(unittest.TestCase):
+    def test_counters(self):
+        state = StreamManagementState(ack_interval = 2)
+        self.assertIsNone(state.stanza_sent(ElementTree.Element("a")))
+        request = state.stanza_sent(ElementTree.Element("b"))
+        self.assertEqual(request.tag, "{urn:xmpp:sm:3}r")
+        state.ack(1)
+        self.assertEqual([e.tag for e in state.unacked], ["b"])
+        state.stanza_received()
+        self.assertEqual(state.inbound, 1)
+
+    def test_wrap_around(self):
+        state = StreamManagementState()
+        state.acked = state.outbound = 2 ** 32 - 1
+        state.stanza_sent(ElementTree.Element("a"))
+        state.stanza_sent(ElementTree.Element("b"))
+        self.assertEqual(state.outbound, 1)
+        state.ack(0)
+        self.assertEqual([e.tag for e in state.unacked], ["b"])
+        state.ack(1)
+        self.assertEqual(len(state.unacked), 0)
+
+    def test_over_ack(self):
+        state = StreamManagementState()
+        state.stanza_sent(ElementTree.Element("a"))
+        state.stanza_sent(ElementTree.Element("b"))
+        state.ack(5)
+        self.assertEqual(len(state.unacked), 0)
+        self.assertEqual(state.acked, 2)
+        state.stanza_sent(ElementTree.Element("c"))
+        state.stanza_sent(ElementTree.Element("d"))
+        state.ack(3)
+        self.assertEqual([e.tag for e in state.unacked], ["d"])
+
+    def test_overflow(self):
+        state = StreamManagementState(max_unacked = 2)
+        state.stanza_sent(ElementTree.Element("a"))
+        state.stanza_sent(ElementTree.Element("b"))
+        self.assertFalse(state.overflow)
+        state.stanza_sent(ElementTree.Element("c"))
+        self.assertTrue(state.overflow)
+        state.ack(1)
+        self.assertFalse(state.overflow)
+
+class TestInitiator(InitiatorSelectTestCase):
+    def start_stream(self, sm_handler):
+        handler = EventRecorder()
+        handlers = [sm_handler, ResourceBindingHandler(), handler]
+        processor = StanzaProcessor()
+        processor.setup_stanza_handlers(handlers, "post-auth")
+        self.stream = StreamBase(u"jabber:client", processor, handlers,
+                                                        sm_handler.settings)
+        processor.uplink = self.stream
+        self.stream.me = JID("test@127.0.0.1")
+        self.stream.authenticated = True
+        self.start_transport([sm_handler, handler])
+        self.stream.initiate(self.transport)
+        self.connect_transport()
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(SM_FEATURES)
+        return handler
+
+    @staticmethod
+    def make_handler():
+        settings = XMPPSettings({u"stream_management": True,
+                                u"stream_management_ack_interval": 2})
+        return StreamManagementHandler(settings)
+
+    def make_resumable_handler(self):
+        sm_handler = self.make_handler()
+        state = StreamManagementState()
+        state.session_id = u"sm-1"
+        state.resumable = True
+        state.jid = JID("test@127.0.0.1/Res")
+        state.inbound = 3
+        for stanza_id in ("m1", "m2"):
+            message = Message(to_jid = JID("a@127.0.0.1"),
+                                                    stanza_id = stanza_id)
+            state.stanza_sent(message.as_xml())
+        sm_handler.state = state
+        return sm_handler
+
+    def test_enable(self):
+        sm_handler = self.make_handler()
+        handler = self.start_stream(sm_handler)
+        req_id = self.wait(1,
+                    expect = re.compile(br".*<iq[^>]*id=[\"']([^\"']*)[\"']"))
+        self.assertIsNotNone(req_id)
+        self.server.write(BIND_RESPONSE.format(req_id.decode("utf-8"))
+                                                            .encode("utf-8"))
+        self.assertIsNotNone(self.wait(1, expect = re.compile(
+                                                    br".*(<enable[^>]*>)")))
+        self.server.write(ENABLED)
+        self.wait(0.5)
+        self.assertTrue(sm_handler.resumable)
+        self.assertEqual(sm_handler.state.jid, JID("test@127.0.0.1/Res"))
+        self.server.rdata = b""
+        self.stream.send(Message(to_jid = JID("a@127.0.0.1")))
+        self.stream.send(Message(to_jid = JID("b@127.0.0.1")))
+        self.assertIsNotNone(self.wait(1, expect = re.compile(br".*(<r[ /])")))
+        self.assertEqual(len(sm_handler.state.unacked), 2)
+        self.server.write(b"<a xmlns='urn:xmpp:sm:3' h='2'/>")
+        self.server.write(MESSAGE)
+        self.server.write(b"<r xmlns='urn:xmpp:sm:3'/>")
+        xml = self.wait(1, expect = re.compile(br".*(<a [^>]*>)"))
+        self.assertIsNotNone(xml)
+        self.assertEqual(XML(xml).get("h"), "1")
+        self.assertEqual(len(sm_handler.state.unacked), 0)
+        self.server.write(STREAM_TAIL)
+        self.server.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertIn(AuthorizedEvent, event_classes)
+        self.assertNotIn(StreamResumedEvent, event_classes)
+
+    def test_resume(self):
+        sm_handler = self.make_resumable_handler()
+        handler = self.start_stream(sm_handler)
+        xml = self.wait(1, expect = re.compile(br".*(<resume[^>]*>)"))
+        self.assertIsNotNone(xml)
+        element = XML(xml)
+        self.assertEqual(element.get("previd"), "sm-1")
+        self.assertEqual(element.get("h"), "3")
+        self.server.rdata = b""
+        self.server.write(RESUMED)
+        self.assertIsNotNone(self.wait(1, expect = re.compile(
+                                                br".*(<message[^>]*m2)")))
+        self.assertNotIn(b"m1", self.server.rdata)
+        self.assertNotIn(b"<iq", self.server.rdata)
+        self.assertEqual(self.stream.me, JID("test@127.0.0.1/Res"))
+        self.assertIs(self.stream.sm_state, sm_handler.state)
+        self.server.write(STREAM_TAIL)
+        self.server.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [ConnectingEvent,
+                    ConnectedEvent, StreamConnectedEvent, GotFeaturesEvent,
+                    StreamResumedEvent, DisconnectedEvent])
+
+    def test_resume_failed(self):
+        sm_handler = self.make_resumable_handler()
+        handler = self.start_stream(sm_handler)
+        self.assertIsNotNone(self.wait(1, expect = re.compile(
+                                                    br".*(<resume[^>]*>)")))
+        self.server.write(FAILED)
+        req_id = self.wait(1,
+                    expect = re.compile(br".*<iq[^>]*id=[\"']([^\"']*)[\"']"))
+        self.assertIsNotNone(req_id)
+        self.assertIsNone(sm_handler.state)
+        self.server.write(BIND_RESPONSE.format(req_id.decode("utf-8"))
+                                                            .encode("utf-8"))
+        self.assertIsNotNone(self.wait(1, expect = re.compile(
+                                                    br".*(<enable[^>]*>)")))
+        self.server.write(STREAM_TAIL)
+        self.server.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [ConnectingEvent,
+                    ConnectedEvent, StreamConnectedEvent, GotFeaturesEvent,
+                    GotFeaturesEvent, BindingResourceEvent, AuthorizedEvent,
+                    DisconnectedEvent])
+
+class TestReceiver(ReceiverSelectTestCase):
+    def start_stream(self, **kwargs):
+        handler = EventRecorder()
+        self.start_transport([handler])
+        settings = XMPPSettings({u"stream_management": True})
+        for key, value in kwargs.items():
+            settings[key] = value
+        handlers = [StreamManagementHandler(settings), handler]
+        self.stream = StreamBase(u"jabber:client", None, handlers, settings)
+        self.stream.receive(self.transport, u"127.0.0.1")
+        self.stream.peer_authenticated = True
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(
+                                br".*<stream:features>(.*)</stream:features>"))
+        self.assertIsNotNone(xml)
+        self.assertEqual(XML(xml).tag, "{urn:xmpp:sm:3}sm")
+        return handler
+
+    def test_enable(self):
+        self.start_stream()
+        self.client.write(ENABLE)
+        xml = self.wait(expect = re.compile(br".*(<enabled[^>]*>)"))
+        self.assertIsNotNone(xml)
+        self.assertTrue(XML(xml).get("id"))
+        self.assertIsNotNone(self.stream.sm_state)
+        self.client.write(b"<r xmlns='urn:xmpp:sm:3'/>")
+        xml = self.wait(expect = re.compile(br".*(<a [^>]*>)"))
+        self.assertIsNotNone(xml)
+        self.assertEqual(XML(xml).get("h"), "0")
+        self.client.write(STREAM_TAIL)
+        self.client.disconnect()
+        self.wait()
+
+    def test_unacked_overflow(self):
+        self.start_stream(stream_management_max_unacked = 2,
+                                stream_management_ack_interval = 0)
+        self.client.write(ENABLE)
+        xml = self.wait(expect = re.compile(br".*(<enabled[^>]*>)"))
+        self.assertIsNotNone(xml)
+        for stanza_id in ("m1", "m2"):
+            self.stream.send(Message(to_jid = JID("test@127.0.0.1/Res"),
+                                                    stanza_id = stanza_id))
+        self.client.write(b"<a xmlns='urn:xmpp:sm:3' h='1'/>")
+        for dummy in range(10):
+            if len(self.stream.sm_state.unacked) < 2:
+                break
+            self.wait_short()
+        self.assertEqual(len(self.stream.sm_state.unacked), 1)
+        self.stream.send(Message(to_jid = JID("test@127.0.0.1/Res"),
+                                                        stanza_id = "m3"))
+        self.wait_short()
+        self.assertNotIn(b"<stream:error>", self.client.rdata)
+        self.stream.send(Message(to_jid = JID("test@127.0.0.1/Res"),
+                                                        stanza_id = "m4"))
+        xml = self.wait(expect = re.compile(
+                                    br".*<stream:error>(.*)</stream:error>"))
+        self.assertIsNotNone(xml)
+        self.assertEqual(XML(xml).tag,
+                "{urn:ietf:params:xml:ns:xmpp-streams}resource-constraint")
+        self.client.disconnect()
+        self.wait()
+
+    def test_resume(self):
+        self.start_stream()
+        self.client.write(RESUME)
+        xml = self.wait(expect = re.compile(br".*(<failed.*</failed>)"))
+        self.assertIsNotNone(xml)
+        self.assertEqual(XML(xml)[0].tag,
+                        "{urn:ietf:params:xml:ns:xmpp-stanzas}item-not-found")
+        self.assertIsNone(self.stream.sm_state)
+        self.client.write(STREAM_TAIL)
+        self.client.disconnect()
+        self.wait()
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
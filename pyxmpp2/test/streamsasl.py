@@ -7,6 +7,7 @@ import re
 import base64
 import binascii
 import os
+import threading
 
 import pyxmpp2.etree
 
@@ -20,11 +21,13 @@ if "PYXMPP2_ETREE" not in os.environ:
 
 from pyxmpp2.etree import ElementTree
 
+from pyxmpp2 import sasl
 from pyxmpp2.streambase import StreamBase
 from pyxmpp2.streamsasl import StreamSASLHandler
 from pyxmpp2.streamevents import * # pylint: disable=W0614,W0401
 from pyxmpp2.exceptions import SASLAuthenticationFailed
 from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.mainloop.workers import WorkerPool, WorkerJobDoneEvent
 
 from pyxmpp2.test._util import EventRecorder
 from pyxmpp2.test._util import InitiatorSelectTestCase
@@ -43,6 +46,12 @@ AUTH_FEATURES = b"""<stream:features>
      </mechanisms>
 </stream:features>"""
 
+DIGEST_FEATURES = b"""<stream:features>
+     <mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>
+        <mechanism>DIGEST-MD5</mechanism>
+     </mechanisms>
+</stream:features>"""
+
 BIND_FEATURES = b"""<stream:features>
      <bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>
 </stream:features>"""
@@ -58,6 +67,21 @@ PARSE_ERROR_RESPONSE = (b'<stream:error><xml-not-well-formed'
 
 TIMEOUT = 1.0 # seconds
 
+class SlowPasswordDatabase(sasl.PasswordDatabase):
+    def __init__(self, passwords):
+        self.passwords = passwords
+        self.release = threading.Event()
+        self.threads = []
+    def get_password(self, username, acceptable_formats, properties):
+        self.threads.append(threading.current_thread())
+        self.release.wait(TIMEOUT)
+        if username in self.passwords:
+            return self.passwords[username], "plain"
+        return None, None
+
+def parse_features(data):
+    return ElementTree.XML(C2S_SERVER_STREAM_HEAD + data + STREAM_TAIL)[0]
+
 class TestInitiator(InitiatorSelectTestCase):
     def test_auth(self):
         handler = EventRecorder()
@@ -130,6 +154,78 @@ class TestInitiator(InitiatorSelectTestCase):
         self.assertEqual(event_classes, [ConnectingEvent, ConnectedEvent,
                     StreamConnectedEvent, GotFeaturesEvent, DisconnectedEvent])
 
+    def pipelined_stream(self, handler, cached_features):
+        settings = XMPPSettings({
+                                u"username": u"user",
+                                u"password": u"secret",
+                                u"stream_pipelining": True,
+                                u"stream_features_cache": {
+                                    (u"127.0.0.1", False, False, False):
+                                            parse_features(cached_features),
+                                    },
+                                })
+        self.stream = StreamBase(u"jabber:client", None,
+                            [StreamSASLHandler(settings), handler], settings)
+        self.start_transport([handler])
+        self.stream.initiate(self.transport, u"127.0.0.1")
+        self.connect_transport()
+        return settings
+
+    def test_auth_pipelined(self):
+        handler = EventRecorder()
+        settings = self.pipelined_stream(handler, AUTH_FEATURES)
+        # <auth/> is sent before the features are received
+        xml = self.wait(expect = re.compile(br".*(<auth.*</auth>)"))
+        self.assertIsNotNone(xml)
+        element = ElementTree.XML(xml)
+        self.assertEqual(element.get("mechanism"), "PLAIN")
+        self.server.rdata = b""
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(AUTH_FEATURES)
+        self.server.write(
+                        b"<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>")
+        stream_start = self.wait(expect = re.compile(
+                                                br"(<stream:stream[^>]*>)"))
+        self.assertIsNotNone(stream_start)
+        self.assertNotIn(b"<auth", self.server.rdata)
+        self.assertTrue(self.stream.authenticated)
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(BIND_FEATURES)
+        self.server.write(b"</stream:stream>")
+        self.server.disconnect()
+        self.wait()
+        cache = settings["stream_features_cache"]
+        self.assertIn((u"127.0.0.1", False, True, False), cache)
+
+    def test_auth_pipelined_mismatch(self):
+        handler = EventRecorder()
+        settings = self.pipelined_stream(handler, DIGEST_FEATURES)
+        xml = self.wait(expect = re.compile(br".*(<auth.*/>)"))
+        self.assertIsNotNone(xml)
+        element = ElementTree.XML(xml)
+        self.assertEqual(element.get("mechanism"), "DIGEST-MD5")
+        self.server.rdata = b""
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(AUTH_FEATURES)
+        xml = self.wait(expect = re.compile(br".*(<auth.*</auth>)"))
+        self.assertIsNotNone(xml)
+        element = ElementTree.XML(xml)
+        self.assertEqual(element.get("mechanism"), "PLAIN")
+        self.server.rdata = b""
+        self.server.write(b"""<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>
+<invalid-mechanism/></failure>""")
+        self.server.write(
+                        b"<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>")
+        stream_start = self.wait(expect = re.compile(
+                                                br"(<stream:stream[^>]*>)"))
+        self.assertIsNotNone(stream_start)
+        self.assertTrue(self.stream.authenticated)
+        self.server.disconnect()
+        self.wait()
+        features = settings["stream_features_cache"][
+                                            u"127.0.0.1", False, False, False]
+        self.assertEqual(features[0][0].text, "PLAIN")
+
 class TestReceiver(ReceiverSelectTestCase):
     def test_auth(self):
         handler = EventRecorder()
@@ -210,6 +306,134 @@ class TestReceiver(ReceiverSelectTestCase):
         self.assertEqual(event_classes, [StreamConnectedEvent,
                                                             DisconnectedEvent])
 
+    def test_auth_offloaded(self):
+        handler = EventRecorder()
+        self.start_transport([handler])
+        pool = WorkerPool(self.loop.settings, 1)
+        self.loop.add_handler(pool)
+        self.addCleanup(pool.stop)
+        database = SlowPasswordDatabase({u"user": u"secret"})
+        self.addCleanup(database.release.set)
+        settings = XMPPSettings({
+                                u"password_database": database,
+                                u"sasl_mechanisms": ["PLAIN"],
+                                u"sasl_worker_pool": pool,
+                                })
+        self.stream = StreamBase(u"jabber:client", None,
+                            [StreamSASLHandler(settings), handler], settings)
+        self.stream.receive(self.transport, self.addr[0])
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(
+                                br".*<stream:features>(.*)</stream:features>"))
+        self.assertIsNotNone(xml)
+        response = base64.standard_b64encode(b"\000user\000secret")
+        self.client.write(PLAIN_AUTH.format(response.decode("utf-8"))
+                                                    .encode("utf-8"))
+        # the main loop keeps running while the password is being checked
+        xml = self.wait(0.3, expect = re.compile(br".*(<success.*>)"))
+        self.assertIsNone(xml)
+        self.assertFalse(self.stream.peer_authenticated)
+        self.assertEqual(len(database.threads), 1)
+        self.assertIsNot(database.threads[0], threading.current_thread())
+        database.release.set()
+        xml = self.wait(expect = re.compile(br".*(<success.*>)"))
+        self.assertIsNotNone(xml)
+        self.assertTrue(self.stream.peer_authenticated)
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(br".*(<stream:stream.*>)"))
+        self.assertIsNotNone(xml)
+        self.client.write(b"</stream:stream>")
+        self.client.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received
+                                if not isinstance(e, WorkerJobDoneEvent)]
+        self.assertEqual(event_classes, [
+                                StreamConnectedEvent, AuthenticatedEvent,
+                                StreamRestartedEvent, DisconnectedEvent])
+
+    def test_auth_offloaded_fail(self):
+        handler = EventRecorder()
+        self.start_transport([handler])
+        pool = WorkerPool(self.loop.settings, 1)
+        self.loop.add_handler(pool)
+        self.addCleanup(pool.stop)
+        database = SlowPasswordDatabase({u"user": u"secret"})
+        database.release.set()
+        settings = XMPPSettings({
+                                u"password_database": database,
+                                u"sasl_mechanisms": ["PLAIN"],
+                                u"sasl_worker_pool": pool,
+                                })
+        self.stream = StreamBase(u"jabber:client", None,
+                            [StreamSASLHandler(settings), handler], settings)
+        self.stream.receive(self.transport, self.addr[0])
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(
+                                br".*<stream:features>(.*)</stream:features>"))
+        self.assertIsNotNone(xml)
+        response = base64.standard_b64encode(b"\000user\000bad")
+        self.client.write(PLAIN_AUTH.format(response.decode("utf-8"))
+                                                    .encode("utf-8"))
+        # the failure is reported to the peer, not raised from the loop
+        xml = self.wait(expect = re.compile(br".*(<failure.*</failure>)"))
+        self.assertIsNotNone(xml)
+        element = ElementTree.XML(xml)
+        self.assertEqual(element[0].tag,
+                            "{urn:ietf:params:xml:ns:xmpp-sasl}not-authorized")
+        self.assertFalse(self.stream.peer_authenticated)
+        # and the peer may try again
+        response = base64.standard_b64encode(b"\000user\000secret")
+        self.client.write(PLAIN_AUTH.format(response.decode("utf-8"))
+                                                    .encode("utf-8"))
+        xml = self.wait(expect = re.compile(br".*(<success.*>)"))
+        self.assertIsNotNone(xml)
+        self.assertTrue(self.stream.peer_authenticated)
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(br".*(<stream:stream.*>)"))
+        self.assertIsNotNone(xml)
+        self.client.write(b"</stream:stream>")
+        self.client.disconnect()
+        self.wait()
+
+    def test_auth_offloaded_abort(self):
+        handler = EventRecorder()
+        self.start_transport([handler])
+        pool = WorkerPool(self.loop.settings, 1)
+        self.loop.add_handler(pool)
+        self.addCleanup(pool.stop)
+        database = SlowPasswordDatabase({u"user": u"secret"})
+        self.addCleanup(database.release.set)
+        settings = XMPPSettings({
+                                u"password_database": database,
+                                u"sasl_mechanisms": ["PLAIN"],
+                                u"sasl_worker_pool": pool,
+                                })
+        self.stream = StreamBase(u"jabber:client", None,
+                            [StreamSASLHandler(settings), handler], settings)
+        self.stream.receive(self.transport, self.addr[0])
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(
+                                br".*<stream:features>(.*)</stream:features>"))
+        self.assertIsNotNone(xml)
+        response = base64.standard_b64encode(b"\000user\000secret")
+        self.client.write(PLAIN_AUTH.format(response.decode("utf-8"))
+                                                    .encode("utf-8"))
+        self.wait(0.1)
+        self.client.write(b"<abort xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>")
+        self.wait(0.1)
+        database.release.set()
+        xml = self.wait(0.5, expect = re.compile(br".*(<success.*>)"))
+        self.assertIsNone(xml)
+        self.assertFalse(self.stream.peer_authenticated)
+        self.assertEqual(len(database.threads), 1)
+        self.client.write(b"</stream:stream>")
+        self.client.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received
+                                if not isinstance(e, WorkerJobDoneEvent)]
+        self.assertEqual(event_classes, [StreamConnectedEvent,
+                                                        DisconnectedEvent])
+
 # pylint: disable=W0611
 from pyxmpp2.test._support import load_tests, setup_logging
 
@@ -5,18 +5,22 @@
 import unittest
 import re
 import os
+import ssl
 
 from pyxmpp2.test._support import DATA_DIR
 
 from xml.etree.ElementTree import XML
 
 from pyxmpp2.streambase import StreamBase
-from pyxmpp2.streamtls import StreamTLSHandler
+from pyxmpp2.streamtls import StreamTLSHandler, TLSSessionCache
+from pyxmpp2.streamtls import get_tls_context
+from pyxmpp2.streamsasl import StreamSASLHandler
 from pyxmpp2.streamevents import *  # pylint: disable=W0614,W0401
 from pyxmpp2.exceptions import TLSNegotiationFailed
 from pyxmpp2.settings import XMPPSettings
 
 from pyxmpp2.test._util import EventRecorder, InitiatorSelectTestCase
+from pyxmpp2.test._util import ReceiverSelectTestCase
 
 C2S_SERVER_STREAM_HEAD = (b'<stream:stream version="1.0"'
                             b' from="server.example.org"'
@@ -36,11 +40,18 @@ TLS_REQUIRED_FEATURES = b"""<stream:features>
      </starttls>
 </stream:features>"""
 
+AUTH_FEATURES = b"""<stream:features>
+     <mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>
+        <mechanism>PLAIN</mechanism>
+     </mechanisms>
+</stream:features>"""
 
 EMPTY_FEATURES = b"""<stream:features/>"""
 
 PROCEED = b"<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls' />"
 
+STARTTLS = b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls' />"
+
 STREAM_TAIL = b'</stream:stream>'
 
 class TestInitiator(InitiatorSelectTestCase):
@@ -179,6 +190,167 @@ class TestInitiator(InitiatorSelectTestCase):
                     ConnectedEvent, StreamConnectedEvent, GotFeaturesEvent,
                     DisconnectedEvent])
 
+    def test_required_cached_without_starttls(self):
+        """Test TLS required in settings and pipelining with cached features
+        not offering StartTLS."""
+        self.start_server()
+        settings = XMPPSettings({
+                        u"starttls": True,
+                        u"tls_require": True,
+                        u"tls_cacert_file": os.path.join(DATA_DIR, "ca.pem"),
+                        u"username": u"user",
+                        u"password": u"secret",
+                        u"stream_pipelining": True,
+                        u"stream_features_cache": {
+                            (u"server.example.org", False, False, False):
+                                    XML(C2S_SERVER_STREAM_HEAD + AUTH_FEATURES
+                                                        + STREAM_TAIL)[0],
+                            },
+                                })
+        handler = EventRecorder()
+        handlers = [StreamTLSHandler(settings), StreamSASLHandler(settings),
+                                                                    handler]
+        self.stream = StreamBase(u"jabber:client", None, handlers, settings)
+        self.start_transport(handlers)
+        self.stream.initiate(self.transport, to = "server.example.org")
+        self.connect_transport()
+        self.wait(1, expect = re.compile(br".*(<auth)"))
+        self.assertNotIn(b"<auth", self.server.rdata)
+        self.server.write(C2S_SERVER_STREAM_HEAD)
+        self.server.write(AUTH_FEATURES)
+        with self.assertRaises(TLSNegotiationFailed):
+            self.wait()
+        self.assertNotIn(b"<auth", self.server.rdata)
+        self.server.disconnect()
+        self.wait()
+
+class TestReceiver(ReceiverSelectTestCase):
+    def make_settings(self, **kwargs):
+        settings = XMPPSettings({
+                    u"starttls": True,
+                    u"tls_cert_file": os.path.join(DATA_DIR, "server.pem"),
+                    u"tls_key_file": os.path.join(DATA_DIR, "server-key.pem"),
+                                })
+        for key, value in kwargs.items():
+            settings[key] = value
+        return settings
+
+    def test_starttls(self):
+        settings = self.make_settings()
+        handler = EventRecorder()
+        handlers = [StreamTLSHandler(settings), handler]
+        self.start_transport(handlers)
+        self.stream = StreamBase(u"jabber:client", None, handlers, settings)
+        self.stream.receive(self.transport, u"server.example.org")
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(
+                                br".*<stream:features>(.*)</stream:features>"))
+        self.assertIsNotNone(xml)
+        element = XML(xml)
+        self.assertEqual(element.tag,
+                                "{urn:ietf:params:xml:ns:xmpp-tls}starttls")
+        self.client.write(STARTTLS)
+        self.assertIsNotNone(self.wait(expect = re.compile(
+                                                    br".*(<proceed.*/>)")))
+        self.client.starttls(self.client.sock,
+                            cert_reqs = ssl.CERT_REQUIRED,
+                            ca_certs = os.path.join(DATA_DIR, "ca.pem"),
+                                )
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        xml = self.wait(expect = re.compile(
+                                br".*<stream:stream.*(<stream:features/>)"))
+        self.assertIsNotNone(xml)
+        self.assertTrue(self.stream.tls_established)
+        self.assertIs(settings["tls_server_context"],
+                                get_tls_context(settings, server_side = True))
+        self.client.write(b"</stream:stream>")
+        self.client.disconnect()
+        self.wait()
+        event_classes = [e.__class__ for e in handler.events_received]
+        self.assertEqual(event_classes, [StreamConnectedEvent,
+                    TLSConnectingEvent, TLSConnectedEvent, StreamRestartedEvent,
+                    DisconnectedEvent])
+
+    def test_not_enabled(self):
+        settings = self.make_settings(starttls = False)
+        handler = EventRecorder()
+        handlers = [StreamTLSHandler(settings), handler]
+        self.start_transport(handlers)
+        self.stream = StreamBase(u"jabber:client", None, handlers, settings)
+        self.stream.receive(self.transport, u"server.example.org")
+        self.client.write(C2S_CLIENT_STREAM_HEAD)
+        self.client.write(STARTTLS)
+        xml = self.wait(expect = re.compile(br".*(<failure.*/>)"))
+        self.assertIsNotNone(xml)
+        self.assertEqual(XML(xml).tag,
+                                "{urn:ietf:params:xml:ns:xmpp-tls}failure")
+        self.client.disconnect()
+        self.wait()
+        self.assertFalse(self.stream.tls_established)
+
+class TestTLSContext(unittest.TestCase):
+    def test_shared(self):
+        settings = XMPPSettings({
+                        u"tls_cacert_file": os.path.join(DATA_DIR, "ca.pem"),
+                                })
+        context = get_tls_context(settings)
+        self.assertIs(settings["tls_context"], context)
+        self.assertIs(get_tls_context(settings), context)
+        self.assertEqual(context.cert_store_stats()["x509_ca"], 1)
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertTrue(context.options & ssl.OP_NO_SSLv3)
+        server_context = get_tls_context(settings, server_side = True)
+        self.assertIsNot(server_context, context)
+        self.assertIs(settings["tls_server_context"], server_context)
+        self.assertEqual(server_context.verify_mode, ssl.CERT_OPTIONAL)
+        other = XMPPSettings({u"tls_verify_peer": False})
+        self.assertIsNot(get_tls_context(other), context)
+        self.assertEqual(other["tls_context"].verify_mode, ssl.CERT_NONE)
+
+    def test_rebuild(self):
+        settings = XMPPSettings({u"tls_verify_peer": False})
+        context = get_tls_context(settings)
+        settings["tls_verify_peer"] = True
+        settings["tls_cacert_file"] = os.path.join(DATA_DIR, "ca.pem")
+        del settings["tls_context"]
+        self.assertIsNot(get_tls_context(settings), context)
+        self.assertEqual(settings["tls_context"].verify_mode,
+                                                        ssl.CERT_REQUIRED)
+
+    def test_settings_changed(self):
+        settings = XMPPSettings({u"tls_verify_peer": False})
+        context = get_tls_context(settings)
+        server_context = get_tls_context(settings, server_side = True)
+        settings["tls_verify_peer"] = True
+        settings["tls_cacert_file"] = os.path.join(DATA_DIR, "ca.pem")
+        new_context = get_tls_context(settings)
+        self.assertIsNot(new_context, context)
+        self.assertEqual(new_context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertIs(get_tls_context(settings), new_context)
+        new_server_context = get_tls_context(settings, server_side = True)
+        self.assertIsNot(new_server_context, server_context)
+        self.assertEqual(new_server_context.verify_mode, ssl.CERT_OPTIONAL)
+
+    def test_provided(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        settings = XMPPSettings({u"tls_context": context})
+        self.assertIs(get_tls_context(settings), context)
+        settings["tls_verify_peer"] = False
+        self.assertIs(get_tls_context(settings), context)
+
+class TestTLSSessionCache(unittest.TestCase):
+    def test_lru(self):
+        cache = TLSSessionCache(max_size = 2)
+        cache.put(("a", "1.1.1.1"), "session a")
+        cache.put(("b", "1.1.1.2"), "session b")
+        self.assertEqual(cache.get(("a", "1.1.1.1")), "session a")
+        cache.put(("c", "1.1.1.3"), "session c")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(("b", "1.1.1.2")))
+        self.assertEqual(cache.get(("a", "1.1.1.1")), "session a")
+        cache.remove(("a", "1.1.1.1"))
+        self.assertIsNone(cache.get(("a", "1.1.1.1")))
+        self.assertEqual(cache.get(("c", "1.1.1.3")), "session c")
 
 # pylint: disable=W0611
 from pyxmpp2.test._support import load_tests, setup_logging
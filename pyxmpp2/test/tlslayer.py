@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import os
+import ssl
+
+from pyxmpp2.test._support import DATA_DIR
+
+from pyxmpp2.tlslayer import TLSLayer, HAVE_MEMORY_BIO
+
+def make_contexts():
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    server_ctx.load_cert_chain(os.path.join(DATA_DIR, "server.pem"),
+                                os.path.join(DATA_DIR, "server-key.pem"))
+    client_ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    client_ctx.verify_mode = ssl.CERT_REQUIRED
+    client_ctx.load_verify_locations(os.path.join(DATA_DIR, "ca.pem"))
+    return server_ctx, client_ctx
+
+def pump(client, server):
+    """Move the pending ciphertext between the layers until the
+    handshake completes."""
+    for dummy in range(10):
+        client_done = client.do_handshake()
+        data = client.data_to_send()
+        if data:
+            server.feed(data)
+        server_done = server.do_handshake()
+        data = server.data_to_send()
+        if data:
+            client.feed(data)
+        if client_done and server_done:
+            return
+    raise AssertionError("Handshake did not complete")
+
+@unittest.skipUnless(HAVE_MEMORY_BIO, "ssl.MemoryBIO not available")
+class TestTLSLayer(unittest.TestCase):
+    def setUp(self):
+        server_ctx, client_ctx = make_contexts()
+        self.server = TLSLayer(server_ctx, server_side = True)
+        self.client = TLSLayer(client_ctx,
+                                    server_hostname = "server.example.org")
+
+    def test_handshake(self):
+        self.assertFalse(self.client.do_handshake())
+        hello = self.client.data_to_send()
+        self.assertTrue(hello)
+        self.server.feed(hello)
+        pump(self.client, self.server)
+        self.assertTrue(self.client.established)
+        self.assertTrue(self.server.established)
+        self.assertTrue(self.client.ssl_object.getpeercert())
+        self.assertIsNotNone(self.client.ssl_object.cipher())
+
+    def test_data(self):
+        pump(self.client, self.server)
+        self.server.feed(self.client.write(b"<message/>"))
+        self.server.feed(self.client.write(b"<presence/>" * 5000))
+        data, closed = self.server.read()
+        self.assertEqual(data, b"<message/>" + b"<presence/>" * 5000)
+        self.assertFalse(closed)
+        self.assertEqual(self.server.read(), (b"", False))
+        self.client.feed(self.server.write(b"<iq/>"))
+        self.assertEqual(self.client.read(), (b"<iq/>", False))
+
+    def test_shutdown(self):
+        pump(self.client, self.server)
+        self.server.feed(self.client.write(b"</stream:stream>")
+                                                    + self.client.shutdown())
+        self.assertEqual(self.server.read(), (b"</stream:stream>", True))
+
+    def test_eof(self):
+        pump(self.client, self.server)
+        self.server.feed_eof()
+        self.assertEqual(self.server.read(), (b"", True))
+
+    def test_bad_certificate(self):
+        client_ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        client_ctx.verify_mode = ssl.CERT_REQUIRED
+        client = TLSLayer(client_ctx)
+        with self.assertRaises(ssl.SSLError):
+            pump(client, self.server)
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import logging
+
+from pyxmpp2.trace import TraceChannel, CHANNELS
+from pyxmpp2.trace import enable_channels, disable_channels
+
+class Expensive(object):
+    """Object counting how many times it was formatted."""
+    # pylint: disable=R0903
+    def __init__(self):
+        self.count = 0
+    def __repr__(self):
+        self.count += 1
+        return "<Expensive>"
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+class TestTraceChannel(unittest.TestCase):
+    def setUp(self):
+        self.channel = TraceChannel("test", "pyxmpp2.test.trace")
+        self.handler = ListHandler()
+        self.channel.logger.addHandler(self.handler)
+        self.channel.logger.propagate = False
+
+    def tearDown(self):
+        self.channel.logger.removeHandler(self.handler)
+        self.channel.logger.setLevel(logging.NOTSET)
+
+    def test_enabled(self):
+        self.channel.logger.setLevel(logging.DEBUG)
+        obj = Expensive()
+        self.channel("value: {0!r} {x}", obj, x = 1)
+        self.channel("no args {0}")
+        self.assertEqual(self.handler.records,
+                                    ["value: <Expensive> 1", "no args {0}"])
+        self.assertEqual(obj.count, 1)
+        self.assertTrue(self.channel)
+
+    def test_level_disabled(self):
+        self.channel.logger.setLevel(logging.INFO)
+        obj = Expensive()
+        self.channel("value: {0!r}", obj)
+        self.assertEqual(self.handler.records, [])
+        self.assertEqual(obj.count, 0)
+        self.assertFalse(self.channel)
+
+    def test_switched_off(self):
+        self.channel.logger.setLevel(logging.DEBUG)
+        self.channel.switch = False
+        obj = Expensive()
+        self.channel("value: {0!r}", obj)
+        self.assertEqual(self.handler.records, [])
+        self.assertEqual(obj.count, 0)
+        self.assertFalse(self.channel)
+
+    def test_not_formatted(self):
+        self.channel.logger.setLevel(logging.INFO)
+        obj = Expensive()
+        for dummy in range(200):
+            self.channel("value: {0!r}", obj)
+        self.assertEqual(obj.count, 0)
+        logging.disable(logging.DEBUG)
+        try:
+            self.channel.logger.setLevel(logging.DEBUG)
+            self.channel("value: {0!r}", obj)
+            self.assertEqual(obj.count, 0)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_configured_later(self):
+        self.channel.logger.setLevel(logging.INFO)
+        self.channel("first")
+        # no explicit update needed
+        self.channel.logger.setLevel(logging.DEBUG)
+        self.channel("second")
+        self.assertEqual(self.handler.records, ["second"])
+
+class TestChannelSwitches(unittest.TestCase):
+    def tearDown(self):
+        enable_channels()
+
+    def test_switches(self):
+        disable_channels("in", "out")
+        self.assertFalse(CHANNELS["in"].switch)
+        self.assertFalse(CHANNELS["out"].switch)
+        self.assertTrue(CHANNELS["dispatch"].switch)
+        disable_channels()
+        self.assertFalse(any(c.switch or c.enabled
+                                            for c in CHANNELS.values()))
+        enable_channels("timers")
+        self.assertTrue(CHANNELS["timers"].switch)
+        self.assertFalse(CHANNELS["io"].switch)
+
+    def test_logger_level(self):
+        logger = CHANNELS["dispatch"].logger
+        try:
+            logger.setLevel(logging.DEBUG)
+            self.assertTrue(CHANNELS["dispatch"].enabled)
+            logger.setLevel(logging.INFO)
+            self.assertFalse(CHANNELS["dispatch"].enabled)
+        finally:
+            logger.setLevel(logging.NOTSET)
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import os
+import socket
+import errno
+import time
+import tempfile
+import shutil
+
+from socket import AF_INET, AF_INET6
+
+from pyxmpp2.transport import TCPTransport, interleave_addresses
+from pyxmpp2.transport import is_unix_socket_path, SO_PEERCRED
+from pyxmpp2.transport import _GENERIC_SOCKOPTS_RE
+from pyxmpp2.interfaces import Resolver
+from pyxmpp2.mainloop.poll import PollMainLoop
+from pyxmpp2.settings import XMPPSettings
+
+from pyxmpp2.test import _support
+
+class FakeResolver(Resolver):
+    def __init__(self, srv, addresses):
+        self.srv = srv
+        self.addresses = addresses
+    def resolve_srv(self, domain, service, protocol, callback):
+        callback(self.srv)
+    def resolve_address(self, hostname, callback, allow_cname = True):
+        callback(self.addresses.get(hostname, []))
+
+class DummyStream(object):
+    # pylint: disable=R0903
+    def __init__(self):
+        self.connected = False
+    def transport_connected(self):
+        self.connected = True
+
+def make_black_hole(address):
+    """Return a listening socket which does not accept any more connections
+    (its backlog is full) and the connections made to fill it."""
+    listener = socket.socket(AF_INET, socket.SOCK_STREAM)
+    listener.bind((address, 0))
+    listener.listen(0)
+    fillers = []
+    for dummy in range(20):
+        sock = socket.socket(AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(listener.getsockname())
+        fillers.append(sock)
+        time.sleep(0.02)
+        if sock.connect_ex(listener.getsockname()) == errno.EALREADY:
+            return listener, fillers
+    raise unittest.SkipTest("Could not make a black hole listener")
+
+class TestInterleave(unittest.TestCase):
+    def test_interleave(self):
+        addrs = [(AF_INET6, "::1"), (AF_INET6, "::2"), (AF_INET6, "::3"),
+                            (AF_INET, "127.0.0.1"), (AF_INET, "127.0.0.2")]
+        self.assertEqual(interleave_addresses(addrs, True), [
+                    (AF_INET6, "::1"), (AF_INET, "127.0.0.1"),
+                    (AF_INET6, "::2"), (AF_INET, "127.0.0.2"),
+                    (AF_INET6, "::3")])
+        self.assertEqual(interleave_addresses(addrs, False), [
+                    (AF_INET, "127.0.0.1"), (AF_INET6, "::1"),
+                    (AF_INET, "127.0.0.2"), (AF_INET6, "::2"),
+                    (AF_INET6, "::3")])
+        self.assertEqual(interleave_addresses(addrs[3:], True), addrs[3:])
+
+@unittest.skipIf("lo-network" not in _support.RESOURCES,
+                                        "loopback network usage disabled")
+class TestHappyEyeballs(unittest.TestCase):
+    def setUp(self):
+        self.sockets = []
+        self.black_hole, fillers = make_black_hole("127.0.0.2")
+        self.sockets += fillers
+        self.port = self.black_hole.getsockname()[1]
+        self.listener = socket.socket(AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", self.port))
+        self.listener.listen(5)
+        self.transport = None
+
+    def tearDown(self):
+        if self.transport:
+            self.transport.close()
+        for sock in self.sockets + [self.black_hole, self.listener]:
+            sock.close()
+
+    def connect(self, resolver, **kwargs):
+        settings = XMPPSettings({"dns_resolver": resolver,
+                                            "connection_attempt_delay": 0.1})
+        self.transport = TCPTransport(settings)
+        stream = DummyStream()
+        self.transport.set_target(stream)
+        self.transport.connect(u"example.com", **kwargs)
+        loop = PollMainLoop(settings, [self.transport])
+        start = time.time()
+        while not stream.connected and time.time() - start < 5:
+            loop.loop_iteration(0.1)
+        self.assertTrue(stream.connected)
+        return time.time() - start
+
+    def test_addresses(self):
+        resolver = FakeResolver([], {u"example.com": [
+                    (AF_INET, "127.0.0.2"), (AF_INET, "127.0.0.1")]})
+        elapsed = self.connect(resolver, port = self.port)
+        # pylint: disable=W0212
+        self.assertEqual(self.transport._dst_addr, ("127.0.0.1", self.port))
+        self.assertTrue(elapsed < 1, elapsed)
+        self.assertEqual(self.transport._attempts, [])
+
+    def test_srv_targets(self):
+        resolver = FakeResolver([("dead.example.com", self.port),
+                                    ("live.example.com", self.port)], {
+                                "dead.example.com": [(AF_INET, "127.0.0.2")],
+                                "live.example.com": [(AF_INET, "127.0.0.1")]})
+        elapsed = self.connect(resolver, service = "xmpp-client")
+        # pylint: disable=W0212
+        self.assertEqual(self.transport._dst_addr, ("127.0.0.1", self.port))
+        self.assertEqual(self.transport._dst_hostname, "live.example.com")
+        self.assertTrue(elapsed < 1, elapsed)
+
+    def test_refused(self):
+        self.listener.close()
+        resolver = FakeResolver([], {u"example.com": [
+                    (AF_INET, "127.0.0.1"), (AF_INET, "127.0.0.1")]})
+        settings = XMPPSettings({"dns_resolver": resolver})
+        self.transport = TCPTransport(settings)
+        self.transport.set_target(DummyStream())
+        self.transport.connect(u"example.com", self.port)
+        loop = PollMainLoop(settings, [self.transport])
+        with self.assertRaises(socket.error):
+            for dummy in range(50):
+                loop.loop_iteration(0.1)
+        # pylint: disable=W0212
+        self.assertEqual(self.transport._state, "aborted")
+
+class TestSocketOptions(unittest.TestCase):
+    def test_generic_machines(self):
+        for machine in ("x86_64", "i686", "armv7l", "aarch64", "riscv64",
+                                                                    "s390x"):
+            self.assertIsNotNone(_GENERIC_SOCKOPTS_RE.match(machine), machine)
+        for machine in ("ppc64le", "ppc", "mips", "mips64", "sparc64",
+                                                            "alpha", "parisc"):
+            self.assertIsNone(_GENERIC_SOCKOPTS_RE.match(machine), machine)
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "No Unix sockets")
+class TestUnixSocket(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "xmpp.sock")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(5)
+        self.transport = None
+
+    def tearDown(self):
+        if self.transport:
+            self.transport.close()
+        self.listener.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_path(self):
+        self.assertTrue(is_unix_socket_path(self.path))
+        self.assertTrue(is_unix_socket_path(u"\0pyxmpp2"))
+        self.assertFalse(is_unix_socket_path(u"example.com"))
+        self.assertFalse(is_unix_socket_path(u"::1"))
+
+    def test_connect(self):
+        # the resolver must not be used
+        settings = XMPPSettings({"dns_resolver": FakeResolver(None, None)})
+        self.transport = TCPTransport(settings)
+        stream = DummyStream()
+        self.transport.set_target(stream)
+        self.transport.connect(self.path, service = "xmpp-client")
+        loop = PollMainLoop(settings, [self.transport])
+        for dummy in range(10):
+            if stream.connected:
+                break
+            loop.loop_iteration(0.1)
+        self.assertTrue(stream.connected)
+        properties = self.transport.auth_properties
+        self.assertEqual(properties["security-layer"], "unix")
+        self.assertNotIn("remote-ip", properties)
+        if SO_PEERCRED is not None:
+            self.assertEqual(properties["peer-credentials"],
+                                    (os.getpid(), os.getuid(), os.getgid()))
+        sock = self.listener.accept()[0]
+        try:
+            accepted = TCPTransport(sock = sock)
+            properties = accepted.auth_properties
+            self.assertEqual(properties["security-layer"], "unix")
+            if SO_PEERCRED is not None:
+                self.assertEqual(properties["peer-credentials"][1],
+                                                                os.getuid())
+        finally:
+            sock.close()
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
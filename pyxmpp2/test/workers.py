@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import threading
+import time
+import Queue
+
+from pyxmpp2.mainloop.workers import WorkerPool, WorkerPoolFull
+from pyxmpp2.mainloop.workers import WorkerJobCancelled
+from pyxmpp2.settings import XMPPSettings
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = []
+        self.pool = None
+        self.event_queue = None
+
+    def tearDown(self):
+        self.release.set()
+        if self.pool:
+            self.pool.stop()
+
+    def make_pool(self, max_threads, max_queued):
+        self.event_queue = Queue.Queue()
+        settings = XMPPSettings({u"event_queue": self.event_queue})
+        self.pool = WorkerPool(settings, max_threads, max_queued)
+        return self.pool
+
+    def job(self):
+        self.started.append(threading.current_thread())
+        self.release.wait(5)
+
+    @staticmethod
+    def callback(result, exc_info):
+        pass
+
+    def events(self):
+        result = []
+        while True:
+            try:
+                result.append(self.event_queue.get_nowait())
+            except Queue.Empty:
+                return result
+
+    def wait_threads(self, count):
+        timeout = time.time() + 5
+        while len(self.pool.threads) != count and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertEqual(len(self.pool.threads), count)
+
+    def test_stop_full_queue(self):
+        pool = self.make_pool(1, 2)
+        pool.submit(self.job, self.callback)
+        timeout = time.time() + 5
+        while not self.started and time.time() < timeout:
+            time.sleep(0.01)
+        pool.submit(self.job, self.callback)
+        pool.submit(self.job, self.callback)
+        with self.assertRaises(WorkerPoolFull):
+            pool.submit(self.job, self.callback)
+        stopper = threading.Thread(target = pool.stop)
+        stopper.daemon = True
+        stopper.start()
+        stopper.join(2)
+        self.assertFalse(stopper.is_alive())
+        with self.assertRaises(WorkerPoolFull):
+            pool.submit(self.job, self.callback)
+        # the queued jobs have been cancelled
+        events = self.events()
+        self.assertEqual(len(events), 2)
+        for event in events:
+            self.assertIs(event.pool, pool)
+            self.assertIs(event.exc_info[0], WorkerJobCancelled)
+        self.release.set()
+        self.wait_threads(0)
+        self.assertEqual(len(self.started), 1)
+
+    def test_stop_idle_threads(self):
+        pool = self.make_pool(3, 1)
+        for dummy in range(3):
+            pool.submit(self.job, self.callback)
+            timeout = time.time() + 5
+            while pool.queue.qsize() and time.time() < timeout:
+                time.sleep(0.01)
+        self.wait_threads(3)
+        self.release.set()
+        timeout = time.time() + 5
+        while pool._idle < 3 and time.time() < timeout:
+            time.sleep(0.01)
+        pool.stop()
+        self.wait_threads(0)
+
+    def test_restart(self):
+        pool = self.make_pool(2, 10)
+        pool.submit(self.job, self.callback)
+        timeout = time.time() + 5
+        while not self.started and time.time() < timeout:
+            time.sleep(0.01)
+        pool.stop()
+        self.assertTrue(pool.stopped)
+        pool.start()
+        self.assertFalse(pool.stopped)
+        self.release.set()
+        pool.submit(self.job, self.callback)
+        timeout = time.time() + 5
+        while len(self.started) < 2 and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertEqual(len(self.started), 2)
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# pylint: disable=C0111
+
+import unittest
+import random
+
+from encodings import idna
+
+from pyxmpp2 import xmppstringprep
+from pyxmpp2.xmppstringprep import NODEPREP, RESOURCEPREP, NAMEPREP, Profile
+from pyxmpp2.xmppstringprep import set_stringprep_cache_size
+from pyxmpp2.sasl.saslprep import SASLPREP
+from pyxmpp2.exceptions import StringprepError
+
+PROFILES = [("nodeprep", NODEPREP), ("resourceprep", RESOURCEPREP),
+                                                    ("saslprep", SASLPREP)]
+
+ALL_PROFILES = PROFILES + [("nameprep", NAMEPREP)]
+
+def slow_prepare(profile, data):
+    # pylint: disable=W0212
+    try:
+        return profile._prepare(data)
+    except StringprepError:
+        return StringprepError
+
+def fast_prepare(profile, data):
+    try:
+        return profile.prepare(data)
+    except StringprepError:
+        return StringprepError
+
+def predicate_prepare(profile, data):
+    # pylint: disable=W0212
+    try:
+        return profile._prepare(data, xmppstringprep._PredicateTable(profile))
+    except StringprepError, err:
+        return str(err)
+
+def table_prepare(profile, data):
+    # pylint: disable=W0212
+    try:
+        return profile._prepare(data)
+    except StringprepError, err:
+        return str(err)
+
+class TestFastPath(unittest.TestCase):
+    def setUp(self):
+        # pylint: disable=W0212
+        self.saved_size = xmppstringprep._stringprep_cache_size
+        set_stringprep_cache_size(0)
+
+    def tearDown(self):
+        set_stringprep_cache_size(self.saved_size)
+
+    def test_latin1_pairs(self):
+        chars = [unichr(i) for i in range(256)]
+        for name, profile in PROFILES:
+            for char1 in chars:
+                for char2 in chars:
+                    data = char1 + char2
+                    self.assertEqual(fast_prepare(profile, data),
+                                        slow_prepare(profile, data),
+                                        "{0} {1!r}".format(name, data))
+
+    def test_examples(self):
+        for data, expected in (
+                    (u"Jajcus", u"jajcus"),
+                    (u"STRAßE", u"strasse"),
+                    (u"ÀÉÎÕÜ", u"àéîõü"),
+                    (u"a­b", u"ab"),
+                    (u"", u""),
+                    ):
+            self.assertEqual(NODEPREP.prepare(data), expected)
+        self.assertEqual(RESOURCEPREP.prepare(u"Test Resource"),
+                                                            u"Test Resource")
+        for data in (u"a b", u"a@b", u"a\x01"):
+            with self.assertRaises(StringprepError):
+                NODEPREP.prepare(data)
+
+    def test_fast_hits(self):
+        profile = Profile(unassigned = NODEPREP.unassigned,
+                            mapping = NODEPREP.mapping,
+                            normalization = NODEPREP.normalization,
+                            prohibited = NODEPREP.prohibited)
+        profile.prepare(u"abc")
+        profile.prepare(u"Źdźbło")
+        self.assertEqual(profile.fast_hits, 1)
+        self.assertEqual(profile.misses, 1)
+
+class TestCharTables(unittest.TestCase):
+    def test_bmp(self):
+        # pylint: disable=W0212
+        for name, profile in ALL_PROFILES:
+            table = profile._get_table()
+            reference = xmppstringprep._PredicateTable(profile)
+            mismatches = [char for char in (unichr(code)
+                                                for code in xrange(0x10000))
+                            if table.lookup(char) != reference.lookup(char)
+                            or table.map([char]) != [reference.map_char(char)]]
+            self.assertEqual(mismatches, [], name)
+
+    def test_warm_up(self):
+        # pylint: disable=W0212
+        profile = Profile(unassigned = NODEPREP.unassigned,
+                            mapping = NODEPREP.mapping,
+                            normalization = NODEPREP.normalization,
+                            prohibited = NODEPREP.prohibited)
+        self.assertIsNone(profile._table)
+        xmppstringprep.warm_up_stringprep()
+        table = profile._table
+        self.assertIsNotNone(table)
+        self.assertEqual(profile.prepare(u"Źdźbło"), u"źdźbło")
+        self.assertIs(profile._table, table)
+
+    def test_non_bmp(self):
+        # pylint: disable=W0212
+        for char in (u"\U0001d400", u"\U000e0001", u"\U0010fffd",
+                                                        u"\U00020000"):
+            for name, profile in ALL_PROFILES:
+                self.assertEqual(table_prepare(profile, char),
+                                    predicate_prepare(profile, char), name)
+
+    def test_random_strings(self):
+        rand = random.Random(32)
+        ranges = [(0x20, 0x250), (0x370, 0x530), (0x590, 0x700),
+                    (0x2000, 0x2070), (0x3000, 0x3100), (0x4e00, 0x4f00),
+                    (0xac00, 0xac80), (0xfe00, 0xff00)]
+        for dummy in range(500):
+            length = rand.randint(1, 8)
+            start, end = rand.choice(ranges)
+            data = u"".join(unichr(rand.randrange(start, end))
+                                                    for dummy in range(length))
+            for name, profile in ALL_PROFILES:
+                self.assertEqual(table_prepare(profile, data),
+                                    predicate_prepare(profile, data),
+                                    "{0} {1!r}".format(name, data))
+            try:
+                expected = idna.nameprep(data)
+            except UnicodeError:
+                expected = StringprepError
+            self.assertEqual(slow_prepare(NAMEPREP, data), expected,
+                                                                repr(data))
+
+    def test_errors(self):
+        for data, message in (
+                (u"a\u05d0", "Both RandALCat and LCat characters present"),
+                (u"\u05d01", "The first and the last character must"
+                                                            " be RandALCat"),
+                (u"\u0221\ue000", "Prohibited character: u'\\ue000'"),
+                (u"a\u0221", "Unassigned character: u'\\u0221'"),
+                ):
+            self.assertEqual(table_prepare(RESOURCEPREP, data), message)
+        self.assertEqual(NAMEPREP.prepare_query(u"a\u0221"), u"a\u0221")
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        # pylint: disable=W0212
+        self.saved_size = xmppstringprep._stringprep_cache_size
+        self.profile = Profile(unassigned = NODEPREP.unassigned,
+                            mapping = NODEPREP.mapping,
+                            normalization = NODEPREP.normalization,
+                            prohibited = NODEPREP.prohibited)
+
+    def tearDown(self):
+        set_stringprep_cache_size(self.saved_size)
+
+    def test_hits_and_misses(self):
+        set_stringprep_cache_size(10)
+        self.profile.prepare(u"Źdźbło")
+        self.profile.prepare(u"Źdźbło")
+        self.profile.prepare(u"żółw")
+        self.assertEqual(self.profile.hits, 1)
+        self.assertEqual(self.profile.misses, 2)
+
+    def test_lru_eviction(self):
+        set_stringprep_cache_size(3)
+        for data in (u"ż1", u"ż2", u"ż3"):
+            self.profile.prepare(data)
+        self.profile.prepare(u"ż1") # make it recently used
+        self.profile.prepare(u"ż4")
+        self.assertEqual(list(self.profile.cache), [u"ż3", u"ż1", u"ż4"])
+
+    def test_resize(self):
+        set_stringprep_cache_size(10)
+        for i in range(10):
+            self.profile.prepare(u"ż{0}".format(i))
+        set_stringprep_cache_size(2)
+        self.assertEqual(list(self.profile.cache), [u"ż8", u"ż9"])
+        set_stringprep_cache_size(0)
+        self.profile.prepare(u"ż")
+        self.assertEqual(len(self.profile.cache), 0)
+
+# pylint: disable=W0611
+from pyxmpp2.test._support import load_tests, setup_logging
+
+def setUpModule():
+    setup_logging()
+
+if __name__ == "__main__":
+    unittest.main()
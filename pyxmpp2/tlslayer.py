@@ -0,0 +1,181 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""TLS on memory buffers.
+
+`TLSLayer` encrypts and decrypts data without touching any socket, using
+:std:`ssl.MemoryBIO` and :std:`ssl.SSLObject`. The transport moves the
+ciphertext through its usual non-blocking socket code, so the TLS handshake
+advances only when data arrives, and all the data read or written at once
+is decrypted or encrypted in a single batch.
+
+Available only when the Python `ssl` module provides `MemoryBIO`
+(`HAVE_MEMORY_BIO`).
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import ssl
+import logging
+
+logger = logging.getLogger("pyxmpp2.tlslayer")
+
+HAVE_MEMORY_BIO = hasattr(ssl, "MemoryBIO")
+
+# plaintext chunk size used when decrypting
+READ_SIZE = 16384
+
+class TLSLayer(object):
+    """TLS connection over memory buffers.
+
+    :Ivariables:
+        - `ssl_object`: the TLS connection object
+        - `established`: `True` when the handshake is complete
+        - `_incoming`: ciphertext received, not processed yet
+        - `_outgoing`: ciphertext to send
+    :Types:
+        - `ssl_object`: :std:`ssl.SSLObject`
+        - `established`: `bool`
+        - `_incoming`: :std:`ssl.MemoryBIO`
+        - `_outgoing`: :std:`ssl.MemoryBIO`
+    """
+    def __init__(self, context, server_side = False, server_hostname = None,
+                                                            session = None):
+        """Initialize the `TLSLayer` object.
+
+        :Parameters:
+            - `context`: the TLS context to use
+            - `server_side`: `True` for the receiving entity
+            - `server_hostname`: the host name for SNI [initiator only]
+            - `session`: the TLS session to resume [initiator only]
+        :Types:
+            - `context`: :std:`ssl.SSLContext`
+            - `server_side`: `bool`
+            - `server_hostname`: `str`
+            - `session`: :std:`ssl.SSLSession`
+        """
+        if not HAVE_MEMORY_BIO:
+            raise NotImplementedError("ssl.MemoryBIO not available")
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        kwargs = {}
+        if session is not None:
+            kwargs["session"] = session
+        self.ssl_object = context.wrap_bio(self._incoming, self._outgoing,
+                                        server_side = server_side,
+                                        server_hostname = server_hostname,
+                                        **kwargs)
+        self.established = False
+
+    def do_handshake(self):
+        """Advance the TLS handshake with the data fed so far.
+
+        :Return: `True` when the handshake is complete, `False` when more
+            data from the peer is needed.
+        :Raise ssl.SSLError: when the handshake fails
+        """
+        if self.established:
+            return True
+        try:
+            self.ssl_object.do_handshake()
+        except ssl.SSLWantReadError:
+            return False
+        self.established = True
+        return True
+
+    def feed(self, data):
+        """Pass ciphertext received from the peer.
+
+        :Parameters:
+            - `data`: the data received
+        :Types:
+            - `data`: `bytes`
+        """
+        self._incoming.write(data)
+
+    def feed_eof(self):
+        """Signal that the peer has closed the connection."""
+        self._incoming.write_eof()
+
+    def read(self):
+        """Decrypt all the data available.
+
+        :Return: (plaintext, closed) tuple, where `closed` is `True`
+            when the peer closed the TLS connection.
+        :Returntype: (`bytes`, `bool`)
+        """
+        chunks = []
+        closed = False
+        while True:
+            try:
+                chunk = self.ssl_object.read(READ_SIZE)
+            except ssl.SSLWantReadError:
+                break
+            except ssl.SSLZeroReturnError:
+                closed = True
+                break
+            except ssl.SSLEOFError:
+                logger.debug("TLS connection closed without close_notify")
+                closed = True
+                break
+            if not chunk:
+                closed = True
+                break
+            chunks.append(chunk)
+        return b"".join(chunks), closed
+
+    def write(self, data):
+        """Encrypt data.
+
+        :Parameters:
+            - `data`: plaintext to send
+        :Types:
+            - `data`: `bytes`
+
+        :Return: ciphertext to be sent to the peer
+        :Returntype: `bytes`
+        """
+        view = memoryview(data)
+        while view:
+            written = self.ssl_object.write(view)
+            view = view[written:]
+        return self._outgoing.read()
+
+    def data_to_send(self):
+        """Get the ciphertext produced by the handshake or alerts.
+
+        :Returntype: `bytes`
+        """
+        return self._outgoing.read()
+
+    def shutdown(self):
+        """Start closing the TLS connection (send close_notify).
+
+        :Return: ciphertext to be sent to the peer
+        :Returntype: `bytes`
+        """
+        try:
+            self.ssl_object.unwrap()
+        except (ssl.SSLWantReadError, ssl.SSLZeroReturnError):
+            pass
+        except ssl.SSLError, err:
+            logger.debug("TLS shutdown failed: {0}".format(err))
+        return self._outgoing.read()
+
+# vi: sts=4 et sw=4
@@ -0,0 +1,131 @@
+#
+# (C) Copyright 2011 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License Version
+# 2.1 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+"""Protocol trace channels.
+
+Debug messages on the hot paths (data sent and received, stanza and event
+dispatching, timers) go through `TraceChannel` objects instead of plain
+``logger.debug("...".format(...))`` calls. The message is only formatted
+when the channel is enabled, so tracing costs a single function call and
+a logger level check when disabled.
+
+A channel is enabled when it is switched on and its logger accepts 'DEBUG'
+messages. The logger configuration is checked on every call, so changes
+made at any time (e.g. logging configured after the main loop has been
+created) take effect immediately.
+
+The channels:
+
+  - `TRACE_IN`: raw data received (the 'pyxmpp2.IN' logger)
+  - `TRACE_OUT`: raw data sent (the 'pyxmpp2.OUT' logger)
+  - `TRACE_IO`: transport internals (the 'pyxmpp2.trace.io' logger)
+  - `TRACE_DISPATCH`: stanza, payload and event dispatching (the
+    'pyxmpp2.trace.dispatch' logger)
+  - `TRACE_TIMERS`: timeout handlers (the 'pyxmpp2.trace.timers' logger)
+
+All channels are switched on by default, so they follow the logging
+configuration. `disable_channels` switches channels off completely,
+regardless of the logging configuration.
+"""
+
+from __future__ import absolute_import, division
+
+__docformat__ = "restructuredtext en"
+
+import logging
+
+class TraceChannel(object):
+    """A protocol trace channel.
+
+    Calling the channel object logs a message at the 'DEBUG' level.
+    The message is a `unicode.format` format string and its arguments;
+    it is formatted only when the channel is enabled.
+
+    :Ivariables:
+        - `name`: the channel name
+        - `logger`: the logger used
+        - `switch`: `False` when the channel has been switched off
+    :Types:
+        - `name`: `str`
+        - `logger`: :std:`logging.Logger`
+        - `switch`: `bool`
+    """
+    __slots__ = ("name", "logger", "switch")
+    def __init__(self, name, logger_name):
+        self.name = name
+        self.logger = logging.getLogger(logger_name)
+        self.switch = True
+
+    @property
+    def enabled(self):
+        """`True` when the channel is switched on and the logger accepts
+        'DEBUG' messages."""
+        return self.switch and self.logger.isEnabledFor(logging.DEBUG)
+
+    def __call__(self, msg, *args, **kwargs):
+        """Log a trace message.
+
+        :Parameters:
+            - `msg`: the message or the format string, when `args` or
+              `kwargs` are given
+            - `args`: positional arguments for `msg.format()`
+            - `kwargs`: keyword arguments for `msg.format()`
+        """
+        if not self.switch or not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if args or kwargs:
+            msg = msg.format(*args, **kwargs)
+        self.logger.debug(msg)
+
+    def __nonzero__(self):
+        """Check if the channel is enabled. Use this to guard
+        expensive trace argument computations."""
+        return self.enabled
+
+    def __repr__(self):
+        return "<TraceChannel {0!r}>".format(self.name)
+
+TRACE_IN = TraceChannel("in", "pyxmpp2.IN")
+TRACE_OUT = TraceChannel("out", "pyxmpp2.OUT")
+TRACE_IO = TraceChannel("io", "pyxmpp2.trace.io")
+TRACE_DISPATCH = TraceChannel("dispatch", "pyxmpp2.trace.dispatch")
+TRACE_TIMERS = TraceChannel("timers", "pyxmpp2.trace.timers")
+
+CHANNELS = dict((channel.name, channel) for channel in (
+                TRACE_IN, TRACE_OUT, TRACE_IO, TRACE_DISPATCH, TRACE_TIMERS))
+
+def enable_channels(*names):
+    """Switch trace channels on.
+
+    :Parameters:
+        - `names`: the channel names ("in", "out", "io", "dispatch",
+          "timers"). All channels when no name is given.
+    """
+    for name in (names or CHANNELS):
+        CHANNELS[name].switch = True
+
+def disable_channels(*names):
+    """Switch trace channels off.
+
+    :Parameters:
+        - `names`: the channel names ("in", "out", "io", "dispatch",
+          "timers"). All channels when no name is given.
+    """
+    for name in (names or CHANNELS):
+        CHANNELS[name].switch = False
+
+# vi: sts=4 et sw=4
@@ -20,17 +20,27 @@
 This module provides the abstract base class for XMPP transports (mechanisms
 used to send and receive XMPP content, not to be confused with protocol
 gateways sometimes also called 'transports') and the standard TCP transport.
+
+The TCP transport may also use Unix domain sockets, e.g. for components
+co-located with the server.
 """
 
 from __future__ import absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
+import os
+import re
+import platform
 import socket
 import threading
 import errno
 import logging
 import ssl
+import sys
+import time
+import zlib
+import struct
 
 try:
     # pylint: disable=E0611
@@ -53,20 +63,99 @@ from .xmppparser import StreamReader
 from .mainloop.wait import wait_for_write
 from .interfaces import XMPPTransport
 from .cert import get_certificate_from_ssl_socket
+from .trace import TRACE_IN, TRACE_OUT, TRACE_IO
+from .tlslayer import TLSLayer, HAVE_MEMORY_BIO
 
 # pylint: disable=W0611
 from . import resolver
 
 logger = logging.getLogger("pyxmpp2.transport")
 
-IN_LOGGER = logging.getLogger("pyxmpp2.IN")
-OUT_LOGGER = logging.getLogger("pyxmpp2.OUT")
-
 BLOCKING_ERRORS = set()
 for __name in ['EAGAIN', 'EWOULDBLOCK', 'WSAEWOULDBLOCK', 'EINPROGRESS']:
     if hasattr(errno, __name):
         BLOCKING_ERRORS.add(getattr(errno, __name))
 
+# how often the connection attempts, other than the one watched by
+# the main loop, are checked
+ATTEMPT_POLL_INTERVAL = 0.05
+
+# maximum size of a piece of decompressed data passed to the stream reader
+INFLATE_CHUNK_SIZE = 65536
+
+AF_UNIX = getattr(socket, "AF_UNIX", None)
+
+# Linux architectures using the asm-generic socket option numbers (others,
+# like powerpc, mips, sparc, alpha or parisc, define their own)
+_GENERIC_SOCKOPTS_RE = re.compile(r"^(i[3-6]86|x86_64|amd64|arm.*|aarch64.*"
+                                    r"|riscv.*|s390x?|ia64|loongarch.*)$")
+LINUX_GENERIC_SOCKOPTS = (sys.platform.startswith("linux") and
+            _GENERIC_SOCKOPTS_RE.match(platform.machine()) is not None)
+
+# not exported by the Python 2 socket module
+if hasattr(socket, "SO_PEERCRED"):
+    SO_PEERCRED = socket.SO_PEERCRED # pylint: disable=E1101
+elif LINUX_GENERIC_SOCKOPTS:
+    SO_PEERCRED = 17
+else:
+    SO_PEERCRED = None
+
+def is_unix_socket_path(addr):
+    """Check if an address passed to `TCPTransport.connect` is a Unix domain
+    socket path: an absolute path or a Linux abstract socket name (starting
+    with a NUL character).
+
+    :Returntype: `bool`
+    """
+    return AF_UNIX is not None and addr.startswith(("/", "\0"))
+
+def get_peer_credentials(sock):
+    """Get the credentials of the process on the other end of a Unix
+    domain socket.
+
+    :Parameters:
+        - `sock`: a connected Unix domain socket
+    :Types:
+        - `sock`: :std:`socket.socket`
+
+    :Return: (pid, uid, gid) tuple or `None` if not available on this
+        platform.
+    """
+    if SO_PEERCRED is None:
+        return None
+    try:
+        data = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                                    struct.calcsize("3i"))
+    except socket.error, err:
+        logger.debug("Could not get the peer credentials: {0}".format(err))
+        return None
+    return struct.unpack("3i", data)
+
+def interleave_addresses(addrs, prefer_ipv6 = True):
+    """Reorder addresses, so the address families alternate, as described
+    in RFC 8305 (Happy Eyeballs).
+
+    The relative order of addresses of the same family is preserved.
+
+    :Parameters:
+        - `addrs`: (family, address) tuples
+        - `prefer_ipv6`: `True` if the first address should be an IPv6 one
+    :Types:
+        - `addrs`: `list`
+        - `prefer_ipv6`: `bool`
+
+    :Returntype: `list`"""
+    ipv6 = [addr for addr in addrs if addr[0] == socket.AF_INET6]
+    others = [addr for addr in addrs if addr[0] != socket.AF_INET6]
+    if prefer_ipv6:
+        first, second = ipv6, others
+    else:
+        first, second = others, ipv6
+    result = []
+    for i in range(max(len(first), len(second))):
+        result += first[i:i + 1] + second[i:i + 1]
+    return result
+
 class WriteJob(object):
     """Base class for objects put to the `TCPTransport` write queue."""
     # pylint: disable-msg=R0903
@@ -108,10 +197,25 @@ class WriteData(WriteJob):
 class TCPTransport(XMPPTransport, IOHandler):
     """XMPP over TCP with optional TLS.
 
+    When connecting, the candidate addresses are tried in parallel, with
+    a new attempt started every 'connection_attempt_delay' seconds, until
+    one of them connects (RFC 8305 "Happy Eyeballs"). The IPv6 and IPv4
+    addresses are interleaved.
+
+    On a Unix domain socket connection the credentials of the peer process
+    are available to the SASL EXTERNAL mechanism as the
+    ``"peer-credentials"`` authentication property.
+
     :Ivariables:
         - `lock`: the lock protecting this object
         - `settings`: settings for this object
           socket is currently open)
+        - `_attempts`: the connection attempts in progress
+        - `_compressor`: compressor of the data sent, when the stream
+          compression is on
+        - `_decompressor`: decompressor of the data received, when the stream
+          compression is on
+        - `_next_attempt`: when the next connection attempt may be started
         - `_dst_addr`: socket address currently in use
         - `_dst_addrs`: list of (family, sockaddr) candidates to connect to
         - `_dst_family`: address family of the socket
@@ -134,9 +238,15 @@ class TCPTransport(XMPPTransport, IOHandler):
           "closing", "closed", "aborted")
         - `_stream`: the stream associated with this transport
         - `_tls_state`: state of TLS handshake
+        - `_tls_layer`: the TLS layer, when TLS is done on memory buffers
+          instead of by wrapping the socket
     :Types:
         - `lock`: :std:`threading.RLock`
         - `settings`: `XMPPSettings`
+        - `_attempts`: `list` of (socket, family, address) tuples
+        - `_compressor`: :std:`zlib.Compress`
+        - `_decompressor`: :std:`zlib.Decompress`
+        - `_next_attempt`: `float`
         - `_dst_addr`: tuple
         - `_dst_addrs`: list of tuples
         - `_dst_family`: `int`
@@ -155,6 +265,7 @@ class TCPTransport(XMPPTransport, IOHandler):
         - `_state`: `unicode`
         - `_stream`: `streambase.StreamBase`
         - `_tls_state`: `unicode`
+        - `_tls_layer`: `TLSLayer`
     """
     # pylint: disable=R0902
     def __init__(self, settings = None, sock = None):
@@ -182,7 +293,12 @@ class TCPTransport(XMPPTransport, IOHandler):
         self._dst_nameports = None
         self._dst_hostname = None
         self._dst_addrs = None
+        self._attempts = []
+        self._next_attempt = 0
         self._tls_state = None
+        self._tls_layer = None
+        self._compressor = None
+        self._decompressor = None
         self._state_cond = threading.Condition(self.lock)
         if sock is None:
             self._socket = None
@@ -197,11 +313,13 @@ class TCPTransport(XMPPTransport, IOHandler):
             self._socket.setblocking(False)
         self._event_queue = self.settings["event_queue"]
         self._auth_properties = {}
+        if sock is not None and self._family == AF_UNIX:
+            self._set_unix_auth_properties()
 
     def _set_state(self, state):
         """Set `_state` and notify any threads waiting for the change.
         """
-        logger.debug(" _set_state({0!r})".format(state))
+        TRACE_IO(" _set_state({0!r})", state)
         self._state = state
         self._state_cond.notify()
 
@@ -215,10 +333,13 @@ class TCPTransport(XMPPTransport, IOHandler):
         at domain `addr`. If `service` is not given or `addr` is an IP address,
         or the SRV lookup fails, connect to `port` at host `addr` directly.
 
+        When `addr` is a Unix domain socket path (see `is_unix_socket_path`)
+        connect to that socket, `port` and `service` are ignored.
+
         [initiating entity only]
 
         :Parameters:
-            - `addr`: peer name or IP address
+            - `addr`: peer name, IP address or Unix socket path
             - `port`: port number to connect to
             - `service`: service name (to be resolved using SRV DNS records)
         """
@@ -230,6 +351,12 @@ class TCPTransport(XMPPTransport, IOHandler):
         """
         self._dst_name = addr
         self._dst_port = port
+        if is_unix_socket_path(addr):
+            self._dst_service = None
+            self._family = AF_UNIX
+            self._dst_addrs = [(AF_UNIX, addr)]
+            self._set_state("connect")
+            return
         family = None
         try:
             res = socket.getaddrinfo(addr, port, socket.AF_UNSPEC,
@@ -317,15 +444,22 @@ class TCPTransport(XMPPTransport, IOHandler):
             - `addrs`: list of (family, address) tuples
         """
         with self.lock:
+            if self._state != "resolving-hostname":
+                # already connected or closed while resolving
+                return
             if not addrs:
                 if self._dst_nameports:
                     self._set_state("resolve-hostname")
                     return
+                elif self._attempts:
+                    self._set_state("connecting")
+                    return
                 else:
                     self._dst_addrs = []
                     self._set_state("aborted")
                     raise DNSError("Could not resolve address record for {0!r}"
                                                                 .format(name))
+            addrs = interleave_addresses(addrs, self.settings["prefer_ipv6"])
             self._dst_addrs = [ (family, (addr, port)) for (family, addr)
                                                                     in addrs ]
             self._set_state("connect")
@@ -333,80 +467,168 @@ class TCPTransport(XMPPTransport, IOHandler):
     def _start_connect(self):
         """Start connecting to the next address on the `_dst_addrs` list.
 
+        The attempts already in progress are continued.
+
         [ called with `lock` acquired ]
 
         """
         family, addr = self._dst_addrs.pop(0)
-        self._socket = socket.socket(family, socket.SOCK_STREAM)
-        self._socket.setblocking(False)
-        self._dst_addr = addr
-        self._family  = family
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        attempt = (sock, family, addr)
+        self._attempts.append(attempt)
         try:
-            self._socket.connect(addr)
+            sock.connect(addr)
         except socket.error, err:
             logger.debug("Connect error: {0}".format(err))
-            if err.args[0] in BLOCKING_ERRORS:
-                self._set_state("connecting")
-                self._write_queue.append(ContinueConnect())
-                self._write_queue_cond.notify()
-                self.event(ConnectingEvent(addr))
+            if err.args[0] not in BLOCKING_ERRORS:
+                self._attempts.remove(attempt)
+                sock.close()
+                self._attempt_failed(err)
                 return
-            elif self._dst_addrs:
+        else:
+            self._attempt_connected(attempt)
+            return
+        # the newest attempt is watched by the main loop
+        self._socket, self._family, self._dst_addr = attempt
+        self._next_attempt = (time.time()
+                                + self.settings["connection_attempt_delay"])
+        self._set_state("connecting")
+        if not any(isinstance(job, ContinueConnect)
+                                                for job in self._write_queue):
+            self._write_queue.append(ContinueConnect())
+            self._write_queue_cond.notify()
+        self.event(ConnectingEvent(addr))
+
+    def _attempt_connected(self, attempt):
+        """Use the connection that succeeded and abandon the other attempts.
+
+        [ called with `lock` acquired ]
+        """
+        for other in self._attempts:
+            if other is not attempt:
+                other[0].close()
+        self._attempts = []
+        self._socket, self._family, self._dst_addr = attempt
+        for job in list(self._write_queue):
+            if isinstance(job, ContinueConnect):
+                self._write_queue.remove(job)
+        self._connected()
+
+    def _attempt_failed(self, err):
+        """Handle failure of a connection attempt: let the other attempts
+        continue, start the next one or give up.
+
+        [ called with `lock` acquired ]
+        """
+        if self._attempts:
+            self._socket, self._family, self._dst_addr = self._attempts[-1]
+            self._next_attempt = 0
+        else:
+            self._socket = None
+            if self._dst_addrs:
                 self._set_state("connect")
-                return
             elif self._dst_nameports:
                 self._set_state("resolve-hostname")
-                return
-            else:
-                self._socket.close()
-                self._socket = None
+            elif self._state != "resolving-hostname":
                 self._set_state("aborted")
                 self._write_queue.clear()
                 self._write_queue_cond.notify()
-                raise
-        self._connected()
+                raise err
+
+    def _check_attempts(self):
+        """Check the connection attempts in progress.
+
+        [ called with `lock` acquired ]
+        """
+        failure = None
+        for attempt in list(self._attempts):
+            sock, dummy, addr = attempt
+            result = sock.connect_ex(addr)
+            if result in (0, errno.EISCONN):
+                self._attempt_connected(attempt)
+                return
+            elif result in BLOCKING_ERRORS or result == errno.EALREADY:
+                continue
+            failure = socket.error(result, os.strerror(result))
+            logger.debug("Connect error: {0}".format(failure))
+            self._attempts.remove(attempt)
+            sock.close()
+        if failure:
+            self._attempt_failed(failure)
+
+    def _race(self):
+        """Check the connection attempts in progress and start the next one,
+        if it is the time.
+
+        [ called with `lock` acquired ]
+
+        :Return: maximum time until the next call
+        :Returntype: `float`
+        """
+        self._check_attempts()
+        if self._state not in ("connecting", "resolving-hostname"):
+            return 0
+        now = time.time()
+        if now >= self._next_attempt:
+            if self._dst_addrs:
+                self._start_connect()
+            elif self._dst_nameports and self._state == "connecting":
+                self._resolve_hostname()
+            if self._state not in ("connecting", "resolving-hostname"):
+                return 0
+        if self._dst_addrs or self._dst_nameports:
+            timeout = max(self._next_attempt - now, 0)
+        else:
+            timeout = None
+        if len(self._attempts) > 1:
+            if timeout is None:
+                timeout = ATTEMPT_POLL_INTERVAL
+            else:
+                timeout = min(timeout, ATTEMPT_POLL_INTERVAL)
+        return timeout
 
     def _connected(self):
         """Handle connection success."""
-        self._auth_properties['remote-ip'] = self._dst_addr[0]
+        if self._family == AF_UNIX:
+            self._set_unix_auth_properties()
+        else:
+            self._auth_properties['remote-ip'] = self._dst_addr[0]
+            if self._dst_hostname is not None:
+                self._auth_properties['service-hostname'] = self._dst_hostname
+            else:
+                self._auth_properties['service-hostname'] = self._dst_addr[0]
+            self._auth_properties['security-layer'] = None
         if self._dst_service:
             self._auth_properties['service-domain'] = self._dst_name
-        if self._dst_hostname is not None:
-            self._auth_properties['service-hostname'] = self._dst_hostname
-        else:
-            self._auth_properties['service-hostname'] = self._dst_addr[0]
-        self._auth_properties['security-layer'] = None
         self.event(ConnectedEvent(self._dst_addr))
         self._set_state("connected")
         self._stream.transport_connected()
 
+    def _set_unix_auth_properties(self):
+        """Set the authentication properties of a Unix domain socket
+        connection.
+
+        The data cannot be intercepted on the network, so the channel is
+        considered secure.
+
+        [ called with `lock` acquired ]
+        """
+        self._auth_properties['security-layer'] = "unix"
+        credentials = get_peer_credentials(self._socket)
+        if credentials is not None:
+            self._auth_properties['peer-credentials'] = credentials
+
     def _continue_connect(self):
-        """Continue connecting.
+        """Continue connecting, when the watched socket became writable.
 
         [called with `lock` acquired]
-
-        :Return: `True` when just connected
         """
-        try:
-            self._socket.connect(self._dst_addr)
-        except socket.error, err:
-            logger.debug("Connect error: {0}".format(err))
-            if err.args[0] == errno.EISCONN:
-                pass
-            elif err.args[0] in BLOCKING_ERRORS:
-                return None
-            elif self._dst_addrs:
-                self._set_state("connect")
-                return None
-            elif self._dst_nameports:
-                self._set_state("resolve-hostname")
-                return None
-            else:
-                self._socket.close()
-                self._socket = None
-                self._set_state("aborted")
-                raise
-        self._connected()
+        self._check_attempts()
+        if self._attempts and not any(isinstance(job, ContinueConnect)
+                                                for job in self._write_queue):
+            self._write_queue.append(ContinueConnect())
+            self._write_queue_cond.notify()
 
     def _write(self, data):
         """Write raw data to the socket.
@@ -416,9 +638,25 @@ class TCPTransport(XMPPTransport, IOHandler):
         :Types:
             - `data`: `bytes`
         """
-        OUT_LOGGER.debug("OUT: %r", data)
+        TRACE_OUT("OUT: {0!r}", data)
         if self._hup or not self._socket:
             raise PyXMPPIOError(u"Connection closed.")
+        if self._compressor is not None:
+            # flush on every write, so each stanza is sent immediately
+            data = (self._compressor.compress(data)
+                                    + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        if self._tls_layer is not None:
+            data = self._tls_layer.write(data)
+        self._send(data)
+
+    def _send(self, data):
+        """Send data (raw or already encrypted) via the socket.
+
+        :Parameters:
+            - `data`: data to send
+        :Types:
+            - `data`: `bytes`
+        """
         try:
             while data:
                 try:
@@ -484,6 +722,31 @@ class TCPTransport(XMPPTransport, IOHandler):
                                                 stream_id, version, language)
             self._write(head.encode("utf-8"))
 
+    def start_compression(self, level = None, window_bits = None):
+        """Start the zlib stream compression (XEP-0138).
+
+        All the data written after this call is compressed and all the data
+        received is decompressed. The compressor is flushed after every
+        write, so the stanzas are not delayed.
+
+        :Parameters:
+            - `level`: compression level (0-9), the :r:`compression_level
+              setting` by default
+            - `window_bits`: base-2 logarithm of the compression window size
+              (9-15), the :r:`compression_window_bits setting` by default
+        :Types:
+            - `level`: `int`
+            - `window_bits`: `int`
+        """
+        with self.lock:
+            if level is None:
+                level = self.settings["compression_level"]
+            if window_bits is None:
+                window_bits = self.settings["compression_window_bits"]
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                                                window_bits)
+            self._decompressor = zlib.decompressobj()
+
     def restart(self):
         """Restart the stream after SASL or StartTLS handshake."""
         self._reader = StreamReader(self._stream)
@@ -505,7 +768,13 @@ class TCPTransport(XMPPTransport, IOHandler):
                                                                 .format(err))
             self._serializer = None
             self._hup = True
-            if self._tls_state is None:
+            if self._tls_layer is not None:
+                try:
+                    self._send(self._tls_layer.shutdown())
+                except PyXMPPIOError, err:
+                    logger.debug(u"Sending TLS close_notify failed: {0}"
+                                                                .format(err))
+            if self._tls_state is None or self._tls_layer is not None:
                 try:
                     self._socket.shutdown(socket.SHUT_WR)
                 except socket.error:
@@ -531,14 +800,17 @@ class TCPTransport(XMPPTransport, IOHandler):
         next `prepare` call, when connected return `HandlerReady()`
         """
         result = HandlerReady()
-        logger.debug("TCPTransport.prepare(): state: {0!r}".format(self._state))
+        TRACE_IO("TCPTransport.prepare(): state: {0!r}", self._state)
         with self.lock:
             if self._state in ("connected", "closing", "closed", "aborted"):
                 # no need to call prepare() .fileno() is stable
                 pass
             elif self._state == "connect":
                 self._start_connect()
-                result = PrepareAgain(None)
+                result = PrepareAgain(self._race())
+            elif self._state == "connecting" or (
+                    self._state == "resolving-hostname" and self._attempts):
+                result = PrepareAgain(self._race())
             elif self._state == "resolve-hostname":
                 self._resolve_hostname()
                 result = PrepareAgain(0)
@@ -548,8 +820,7 @@ class TCPTransport(XMPPTransport, IOHandler):
             else:
                 # wait for i/o, but keep calling prepare()
                 result = PrepareAgain(None)
-        logger.debug("TCPTransport.prepare(): new state: {0!r}"
-                                                        .format(self._state))
+        TRACE_IO("TCPTransport.prepare(): new state: {0!r}", self._state)
         return result
 
     def fileno(self):
@@ -565,6 +836,7 @@ class TCPTransport(XMPPTransport, IOHandler):
         """
         return self._socket is not None and not self._eof and (
                     self._state in ("connected", "closing")
+                                        and self._tls_state != "starting"
                         or self._state == "tls-handshake"
                                         and self._tls_state == "want_read")
 
@@ -578,7 +850,8 @@ class TCPTransport(XMPPTransport, IOHandler):
             while True:
                 if self._socket is None or self._eof:
                     return False
-                if self._state in ("connected", "closing"):
+                if self._state in ("connected", "closing") and \
+                                            self._tls_state != "starting":
                     return True
                 if self._state == "tls-handshake" and \
                                             self._tls_state == "want_read":
@@ -613,7 +886,7 @@ class TCPTransport(XMPPTransport, IOHandler):
         socket.
         """
         with self.lock:
-            logger.debug("handle_write: queue: {0!r}".format(self._write_queue))
+            TRACE_IO("handle_write: queue: {0!r}", self._write_queue)
             try:
                 job = self._write_queue.popleft()
             except IndexError:
@@ -636,13 +909,28 @@ class TCPTransport(XMPPTransport, IOHandler):
         The handshake will start after any currently buffered data is sent.
 
         :Parameters:
-            - `kwargs`: arguments for :std:`ssl.wrap_socket`
+            - `kwargs`: arguments for :std:`ssl.SSLContext.wrap_socket`,
+              with the context passed as `context`, or for
+              :std:`ssl.wrap_socket`, when no `context` is given
         """
         with self.lock:
             self.event(TLSConnectingEvent())
+            # stop reading, the TLS handshake data must not reach the parser
+            self._tls_state = "starting"
             self._write_queue.append(StartTLS(**kwargs))
             self._write_queue_cond.notify()
 
+    def get_tls_session(self):
+        """Return the TLS session, for resumption on the next connection.
+
+        :Return: the session or `None` if not available
+        :ReturnType: :std:`ssl.SSLSession`
+        """
+        with self.lock:
+            if not self._socket or self._tls_state != "connected":
+                return None
+            return getattr(self._tls_object(), "session", None)
+
     def getpeercert(self):
         """Return the peer certificate.
 
@@ -651,21 +939,55 @@ class TCPTransport(XMPPTransport, IOHandler):
         with self.lock:
             if not self._socket or self._tls_state != "connected":
                 raise ValueError("Not TLS-connected")
-            return get_certificate_from_ssl_socket(self._socket)
+            return get_certificate_from_ssl_socket(self._tls_object())
+
+    def _tls_object(self):
+        """Get the object providing the TLS connection information.
+
+        :Returntype: :std:`ssl.SSLObject` or :std:`ssl.SSLSocket`
+        """
+        if self._tls_layer is not None:
+            return self._tls_layer.ssl_object
+        return self._socket
 
     def _initiate_starttls(self, **kwargs):
         """Initiate starttls handshake over the socket.
+
+        When a TLS context is given and the `ssl` module supports memory
+        buffers, TLS is done by a `TLSLayer` over the plain socket,
+        otherwise the socket is wrapped.
         """
         if self._tls_state == "connected":
             raise RuntimeError("Already TLS-connected")
         kwargs["do_handshake_on_connect"] = False
-        logger.debug("Wrapping the socket into ssl")
-        self._socket = ssl.wrap_socket(self._socket, **kwargs)
+        context = kwargs.pop("context", None)
+        if context is not None and HAVE_MEMORY_BIO:
+            logger.debug("Starting TLS on memory buffers")
+            self._tls_layer = TLSLayer(context,
+                            server_side = bool(kwargs.get("server_side")),
+                            server_hostname = kwargs.get("server_hostname"),
+                            session = kwargs.get("session"))
+        elif context is not None:
+            logger.debug("Wrapping the socket into ssl")
+            self._socket = context.wrap_socket(self._socket, **kwargs)
+        else:
+            logger.debug("Wrapping the socket into ssl")
+            self._socket = ssl.wrap_socket(self._socket, **kwargs)
         self._set_state("tls-handshake")
         self._continue_tls_handshake()
 
     def _continue_tls_handshake(self):
         """Continue a TLS handshake."""
+        if self._tls_layer is not None:
+            done = self._tls_layer.do_handshake()
+            self._send(self._tls_layer.data_to_send())
+            if not done:
+                self._tls_state = "want_read"
+                TRACE_IO("   want_read")
+                self._state_cond.notify()
+                return
+            self._tls_connected()
+            return
         try:
             logger.debug(" do_handshake()")
             self._socket.do_handshake()
@@ -682,24 +1004,29 @@ class TCPTransport(XMPPTransport, IOHandler):
                 return
             else:
                 raise
+        self._tls_connected()
+
+    def _tls_connected(self):
+        """Finish the TLS handshake."""
+        tls_object = self._tls_object()
         self._tls_state = "connected"
         self._set_state("connected")
         self._auth_properties['security-layer'] = "TLS"
         if "tls-unique" in CHANNEL_BINDING_TYPES:
             try:
                 # pylint: disable=E1103
-                tls_unique = self._socket.get_channel_binding("tls-unique")
+                tls_unique = tls_object.get_channel_binding("tls-unique")
             except ValueError:
                 pass
             else:
                 self._auth_properties['channel-binding'] = {
                                                     "tls-unique": tls_unique}
         try:
-            cipher = self._socket.cipher()
+            cipher = tls_object.cipher()
         except AttributeError:
             # SSLSocket.cipher doesn't work on PyPy
             cipher = "unknown"
-        cert = get_certificate_from_ssl_socket(self._socket)
+        cert = get_certificate_from_ssl_socket(tls_object)
         self.event(TLSConnectedEvent(cipher, cert))
 
     def handle_read(self):
@@ -707,19 +1034,21 @@ class TCPTransport(XMPPTransport, IOHandler):
         Handle the 'channel readable' state. E.g. read from a socket.
         """
         with self.lock:
-            logger.debug("handle_read()")
+            TRACE_IO("handle_read()")
             if self._eof or self._socket is None:
                 return
-            if self._state == "tls-handshake":
+            if self._tls_layer is not None:
+                self._read_tls_layer()
+            elif self._state == "tls-handshake":
                 while True:
-                    logger.debug("tls handshake read...")
+                    TRACE_IO("tls handshake read...")
                     self._continue_tls_handshake()
-                    logger.debug("  state: {0}".format(self._tls_state))
+                    TRACE_IO("  state: {0}", self._tls_state)
                     if self._tls_state != "want_read":
                         break
             elif self._tls_state == "connected":
                 while self._socket and not self._eof:
-                    logger.debug("tls socket read...")
+                    TRACE_IO("tls socket read...")
                     try:
                         data = self._socket.read(4096)
                     except ssl.SSLError, err:
@@ -727,6 +1056,12 @@ class TCPTransport(XMPPTransport, IOHandler):
                             break
                         elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
                             break
+                        elif err.args[0] == ssl.SSL_ERROR_EOF or \
+                                            "unexpected eof" in str(err):
+                            # OpenSSL 3 reports missing close_notify as error
+                            logger.debug("TLS connection closed without"
+                                                        " close_notify")
+                            data = None
                         else:
                             raise
                     except socket.error, err:
@@ -741,8 +1076,9 @@ class TCPTransport(XMPPTransport, IOHandler):
                             raise
                     self._feed_reader(data)
             else:
-                while self._socket and not self._eof:
-                    logger.debug("raw socket read...")
+                while self._socket and not self._eof \
+                                        and self._tls_state != "starting":
+                    TRACE_IO("raw socket read...")
                     try:
                         data = self._socket.recv(4096)
                     except socket.error, err:
@@ -757,15 +1093,68 @@ class TCPTransport(XMPPTransport, IOHandler):
                             raise
                     self._feed_reader(data)
 
+    def _recv_all(self):
+        """Read all the data available from the (non-TLS) socket.
+
+        [ called with `lock` acquired ]
+
+        :Return: (data, eof) tuple
+        :Returntype: (`bytes`, `bool`)
+        """
+        chunks = []
+        eof = False
+        while True:
+            try:
+                data = self._socket.recv(4096)
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                elif err.args[0] in BLOCKING_ERRORS:
+                    break
+                elif err.args[0] == errno.ECONNRESET:
+                    logger.warning("Connection reset by peer")
+                    eof = True
+                    break
+                else:
+                    raise
+            if not data:
+                eof = True
+                break
+            chunks.append(data)
+        return b"".join(chunks), eof
+
+    def _read_tls_layer(self):
+        """Handle the socket readability when TLS is done by `_tls_layer`:
+        pass all the ciphertext available to the layer at once, advance
+        the handshake or decrypt the data.
+
+        [ called with `lock` acquired ]
+        """
+        TRACE_IO("tls layer read...")
+        data, eof = self._recv_all()
+        if data:
+            self._tls_layer.feed(data)
+        if eof:
+            self._tls_layer.feed_eof()
+        if self._state == "tls-handshake":
+            self._continue_tls_handshake()
+            if self._state == "tls-handshake":
+                return
+        data, closed = self._tls_layer.read()
+        if data:
+            self._feed_reader(data)
+        if (closed or eof) and self._socket and not self._eof:
+            self._feed_reader(None)
+
     def handle_hup(self):
         """
         Handle the 'channel hungup' state. The handler should not be writable
         after this.
         """
         with self.lock:
-            if self._state == 'connecting' and self._dst_addrs:
+            if self._attempts:
                 self._hup = False
-                self._set_state("connect")
+                self._continue_connect()
                 return
         self._hup = True
 
@@ -774,9 +1163,9 @@ class TCPTransport(XMPPTransport, IOHandler):
         Handle an error reported.
         """
         with self.lock:
-            if self._state == 'connecting' and self._dst_addrs:
+            if self._attempts:
                 self._hup = False
-                self._set_state("connect")
+                self._continue_connect()
                 return
             self._socket.close()
             self._socket = None
@@ -829,6 +1218,10 @@ class TCPTransport(XMPPTransport, IOHandler):
         if self._state != "closed":
             self.event(DisconnectedEvent(self._dst_addr))
             self._set_state("closed")
+        for sock, dummy, dummy in self._attempts:
+            if sock is not self._socket:
+                sock.close()
+        self._attempts = []
         if self._socket is None:
             return
         try:
@@ -837,6 +1230,9 @@ class TCPTransport(XMPPTransport, IOHandler):
             pass
         self._socket.close()
         self._socket = None
+        self._tls_layer = None
+        self._compressor = None
+        self._decompressor = None
         self._write_queue.clear()
         self._write_queue_cond.notify()
 
@@ -855,7 +1251,10 @@ class TCPTransport(XMPPTransport, IOHandler):
         :Types:
             - `data`: `unicode`
         """
-        IN_LOGGER.debug("IN: %r", data)
+        if data and self._decompressor is not None:
+            self._feed_compressed(data)
+            return
+        TRACE_IN("IN: {0!r}", data)
         if data:
             self.lock.release() # not to deadlock with the stream
             try:
@@ -874,6 +1273,45 @@ class TCPTransport(XMPPTransport, IOHandler):
                     self.event(DisconnectedEvent(self._dst_addr))
                     self._set_state("closed")
 
+    def _feed_compressed(self, data):
+        """Decompress data received and feed the stream reader with it.
+
+        [ called with `lock` acquired ]
+
+        The data is decompressed in `INFLATE_CHUNK_SIZE` pieces, up to
+        the :r:`compression_max_inflated setting` bytes, so a small
+        compressed block cannot make us allocate lots of memory.
+
+        :Parameters:
+            - `data`: compressed data received from the stream socket.
+        :Types:
+            - `data`: `bytes`
+        """
+        limit = self.settings["compression_max_inflated"]
+        total = 0
+        while data:
+            try:
+                chunk = self._decompressor.decompress(data,
+                                                        INFLATE_CHUNK_SIZE)
+            except zlib.error, err:
+                raise PyXMPPIOError(u"Decompression failed: {0}".format(err))
+            data = self._decompressor.unconsumed_tail
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > limit:
+                raise PyXMPPIOError(u"Decompressed data exceeds {0} bytes"
+                                                            .format(limit))
+            TRACE_IN("IN: {0!r}", chunk)
+            self.lock.release() # not to deadlock with the stream
+            try:
+                self._reader.feed(chunk)
+            finally:
+                self.lock.acquire()
+            if self._decompressor is None:
+                # closed in the meantime
+                break
+
     def event(self, event):
         """Pass an event to the target stream or just log it."""
         logger.debug(u"TCP transport event: {0}".format(event))
@@ -885,3 +1323,12 @@ class TCPTransport(XMPPTransport, IOHandler):
     def auth_properties(self):
         return self._auth_properties
 
+XMPPSettings.add_setting(u"connection_attempt_delay", type = float,
+        default = 0.25,
+        validator = XMPPSettings.validate_positive_float,
+        cmdline_help = "Delay between parallel connection attempts",
+        doc = u"""Time (in seconds) to wait for a connection attempt before
+the next address is tried in parallel."""
+    )
+
+# vi: sts=4 et sw=4
@@ -28,8 +28,16 @@ from __future__ import absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
+import re
 import stringprep
 import unicodedata
+import threading
+import weakref
+
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
 from .exceptions import StringprepError
 
 def b1_mapping(char):
@@ -69,10 +77,250 @@ def nfkc(data):
         data = u"".join(data)
     return unicodedata.normalize("NFKC", data)
 
+def nfkc_3_2(data):
+    """Do NFKC normalization of Unicode data, using the Unicode 3.2 database
+    (as `encodings.idna.nameprep` does).
+
+    :Parameters:
+        - `data`: list of Unicode characters or Unicode string.
+
+    :return: normalized Unicode string."""
+    if isinstance(data, list):
+        data = u"".join(data)
+    return unicodedata.ucd_3_2_0.normalize("NFKC", data)
+
+# character property flags in the `_CharTable` masks
+_PROHIBITED = 1
+_UNASSIGNED = 2
+_RANDAL = 4
+_LCAT = 8
+
+_BMP_END = 0x10000
+
+_tables_lock = threading.Lock() # pylint: disable-msg=C0103
+_toggles_cache = {}
+_mappings_cache = {}
+
+def _predicate_toggles(predicate):
+    """Find the code points in the Basic Multilingual Plane, where the
+    value of a character predicate (e.g. `stringprep.in_table_c21`) changes.
+
+    The predicate is true for the code point `code` when
+    ``bisect_right(toggles, code)`` is odd.
+
+    Must be called with `_tables_lock` held.
+
+    :Returntype: `array.array` of `int`
+    """
+    toggles = _toggles_cache.get(predicate)
+    if toggles is None:
+        toggles = array("i")
+        value = False
+        for code in xrange(_BMP_END):
+            if bool(predicate(unichr(code))) != value:
+                value = not value
+                toggles.append(code)
+        _toggles_cache[predicate] = toggles
+    return toggles
+
+def _bmp_mapping(mapping):
+    """Compute the mapping of the Basic Multilingual Plane characters
+    for a tuple of mapping functions.
+
+    Must be called with `_tables_lock` held.
+
+    :Return: dictionary of the characters changed by the mapping
+    """
+    result = _mappings_cache.get(mapping)
+    if result is None:
+        result = {}
+        for code in xrange(_BMP_END):
+            char = unichr(code)
+            for lookup in mapping:
+                ret = lookup(char)
+                if ret is not None:
+                    if ret != char:
+                        result[char] = ret
+                    break
+        _mappings_cache[mapping] = result
+    return result
+
+class _PredicateTable(object):
+    """Character lookups of a `Profile`, done with the lookup functions
+    of the profile."""
+    def __init__(self, profile):
+        self.mapping = profile.mapping
+        self.flags = ((_PROHIBITED, profile.prohibited),
+                        (_UNASSIGNED, profile.unassigned),
+                        (_RANDAL, (stringprep.in_table_d1,)),
+                        (_LCAT, (stringprep.in_table_d2,)))
+
+    def lookup(self, char):
+        """Get the character property flags of a character.
+
+        :Return: a bitwise or of the `_PROHIBITED`, `_UNASSIGNED`, `_RANDAL`
+            and `_LCAT` flags
+        """
+        mask = 0
+        for flag, predicates in self.flags:
+            for predicate in predicates:
+                if predicate(char):
+                    mask |= flag
+                    break
+        return mask
+
+    def map_char(self, char):
+        """Map a single character.
+
+        :Return: the replacement string
+        """
+        for lookup in self.mapping:
+            ret = lookup(char)
+            if ret is not None:
+                return ret
+        return char
+
+    def map(self, data):
+        """Mapping part of string preparation."""
+        return [self.map_char(char) for char in data]
+
+    def check(self, data, prohibited, unassigned, bidi):
+        """Check the mapped and normalized string for the prohibited
+        or unassigned characters and for the bidirectional text requirements.
+
+        There is only one property lookup per character, but the errors are
+        reported in the same order as if the checks were done one after
+        another.
+
+        :Parameters:
+            - `data`: the string to check
+            - `prohibited`: if the prohibited characters should be checked
+            - `unassigned`: if the unassigned characters should be checked
+            - `bidi`: if the bidirectional checks should be done
+        :Types:
+            - `data`: `unicode` or `list` of `unicode`
+            - `prohibited`: `bool`
+            - `unassigned`: `bool`
+            - `bidi`: `bool`
+
+        :raise StringprepError: if the check fails
+        """
+        lookup = self.lookup
+        masks = [lookup(char) for char in data]
+        combined = 0
+        for mask in masks:
+            combined |= mask
+        if prohibited and combined & _PROHIBITED:
+            self._raise(data, masks, _PROHIBITED, "Prohibited character")
+        if unassigned and combined & _UNASSIGNED:
+            self._raise(data, masks, _UNASSIGNED, "Unassigned character")
+        if bidi and combined & _RANDAL:
+            if combined & _LCAT:
+                raise StringprepError("Both RandALCat and LCat characters"
+                                                                " present")
+            if not masks[0] & _RANDAL or not masks[-1] & _RANDAL:
+                raise StringprepError("The first and the last character must"
+                                                                " be RandALCat")
+        return data
+
+    @staticmethod
+    def _raise(data, masks, flag, message):
+        """Raise `StringprepError` for the first character with `flag`
+        set."""
+        for char, mask in zip(data, masks):
+            if mask & flag:
+                raise StringprepError("{0}: {1!r}".format(message, char))
+
+class _CharTable(_PredicateTable):
+    """Character lookups of a `Profile`, compiled into sorted code point
+    ranges.
+
+    The Basic Multilingual Plane is split into ranges of characters with the
+    same property flags, so a character lookup is a single bisection of
+    the `starts` array, instead of calling all the profile lookup functions.
+    The mapping of the BMP characters is precomputed into a dictionary.
+    Characters outside of the BMP fall back to the lookup functions.
+
+    :Ivariables:
+        - `starts`: the first code point of each range
+        - `masks`: the property flags of each range
+        - `bmp_mapping`: characters changed by the profile mapping
+    :Types:
+        - `starts`: `array.array` of `int`
+        - `masks`: `array.array` of `int`
+        - `bmp_mapping`: `dict`
+    """
+    def __init__(self, profile):
+        _PredicateTable.__init__(self, profile)
+        with _tables_lock:
+            toggles = [(flag, _predicate_toggles(predicate))
+                                    for flag, predicates in self.flags
+                                        for predicate in predicates]
+            self.bmp_mapping = _bmp_mapping(self.mapping)
+        bounds = set([0])
+        for dummy, points in toggles:
+            bounds.update(points)
+        self.starts = array("i")
+        self.masks = array("B")
+        for code in sorted(bounds):
+            mask = 0
+            for flag, points in toggles:
+                if bisect_right(points, code) % 2:
+                    mask |= flag
+            if not self.masks or mask != self.masks[-1]:
+                self.starts.append(code)
+                self.masks.append(mask)
+
+    def lookup(self, char):
+        code = ord(char)
+        if code < _BMP_END:
+            return self.masks[bisect_right(self.starts, code) - 1]
+        return _PredicateTable.lookup(self, char)
+
+    def map(self, data):
+        bmp_mapping = self.bmp_mapping
+        result = []
+        for char in data:
+            ret = bmp_mapping.get(char)
+            if ret is not None:
+                result.append(ret)
+            elif ord(char) < _BMP_END:
+                result.append(char)
+            else:
+                result.append(self.map_char(char))
+        return result
+
 class Profile(object):
     """Base class for stringprep profiles.
+
+    Strings consisting only of Latin-1 characters which prepare to Latin-1
+    strings, without any normalization effects (that is most of the real-world
+    JIDs) are prepared in a fast path: a precomputed regular expression
+    checks if the string qualifies and a precomputed translation table does
+    the mapping. Results for the other strings are kept in a LRU cache (see
+    `set_stringprep_cache_size`).
+
+    The other strings are prepared with the profile lookup tables compiled
+    into sorted code point ranges, so there is a single lookup per character
+    instead of calling every lookup function. Compiling the tables takes
+    a while, so it should be done before the main loop starts, with
+    `warm_up_stringprep` (otherwise it is done on the first use).
+
+    :Ivariables:
+        - `cache`: the results cache, the least recently used first
+        - `lock`: the lock protecting the `cache`
+        - `fast_hits`: number of strings prepared in the fast path
+        - `hits`: number of cache hits
+        - `misses`: number of cache misses
+    :Types:
+        - `cache`: :std:`collections.OrderedDict`
+        - `lock`: :std:`threading.Lock`
+        - `fast_hits`: `int`
+        - `hits`: `int`
+        - `misses`: `int`
     """
-    cache_items = []
+    # pylint: disable-msg=R0902
+    instances = weakref.WeakSet()
     def __init__(self, unassigned, mapping, normalization, prohibited,
                                                                 bidi = True):
         """Initialize Profile object.
@@ -96,7 +344,44 @@ class Profile(object):
         self.normalization = normalization
         self.prohibited = prohibited
         self.bidi = bidi
-        self.cache = {}
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.fast_hits = 0
+        self.hits = 0
+        self.misses = 0
+        self._table = None
+        self._fast_re, self._fast_table = self._build_fast_path()
+        Profile.instances.add(self)
+
+    def _build_fast_path(self):
+        """Compute the fast path regular expression and translation table.
+
+        A character qualifies for the fast path if it is prepared to
+        a sequence of Latin-1 characters. Such characters never combine with
+        each other, so a string of them may be prepared character by
+        character. Bidi checks always pass for them too, as there are no
+        RandALCat characters in Latin-1.
+
+        :Return: (regexp, table) tuple
+        """
+        chars = []
+        table = {}
+        lookup_table = _PredicateTable(self)
+        for code in range(256):
+            char = unichr(code)
+            try:
+                result = self._prepare(char, lookup_table)
+            except StringprepError:
+                continue
+            if any(ord(rchar) > 255 or stringprep.in_table_d1(rchar)
+                                                        for rchar in result):
+                continue
+            chars.append(char)
+            if result != char:
+                table[code] = result
+        fast_re = re.compile(u"[{0}]*\\Z".format(
+                                u"".join(re.escape(char) for char in chars)))
+        return fast_re, table
 
     def prepare(self, data):
         """Complete string preparation procedure for 'stored' strings.
@@ -109,29 +394,55 @@ class Profile(object):
 
         :raise StringprepError: if the preparation fails
         """
-        ret = self.cache.get(data)
-        if ret is not None:
-            return ret
-        result = self.map(data)
+        if self._fast_re.match(data):
+            self.fast_hits += 1
+            return data.translate(self._fast_table)
+        with self.lock:
+            result = self.cache.pop(data, None)
+            if result is not None:
+                self.cache[data] = result
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = self._prepare(data)
+        if _stringprep_cache_size:
+            with self.lock:
+                self.cache[data] = result
+                if len(self.cache) > _stringprep_cache_size:
+                    self.cache.popitem(last = False)
+        return result
+
+    def warm_up(self):
+        """Compile the lookup table now, instead of on the first use."""
+        self._get_table()
+
+    def _get_table(self):
+        """Get the compiled lookup table, building it on the first use.
+
+        :Returntype: `_CharTable`
+        """
+        table = self._table
+        if table is None:
+            table = _CharTable(self)
+            self._table = table
+        return table
+
+    def _prepare(self, data, table = None):
+        """Do the actual string preparation, as in `prepare`, bypassing the
+        fast path and the cache.
+
+        :Parameters:
+            - `data`: Unicode string to prepare.
+            - `table`: the lookup table to use, the compiled one by default
+        """
+        if table is None:
+            table = self._get_table()
+        result = table.map(data)
         if self.normalization:
             result = self.normalization(result)
-        result = self.prohibit(result)
-        result = self.check_unassigned(result)
-        if self.bidi:
-            result = self.check_bidi(result)
+        table.check(result, True, True, self.bidi)
         if isinstance(result, list):
-            result = u"".join()
-        if len(self.cache_items) >= _stringprep_cache_size:
-            remove = self.cache_items[: -_stringprep_cache_size // 2]
-            for profile, key in remove:
-                try:
-                    del profile.cache[key]
-                except KeyError:
-                    pass
-            self.cache_items[:] = self.cache_items[
-                                                -_stringprep_cache_size // 2 :]
-        self.cache_items.append((self, data))
-        self.cache[data] = result
+            result = u"".join(result)
         return result
 
     def prepare_query(self, data):
@@ -145,66 +456,30 @@ class Profile(object):
 
         :raise StringprepError: if the preparation fails
         """
-        data = self.map(data)
+        table = self._get_table()
+        data = table.map(data)
         if self.normalization:
             data = self.normalization(data)
-        data = self.prohibit(data)
-        if self.bidi:
-            data = self.check_bidi(data)
+        table.check(data, True, False, self.bidi)
         if isinstance(data, list):
             data = u"".join(data)
         return data
 
     def map(self, data):
         """Mapping part of string preparation."""
-        result = []
-        for char in data:
-            ret = None
-            for lookup in self.mapping:
-                ret = lookup(char)
-                if ret is not None:
-                    break
-            if ret is not None:
-                result.append(ret)
-            else:
-                result.append(char)
-        return result
+        return self._get_table().map(data)
 
     def prohibit(self, data):
         """Checks for prohibited characters."""
-        for char in data:
-            for lookup in self.prohibited:
-                if lookup(char):
-                    raise StringprepError("Prohibited character: {0!r}"
-                                                                .format(char))
-        return data
+        return self._get_table().check(data, True, False, False)
 
     def check_unassigned(self, data):
         """Checks for unassigned character codes."""
-        for char in data:
-            for lookup in self.unassigned:
-                if lookup(char):
-                    raise StringprepError("Unassigned character: {0!r}"
-                                                                .format(char))
-        return data
+        return self._get_table().check(data, False, True, False)
 
-    @staticmethod
-    def check_bidi(data):
+    def check_bidi(self, data):
         """Checks if sting is valid for bidirectional printing."""
-        has_l = False
-        has_ral = False
-        for char in data:
-            if stringprep.in_table_d1(char):
-                has_ral = True
-            elif stringprep.in_table_d2(char):
-                has_l = True
-        if has_l and has_ral:
-            raise StringprepError("Both RandALCat and LCat characters present")
-        if has_ral and (not stringprep.in_table_d1(data[0])
-                                    or not stringprep.in_table_d1(data[-1])):
-            raise StringprepError("The first and the last character must"
-                                                                " be RandALCat")
-        return data
+        return self._get_table().check(data, False, False, True)
 
 NODEPREP_PROHIBITED = set([u'"', u'&', u"'", u"/", u":", u"<", u">", u"@"])
 
@@ -232,24 +507,41 @@ RESOURCEPREP = Profile(
                     stringprep.in_table_c8, stringprep.in_table_c9 ),
     bidi = True)
 
+NAMEPREP = Profile(
+    unassigned = (),
+    mapping = (b1_mapping, stringprep.map_table_b2),
+    normalization = nfkc_3_2,
+    prohibited = (  stringprep.in_table_c12, stringprep.in_table_c22,
+                    stringprep.in_table_c3, stringprep.in_table_c4,
+                    stringprep.in_table_c5, stringprep.in_table_c6,
+                    stringprep.in_table_c7, stringprep.in_table_c8,
+                    stringprep.in_table_c9 ),
+    bidi = True)
+
+def warm_up_stringprep():
+    """Compile the lookup tables of all the profiles.
+
+    Called by the `pyxmpp2.client.Client` constructor and
+    `pyxmpp2.server.prefork.PreforkServer.start`, so the first non-Latin-1
+    JID does not stall the main loop.
+    """
+    for profile in list(Profile.instances):
+        profile.warm_up()
+
 _stringprep_cache_size = 1000 # pylint: disable-msg=C0103
 
 def set_stringprep_cache_size(size):
     """Modify stringprep cache size.
 
     :Parameters:
-        - `size`: new cache size
+        - `size`: new cache size (per profile), 0 to disable the cache
     """
     # pylint: disable-msg=W0603
     global _stringprep_cache_size
     _stringprep_cache_size = size
-    if len(Profile.cache_items) > size:
-        remove = Profile.cache_items[:-size]
-        for profile, key in remove:
-            try:
-                del profile.cache[key]
-            except KeyError:
-                pass
-        Profile.cache_items = Profile.cache_items[-size:]
+    for profile in list(Profile.instances):
+        with profile.lock:
+            while len(profile.cache) > size:
+                profile.cache.popitem(last = False)
 
 # vi: sts=4 et sw=4